@@ -0,0 +1,57 @@
+'''
+Worker selection hashing benchmark.
+
+Times extracting the affinity key of an instance and hashing it to a
+worker, per instance, for each hash function with and without the
+worker set hash cache. Instances are generated for a number of
+patients with several instances each, as they arrive from modalities.
+
+    PYTHONPATH=src python benchmarks/bench_hashing.py --instances 100000 --instances-per-patient 200
+'''
+import argparse
+import functools
+import sys
+import time
+
+import pydicom
+
+import hash_functions
+import workerset
+
+def generate_datasets(instance_count: int, instances_per_patient: int):
+    datasets = []
+    for index in range(instance_count):
+        ds = pydicom.Dataset()
+        ds.PatientID = f'PATIENT{index // instances_per_patient}'
+        ds.StudyInstanceUID = f'1.2.826.0.1.3680043.8.498.{index // instances_per_patient}'
+        ds.SOPInstanceUID = f'1.2.826.0.1.3680043.8.498.{index // instances_per_patient}.{index}'
+        datasets.append(ds)
+    return datasets
+
+def time_per_instance(datasets, keys, hash_function, worker_count: int) -> float:
+    start = time.perf_counter()
+    for ds in datasets:
+        hash_function(workerset.affinity_key(keys, ds), worker_count)
+    return (time.perf_counter() - start) / len(datasets)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Worker selection hashing benchmark')
+    parser.add_argument('--instances', type=int, default=100000, help='Number of instances')
+    parser.add_argument('--instances-per-patient', type=int, default=200, help='Number of instances per patient')
+    parser.add_argument('--workers', type=int, default=10, help='Number of workers hashed to')
+    args = parser.parse_args()
+
+    datasets = generate_datasets(args.instances, args.instances_per_patient)
+    keys = [[pydicom.tag.Tag(0x0010, 0x0020)]]
+    key_only = time_per_instance(datasets, keys, lambda key, count: 0, args.workers)
+    print(f'instances:            {args.instances}')
+    print(f'affinity key only:    {key_only * 1e6:8.3f} us/instance')
+    for name, hash_function in sorted(hash_functions.HASH_FUNCTIONS.items()):
+        uncached = time_per_instance(datasets, keys, hash_function, args.workers)
+        cached = time_per_instance(
+            datasets, keys, functools.lru_cache(maxsize=workerset.HASH_CACHE_SIZE)(hash_function), args.workers)
+        print(f'{name + ":":<21} {uncached * 1e6:8.3f} us/instance, cached {cached * 1e6:8.3f} us/instance')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
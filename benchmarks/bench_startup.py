@@ -0,0 +1,96 @@
+'''
+Startup time benchmark for large topologies.
+
+Generates a configuration with many workers and worker sets, then
+times configuration loading, topology validation and creation of all
+components (excluding SCP listeners).
+
+    PYTHONPATH=src python benchmarks/bench_startup.py --workers 5000
+'''
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import configuration
+import dicom_loadbalancer
+
+def generate_config(worker_count: int, workers_per_set: int, worker_type: str, output_dir_path: str) -> dict:
+    workers = []
+    for index in range(worker_count):
+        workers.append({
+            "type": worker_type,
+            "id": f"WORKER{index}",
+            "name": f"Worker {index}",
+            "ae-title": f"WORKER{index}",
+            "address": "127.0.0.1",
+            "port": 1,
+            "output-dir-path": output_dir_path
+        })
+    worker_sets = []
+    for index in range(0, worker_count, workers_per_set):
+        worker_sets.append({
+            "id": f"SET{index}",
+            "name": f"Set {index}",
+            "worker-ids": [w["id"] for w in workers[index:index + workers_per_set]],
+            "distribution": "round-robin",
+            "hash-method": "modulo",
+            "accepted-scp-ids": [],
+            "header-requirements": [
+                {"tag": ["0x0008", "0x0060"], "requirement": "regexp-match", "regexp": f"^M{index}$"}
+            ]
+        })
+    return {
+        "core": {
+            "log-dir-path": ".",
+            "log-format": "json",
+            "buffer-dir-path": output_dir_path,
+            "router-count": 4
+        },
+        "workers": workers,
+        "scps": [],
+        "worker-sets": worker_sets
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Startup time benchmark')
+    parser.add_argument('--workers', type=int, default=5000, help='Number of workers')
+    parser.add_argument('--workers-per-set', type=int, default=10, help='Number of workers per worker set')
+    parser.add_argument(
+        '--worker-type',
+        choices=[configuration.WorkerConfiguration.TYPE_LOCAL_STORAGE, configuration.WorkerConfiguration.TYPE_SCU],
+        default=configuration.WorkerConfiguration.TYPE_LOCAL_STORAGE,
+        help='Type of generated workers')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('pynetdicom').setLevel(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        config_file_path = os.path.join(dir_path, 'config.json')
+        with open(config_file_path, 'w') as f:
+            json.dump(generate_config(args.workers, args.workers_per_set, args.worker_type, dir_path), f)
+
+        start = time.perf_counter()
+        config = configuration.Configuration(config_file_path)
+        loaded = time.perf_counter()
+        config.validate_topology()
+        validated = time.perf_counter()
+        load_balancer = dicom_loadbalancer.DicomLoadBalancer(config)
+        load_balancer.start()
+        started = time.perf_counter()
+
+        print(f'workers:             {args.workers}')
+        print(f'load configuration:  {loaded - start:8.3f} s')
+        print(f'validate topology:   {validated - loaded:8.3f} s')
+        print(f'start components:    {started - validated:8.3f} s')
+        print(f'total:               {started - start:8.3f} s')
+        sys.stdout.flush()
+    # Components run forever, so exit without waiting for them
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
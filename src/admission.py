@@ -0,0 +1,160 @@
+'''
+Admission control module.
+
+Limits the associations an SCP accepts, in total and per calling AE,
+so a single bulk sender such as an archive migration cannot starve
+other senders. Associations over the limits are rejected as soon as
+they are requested, with a transient A-ASSOCIATE-RJ, so senders retry
+later. Once only the reserved associations are left, they are only
+granted to calling AEs holding less than their fair share, keeping
+room for modalities to connect while a bulk sender is saturating the
+SCP.
+
+Received bytes are rate limited per calling AE by delaying C-STORE
+responses, with the total rate shared evenly among the calling AEs
+with open associations.
+'''
+import collections
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import configuration
+import metrics
+import ratelimit
+
+# A-ASSOCIATE-RJ result, source and reason: transient, service provider
+# (presentation related), temporary congestion or local limit exceeded
+REJECT_CONGESTION = (0x02, 0x03, 0x01)
+REJECT_LIMIT_EXCEEDED = (0x02, 0x03, 0x02)
+
+class AdmissionController:
+    '''
+    Admits associations of an SCP and rate limits what they send
+    '''
+    def __init__(self, scp_id: str, config: configuration.AdmissionConfiguration) -> None:
+        self._scp_id = scp_id
+        self._config = config
+        # Calling AE per admitted association
+        self._associations: Dict[Any, str] = {}
+        self._counts: Dict[str, int] = collections.defaultdict(int)
+        self._buckets: Dict[str, ratelimit.TokenBucket] = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+        self._admitted = metrics.counter(f'scp.{scp_id}.admission.admitted')
+        self._rejected = metrics.counter(f'scp.{scp_id}.admission.rejected')
+        # Only for configured calling AEs, as any sender may make one up
+        self._rejected_per_ae = {
+            calling_ae: metrics.counter(f'scp.{scp_id}.admission.rejected.{calling_ae}')
+            for calling_ae in config.calling_aes}
+        self._delayed = metrics.counter(f'scp.{scp_id}.admission.delayed')
+        self._active = metrics.gauge(f'scp.{scp_id}.admission.associations')
+
+    def _rate(self, calling_ae: str) -> Optional[float]:
+        # Must be called with lock held
+        rates = []
+        quota = self._config.max_bytes_per_second_for(calling_ae)
+        if quota is not None:
+            rates.append(quota)
+        if self._config.max_bytes_per_second is not None:
+            rates.append(self._config.max_bytes_per_second / max(1, len(self._counts)))
+        return min(rates) if rates else None
+
+    def _update_rates(self) -> None:
+        # Fair shares change with the calling AEs holding associations.
+        # Must be called with lock held
+        for calling_ae in self._counts:
+            rate = self._rate(calling_ae)
+            bucket = self._buckets.get(calling_ae)
+            if rate is None:
+                self._buckets.pop(calling_ae, None)
+            elif bucket is None:
+                self._buckets[calling_ae] = ratelimit.TokenBucket(rate)
+            elif bucket.rate != rate:
+                bucket.set_rate(rate)
+
+    def _check(self, calling_ae: str) -> Optional[Tuple[int, int, int]]:
+        # Must be called with lock held
+        total = len(self._associations)
+        held = self._counts.get(calling_ae, 0)
+        if total >= self._config.max_associations:
+            return REJECT_CONGESTION
+        limit = self._config.max_associations_for(calling_ae)
+        if limit is not None and held >= limit:
+            return REJECT_LIMIT_EXCEEDED
+        if total >= self._config.max_associations - self._config.reserved_associations:
+            # Fair shares count one more calling AE than are connected,
+            # so there is room for the next one to connect
+            calling_aes = len(self._counts) + 1
+            if held >= max(1, self._config.max_associations // calling_aes):
+                return REJECT_CONGESTION
+        return None
+
+    def admit(self, association: Any, calling_ae: str) -> Optional[Tuple[int, int, int]]:
+        '''
+        Admit an association requested by calling_ae. Returns the
+        A-ASSOCIATE-RJ result, source and reason if it is rejected
+        '''
+        with self._lock:
+            rejection = self._check(calling_ae)
+            if rejection is None:
+                self._associations[association] = calling_ae
+                self._counts[calling_ae] += 1
+                self._update_rates()
+            active = len(self._associations)
+        self._active.set(active)
+        if rejection is not None:
+            self._rejected.increment()
+            rejected = self._rejected_per_ae.get(calling_ae)
+            if rejected is not None:
+                rejected.increment()
+            self._logger.info(
+                'Rejected association from %s to %s with %d associations open (reason 0x%02X)',
+                calling_ae, self._scp_id, active, rejection[2])
+        else:
+            self._admitted.increment()
+        return rejection
+
+    def release(self, association: Any) -> None:
+        '''
+        Release an association once its connection is closed
+        '''
+        with self._lock:
+            calling_ae = self._associations.pop(association, None)
+            if calling_ae is None:
+                # Rejected, or admission was not asked
+                return
+            self._counts[calling_ae] -= 1
+            if not self._counts[calling_ae]:
+                # No longer connected, so its bucket is dropped too
+                del self._counts[calling_ae]
+                self._buckets.pop(calling_ae, None)
+            self._update_rates()
+            active = len(self._associations)
+        self._active.set(active)
+
+    def throttle(self, association: Any, size: int) -> float:
+        '''
+        Account for size bytes received over an association, waiting
+        as long as the calling AE is over its rate. Returns the seconds
+        waited
+        '''
+        with self._lock:
+            bucket = self._buckets.get(self._associations.get(association))
+        if bucket is None:
+            return 0.0
+        delay = bucket.take(size)
+        if delay > 0:
+            self._delayed.increment()
+            time.sleep(delay)
+        return delay
+
+    def associations(self, calling_ae: str = None) -> int:
+        '''
+        Number of admitted associations, in total or of a calling AE
+        '''
+        with self._lock:
+            if calling_ae is None:
+                return len(self._associations)
+            return self._counts.get(calling_ae, 0)
@@ -0,0 +1,360 @@
+'''
+Affinity module.
+
+Hashing patient ids places patients by worker set membership, so
+adding or removing a worker moves patients, invalidating the prior
+study caches workers keep per patient. An affinity table instead
+remembers the worker each patient was assigned to, so patients only
+move when their worker leaves the set or when they are explicitly
+migrated.
+
+Each table is stored in two files: a snapshot of all assignments and a
+log of the assignments made since, both holding one tab separated
+patient id and worker id per line. Once the log grows long enough it
+is folded into a new snapshot by a background thread, which writes the
+snapshot without holding the table lock, so routing goes on meanwhile.
+
+Running this module migrates a fraction of the patients not assigned
+to the worker hashing would place them on with the current membership,
+at a limited rate. It may run while the relay is running, which picks
+up the migrations from the log:
+
+    python src/affinity.py --config-file-path config.json --worker-set-id ID --fraction 0.1 [--moves-per-second 10]
+'''
+import argparse
+import collections
+import contextlib
+import fcntl
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Mapping, Optional, Tuple
+
+import configuration
+import hash_functions
+import metrics
+
+def _key(patient_id: str) -> str:
+    # Tabs and line breaks are not valid in patient ids, but must not
+    # corrupt the files either
+    return patient_id.replace('\t', ' ').replace('\n', ' ').replace('\r', ' ')
+
+def _encode(patient_id: str, worker_id: str) -> bytes:
+    return f'{patient_id}\t{worker_id}\n'.encode('utf-8', 'surrogateescape')
+
+class AffinityTable:
+    '''
+    Persistent map of patient ids to the ids of the workers they are
+    assigned to. Lookups are served from memory.
+    '''
+    def __init__(
+        self,
+        dir_path: str,
+        table_id: str,
+        assignment: str = configuration.AffinityConfiguration.ASSIGNMENT_HASH,
+        compact_after: Optional[int] = 100000,
+        refresh_interval: float = 5) -> None:
+        os.makedirs(dir_path, exist_ok=True)
+        self._snapshot_path = os.path.join(dir_path, f'{table_id}.snapshot')
+        self._log_path = os.path.join(dir_path, f'{table_id}.log')
+        self._lock_path = os.path.join(dir_path, f'{table_id}.lock')
+        self._assignment = assignment
+        self._compact_after = compact_after
+        self._refresh_interval = refresh_interval
+        self._assignments: Dict[str, str] = {}
+        self._patient_counts: Dict[str, int] = collections.Counter()
+        self._log_offset = 0
+        self._loaded_snapshot_version: Optional[Tuple[int, int]] = None
+        self._logged = 0
+        self._compacting = False
+        self._next_refresh = 0.0
+        # Serialises threads of this process, the file lock serialises
+        # processes, such as a rebalance running next to the relay
+        self._lock = threading.Lock()
+        self._assigned = metrics.counter('affinity.assigned')
+        self._moved = metrics.counter('affinity.moved')
+        self._logger = logging.getLogger(__name__)
+        with self._locked():
+            self._catch_up()
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        with self._lock, open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _set(self, patient_id: str, worker_id: str) -> None:
+        previous = self._assignments.get(patient_id)
+        if previous is not None:
+            self._patient_counts[previous] -= 1
+        self._assignments[patient_id] = worker_id
+        self._patient_counts[worker_id] += 1
+
+    def _apply(self, data: bytes) -> None:
+        for line in data.decode('utf-8', 'surrogateescape').split('\n'):
+            patient_id, _, worker_id = line.rpartition('\t')
+            if worker_id:
+                self._set(patient_id, worker_id)
+
+    def _snapshot_version(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._snapshot_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _catch_up(self) -> None:
+        # Apply assignments logged by other processes since last read
+        snapshot_version = self._snapshot_version()
+        if snapshot_version != self._loaded_snapshot_version:
+            # Log was folded into a new snapshot, start over from it
+            self._assignments = {}
+            self._patient_counts = collections.Counter()
+            self._log_offset = 0
+            if snapshot_version is not None:
+                with open(self._snapshot_path, 'rb') as f:
+                    self._apply(f.read())
+            self._loaded_snapshot_version = snapshot_version
+        size = self._log_size()
+        if size > self._log_offset:
+            with open(self._log_path, 'rb') as f:
+                f.seek(self._log_offset)
+                data = f.read(size - self._log_offset)
+            # A line still being written is read with the next refresh
+            complete = data.rfind(b'\n') + 1
+            self._apply(data[:complete])
+            self._log_offset += complete
+
+    def _log_size(self) -> int:
+        try:
+            return os.path.getsize(self._log_path)
+        except FileNotFoundError:
+            return 0
+
+    def _append(self, patient_id: str, worker_id: str) -> None:
+        with open(self._log_path, 'ab') as f:
+            f.write(_encode(patient_id, worker_id))
+            self._log_offset = f.tell()
+        self._set(patient_id, worker_id)
+        self._logged += 1
+        if self._compact_after is not None and self._logged >= self._compact_after and not self._compacting:
+            # Compacted in the background, as writing out every
+            # assignment would hold up routing
+            self._compacting = True
+            threading.Thread(target=self._compact_in_background, daemon=True, name='affinity-compact').start()
+
+    def _compact_in_background(self) -> None:
+        try:
+            self.compact()
+        except OSError as exception:
+            self._logger.error('Failed to compact affinity table %s: %s', self._snapshot_path, exception)
+            # Tried again once as many assignments were logged
+            self._logged = 0
+        finally:
+            self._compacting = False
+
+    def compact(self) -> None:
+        '''
+        Fold the log into a new snapshot. The snapshot is written
+        without holding the lock, after which what was logged meanwhile
+        is kept as the new log
+        '''
+        with self._locked():
+            self._catch_up()
+            assignments = dict(self._assignments)
+            log_offset = self._log_offset
+            snapshot_version = self._loaded_snapshot_version
+        tmp_path = f'{self._snapshot_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.writelines(_encode(p, w) for p, w in assignments.items())
+            f.flush()
+            os.fsync(f.fileno())
+        with self._locked():
+            self._catch_up()
+            if self._loaded_snapshot_version != snapshot_version:
+                # Another process compacted meanwhile
+                os.remove(tmp_path)
+                return
+            tail = b''
+            if self._log_offset > log_offset:
+                with open(self._log_path, 'rb') as f:
+                    f.seek(log_offset)
+                    tail = f.read(self._log_offset - log_offset)
+            # A crash in between replays the whole log onto the new
+            # snapshot, which holds the same assignments
+            os.replace(tmp_path, self._snapshot_path)
+            with open(self._log_path + '.tmp', 'wb') as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self._log_path + '.tmp', self._log_path)
+            self._loaded_snapshot_version = self._snapshot_version()
+            self._log_offset = len(tail)
+            self._logged = tail.count(b'\n')
+        self._logger.info('Compacted affinity table %s with %d patients', self._snapshot_path, len(assignments))
+
+    def refresh(self) -> None:
+        '''
+        Read assignments logged by other processes
+        '''
+        if self._log_size() != self._log_offset or self._snapshot_version() != self._loaded_snapshot_version:
+            with self._locked():
+                self._catch_up()
+        self._next_refresh = time.monotonic() + self._refresh_interval
+
+    def get(self, patient_id: str) -> Optional[str]:
+        '''
+        Get the id of the worker patient is assigned to
+        '''
+        if time.monotonic() >= self._next_refresh:
+            self.refresh()
+        return self._assignments.get(_key(patient_id))
+
+    def __len__(self) -> int:
+        return len(self._assignments)
+
+    def items(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._assignments.items())
+
+    def patient_count(self, worker_id: str) -> int:
+        '''
+        Get the number of patients assigned to a worker
+        '''
+        return self._patient_counts[worker_id]
+
+    def worker_for(
+        self,
+        patient_id: str,
+        worker_ids: Mapping[str, object],
+        hash_function: Callable[[str, int], int]) -> str:
+        '''
+        Get the id of the worker patient is assigned to, assigning the
+        patient if new or if its worker is not among worker_ids
+        '''
+        worker_id = self.get(patient_id)
+        if worker_id in worker_ids:
+            return worker_id
+        key = _key(patient_id)
+        with self._locked():
+            # Another thread or process may have assigned it meanwhile
+            self._catch_up()
+            worker_id = self._assignments.get(key)
+            if worker_id in worker_ids:
+                return worker_id
+            candidates = list(worker_ids)
+            if self._assignment == configuration.AffinityConfiguration.ASSIGNMENT_LEAST_PATIENTS:
+                new_worker_id = min(candidates, key=lambda i: self._patient_counts[i])
+            else:
+                new_worker_id = candidates[hash_function(patient_id, len(candidates))]
+            if worker_id is not None:
+                self._logger.warning('Moving patient from worker %s, which left the worker set, to %s',
+                    worker_id, new_worker_id)
+                self._moved.increment()
+            else:
+                self._assigned.increment()
+            self._append(key, new_worker_id)
+            return new_worker_id
+
+    def move(self, patient_id: str, worker_id: str) -> None:
+        '''
+        Assign patient to another worker
+        '''
+        with self._locked():
+            self._catch_up()
+            self._append(_key(patient_id), worker_id)
+        self._moved.increment()
+
+def plan_rebalance(
+    table: AffinityTable,
+    worker_ids: List[str],
+    hash_function: Callable[[str, int], int],
+    fraction: float) -> List[Tuple[str, str]]:
+    '''
+    Select a fraction of the patients not assigned to the worker
+    hashing places them on, returning them with that worker. Patients
+    of workers which left the set are selected first.
+    '''
+    if not worker_ids:
+        return []
+    departed = []
+    misplaced = []
+    for patient_id, worker_id in table.items():
+        target = worker_ids[hash_function(patient_id, len(worker_ids))]
+        if worker_id not in worker_ids:
+            departed.append((patient_id, target))
+        elif worker_id != target:
+            misplaced.append((patient_id, target))
+    count = math.ceil(fraction * (len(departed) + len(misplaced)))
+    random.shuffle(misplaced)
+    return (departed + misplaced)[:count]
+
+def rebalance(table: AffinityTable, moves: List[Tuple[str, str]], moves_per_second: float) -> int:
+    '''
+    Move patients at no more than moves_per_second
+    '''
+    for index, (patient_id, worker_id) in enumerate(moves):
+        table.move(patient_id, worker_id)
+        if index + 1 < len(moves):
+            time.sleep(1 / moves_per_second)
+    return len(moves)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Migrate patients between the workers of a worker set')
+    parser.add_argument(
+        '--config-file-path',
+        required=True,
+        type=str,
+        help='Path to configuration file or dir')
+    parser.add_argument(
+        '--worker-set-id',
+        required=True,
+        type=str,
+        help='Worker set to rebalance')
+    parser.add_argument(
+        '--fraction',
+        required=True,
+        type=float,
+        help='Fraction of misplaced patients to migrate, between 0 and 1')
+    parser.add_argument(
+        '--moves-per-second',
+        default=10,
+        type=float,
+        help='Maximum number of patients migrated per second')
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only report the number of patients that would be migrated')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s')
+
+    if not 0 <= args.fraction <= 1 or args.moves_per_second <= 0:
+        logging.error('Fraction must be between 0 and 1 and moves per second positive')
+        return 1
+    config = configuration.Configuration(args.config_file_path)
+    worker_sets = {ws.id: ws for ws in config.worker_sets()}
+    worker_set_config = worker_sets.get(args.worker_set_id)
+    if worker_set_config is None:
+        logging.error(f'Unknown worker set {args.worker_set_id}')
+        return 1
+    # The relay folds the log into snapshots, so never compact here
+    table = AffinityTable(config.core().affinity_dir_path, worker_set_config.id, compact_after=None)
+    moves = plan_rebalance(
+        table, worker_set_config.worker_ids, hash_functions.get(worker_set_config.hash_function), args.fraction)
+    logging.info(f'Migrating {len(moves)} of {len(table)} patients in worker set {worker_set_config.id}')
+    if not args.dry_run:
+        rebalance(table, moves, args.moves_per_second)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
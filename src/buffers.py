@@ -0,0 +1,127 @@
+'''
+Byte buffer module.
+
+Encoded instances are passed around as bytes-like objects supporting
+len() and slicing. SegmentedBuffer lets a modified instance share the
+unmodified parts, such as pixel data, with the original instead of
+copying them. FileBuffer keeps large instances on disk.
+'''
+import bisect
+import io
+import mmap
+import os
+from typing import List, Union
+
+class SegmentedBuffer:
+    '''
+    Read-only buffer made up of a sequence of byte segments, which is
+    sliced without joining the segments
+    '''
+    def __init__(self, segments: List) -> None:
+        self._segments: List[memoryview] = [memoryview(s).cast('B') for s in segments if len(s)]
+        self._offsets: List[int] = []
+        offset = 0
+        for segment in self._segments:
+            self._offsets.append(offset)
+            offset += len(segment)
+        self._length = offset
+
+    @property
+    def segments(self) -> List[memoryview]:
+        return self._segments
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, key: slice) -> bytes:
+        if not isinstance(key, slice):
+            raise TypeError('SegmentedBuffer only supports slicing')
+        start, stop, step = key.indices(self._length)
+        if step != 1:
+            raise ValueError('SegmentedBuffer does not support extended slicing')
+        if start >= stop:
+            return b''
+        parts = []
+        index = bisect.bisect_right(self._offsets, start) - 1
+        while start < stop:
+            segment = self._segments[index]
+            offset = self._offsets[index]
+            end = min(stop, offset + len(segment))
+            parts.append(segment[start - offset:end - offset])
+            start = end
+            index += 1
+        return b''.join(parts)
+
+    def tobytes(self) -> bytes:
+        return b''.join(self._segments)
+
+class FileBuffer:
+    '''
+    Read-only buffer backed by a memory mapped file, so its content
+    is paged in from disk as it is read and can be evicted again
+    instead of occupying process memory
+    '''
+    def __init__(self, path: str, offset: int = 0, unlink: bool = False, length: int = None) -> None:
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if unlink:
+            # The mapping keeps the content available, and the disk
+            # space is released along with the last reference to it
+            os.unlink(path)
+        self._view = memoryview(self._mmap)[offset:None if length is None else offset + length]
+
+    @property
+    def segments(self) -> List[memoryview]:
+        return [self._view]
+
+    def __len__(self) -> int:
+        return len(self._view)
+
+    def __getitem__(self, key: slice) -> bytes:
+        return self._view[key].tobytes()
+
+class _SegmentReader(io.RawIOBase):
+    def __init__(self, segments: List[memoryview]) -> None:
+        self._buffer = SegmentedBuffer(segments)
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self._buffer[self._position:self._position + len(b)]
+        b[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._buffer)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+Buffer = Union[bytes, SegmentedBuffer, FileBuffer]
+
+def segments(buffer: Buffer) -> List[memoryview]:
+    '''
+    Get the segments of a buffer, for writing it out without joining
+    '''
+    if isinstance(buffer, (SegmentedBuffer, FileBuffer)):
+        return buffer.segments
+    return [memoryview(buffer)]
+
+def open_buffer(buffer: Buffer) -> io.BufferedIOBase:
+    '''
+    Open a buffer as a binary file without copying it
+    '''
+    if isinstance(buffer, bytes):
+        return io.BytesIO(buffer)
+    return io.BufferedReader(_SegmentReader(segments(buffer)))
@@ -0,0 +1,147 @@
+'''
+Capture module.
+
+Records a compact trace of received instances for replay in load
+tests: arrival time, source SCP, size, SOP class, transfer syntax,
+C-STORE priority and the values of the tags routing depends on. No
+pixel data is recorded, and identifiers are pseudonymised with a keyed
+hash, consistently within a trace, so patients and studies can be told
+apart without being identifiable.
+
+Traces are written as JSON lines by a background thread, so capturing
+never holds up receiving. Records of instances received while the
+queue is full are dropped and counted.
+'''
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from pydicom.multival import MultiValue
+
+import metrics
+import rewrite
+import routable
+
+# Identifying tags without a PN or UI VR
+IDENTIFIER_TAGS = {
+    (0x0008, 0x0050),  # Accession Number
+    (0x0010, 0x0020),  # Patient ID
+    (0x0010, 0x1000),  # Other Patient IDs
+    (0x0020, 0x0010)   # Study ID
+}
+# Tags always recorded
+DEFAULT_TAGS = [
+    (0x0008, 0x0060),  # Modality
+]
+
+def _tag_key(tag: Tuple[int, int]) -> str:
+    return f'{tag[0]:04X}{tag[1]:04X}'
+
+def _value(value: Any) -> str:
+    if isinstance(value, MultiValue):
+        return '\\'.join(str(v) for v in value)
+    return str(value)
+
+class Pseudonymiser:
+    '''
+    Replaces identifiers with keyed hashes, mapping UIDs to UIDs. The
+    salt is the key, so it must not be empty or longer than a key
+    '''
+    def __init__(self, salt: str) -> None:
+        self._salt = salt.encode('utf-8')
+        if not self._salt or len(self._salt) > hashlib.blake2b.MAX_KEY_SIZE:
+            raise ValueError(f'Salt must be between 1 and {hashlib.blake2b.MAX_KEY_SIZE} bytes')
+        self._uid_mapper = rewrite.UIDMapper(salt)
+
+    def pseudonymise(self, tag: Tuple[int, int], vr: str, value: str) -> str:
+        if vr == 'UI':
+            return '\\'.join(self._uid_mapper.map(uid) for uid in value.split('\\'))
+        if vr == 'PN' or tag in IDENTIFIER_TAGS:
+            return hashlib.blake2b(value.encode('utf-8'), digest_size=8, key=self._salt).hexdigest()
+        return value
+
+class TraceRecorder(threading.Thread):
+    '''
+    Writes a trace of received instances to a file in a directory
+    '''
+    def __init__(self, dir_path: str, tags: List[Tuple[int, int]], salt: str, queue_size: int = 10000) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        os.makedirs(dir_path, exist_ok=True)
+        self._path = os.path.join(dir_path, f'trace-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.jsonl')
+        self._tags = sorted(set(tags) | set(DEFAULT_TAGS))
+        self._pseudonymiser = Pseudonymiser(salt)
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._stopped = threading.Event()
+        self._recorded = metrics.counter('capture.recorded')
+        self._dropped = metrics.counter('capture.dropped')
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def record(self, r: routable.Routable) -> None:
+        '''
+        Record the arrival of an instance
+        '''
+        dataset = r.dataset
+        values = []
+        for tag in self._tags:
+            element = dataset.get(tag)
+            if element is not None and element.value is not None:
+                values.append((tag, element.VR, element.value))
+        entry = (time.time(), r.scp_id, len(r.encoded), r.sop_class_uid, str(r.transfer_syntax), r.c_store_priority, values)
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self._dropped.increment()
+
+    def stop(self) -> None:
+        '''
+        Stop once what is queued is written
+        '''
+        self._stopped.set()
+
+    def _format(self, entry: Tuple) -> str:
+        arrival_time, scp_id, size, sop_class_uid, transfer_syntax, c_store_priority, values = entry
+        tags: Dict[str, List[str]] = {}
+        for tag, vr, value in values:
+            tags[_tag_key(tag)] = [vr, self._pseudonymiser.pseudonymise(tag, vr, _value(value))]
+        return json.dumps({
+            'time': arrival_time,
+            'scp-id': scp_id,
+            'size': size,
+            'sop-class-uid': sop_class_uid,
+            'transfer-syntax': transfer_syntax,
+            'priority': c_store_priority,
+            'tags': tags
+        })
+
+    def run(self):
+        self._logger.info(f'Capturing traffic to {self._path}')
+        with open(self._path, 'a') as f:
+            while not (self._stopped.is_set() and self._queue.empty()):
+                # Wake up now and then to notice being stopped
+                try:
+                    entry = self._queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                f.write(self._format(entry) + '\n')
+                self._recorded.increment()
+                # Write out once the queue is drained
+                if self._queue.empty():
+                    f.flush()
+
+def read_trace(path: str) -> List[Dict]:
+    '''
+    Read the records of a trace in order of arrival
+    '''
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda record: record['time'])
+    return records
@@ -0,0 +1,302 @@
+'''
+Catalog module.
+
+Records where every instance was sent: SOP Instance, Series and Study
+UID, patient, source SCP, worker set and worker, when it was routed and
+sent, and whether it was sent, dead lettered or failed to be written.
+Instances routed to several workers have a record per worker. Records
+are kept in an SQLite database in WAL mode, indexed by study and
+patient, and pruned once older than the retention period.
+
+Records are written in batches by a single background thread, so
+routers and workers only queue them. Records arriving while the queue
+is full are dropped and counted. Querying the catalog of a running or
+stopped relay:
+
+    python src/catalog.py --config-file-path config.json (--study-instance-uid UID | --patient-id ID | --sop-instance-uid UID)
+'''
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import configuration
+import metrics
+import routable
+
+ROUTED = 'routed'
+SENT = 'sent'
+DEAD_LETTERED = 'dead-lettered'
+FAILED = 'failed'
+
+# Seconds between pruning records older than the retention period
+PRUNE_INTERVAL = 3600
+# Milliseconds readers and the writer wait for each other's locks
+BUSY_TIMEOUT = 5000
+
+COLUMNS = [
+    'sop_instance_uid',
+    'worker_id',
+    'study_instance_uid',
+    'series_instance_uid',
+    'patient_id',
+    'scp_id',
+    'worker_set_id',
+    'routed_at',
+    'completed_at',
+    'status'
+]
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS instances (
+        sop_instance_uid TEXT NOT NULL,
+        worker_id TEXT NOT NULL,
+        study_instance_uid TEXT,
+        series_instance_uid TEXT,
+        patient_id TEXT,
+        scp_id TEXT,
+        worker_set_id TEXT,
+        routed_at REAL,
+        completed_at REAL,
+        status TEXT NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (sop_instance_uid, worker_id))''',
+    'CREATE INDEX IF NOT EXISTS instances_study ON instances (study_instance_uid)',
+    'CREATE INDEX IF NOT EXISTS instances_patient ON instances (patient_id)',
+    'CREATE INDEX IF NOT EXISTS instances_updated_at ON instances (updated_at)'
+]
+
+# Routing an instance again, when re-sent, starts its record over
+_INSERT_ROUTED = '''INSERT INTO instances (
+        sop_instance_uid, worker_id, study_instance_uid, series_instance_uid, patient_id,
+        scp_id, worker_set_id, routed_at, status, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (sop_instance_uid, worker_id) DO UPDATE SET
+        study_instance_uid = excluded.study_instance_uid,
+        series_instance_uid = excluded.series_instance_uid,
+        patient_id = excluded.patient_id,
+        scp_id = excluded.scp_id,
+        worker_set_id = excluded.worker_set_id,
+        routed_at = excluded.routed_at,
+        completed_at = NULL,
+        status = excluded.status,
+        updated_at = excluded.updated_at'''
+
+# Instances may complete without a record of being routed, when they
+# were restored from a snapshot taken before the catalog was enabled
+_INSERT_COMPLETED = '''INSERT INTO instances (sop_instance_uid, worker_id, completed_at, status, updated_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (sop_instance_uid, worker_id) DO UPDATE SET
+        completed_at = excluded.completed_at,
+        status = excluded.status,
+        updated_at = excluded.updated_at'''
+
+def connect(path: str) -> sqlite3.Connection:
+    '''
+    Open the catalog database, creating it if needed
+    '''
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT / 1000, check_same_thread=False)
+    # Readers do not block the writer, nor the writer readers, and
+    # commits are only synced on checkpoints
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    with connection:
+        for statement in _SCHEMA:
+            connection.execute(statement)
+    return connection
+
+def _uid(r: routable.Routable, keyword: str) -> str:
+    value = r.dataset.get(keyword)
+    return str(value) if value is not None else None
+
+class CatalogWriter(threading.Thread):
+    '''
+    Writes records of routed and completed instances to the catalog
+    '''
+    def __init__(
+        self,
+        path: str,
+        retention_seconds: float,
+        batch_size: int = 1000,
+        queue_size: int = 100000) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self._path = path
+        self._retention_seconds = retention_seconds
+        self._batch_size = batch_size
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._stopped = threading.Event()
+        self._recorded = metrics.counter('catalog.recorded')
+        self._dropped = metrics.counter('catalog.dropped')
+        self._pruned = metrics.counter('catalog.pruned')
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _put(self, entry: Tuple) -> None:
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self._dropped.increment()
+
+    def routed(self, r: routable.Routable, worker_set_id: str, worker_id: str) -> None:
+        '''
+        Record an instance being handed off to a worker
+        '''
+        now = time.time()
+        self._put((_INSERT_ROUTED, (
+            r.sop_instance_uid,
+            worker_id,
+            _uid(r, 'StudyInstanceUID'),
+            _uid(r, 'SeriesInstanceUID'),
+            _uid(r, 'PatientID'),
+            r.scp_id,
+            worker_set_id,
+            now,
+            ROUTED,
+            now)))
+
+    def completed(self, r: routable.Routable, worker_id: str, status: str) -> None:
+        '''
+        Record an instance being sent, dead lettered or dropped by a worker
+        '''
+        now = time.time()
+        self._put((_INSERT_COMPLETED, (r.sop_instance_uid, worker_id, now, status, now)))
+
+    def stop(self) -> None:
+        '''
+        Stop once what is queued is written
+        '''
+        self._stopped.set()
+
+    def _take_batch(self) -> List[Tuple]:
+        # Wait for a record, waking up now and then to notice being
+        # stopped, then take what else is queued up to a batch
+        try:
+            batch = [self._queue.get(timeout=1)]
+        except queue.Empty:
+            return []
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, connection: sqlite3.Connection, batch: List[Tuple]) -> None:
+        # A single transaction per batch, records of an instance being
+        # written in the order they were queued
+        try:
+            with connection:
+                for statement, entries in itertools.groupby(batch, key=lambda entry: entry[0]):
+                    connection.executemany(statement, [values for _, values in entries])
+        except sqlite3.Error as exception:
+            self._logger.error('Failed to write %d records to catalog %s: %s', len(batch), self._path, exception)
+            self._dropped.increment(len(batch))
+            return
+        self._recorded.increment(len(batch))
+
+    def _prune(self, connection: sqlite3.Connection) -> None:
+        try:
+            with connection:
+                cursor = connection.execute(
+                    'DELETE FROM instances WHERE updated_at < ?', (time.time() - self._retention_seconds,))
+        except sqlite3.Error as exception:
+            self._logger.error('Failed to prune catalog %s: %s', self._path, exception)
+            return
+        if cursor.rowcount:
+            self._pruned.increment(cursor.rowcount)
+            self._logger.info('Pruned %d records from catalog %s', cursor.rowcount, self._path)
+
+    def run(self):
+        self._logger.info(f'Cataloguing instances in {self._path}')
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        connection = connect(self._path)
+        next_prune = time.monotonic()
+        try:
+            while True:
+                if time.monotonic() >= next_prune:
+                    self._prune(connection)
+                    next_prune = time.monotonic() + PRUNE_INTERVAL
+                if self._stopped.is_set() and self._queue.empty():
+                    break
+                batch = self._take_batch()
+                if batch:
+                    self._write(connection, batch)
+        finally:
+            connection.close()
+
+def find(
+    connection: sqlite3.Connection,
+    study_instance_uid: str = None,
+    patient_id: str = None,
+    sop_instance_uid: str = None,
+    limit: int = 1000) -> List[Dict]:
+    '''
+    Find the records of instances of a study, of a patient or of a
+    single instance, in the order they were routed
+    '''
+    conditions = []
+    parameters = []
+    for column, value in (
+            ('study_instance_uid', study_instance_uid),
+            ('patient_id', patient_id),
+            ('sop_instance_uid', sop_instance_uid)):
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            parameters.append(value)
+    if not conditions:
+        raise ValueError('Records are found by study, patient or instance')
+    cursor = connection.execute(
+        f'SELECT {", ".join(COLUMNS)} FROM instances WHERE {" AND ".join(conditions)} '
+        'ORDER BY routed_at, sop_instance_uid, worker_id LIMIT ?',
+        parameters + [limit])
+    return [dict(zip(COLUMNS, row)) for row in cursor]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Find where instances were sent')
+    parser.add_argument(
+        '--config-file-path',
+        required=True,
+        type=str,
+        help='Path to configuration file or dir of the relay')
+    key = parser.add_mutually_exclusive_group(required=True)
+    key.add_argument('--study-instance-uid', type=str, help='Find instances of a study')
+    key.add_argument('--patient-id', type=str, help='Find instances of a patient')
+    key.add_argument('--sop-instance-uid', type=str, help='Find an instance')
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=1000,
+        help='Maximum number of records printed (default 1000)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s')
+
+    config = configuration.Configuration(args.config_file_path)
+    path = config.core().catalog.path
+    if not os.path.isfile(path):
+        logging.error(f'No catalog at {path}')
+        return 1
+    connection = connect(path)
+    try:
+        records = find(connection, args.study_instance_uid, args.patient_id, args.sop_instance_uid, args.limit)
+    finally:
+        connection.close()
+    # One JSON record per line
+    for record in records:
+        print(json.dumps(record))
+    return 0 if records else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
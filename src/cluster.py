@@ -0,0 +1,542 @@
+'''
+Cluster module.
+
+Several relay nodes can run behind a TCP load balancer, on one or many
+hosts. For them to agree on where a patient goes, nodes share worker
+liveness, patient to worker overrides and worker queue depths through a
+coordination backend. Each node syncs with the backend periodically and
+routes from its local copy of the shared state, so the backend is never
+on the hot path, except for claiming or removing an override when
+failing a patient over. Overrides are synced incrementally, and expire
+once older than their time to live.
+
+Nodes on a single host may share an SQLite database directly. Nodes on
+several hosts reach a state service over HTTP instead, which keeps the
+database on local storage of the host it runs on, either in one of the
+nodes or on its own.
+'''
+import abc
+import argparse
+import collections
+import hmac
+import http.server
+import json
+import logging
+import socketserver
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import configuration
+import livenesschecker
+import metrics
+import stowrs
+
+class ClusterState:
+    '''
+    Snapshot of the state shared by cluster nodes
+    '''
+    def __init__(
+        self,
+        live_nodes: List[str],
+        liveness: Dict[str, livenesschecker.LivenessStatus],
+        overrides: Dict[str, Tuple[Optional[str], float]],
+        queue_depths: Dict[str, int],
+        read_at: float = 0.0) -> None:
+        self.live_nodes = live_nodes
+        # Cluster wide liveness per worker id
+        self.liveness = liveness
+        # Worker id, None once removed, and when it was updated, per
+        # affinity key updated since the last read
+        self.overrides = overrides
+        # Queue depth per worker id, summed over nodes
+        self.queue_depths = queue_depths
+        # Time of the backend when read, so nodes on hosts with clocks
+        # apart read overrides from where the last read left off
+        self.read_at = read_at
+
+class CoordinationBackend(metaclass=abc.ABCMeta):
+    '''
+    Storage for state shared by cluster nodes
+    '''
+    @abc.abstractmethod
+    def publish(
+        self,
+        node_id: str,
+        liveness: Dict[str, livenesschecker.LivenessStatus],
+        queue_depths: Dict[str, int]) -> None:
+        '''
+        Publish the liveness and queue depths observed by a node,
+        which doubles as the heartbeat of the node
+        '''
+
+    @abc.abstractmethod
+    def read_state(self, node_timeout: float, overrides_since: float) -> ClusterState:
+        '''
+        Read the shared state, considering nodes which have not
+        published within node_timeout seconds gone. Only overrides
+        updated since overrides_since, a read_at of an earlier read,
+        are read
+        '''
+
+    @abc.abstractmethod
+    def claim_override(self, key: str, worker_id: str, replaces: Optional[str] = None) -> str:
+        '''
+        Route key to worker_id, unless another node got there first.
+        An existing override is only replaced if it routes to replaces.
+        Returns the worker id key is routed to
+        '''
+
+    @abc.abstractmethod
+    def remove_override(self, key: str, worker_id: Optional[str] = None) -> None:
+        '''
+        Remove the override of key, only if it routes to worker_id if
+        given. Nodes read the removal on their next sync
+        '''
+
+    @abc.abstractmethod
+    def expire_overrides(self, before: float) -> None:
+        '''
+        Remove overrides, and records of removed ones, updated before
+        the given time
+        '''
+
+def merge_liveness(reports: Dict[str, List[livenesschecker.LivenessStatus]]) -> Dict[str, livenesschecker.LivenessStatus]:
+    '''
+    Merge liveness reported by nodes per worker. A worker is failed
+    when a majority of nodes report it failed, so a node with a bad
+    network path to a worker does not fail it over for everyone.
+    '''
+    merged = {}
+    for worker_id, statuses in reports.items():
+        failed = sum(1 for s in statuses if s == livenesschecker.LivenessStatus.HARD_FAIL)
+        if failed * 2 > len(statuses):
+            merged[worker_id] = livenesschecker.LivenessStatus.HARD_FAIL
+        elif any(s == livenesschecker.LivenessStatus.LIVE for s in statuses):
+            merged[worker_id] = livenesschecker.LivenessStatus.LIVE
+        else:
+            merged[worker_id] = livenesschecker.LivenessStatus.UNKNOWN
+    return merged
+
+class SQLiteBackend(CoordinationBackend):
+    '''
+    Coordination backend using an SQLite database in WAL mode, which
+    only works for nodes on a single host sharing local storage
+    '''
+    # Seconds of overrides read again on each sync, as claims may commit
+    # slightly out of order of when they were updated
+    SYNC_OVERLAP = 1.0
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._local = threading.local()
+        connection = self._connection()
+        with connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, updated REAL)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS liveness (node_id TEXT, worker_id TEXT, status INTEGER, '
+                'PRIMARY KEY (node_id, worker_id))')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS queue_depths (node_id TEXT, worker_id TEXT, depth INTEGER, '
+                'PRIMARY KEY (node_id, worker_id))')
+            # Removed overrides have no worker id until expired
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS overrides (key TEXT PRIMARY KEY, worker_id TEXT, updated REAL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS overrides_updated ON overrides (updated)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections cannot be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=10)
+            self._local.connection = connection
+        return connection
+
+    def publish(self, node_id, liveness, queue_depths) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO nodes VALUES (?, ?)', (node_id, time.time()))
+            connection.executemany(
+                'INSERT OR REPLACE INTO liveness VALUES (?, ?, ?)',
+                [(node_id, worker_id, status.value) for worker_id, status in liveness.items()])
+            connection.executemany(
+                'INSERT OR REPLACE INTO queue_depths VALUES (?, ?, ?)',
+                [(node_id, worker_id, depth) for worker_id, depth in queue_depths.items()])
+
+    def read_state(self, node_timeout: float, overrides_since: float) -> ClusterState:
+        connection = self._connection()
+        read_at = time.time()
+        threshold = read_at - node_timeout
+        with connection:
+            live_nodes = [row[0] for row in connection.execute(
+                'SELECT node_id FROM nodes WHERE updated >= ? ORDER BY node_id', (threshold,))]
+            reports = collections.defaultdict(list)
+            for worker_id, status in connection.execute(
+                    'SELECT l.worker_id, l.status FROM liveness l JOIN nodes n ON l.node_id = n.node_id '
+                    'WHERE n.updated >= ?', (threshold,)):
+                reports[worker_id].append(livenesschecker.LivenessStatus(status))
+            queue_depths = dict(connection.execute(
+                'SELECT q.worker_id, SUM(q.depth) FROM queue_depths q JOIN nodes n ON q.node_id = n.node_id '
+                'WHERE n.updated >= ? GROUP BY q.worker_id', (threshold,)))
+            overrides = {key: (worker_id, updated) for key, worker_id, updated in connection.execute(
+                'SELECT key, worker_id, updated FROM overrides WHERE updated >= ?',
+                (overrides_since - SQLiteBackend.SYNC_OVERLAP,))}
+        return ClusterState(live_nodes, merge_liveness(reports), overrides, queue_depths, read_at)
+
+    def claim_override(self, key: str, worker_id: str, replaces: Optional[str] = None) -> str:
+        connection = self._connection()
+        with connection:
+            # Serialise claims, so only one node fails a patient over
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT worker_id FROM overrides WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[0] is not None and row[0] != replaces:
+                return row[0]
+            connection.execute(
+                'INSERT OR REPLACE INTO overrides VALUES (?, ?, ?)', (key, worker_id, time.time()))
+        return worker_id
+
+    def remove_override(self, key: str, worker_id: Optional[str] = None) -> None:
+        connection = self._connection()
+        with connection:
+            # Kept without a worker id, so nodes read the removal
+            if worker_id is None:
+                connection.execute(
+                    'UPDATE overrides SET worker_id = NULL, updated = ? WHERE key = ?', (time.time(), key))
+            else:
+                connection.execute(
+                    'UPDATE overrides SET worker_id = NULL, updated = ? WHERE key = ? AND worker_id = ?',
+                    (time.time(), key, worker_id))
+
+    def expire_overrides(self, before: float) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM overrides WHERE updated < ?', (before,))
+
+class HTTPBackend(CoordinationBackend):
+    '''
+    Coordination backend reaching a state service over HTTP, for nodes
+    on several hosts
+    '''
+    # Seconds to wait for the state service, short as overrides are
+    # claimed while routing
+    TIMEOUT = 5.0
+
+    def __init__(self, url: str, token: Optional[str] = None, timeout: float = TIMEOUT) -> None:
+        self._pool = stowrs.ConnectionPool(url, timeout)
+        self._headers = {'Content-Type': 'application/json'}
+        if token:
+            self._headers['Authorization'] = f'Bearer {token}'
+
+    def _call(self, operation: str, **arguments):
+        body = json.dumps(dict(arguments, operation=operation)).encode('utf-8')
+        headers = dict(self._headers)
+        headers['Content-Length'] = str(len(body))
+        status, data = self._pool.request('POST', [body], headers)
+        if status != 200:
+            raise OSError(f'Cluster state service answered {operation} with status {status}')
+        return json.loads(data.decode('utf-8'))
+
+    def publish(self, node_id, liveness, queue_depths) -> None:
+        self._call(
+            'publish',
+            node_id=node_id,
+            liveness={worker_id: status.value for worker_id, status in liveness.items()},
+            queue_depths=queue_depths)
+
+    def read_state(self, node_timeout: float, overrides_since: float) -> ClusterState:
+        state = self._call('read_state', node_timeout=node_timeout, overrides_since=overrides_since)
+        return ClusterState(
+            state['live_nodes'],
+            {worker_id: livenesschecker.LivenessStatus(status) for worker_id, status in state['liveness'].items()},
+            {key: (worker_id, updated) for key, (worker_id, updated) in state['overrides'].items()},
+            state['queue_depths'],
+            state['read_at'])
+
+    def claim_override(self, key: str, worker_id: str, replaces: Optional[str] = None) -> str:
+        return self._call('claim_override', key=key, worker_id=worker_id, replaces=replaces)
+
+    def remove_override(self, key: str, worker_id: Optional[str] = None) -> None:
+        self._call('remove_override', key=key, worker_id=worker_id)
+
+    def expire_overrides(self, before: float) -> None:
+        self._call('expire_overrides', before=before)
+
+    def close(self) -> None:
+        self._pool.close()
+
+class _StateHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status: int, result=None) -> None:
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _call(self, backend: CoordinationBackend, request: dict):
+        operation = request.pop('operation')
+        if operation == 'publish':
+            backend.publish(
+                request['node_id'],
+                {worker_id: livenesschecker.LivenessStatus(status) for worker_id, status in request['liveness'].items()},
+                request['queue_depths'])
+            return None
+        if operation == 'read_state':
+            state = backend.read_state(request['node_timeout'], request['overrides_since'])
+            return {
+                'live_nodes': state.live_nodes,
+                'liveness': {worker_id: status.value for worker_id, status in state.liveness.items()},
+                'overrides': state.overrides,
+                'queue_depths': state.queue_depths,
+                'read_at': state.read_at}
+        if operation == 'claim_override':
+            return backend.claim_override(request['key'], request['worker_id'], request['replaces'])
+        if operation == 'remove_override':
+            backend.remove_override(request['key'], request['worker_id'])
+            return None
+        if operation == 'expire_overrides':
+            backend.expire_overrides(request['before'])
+            return None
+        raise KeyError(operation)
+
+    def do_POST(self):
+        service: StateService = self.server.service
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if service.token and not hmac.compare_digest(
+                self.headers.get('Authorization', '').encode('utf-8'), f'Bearer {service.token}'.encode('utf-8')):
+            self._respond(401)
+            return
+        try:
+            request = json.loads(body.decode('utf-8'))
+            result = self._call(service.backend, request)
+        except (ValueError, KeyError, TypeError, AttributeError) as exception:
+            service.logger.warning('Rejected cluster state request: %r', exception)
+            self._respond(400)
+            return
+        except Exception as exception:
+            service.logger.warning('Failed cluster state request: %s', exception)
+            self._respond(500)
+            return
+        self._respond(200, result)
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class StateService:
+    '''
+    Serves the state of a coordination backend to nodes over HTTP. Any
+    request without the token, if set, is rejected
+    '''
+    def __init__(self, backend: CoordinationBackend, address: str = '', port: int = 0, token: Optional[str] = None) -> None:
+        self.backend = backend
+        self.token = token
+        self.logger = logging.getLogger(__name__)
+        self._server = _ThreadingHTTPServer((address, port), _StateHandler)
+        self._server.service = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        address, port = self._server.server_address[:2]
+        return f'http://{address}:{port}/'
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        self.logger.info('Serving cluster state on %s', self.url)
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+class Cluster(threading.Thread):
+    '''
+    Membership of this node in a cluster of relay nodes. Periodically
+    publishes what this node observes and refreshes its copy of the
+    shared state.
+    '''
+    def __init__(self, config: configuration.ClusterConfiguration, backend: CoordinationBackend) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self._node_id = config.node_id
+        self._sync_interval = config.sync_interval
+        self._node_timeout = config.node_timeout
+        self._override_ttl = config.override_ttl
+        self._backend = backend
+        self._liveness_checkers: Dict[str, livenesschecker.LivenessChecker] = {}
+        self._workers: Dict[str, object] = {}
+        self._state = ClusterState([], {}, {}, {})
+        # Worker id and when it was updated per affinity key, least
+        # recently updated first
+        self._overrides: collections.OrderedDict = collections.OrderedDict()
+        # Time of the last read of overrides
+        self._overrides_synced = 0.0
+        self._lock = threading.Lock()
+        self._sync_failures = metrics.counter('cluster.sync_failures')
+        self._live_nodes = metrics.gauge('cluster.live_nodes')
+        self._stopped = threading.Event()
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def node_id(self) -> str:
+        return self._node_id
+
+    def register_worker(self, w, liveness_checker: livenesschecker.LivenessChecker = None) -> None:
+        '''
+        Share the queue depth and, if checked, the liveness of a worker
+        '''
+        self._workers[w.id] = w
+        if liveness_checker is not None:
+            self._liveness_checkers[w.id] = liveness_checker
+
+    def worker_available(self, worker_id: str) -> bool:
+        '''
+        Check whether the cluster considers a worker available
+        '''
+        status = self._state.liveness.get(worker_id)
+        if status is None:
+            # Not known to the cluster yet, go by what this node sees
+            checker = self._liveness_checkers.get(worker_id)
+            status = checker.status if checker is not None else livenesschecker.LivenessStatus.UNKNOWN
+        return status != livenesschecker.LivenessStatus.HARD_FAIL
+
+    def queue_depth(self, worker_id: str) -> int:
+        '''
+        Get the queue depth of a worker summed over all nodes
+        '''
+        return self._state.queue_depths.get(worker_id, 0)
+
+    def override(self, key: str) -> Optional[str]:
+        '''
+        Get the worker id key is routed to instead of its hashed worker
+        '''
+        entry = self._overrides.get(key)
+        if entry is None or entry[1] < time.time() - self._override_ttl:
+            return None
+        return entry[0]
+
+    def _set_override(self, key: str, worker_id: Optional[str], updated: float) -> None:
+        # Must be called with lock held
+        self._overrides.pop(key, None)
+        if worker_id is not None:
+            self._overrides[key] = (worker_id, updated)
+
+    def claim_override(self, key: str, worker_id: str, replaces: Optional[str] = None) -> str:
+        '''
+        Route key to worker_id in the whole cluster, unless another node
+        routed it elsewhere first. Returns the worker id key is routed to
+        '''
+        try:
+            winner = self._backend.claim_override(key, worker_id, replaces)
+        except Exception as exception:
+            # Route locally, the claim is retried with the next instance
+            self._logger.warning('Failed to claim override of %s: %s', key, exception)
+            return worker_id
+        with self._lock:
+            self._set_override(key, winner, time.time())
+        return winner
+
+    def remove_override(self, key: str, worker_id: Optional[str] = None) -> None:
+        '''
+        Route key to its hashed worker again in the whole cluster, only
+        if it is routed to worker_id if given
+        '''
+        try:
+            self._backend.remove_override(key, worker_id)
+        except Exception as exception:
+            # Expires in time otherwise
+            self._logger.warning('Failed to remove override of %s: %s', key, exception)
+        with self._lock:
+            entry = self._overrides.get(key)
+            if entry is not None and worker_id in (None, entry[0]):
+                self._set_override(key, None, time.time())
+
+    def sync(self) -> None:
+        '''
+        Publish local observations and refresh the shared state
+        '''
+        liveness = {worker_id: checker.status for worker_id, checker in self._liveness_checkers.items()}
+        queue_depths = {worker_id: w.queue_depth() for worker_id, w in self._workers.items()}
+        self._backend.publish(self._node_id, liveness, queue_depths)
+        now = time.time()
+        self._backend.expire_overrides(now - self._override_ttl)
+        state = self._backend.read_state(self._node_timeout, self._overrides_synced)
+        with self._lock:
+            self._state = state
+            for key, (worker_id, updated) in sorted(state.overrides.items(), key=lambda item: item[1][1]):
+                self._set_override(key, worker_id, updated)
+            # Expire overrides, which are kept in order of being updated
+            while self._overrides and next(iter(self._overrides.values()))[1] < now - self._override_ttl:
+                self._overrides.popitem(last=False)
+        self._overrides_synced = state.read_at
+        self._live_nodes.set(len(state.live_nodes))
+
+    def run(self):
+        self._logger.info('Joining cluster as node %s', self._node_id)
+        while not self._stopped.is_set():
+            try:
+                self.sync()
+            except Exception as exception:
+                # Keep routing with the last known state
+                self._sync_failures.increment()
+                self._logger.warning('Failed to sync cluster state: %s', exception)
+            self._stopped.wait(self._sync_interval)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+def create_backend(config: configuration.ClusterConfiguration) -> CoordinationBackend:
+    '''
+    Create the coordination backend selected in configuration. A node
+    serving the state uses the database directly
+    '''
+    if config.backend == configuration.ClusterConfiguration.BACKEND_SQLITE or config.serve:
+        return SQLiteBackend(config.path)
+    if config.backend == configuration.ClusterConfiguration.BACKEND_HTTP:
+        return HTTPBackend(config.url, config.token)
+    raise configuration.ConfigurationError(f'Unknown cluster backend {config.backend}')
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve cluster state to relay nodes using the http backend')
+    parser.add_argument(
+        '--config-file-path',
+        required=True,
+        type=str,
+        help='Path to configuration file or dir')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s')
+
+    cluster_config = configuration.Configuration(args.config_file_path).core().cluster
+    service = StateService(
+        SQLiteBackend(cluster_config.path),
+        cluster_config.listen_address,
+        cluster_config.listen_port,
+        cluster_config.token)
+    logging.info('Serving cluster state on %s', service.url)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
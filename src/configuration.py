@@ -3,7 +3,8 @@ Configuration management module
 '''
 import os
 import json
-from typing import List, Tuple, Dict
+import socket
+from typing import List, Tuple, Dict, Optional
 import abc
 import logging
 import jsonschema
@@ -12,11 +13,23 @@ class AbstractConfiguration:
     '''
     Abstract super class for all configuration classes
     '''
+    # Compiled schema validators, one per configuration class
+    _validators: Dict[type, jsonschema.Draft7Validator] = {}
+
+    def _validator(self):
+        validator = AbstractConfiguration._validators.get(type(self))
+        if validator is None:
+            schema = self.schema()
+            validator_class = jsonschema.validators.validator_for(schema)
+            validator_class.check_schema(schema)
+            validator = validator_class(schema)
+            AbstractConfiguration._validators[type(self)] = validator
+        return validator
+
     def _validate_json(self, json_object):
-        try:
-            jsonschema.validate(json_object, schema=self.schema())
-        except jsonschema.ValidationError as exception:
-            raise ConfigurationError(exception.message)
+        error = jsonschema.exceptions.best_match(self._validator().iter_errors(json_object))
+        if error is not None:
+            raise ConfigurationError(error.message)
 
     @abc.abstractmethod
     def schema(self) -> Dict:
@@ -68,10 +81,168 @@ class HeaderRequirementConfiguration(AbstractConfiguration):
             "required": ["tag", "requirement", "regexp"]
         }
 
+class RewriteConfiguration(AbstractConfiguration):
+    '''
+    Configuration class representing a single header rewrite
+    applied to instances relayed by a worker set
+    '''
+    SET = "set"
+    DELETE = "delete"
+    REGEXP_REPLACE = "regexp-replace"
+    UID_REMAP = "uid-remap"
+
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._tag = (int(json_data['tag'][0], 16), int(json_data['tag'][1], 16))
+        self._operation = json_data['operation']
+        self._value = json_data.get('value', '')
+        self._vr = json_data.get('vr')
+        self._regexp = json_data.get('regexp', '')
+        self._replacement = json_data.get('replacement', '')
+
+    @property
+    def tag(self) -> Tuple[int, int]:
+        '''
+        Get the DICOM tag rewritten
+        '''
+        return self._tag
+
+    @property
+    def operation(self) -> str:
+        '''
+        Get the type of rewrite
+        '''
+        return self._operation
+
+    @property
+    def value(self) -> str:
+        '''Get the value set by a set rewrite'''
+        return self._value
+
+    @property
+    def vr(self) -> str:
+        '''Get the VR of elements added by a set rewrite, if not the dictionary VR'''
+        return self._vr
+
+    @property
+    def regexp(self) -> str:
+        '''Get the regular expression replaced by a regexp-replace rewrite'''
+        return self._regexp
+
+    @property
+    def replacement(self) -> str:
+        '''Get the replacement of a regexp-replace rewrite'''
+        return self._replacement
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Rewrite",
+            "properties": {
+                "tag": { "type": "array", "items": { "type": "string" }, "minItems": 2},
+                "operation": { "enum": [
+                    RewriteConfiguration.SET,
+                    RewriteConfiguration.DELETE,
+                    RewriteConfiguration.REGEXP_REPLACE,
+                    RewriteConfiguration.UID_REMAP] },
+                "value": { "type": "string" },
+                "vr": { "type": "string", "pattern": "^[A-Z]{2}$" },
+                "regexp": { "type": "string" },
+                "replacement": { "type": "string" }
+            },
+            "required": ["tag", "operation"]
+        }
+
+class OverflowConfiguration(AbstractConfiguration):
+    '''
+    Configuration of diverting new studies from a worker set to another
+    while its workers are far behind
+    '''
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._worker_set_id = json_data['worker-set-id']
+        self._max_backlog_instances = json_data.get('max-backlog-instances')
+        self._max_backlog_bytes = json_data.get('max-backlog-bytes')
+        self._max_drain_seconds = json_data.get('max-drain-seconds')
+        self._resume_ratio = json_data.get('resume-ratio', 0.5)
+        self._study_timeout = json_data.get('study-timeout', 3600)
+
+    @property
+    def worker_set_id(self) -> str:
+        '''
+        Id of the worker set new studies are diverted to
+        '''
+        return self._worker_set_id
+
+    @property
+    def max_backlog_instances(self) -> Optional[int]:
+        '''
+        Number of instances held by the workers above which new studies
+        are diverted
+        '''
+        return self._max_backlog_instances
+
+    @property
+    def max_backlog_bytes(self) -> Optional[int]:
+        '''
+        Size in bytes of instances held by the workers above which new
+        studies are diverted
+        '''
+        return self._max_backlog_bytes
+
+    @property
+    def max_drain_seconds(self) -> Optional[float]:
+        '''
+        Seconds the workers are estimated to take to send what they hold,
+        at the rate they recently sent at, above which new studies are
+        diverted
+        '''
+        return self._max_drain_seconds
+
+    @property
+    def resume_ratio(self) -> float:
+        '''
+        Fraction of each threshold the backlog must fall below before new
+        studies are no longer diverted, so diverting does not flap
+        '''
+        return self._resume_ratio
+
+    @property
+    def study_timeout(self) -> float:
+        '''
+        Seconds the worker set of a study is remembered after its last
+        instance was sent, so instances of a study are never split
+        between worker sets
+        '''
+        return self._study_timeout
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Overflow",
+            "properties": {
+                "worker-set-id": { "type": "string" },
+                "max-backlog-instances": { "type": "integer", "minimum": 1 },
+                "max-backlog-bytes": { "type": "integer", "minimum": 1 },
+                "max-drain-seconds": { "type": "number", "exclusiveMinimum": 0 },
+                "resume-ratio": { "type": "number", "exclusiveMinimum": 0, "exclusiveMaximum": 1 },
+                "study-timeout": { "type": "number", "exclusiveMinimum": 0 }
+            },
+            "required": ["worker-set-id"],
+            "anyOf": [
+                { "required": ["max-backlog-instances"] },
+                { "required": ["max-backlog-bytes"] },
+                { "required": ["max-drain-seconds"] }
+            ]
+        }
+
 class WorkerSetConfiguration(AbstractConfiguration):
     '''
     Class representing a single WorkerSet configuration
     '''
+    # Patients are kept together by default
+    DEFAULT_AFFINITY_KEYS = [[["0x0010", "0x0020"]]]
+
     def __init__(self, json_data: json) -> None:
         self._validate_json(json_data)
         self._id = json_data['id']
@@ -83,133 +254,1168 @@ class WorkerSetConfiguration(AbstractConfiguration):
         self._header_requirements: List[HeaderRequirementConfiguration] = []
         for json_obj in json_data['header-requirements']:
             self._header_requirements.append(HeaderRequirementConfiguration(json_obj))
+        self._rewrites: List[RewriteConfiguration] = [
+            RewriteConfiguration(r) for r in json_data.get('rewrites', [])]
+        self._affinity_keys: List[List[Tuple[int, int]]] = [
+            [(int(tag[0], 16), int(tag[1], 16)) for tag in key]
+            for key in json_data.get('affinity-keys', WorkerSetConfiguration.DEFAULT_AFFINITY_KEYS)]
+        self._hash_function = json_data.get('hash-function', 'md5')
+        self._overflow = None
+        if 'overflow' in json_data:
+            self._overflow = OverflowConfiguration(json_data['overflow'])
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Worker Set",
+            "properties": {
+                "id": { "type": "string" },
+                "name": { "type": "string" },
+                "worker-ids": {
+                    "type": "array",
+                    "minItems": 1,
+                    "items": { "type": "string" } 
+                },
+                "distribution": { "type": "string" },
+                "hash-method": { "type": "string" },
+                "accepted-scp-ids": { 
+                    "type": "array",
+                    "items": { "type": "string", "minItems": 1 } 
+                },
+                "header-requirements": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "tag": { "type": "array", "items": { "type": "string" }, "minItems": 2},
+                            "requirement": { "type": "string" },
+                            "regexp": { "type": "string" }
+                        }
+                    }
+                },
+                "rewrites": { "type": "array", "items": { "type": "object" } },
+                "affinity-keys": {
+                    "type": "array",
+                    "minItems": 1,
+                    "items": {
+                        "type": "array",
+                        "minItems": 1,
+                        "items": {
+                            "type": "array",
+                            "items": { "type": "string", "pattern": "^(0x)?[0-9A-Fa-f]{1,4}$" },
+                            "minItems": 2,
+                            "maxItems": 2
+                        }
+                    }
+                },
+                "hash-function": { "enum": ["md5", "crc32"] },
+                "overflow": { "type": "object" }
+            },
+            "required": [
+                "id",
+                "worker-ids",
+                "distribution",
+                "hash-method",
+                "accepted-scp-ids",
+                "header-requirements"]
+        }
+
+    @property
+    def id(self) -> str:
+        '''
+        The unique id of the worker set
+        '''
+        return self._id
+
+    @property
+    def name(self) -> str:
+        '''
+        The friendly name of the worker set
+        '''
+        return self._name
+
+    @property
+    def worker_ids(self) -> List[str]:
+        '''
+        The list of worker ids included in the worker set
+        '''
+        return self._worker_ids
+
+    @property
+    def distribution(self):
+        '''
+        The distribution algorithm
+        '''
+        return self._distribution
+
+    @property
+    def hash_method(self):
+        '''
+        The hash method used to associate incoming studies
+        with workers
+        '''
+        return self._hash_method
+
+    @property
+    def accepted_scp_ids(self) -> List[str]:
+        '''
+        The list of SCP ids accepted by this worker set
+        '''
+        return self._accepted_scp_ids
+
+    @property
+    def header_requirements(self) -> List[HeaderRequirementConfiguration]:
+        '''
+        Get a list of requirements which must be satisfied by a DICOM instance
+        to be routed to this workerset
+        '''
+        return self._header_requirements
+
+    @property
+    def rewrites(self) -> List[RewriteConfiguration]:
+        '''
+        Get the header rewrites applied, in order, to instances relayed
+        by this worker set
+        '''
+        return self._rewrites
+
+    @property
+    def affinity_keys(self) -> List[List[Tuple[int, int]]]:
+        '''
+        Keys instances are kept together by on the same worker, in order
+        of preference, each made of the values of one or more tags
+        '''
+        return self._affinity_keys
+
+    @property
+    def hash_function(self) -> str:
+        '''
+        Name of the hash function placing affinity keys on workers
+        '''
+        return self._hash_function
+
+    @property
+    def overflow(self) -> Optional[OverflowConfiguration]:
+        '''
+        Where new studies are diverted while the workers are far behind,
+        or None if they are never diverted
+        '''
+        return self._overflow
+
+
+class RetryConfiguration(AbstractConfiguration):
+    '''
+    Configuration of retries of failed sends to workers
+    '''
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._max_attempts = json_data.get('max-attempts', 5)
+        self._initial_delay = json_data.get('initial-delay', 1)
+        self._max_delay = json_data.get('max-delay', 300)
+
+    @property
+    def max_attempts(self) -> int:
+        '''
+        Number of failed attempts after which an instance is dead lettered
+        '''
+        return self._max_attempts
+
+    @property
+    def initial_delay(self) -> float:
+        '''
+        Delay in seconds before the first retry
+        '''
+        return self._initial_delay
+
+    @property
+    def max_delay(self) -> float:
+        '''
+        Upper bound in seconds of the exponential backoff delay
+        '''
+        return self._max_delay
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Retry",
+            "properties": {
+                "max-attempts": { "type": "number", "minimum": 1 },
+                "initial-delay": { "type": "number", "minimum": 0 },
+                "max-delay": { "type": "number", "minimum": 0 }
+            }
+        }
+
+class DeduplicationConfiguration(AbstractConfiguration):
+    '''
+    Configuration of relay wide deduplication of received instances
+    '''
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._enabled = json_data.get('enabled', False)
+        self._window_seconds = json_data.get('window-seconds', 3600)
+        self._max_entries = json_data.get('max-entries', 1000000)
+
+    @property
+    def enabled(self) -> bool:
+        '''
+        Whether duplicate instances are dropped at ingest
+        '''
+        return self._enabled
+
+    @property
+    def window_seconds(self) -> float:
+        '''
+        Time after which a received instance is forgotten
+        '''
+        return self._window_seconds
+
+    @property
+    def max_entries(self) -> int:
+        '''
+        Maximum number of instances remembered
+        '''
+        return self._max_entries
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Deduplication",
+            "properties": {
+                "enabled": { "type": "boolean" },
+                "window-seconds": { "type": "number", "minimum": 0 },
+                "max-entries": { "type": "number", "minimum": 1 }
+            }
+        }
+
+class LivenessConfiguration(AbstractConfiguration):
+    '''
+    Configuration of liveness checking of workers
+    '''
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._check_interval = json_data.get('check-interval', 10)
+        self._jitter = json_data.get('jitter', 0.2)
+        self._timeout = json_data.get('timeout', 5)
+        self._failure_threshold = json_data.get('failure-threshold', 3)
+        self._open_interval = json_data.get('open-interval', 30)
+        self._max_concurrent_checks = json_data.get('max-concurrent-checks', 16)
+
+    @property
+    def check_interval(self) -> float:
+        '''
+        Seconds between active liveness checks of a worker
+        '''
+        return self._check_interval
+
+    @property
+    def jitter(self) -> float:
+        '''
+        Fraction by which check intervals are randomly varied
+        '''
+        return self._jitter
+
+    @property
+    def timeout(self) -> float:
+        '''
+        Timeout in seconds of a single liveness check
+        '''
+        return self._timeout
+
+    @property
+    def failure_threshold(self) -> int:
+        '''
+        Number of consecutive failed sends after which a worker is
+        considered failed
+        '''
+        return self._failure_threshold
+
+    @property
+    def open_interval(self) -> float:
+        '''
+        Seconds a failed worker is left alone before it is probed again
+        '''
+        return self._open_interval
+
+    @property
+    def max_concurrent_checks(self) -> int:
+        '''
+        Maximum number of liveness checks running at the same time
+        '''
+        return self._max_concurrent_checks
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Liveness",
+            "properties": {
+                "check-interval": { "type": "number", "exclusiveMinimum": 0 },
+                "jitter": { "type": "number", "minimum": 0, "maximum": 1 },
+                "timeout": { "type": "number", "exclusiveMinimum": 0 },
+                "failure-threshold": { "type": "number", "minimum": 1 },
+                "open-interval": { "type": "number", "minimum": 0 },
+                "max-concurrent-checks": { "type": "number", "minimum": 1 }
+            }
+        }
+
+class LoggingConfiguration(AbstractConfiguration):
+    '''
+    Configuration of log levels, log file rotation and rate limiting
+    '''
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._level = json_data.get('level', 'INFO')
+        self._levels: Dict[str, str] = json_data.get('levels', {})
+        self._max_bytes = json_data.get('max-bytes', 10 * 1024 * 1024)
+        self._backup_count = json_data.get('backup-count', 5)
+        self._queue_size = json_data.get('queue-size', 10000)
+        self._rate_limit_burst = json_data.get('rate-limit-burst', 10)
+        self._rate_limit_interval = json_data.get('rate-limit-interval', 60)
+        self._sample_every = json_data.get('sample-every', 100)
+
+    @property
+    def level(self) -> str:
+        '''
+        Level of loggers not given a level of their own
+        '''
+        return self._level
+
+    @property
+    def levels(self) -> Dict[str, str]:
+        '''
+        Levels per logger name, e.g. "scp" or "pynetdicom"
+        '''
+        return self._levels
+
+    @property
+    def max_bytes(self) -> int:
+        '''
+        Size in bytes at which the log file is rotated
+        '''
+        return self._max_bytes
+
+    @property
+    def backup_count(self) -> int:
+        '''
+        Number of rotated log files kept
+        '''
+        return self._backup_count
+
+    @property
+    def queue_size(self) -> int:
+        '''
+        Maximum number of records waiting to be written. Records
+        logged while the queue is full are dropped
+        '''
+        return self._queue_size
+
+    @property
+    def rate_limit_burst(self) -> int:
+        '''
+        Number of times the same warning is logged per rate limit
+        interval before it is sampled
+        '''
+        return self._rate_limit_burst
+
+    @property
+    def rate_limit_interval(self) -> float:
+        '''
+        Seconds after which the rate limit of a warning is reset
+        '''
+        return self._rate_limit_interval
+
+    @property
+    def sample_every(self) -> int:
+        '''
+        Once rate limited, only one in this many repeats of a
+        warning is logged
+        '''
+        return self._sample_every
+
+    def schema(self):
+        level = { "enum": ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] }
+        return {
+            "type": "object",
+            "title": "Logging",
+            "properties": {
+                "level": level,
+                "levels": { "type": "object", "additionalProperties": level },
+                "max-bytes": { "type": "integer", "minimum": 0 },
+                "backup-count": { "type": "integer", "minimum": 0 },
+                "queue-size": { "type": "integer", "minimum": 1 },
+                "rate-limit-burst": { "type": "integer", "minimum": 1 },
+                "rate-limit-interval": { "type": "number", "exclusiveMinimum": 0 },
+                "sample-every": { "type": "integer", "minimum": 1 }
+            }
+        }
+
+class ClusterConfiguration(AbstractConfiguration):
+    '''
+    Configuration of state shared with other relay nodes
+    '''
+    BACKEND_SQLITE = 'sqlite'
+    BACKEND_HTTP = 'http'
+
+    def __init__(self, json_data: json, default_path: str) -> None:
+        self._validate_json(json_data)
+        self._enabled = json_data.get('enabled', False)
+        self._node_id = json_data.get('node-id', socket.gethostname())
+        self._backend = json_data.get('backend', ClusterConfiguration.BACKEND_SQLITE)
+        self._path = json_data.get('path', default_path)
+        self._url = json_data.get('url')
+        self._serve = json_data.get('serve', False)
+        self._listen_address = json_data.get('listen-address', '')
+        self._listen_port = json_data.get('listen-port', 7070)
+        self._token = json_data.get('token')
+        self._sync_interval = json_data.get('sync-interval', 2)
+        self._node_timeout = json_data.get('node-timeout', 10)
+        self._override_ttl = json_data.get('override-ttl', 86400)
+
+    @property
+    def enabled(self) -> bool:
+        '''
+        Whether worker liveness, affinity overrides and queue depths
+        are shared with other nodes
+        '''
+        return self._enabled
+
+    @property
+    def node_id(self) -> str:
+        '''
+        Id of this node, unique within the cluster. Defaults to the host name
+        '''
+        return self._node_id
+
+    @property
+    def backend(self) -> str:
+        '''
+        Coordination backend the state is shared through
+        '''
+        return self._backend
+
+    @property
+    def path(self) -> str:
+        '''
+        Path to the database of the sqlite backend, or of the state
+        service, on local storage of the host it is used on
+        '''
+        return self._path
+
+    @property
+    def url(self) -> Optional[str]:
+        '''
+        URL of the state service of the http backend
+        '''
+        return self._url
+
+    @property
+    def serve(self) -> bool:
+        '''
+        Whether this node serves the state to nodes using the http backend
+        '''
+        return self._serve
+
+    @property
+    def listen_address(self) -> str:
+        '''
+        Address the state service listens on, all addresses by default
+        '''
+        return self._listen_address
+
+    @property
+    def listen_port(self) -> int:
+        '''
+        Port the state service listens on
+        '''
+        return self._listen_port
+
+    @property
+    def token(self) -> Optional[str]:
+        '''
+        Shared secret the http backend authenticates to the state
+        service with
+        '''
+        return self._token
+
+    @property
+    def sync_interval(self) -> float:
+        '''
+        Seconds between syncs with the coordination backend
+        '''
+        return self._sync_interval
+
+    @property
+    def node_timeout(self) -> float:
+        '''
+        Seconds after which a node which has not synced is considered
+        gone, and its observations are ignored
+        '''
+        return self._node_timeout
+
+    @property
+    def override_ttl(self) -> float:
+        '''
+        Seconds after which a patient failed over goes back to its
+        hashed worker
+        '''
+        return self._override_ttl
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Cluster",
+            "properties": {
+                "enabled": { "type": "boolean" },
+                "node-id": { "type": "string", "minLength": 1 },
+                "backend": { "enum": [ClusterConfiguration.BACKEND_SQLITE, ClusterConfiguration.BACKEND_HTTP] },
+                "path": { "type": "string" },
+                "url": { "type": "string", "pattern": "^https?://" },
+                "serve": { "type": "boolean" },
+                "listen-address": { "type": "string" },
+                "listen-port": { "type": "integer", "minimum": 0, "maximum": 65535 },
+                "token": { "type": "string", "minLength": 1 },
+                "sync-interval": { "type": "number", "exclusiveMinimum": 0 },
+                "node-timeout": { "type": "number", "exclusiveMinimum": 0 },
+                "override-ttl": { "type": "number", "exclusiveMinimum": 0 }
+            }
+        }
+
+class AffinityConfiguration(AbstractConfiguration):
+    '''
+    Configuration of persistent patient to worker assignments
+    '''
+    ASSIGNMENT_HASH = 'hash'
+    ASSIGNMENT_LEAST_PATIENTS = 'least-patients'
+
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._enabled = json_data.get('enabled', False)
+        self._assignment = json_data.get('assignment', AffinityConfiguration.ASSIGNMENT_HASH)
+        self._compact_after = json_data.get('compact-after', 100000)
+        self._refresh_interval = json_data.get('refresh-interval', 5)
+
+    @property
+    def enabled(self) -> bool:
+        '''
+        Whether patients stay with the worker they were first assigned
+        to, regardless of changes to worker set membership
+        '''
+        return self._enabled
+
+    @property
+    def assignment(self) -> str:
+        '''
+        How new patients are assigned: by hashing the patient id, or to
+        the worker with the fewest patients
+        '''
+        return self._assignment
+
+    @property
+    def compact_after(self) -> int:
+        '''
+        Number of logged assignments after which the table is written
+        to a new snapshot and the log is cleared
+        '''
+        return self._compact_after
+
+    @property
+    def refresh_interval(self) -> float:
+        '''
+        Seconds between reading assignments logged by a rebalance
+        '''
+        return self._refresh_interval
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Affinity",
+            "properties": {
+                "enabled": { "type": "boolean" },
+                "assignment": { "enum": [
+                    AffinityConfiguration.ASSIGNMENT_HASH,
+                    AffinityConfiguration.ASSIGNMENT_LEAST_PATIENTS] },
+                "compact-after": { "type": "integer", "minimum": 1 },
+                "refresh-interval": { "type": "number", "exclusiveMinimum": 0 }
+            }
+        }
+
+class CaptureConfiguration(AbstractConfiguration):
+    '''
+    Configuration of traffic capture for later replay
+    '''
+    # Longest key of the keyed hash identifiers are pseudonymised with
+    MAX_SALT_BYTES = 64
+
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._enabled = json_data.get('enabled', False)
+        self._salt = json_data.get('salt', '')
+        self._tags: List[Tuple[int, int]] = [
+            (int(tag[0], 16), int(tag[1], 16)) for tag in json_data.get('tags', [])]
+        self._queue_size = json_data.get('queue-size', 10000)
+        # Without a salt, identifiers such as patient ids could be
+        # recovered by hashing candidates
+        if self._enabled and not self._salt:
+            raise ConfigurationError('Capture needs a salt to pseudonymise identifiers with')
+        if len(self._salt.encode('utf-8')) > CaptureConfiguration.MAX_SALT_BYTES:
+            raise ConfigurationError(f'Capture salt exceeds {CaptureConfiguration.MAX_SALT_BYTES} bytes')
+
+    @property
+    def enabled(self) -> bool:
+        '''
+        Whether metadata of received instances is recorded to a trace
+        '''
+        return self._enabled
+
+    @property
+    def salt(self) -> str:
+        '''
+        Secret mixed into pseudonymised identifiers, required when
+        enabled
+        '''
+        return self._salt
+
+    @property
+    def tags(self) -> List[Tuple[int, int]]:
+        '''
+        Tags recorded in addition to those routing depends on
+        '''
+        return self._tags
+
+    @property
+    def queue_size(self) -> int:
+        '''
+        Maximum number of records waiting to be written. Records of
+        instances received while the queue is full are dropped
+        '''
+        return self._queue_size
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Capture",
+            "properties": {
+                "enabled": { "type": "boolean" },
+                "salt": { "type": "string" },
+                "tags": { "type": "array", "items": {
+                    "type": "array", "items": { "type": "string" }, "minItems": 2, "maxItems": 2 } },
+                "queue-size": { "type": "integer", "minimum": 1 }
+            }
+        }
+
+class DiagnosticsConfiguration(AbstractConfiguration):
+    '''
+    Configuration of diagnostics triggered in the running relay
+    '''
+    def __init__(self, json_data: json, default_socket_path: str) -> None:
+        self._validate_json(json_data)
+        self._enabled = json_data.get('enabled', True)
+        self._socket_path = json_data.get('socket-path', default_socket_path)
+        self._seconds = json_data.get('seconds', 10)
+        self._top = json_data.get('top', 25)
+
+    @property
+    def enabled(self) -> bool:
+        '''
+        Whether diagnostics can be triggered with SIGUSR1 or through the
+        diagnostics socket
+        '''
+        return self._enabled
+
+    @property
+    def socket_path(self) -> str:
+        '''
+        Path of the local socket diagnostics are requested through
+        '''
+        return self._socket_path
+
+    @property
+    def seconds(self) -> float:
+        '''
+        Default duration of profiling and memory tracing
+        '''
+        return self._seconds
+
+    @property
+    def top(self) -> int:
+        '''
+        Number of entries listed in profiles and memory snapshots
+        '''
+        return self._top
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Diagnostics",
+            "properties": {
+                "enabled": { "type": "boolean" },
+                "socket-path": { "type": "string" },
+                "seconds": { "type": "number", "exclusiveMinimum": 0 },
+                "top": { "type": "integer", "minimum": 1 }
+            }
+        }
+
+class ControlConfiguration(AbstractConfiguration):
+    '''
+    Configuration of the control socket of the running relay
+    '''
+    def __init__(self, json_data: json, default_socket_path: str) -> None:
+        self._validate_json(json_data)
+        self._enabled = json_data.get('enabled', True)
+        self._socket_path = json_data.get('socket-path', default_socket_path)
+
+    @property
+    def enabled(self) -> bool:
+        '''
+        Whether workers and routers can be controlled through the
+        control socket
+        '''
+        return self._enabled
+
+    @property
+    def socket_path(self) -> str:
+        '''
+        Path of the local socket control commands are sent through
+        '''
+        return self._socket_path
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Control",
+            "properties": {
+                "enabled": { "type": "boolean" },
+                "socket-path": { "type": "string" }
+            }
+        }
+
+class CatalogConfiguration(AbstractConfiguration):
+    '''
+    Configuration of the catalog of where instances were sent
+    '''
+    def __init__(self, json_data: json, default_path: str) -> None:
+        self._validate_json(json_data)
+        self._enabled = json_data.get('enabled', False)
+        self._path = json_data.get('path', default_path)
+        self._retention_days = json_data.get('retention-days', 30)
+        self._batch_size = json_data.get('batch-size', 1000)
+        self._queue_size = json_data.get('queue-size', 100000)
+
+    @property
+    def enabled(self) -> bool:
+        '''
+        Whether routed, sent and dead lettered instances are recorded
+        '''
+        return self._enabled
+
+    @property
+    def path(self) -> str:
+        '''
+        Path of the SQLite catalog database
+        '''
+        return self._path
+
+    @property
+    def retention_days(self) -> float:
+        '''
+        Days after which records are pruned
+        '''
+        return self._retention_days
+
+    @property
+    def batch_size(self) -> int:
+        '''
+        Maximum number of records written in a single transaction
+        '''
+        return self._batch_size
+
+    @property
+    def queue_size(self) -> int:
+        '''
+        Maximum number of records waiting to be written. Records arriving
+        while the queue is full are dropped
+        '''
+        return self._queue_size
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Catalog",
+            "properties": {
+                "enabled": { "type": "boolean" },
+                "path": { "type": "string" },
+                "retention-days": { "type": "number", "exclusiveMinimum": 0 },
+                "batch-size": { "type": "integer", "minimum": 1 },
+                "queue-size": { "type": "integer", "minimum": 1 }
+            }
+        }
+
+class ShapingConfiguration(AbstractConfiguration):
+    '''
+    Configuration of the rates instances are sent at, by a worker or by
+    the workers of a destination group together
+    '''
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._max_instances_per_second = json_data.get('max-instances-per-second')
+        self._max_bytes_per_second = json_data.get('max-bytes-per-second')
+        self._burst_instances = json_data.get('burst-instances', self._max_instances_per_second)
+        self._burst_bytes = json_data.get('burst-bytes', self._max_bytes_per_second)
+
+    @property
+    def max_instances_per_second(self) -> Optional[float]:
+        '''
+        Average number of instances sent per second, unlimited if None
+        '''
+        return self._max_instances_per_second
+
+    @property
+    def max_bytes_per_second(self) -> Optional[float]:
+        '''
+        Average number of bytes sent per second, unlimited if None
+        '''
+        return self._max_bytes_per_second
+
+    @property
+    def burst_instances(self) -> Optional[float]:
+        '''
+        Number of instances which may be sent at once after sending less
+        than the rate, one second worth by default
+        '''
+        return self._burst_instances
+
+    @property
+    def burst_bytes(self) -> Optional[float]:
+        '''
+        Number of bytes which may be sent at once after sending less
+        than the rate, one second worth by default
+        '''
+        return self._burst_bytes
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Shaping",
+            "properties": {
+                "max-instances-per-second": { "type": "number", "exclusiveMinimum": 0 },
+                "max-bytes-per-second": { "type": "number", "exclusiveMinimum": 0 },
+                "burst-instances": { "type": "number", "minimum": 1 },
+                "burst-bytes": { "type": "number", "minimum": 1 }
+            }
+        }
+
+class PriorityRuleConfiguration(AbstractConfiguration):
+    '''
+    Configuration of a rule assigning instances to a priority class.
+    All specified criteria must be satisfied for the rule to match.
+    '''
+    C_STORE_PRIORITIES = {"medium": 0, "high": 1, "low": 2}
+
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._accepted_scp_ids = json_data.get('accepted-scp-ids', [])
+        self._c_store_priorities = [
+            PriorityRuleConfiguration.C_STORE_PRIORITIES[p] for p in json_data.get('c-store-priorities', [])]
+        self._header_requirements: List[HeaderRequirementConfiguration] = [
+            HeaderRequirementConfiguration(h) for h in json_data.get('header-requirements', [])]
+
+    @property
+    def accepted_scp_ids(self) -> List[str]:
+        '''
+        Ids of SCPs the instance must be received by, if any
+        '''
+        return self._accepted_scp_ids
+
+    @property
+    def c_store_priorities(self) -> List[int]:
+        '''
+        C-STORE request priority values the instance must be sent with, if any
+        '''
+        return self._c_store_priorities
+
+    @property
+    def header_requirements(self) -> List[HeaderRequirementConfiguration]:
+        '''
+        Header requirements the instance must satisfy
+        '''
+        return self._header_requirements
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Priority Rule",
+            "properties": {
+                "accepted-scp-ids": { "type": "array", "items": { "type": "string" } },
+                "c-store-priorities": {
+                    "type": "array",
+                    "items": { "type": "string", "enum": list(PriorityRuleConfiguration.C_STORE_PRIORITIES) }
+                },
+                "header-requirements": { "type": "array", "items": { "type": "object" } }
+            }
+        }
+
+class PriorityClassConfiguration(AbstractConfiguration):
+    '''
+    Configuration of a priority class. Instances are assigned to the
+    first class having a matching rule, and queues share capacity
+    between classes in proportion to their weights.
+    '''
+    DEFAULT = "default"
+
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._name = json_data['name']
+        self._weight = json_data['weight']
+        self._rules: List[PriorityRuleConfiguration] = [
+            PriorityRuleConfiguration(r) for r in json_data.get('rules', [])]
+
+    @property
+    def name(self) -> str:
+        '''
+        The unique name of the priority class
+        '''
+        return self._name
+
+    @property
+    def weight(self) -> int:
+        '''
+        Relative share of queue capacity given to the class
+        '''
+        return self._weight
+
+    @property
+    def rules(self) -> List[PriorityRuleConfiguration]:
+        '''
+        Rules assigning instances to this class. Any rule may match
+        '''
+        return self._rules
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Priority Class",
+            "properties": {
+                "name": { "type": "string" },
+                "weight": { "type": "number", "minimum": 1 },
+                "rules": { "type": "array", "items": { "type": "object" } }
+            },
+            "required": ["name", "weight"]
+        }
+
+class CoreConfiguration(AbstractConfiguration):
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._log_dir_path = json_data['log-dir-path']
+        self._log_format = json_data['log-format']
+        self._buffer_dir_path = json_data['buffer-dir-path']
+        self._router_count = json_data['router-count']
+        self._retry = RetryConfiguration(json_data.get('retry', {}))
+        self._deduplication = DeduplicationConfiguration(json_data.get('deduplication', {}))
+        self._liveness = LivenessConfiguration(json_data.get('liveness', {}))
+        self._priority_classes: List[PriorityClassConfiguration] = [
+            PriorityClassConfiguration(p) for p in json_data.get('priority-classes', [])]
+        self._uid_remap_salt = json_data.get('uid-remap-salt', '')
+        self._spool_threshold = json_data.get('spool-threshold', 64 * 1024 * 1024)
+        self._logging = LoggingConfiguration(json_data.get('logging', {}))
+        self._affinity = AffinityConfiguration(json_data.get('affinity', {}))
+        self._capture = CaptureConfiguration(json_data.get('capture', {}))
+        self._cluster = ClusterConfiguration(
+            json_data.get('cluster', {}), os.path.join(self._buffer_dir_path, 'cluster.sqlite'))
+        self._diagnostics = DiagnosticsConfiguration(
+            json_data.get('diagnostics', {}), os.path.join(self._buffer_dir_path, 'diagnostics.sock'))
+        self._control = ControlConfiguration(
+            json_data.get('control', {}), os.path.join(self._buffer_dir_path, 'control.sock'))
+        self._catalog = CatalogConfiguration(
+            json_data.get('catalog', {}), os.path.join(self._buffer_dir_path, 'catalog.sqlite'))
+        self._shutdown_timeout = json_data.get('shutdown-timeout', 10)
+        self._shaping_groups: Dict[str, ShapingConfiguration] = {
+            group_id: ShapingConfiguration(group) for group_id, group in json_data.get('shaping-groups', {}).items()}
+
+    @property
+    def log_dir_path(self):
+        '''
+        Path to the directory where log files are written
+        '''
+        return self._log_dir_path
+
+    @property
+    def log_format(self):
+        '''
+        Logging format to use
+        '''
+        return self._log_format
+
+    @property
+    def logging(self) -> LoggingConfiguration:
+        '''
+        Log levels, rotation and rate limiting configuration
+        '''
+        return self._logging
+
+    @property
+    def buffer_dir_path(self):
+        '''
+        Temporary dir used for buffering incoming files
+        '''
+        return self._buffer_dir_path
+
+    @property
+    def router_count(self):
+        '''
+        Number of routing threads to spin up
+        '''
+        return self._router_count
+
+    @property
+    def retry(self) -> RetryConfiguration:
+        '''
+        Retry configuration for failed sends to workers
+        '''
+        return self._retry
+
+    @property
+    def deduplication(self) -> DeduplicationConfiguration:
+        '''
+        Deduplication configuration for received instances
+        '''
+        return self._deduplication
+
+    @property
+    def liveness(self) -> LivenessConfiguration:
+        '''
+        Liveness checking configuration for workers
+        '''
+        return self._liveness
+
+    @property
+    def priority_classes(self) -> List[PriorityClassConfiguration]:
+        '''
+        Priority classes in order of evaluation
+        '''
+        return self._priority_classes
 
-    def schema(self):
-        return {
-            "type": "object",
-            "title": "Worker Set",
-            "properties": {
-                "id": { "type": "string" },
-                "name": { "type": "string" },
-                "worker-ids": {
-                    "type": "array",
-                    "minItems": 1,
-                    "items": { "type": "string" } 
-                },
-                "distribution": { "type": "string" },
-                "hash-method": { "type": "string" },
-                "accepted-scp-ids": { 
-                    "type": "array",
-                    "items": { "type": "string", "minItems": 1 } 
-                },
-                "header-requirements": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "tag": { "type": "array", "items": { "type": "string" }, "minItems": 2},
-                            "requirement": { "type": "string" },
-                            "regexp": { "type": "string" }
-                        }
-                    }
-                }
-            },
-            "required": [
-                "id",
-                "worker-ids",
-                "distribution",
-                "hash-method",
-                "accepted-scp-ids",
-                "header-requirements"]
-        }
+    @property
+    def uid_remap_salt(self) -> str:
+        '''
+        Secret mixed into remapped UIDs, so they cannot be traced back
+        to the originals by hashing candidate UIDs
+        '''
+        return self._uid_remap_salt
 
     @property
-    def id(self) -> str:
+    def spool_threshold(self) -> int:
         '''
-        The unique id of the worker set
+        Size in bytes above which received instances are spooled to
+        disk instead of being held in memory
         '''
-        return self._id
+        return self._spool_threshold
 
     @property
-    def name(self) -> str:
+    def spool_dir_path(self) -> str:
         '''
-        The friendly name of the worker set
+        Dir where large received instances are spooled
         '''
-        return self._name
+        return os.path.join(self._buffer_dir_path, 'spool')
 
     @property
-    def worker_ids(self) -> List[str]:
+    def affinity(self) -> AffinityConfiguration:
         '''
-        The list of worker ids included in the worker set
+        Persistent patient to worker assignment configuration
         '''
-        return self._worker_ids
+        return self._affinity
 
     @property
-    def distribution(self):
+    def affinity_dir_path(self) -> str:
         '''
-        The distribution algorithm
+        Dir where patient to worker assignments are stored
         '''
-        return self._distribution
+        return os.path.join(self._buffer_dir_path, 'affinity')
 
     @property
-    def hash_method(self):
+    def capture(self) -> CaptureConfiguration:
         '''
-        The hash method used to associate incoming studies
-        with workers
+        Traffic capture configuration
         '''
-        return self._hash_method
+        return self._capture
 
     @property
-    def accepted_scp_ids(self) -> List[str]:
+    def capture_dir_path(self) -> str:
         '''
-        The list of SCP ids accepted by this worker set
+        Dir where traffic traces are written
         '''
-        return self._accepted_scp_ids
+        return os.path.join(self._buffer_dir_path, 'capture')
 
     @property
-    def header_requirements(self) -> List[HeaderRequirementConfiguration]:
+    def cluster(self) -> ClusterConfiguration:
         '''
-        Get a list of requirements which must be satisfied by a DICOM instance
-        to be routed to this workerset
+        Cluster configuration for state shared with other nodes
         '''
-        return self._header_requirements
+        return self._cluster
 
+    @property
+    def diagnostics(self) -> DiagnosticsConfiguration:
+        '''
+        Runtime diagnostics configuration
+        '''
+        return self._diagnostics
 
-class CoreConfiguration(AbstractConfiguration):
-    def __init__(self, json_data: json) -> None:
-        self._validate_json(json_data)
-        self._log_dir_path = json_data['log-dir-path']
-        self._log_format = json_data['log-format']
-        self._buffer_dir_path = json_data['buffer-dir-path']
-        self._router_count = json_data['router-count']
+    @property
+    def catalog(self) -> CatalogConfiguration:
+        '''
+        Configuration of the catalog of where instances were sent
+        '''
+        return self._catalog
 
     @property
-    def log_dir_path(self):
+    def shutdown_timeout(self) -> float:
         '''
-        Path to the directory where log files are written
+        Seconds routers and workers are given to finish what they are
+        doing on shutdown, before what they hold is snapshotted
         '''
-        return self._log_dir_path
+        return self._shutdown_timeout
 
     @property
-    def log_format(self):
+    def snapshot_dir_path(self) -> str:
         '''
-        Logging format to use
+        Dir where instances still queued on shutdown are snapshotted,
+        to be restored on the next start
         '''
-        return self._log_format
+        return os.path.join(self._buffer_dir_path, 'snapshot')
 
     @property
-    def buffer_dir_path(self):
+    def shaping_groups(self) -> Dict[str, ShapingConfiguration]:
         '''
-        Temporary dir used for buffering incoming files
+        Rates shared by the workers of each destination group, by group id
         '''
-        return self._buffer_dir_path
+        return self._shaping_groups
 
     @property
-    def router_count(self):
+    def control(self) -> ControlConfiguration:
         '''
-        Number of routing threads to spin up
+        Runtime control configuration
         '''
-        return self._router_count
+        return self._control
+
+    @property
+    def diagnostics_dir_path(self) -> str:
+        '''
+        Dir where diagnostics are written
+        '''
+        return os.path.join(self._buffer_dir_path, 'diagnostics')
+
+    @property
+    def ingest_failed_dir_path(self) -> str:
+        '''
+        Dir where files dropped into folder SCPs which could not be
+        read as DICOM are moved
+        '''
+        return os.path.join(self._buffer_dir_path, 'ingest-failed')
+
+    @property
+    def dead_letter_dir_path(self) -> str:
+        '''
+        Dir where instances which could not be relayed are stored
+        '''
+        return os.path.join(self._buffer_dir_path, 'dead-letter')
 
     def schema(self):
         return {
@@ -219,19 +1425,133 @@ class CoreConfiguration(AbstractConfiguration):
                 "log-dir-path": { "type": "string" },
                 "log-format": { "type": "string" },
                 "buffer-dir-path": { "type": "string" },
-                "router-count": { "type": "number", "minimum": 1 }
+                "router-count": { "type": "number", "minimum": 1 },
+                "retry": { "type": "object" },
+                "deduplication": { "type": "object" },
+                "liveness": { "type": "object" },
+                "priority-classes": { "type": "array", "items": { "type": "object" } },
+                "uid-remap-salt": { "type": "string" },
+                "spool-threshold": { "type": "integer", "minimum": 0 },
+                "logging": { "type": "object" },
+                "cluster": { "type": "object" },
+                "affinity": { "type": "object" },
+                "capture": { "type": "object" },
+                "diagnostics": { "type": "object" },
+                "control": { "type": "object" },
+                "catalog": { "type": "object" },
+                "shaping-groups": { "type": "object", "additionalProperties": { "type": "object" } },
+                "shutdown-timeout": { "type": "number", "minimum": 0 }
             },
             "required": ["log-dir-path", "log-format", "buffer-dir-path", "router-count"]
         }
 
+class AdmissionConfiguration(AbstractConfiguration):
+    '''
+    Configuration of association admission control of an SCP
+    '''
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._enabled = json_data.get('enabled', False)
+        self._max_associations = json_data.get('max-associations', 10)
+        self._max_associations_per_ae = json_data.get('max-associations-per-ae')
+        self._reserved_associations = json_data.get('reserved-associations', 0)
+        self._max_bytes_per_second = json_data.get('max-bytes-per-second')
+        self._max_bytes_per_second_per_ae = json_data.get('max-bytes-per-second-per-ae')
+        self._calling_aes: Dict[str, Dict] = json_data.get('calling-aes', {})
+
+    @property
+    def enabled(self) -> bool:
+        '''
+        Whether associations are admitted and received bytes rate
+        limited per calling AE
+        '''
+        return self._enabled
+
+    @property
+    def max_associations(self) -> int:
+        '''
+        Maximum number of concurrent associations
+        '''
+        return self._max_associations
+
+    @property
+    def reserved_associations(self) -> int:
+        '''
+        Number of associations, out of the maximum, only granted to
+        calling AEs holding less than their fair share
+        '''
+        return self._reserved_associations
+
+    @property
+    def max_bytes_per_second(self) -> float:
+        '''
+        Total received bytes per second, shared evenly among calling AEs
+        with open associations. Not limited if None
+        '''
+        return self._max_bytes_per_second
+
+    @property
+    def calling_aes(self) -> List[str]:
+        '''
+        Calling AEs given quotas of their own
+        '''
+        return list(self._calling_aes)
+
+    def max_associations_for(self, calling_ae: str) -> int:
+        '''
+        Maximum number of concurrent associations of a calling AE, None
+        if not limited
+        '''
+        return self._calling_aes.get(calling_ae, {}).get('max-associations', self._max_associations_per_ae)
+
+    def max_bytes_per_second_for(self, calling_ae: str) -> float:
+        '''
+        Received bytes per second of a calling AE, None if not limited
+        '''
+        return self._calling_aes.get(calling_ae, {}).get('max-bytes-per-second', self._max_bytes_per_second_per_ae)
+
+    def schema(self):
+        quota = {
+            "type": "object",
+            "properties": {
+                "max-associations": { "type": "integer", "minimum": 1 },
+                "max-bytes-per-second": { "type": "number", "exclusiveMinimum": 0 }
+            },
+            "additionalProperties": False
+        }
+        return {
+            "type": "object",
+            "title": "Admission",
+            "properties": {
+                "enabled": { "type": "boolean" },
+                "max-associations": { "type": "integer", "minimum": 1 },
+                "max-associations-per-ae": { "type": "integer", "minimum": 1 },
+                "reserved-associations": { "type": "integer", "minimum": 0 },
+                "max-bytes-per-second": { "type": "number", "exclusiveMinimum": 0 },
+                "max-bytes-per-second-per-ae": { "type": "number", "exclusiveMinimum": 0 },
+                "calling-aes": { "type": "object", "additionalProperties": quota }
+            }
+        }
+
 class SCPConfiguration(AbstractConfiguration):
+
+    TYPE_DICOM = "dicom"
+    TYPE_FOLDER = "folder"
+
     def __init__(self, json_data: json) -> None:
         self._validate_json(json_data)
         self._id = json_data['id']
         self._name = json_data['name']
-        self._ae_title = json_data['ae-title']
-        self._address = json_data['address']
-        self._port = json_data['port']
+        self._type = json_data.get('type', SCPConfiguration.TYPE_DICOM)
+        self._ae_title = json_data.get('ae-title')
+        self._address = json_data.get('address')
+        self._port = json_data.get('port')
+        self._watch_dir_path = json_data.get('watch-dir-path')
+        self._processed_dir_path = json_data.get('processed-dir-path')
+        self._threads = json_data.get('threads', 4)
+        self._max_pending = json_data.get('max-pending', 1000)
+        self._poll_interval = json_data.get('poll-interval', 5)
+        self._admission = AdmissionConfiguration(json_data.get('admission', {}))
 
     @property
     def id(self):
@@ -247,6 +1567,14 @@ class SCPConfiguration(AbstractConfiguration):
         '''
         return self._name
 
+    @property
+    def type(self) -> str:
+        '''
+        Get the type of this SCP: a DICOM SCP receiving over the network,
+        or a folder instances are dropped into
+        '''
+        return self._type
+
     @property
     def ae_title(self):
         '''
@@ -268,6 +1596,51 @@ class SCPConfiguration(AbstractConfiguration):
         '''
         return self._port
 
+    @property
+    def watch_dir_path(self) -> str:
+        '''
+        Dir watched for DICOM files (if type is folder)
+        '''
+        return self._watch_dir_path
+
+    @property
+    def processed_dir_path(self) -> str:
+        '''
+        Dir files are moved to once routed (if type is folder). Routed
+        files are deleted if not set
+        '''
+        return self._processed_dir_path
+
+    @property
+    def threads(self) -> int:
+        '''
+        Number of files read in parallel (if type is folder)
+        '''
+        return self._threads
+
+    @property
+    def max_pending(self) -> int:
+        '''
+        Number of routables waiting in router queues above which reading
+        files pauses (if type is folder)
+        '''
+        return self._max_pending
+
+    @property
+    def poll_interval(self) -> float:
+        '''
+        Seconds between scans of the watched dir where inotify is not
+        available (if type is folder)
+        '''
+        return self._poll_interval
+
+    @property
+    def admission(self) -> AdmissionConfiguration:
+        '''
+        Association admission control (if type is dicom)
+        '''
+        return self._admission
+
     def schema(self):
         return {
             "type": "object",
@@ -275,27 +1648,98 @@ class SCPConfiguration(AbstractConfiguration):
             "properties": {
                 "id": { "type": "string" },
                 "name": { "type": "string" },
+                "type": { "enum": [SCPConfiguration.TYPE_DICOM, SCPConfiguration.TYPE_FOLDER] },
                 "ae-title": { "type": "string" },
                 "address": { "type": "string" },
-                "port": { "type": "number", "minimum": 1 }
+                "port": { "type": "number", "minimum": 1 },
+                "watch-dir-path": { "type": "string" },
+                "processed-dir-path": { "type": "string" },
+                "threads": { "type": "integer", "minimum": 1 },
+                "max-pending": { "type": "integer", "minimum": 1 },
+                "poll-interval": { "type": "number", "exclusiveMinimum": 0 },
+                "admission": { "type": "object" }
             },
-            "required": ["id", "name", "ae-title", "address", "port"]
+            "required": ["id", "name"],
+            "if": { "properties": { "type": { "const": SCPConfiguration.TYPE_FOLDER } }, "required": ["type"] },
+            "then": { "required": ["watch-dir-path"] },
+            "else": { "required": ["ae-title", "address", "port"] }
+        }
+
+class ConcurrencyConfiguration(AbstractConfiguration):
+    '''
+    Configuration of the number of associations a worker sends over at
+    once, adapted between a floor and a ceiling to how the peer copes
+    '''
+    def __init__(self, json_data: json) -> None:
+        self._validate_json(json_data)
+        self._min_associations = json_data.get('min-associations', 1)
+        self._max_associations = json_data.get('max-associations', 1)
+        self._latency_tolerance = json_data.get('latency-tolerance', 2.0)
+        if self._min_associations > self._max_associations:
+            raise ConfigurationError(
+                f'min-associations {self._min_associations} exceeds max-associations {self._max_associations}')
+
+    @property
+    def min_associations(self) -> int:
+        '''
+        Number of associations sent over at once when the peer is
+        failing or overloaded
+        '''
+        return self._min_associations
+
+    @property
+    def max_associations(self) -> int:
+        '''
+        Maximum number of associations sent over at once. The default
+        of 1 sends over a single association, without adapting
+        '''
+        return self._max_associations
+
+    @property
+    def latency_tolerance(self) -> float:
+        '''
+        Factor by which the peer may respond slower than at its fastest,
+        for instances of a similar size, before fewer associations are
+        sent over
+        '''
+        return self._latency_tolerance
+
+    def schema(self):
+        return {
+            "type": "object",
+            "title": "Concurrency",
+            "properties": {
+                "min-associations": { "type": "integer", "minimum": 1 },
+                "max-associations": { "type": "integer", "minimum": 1 },
+                "latency-tolerance": { "type": "number", "exclusiveMinimum": 1 }
+            }
         }
 
 class WorkerConfiguration(AbstractConfiguration):
 
     TYPE_SCU = "scu"
     TYPE_LOCAL_STORAGE = "local-storage"
+    TYPE_STOW_RS = "stow-rs"
 
     def __init__(self, json_data: json) -> None:
         self._validate_json(json_data)
         self._id = json_data['id']
         self._name = json_data['name']
-        self._ae_title = json_data['ae-title']
-        self._address = json_data['address']
-        self._port = json_data['port']
+        self._ae_title = json_data.get('ae-title')
+        self._address = json_data.get('address')
+        self._port = json_data.get('port')
         self._type = json_data['type']
-        self._output_dir_path = json_data['output-dir-path']
+        self._output_dir_path = json_data.get('output-dir-path')
+        self._url = json_data.get('url')
+        self._headers = json_data.get('headers', {})
+        self._max_batch_count = json_data.get('max-batch-count', 50)
+        self._max_batch_bytes = json_data.get('max-batch-bytes', 32 * 1024 * 1024)
+        self._max_in_flight = json_data.get('max-in-flight', 4)
+        self._gzip = json_data.get('gzip', False)
+        self._timeout = json_data.get('timeout', 60)
+        self._shaping = ShapingConfiguration(json_data.get('shaping', {}))
+        self._shaping_group = json_data.get('shaping-group')
+        self._concurrency = ConcurrencyConfiguration(json_data.get('concurrency', {}))
 
     @property
     def id(self):
@@ -346,6 +1790,81 @@ class WorkerConfiguration(AbstractConfiguration):
         '''
         return self._type
 
+    @property
+    def url(self) -> str:
+        '''
+        Get the STOW-RS URL instances are stored to, typically ending in
+        /studies (if type is stow-rs)
+        '''
+        return self._url
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        '''
+        Get extra HTTP headers sent with each request, such as
+        Authorization (if type is stow-rs)
+        '''
+        return self._headers
+
+    @property
+    def max_batch_count(self) -> int:
+        '''
+        Maximum number of instances per request (if type is stow-rs)
+        '''
+        return self._max_batch_count
+
+    @property
+    def max_batch_bytes(self) -> int:
+        '''
+        Size in bytes of instances above which a request is not added to,
+        a single larger instance is still sent alone (if type is stow-rs)
+        '''
+        return self._max_batch_bytes
+
+    @property
+    def max_in_flight(self) -> int:
+        '''
+        Maximum number of concurrent requests, each over its own
+        keep-alive connection (if type is stow-rs)
+        '''
+        return self._max_in_flight
+
+    @property
+    def gzip(self) -> bool:
+        '''
+        Whether request bodies are gzip compressed (if type is stow-rs)
+        '''
+        return self._gzip
+
+    @property
+    def timeout(self) -> float:
+        '''
+        Seconds to wait for the peer on a request (if type is stow-rs)
+        '''
+        return self._timeout
+
+    @property
+    def shaping(self) -> ShapingConfiguration:
+        '''
+        Rates this worker sends at
+        '''
+        return self._shaping
+
+    @property
+    def shaping_group(self) -> Optional[str]:
+        '''
+        Id of the shaping group of the destination this worker shares
+        with other workers, such as workers sending to the same host
+        '''
+        return self._shaping_group
+
+    @property
+    def concurrency(self) -> ConcurrencyConfiguration:
+        '''
+        Number of associations sent over at once (if type is scu)
+        '''
+        return self._concurrency
+
     def schema(self):
         return {
             "type": "object",
@@ -353,21 +1872,57 @@ class WorkerConfiguration(AbstractConfiguration):
             "properties": {
                 "type": { 
                     "type": "string", 
-                    "enum": [WorkerConfiguration.TYPE_LOCAL_STORAGE, WorkerConfiguration.TYPE_SCU] 
+                    "enum": [
+                        WorkerConfiguration.TYPE_LOCAL_STORAGE,
+                        WorkerConfiguration.TYPE_SCU,
+                        WorkerConfiguration.TYPE_STOW_RS]
                 },
                 "id": { "type": "string" },
                 "name": { "type": "string" },
                 "ae-title": { "type": "string" },
                 "address": { "type": "string" },
                 "port": { "type": "number" },
-                "output-dir-path": { "type": "string" }
+                "output-dir-path": { "type": "string" },
+                "url": { "type": "string", "pattern": "^https?://" },
+                "headers": { "type": "object", "additionalProperties": { "type": "string" } },
+                "max-batch-count": { "type": "integer", "minimum": 1 },
+                "max-batch-bytes": { "type": "integer", "minimum": 1 },
+                "max-in-flight": { "type": "integer", "minimum": 1 },
+                "gzip": { "type": "boolean" },
+                "timeout": { "type": "number", "exclusiveMinimum": 0 },
+                "shaping": { "type": "object" },
+                "shaping-group": { "type": "string" },
+                "concurrency": { "type": "object" }
             },
-            "required": ["type", "id", "name", "ae-title", "address", "port", "output-dir-path"]
+            "required": ["type", "id", "name"],
+            "if": { "properties": { "type": { "const": WorkerConfiguration.TYPE_STOW_RS } } },
+            "then": { "required": ["url"] },
+            "else": { "required": ["ae-title", "address", "port", "output-dir-path"] }
         }
 
 class ConfigurationError(BaseException):
     pass
 
+# File systems the shared memory and locks of SQLite in WAL mode do not work on
+NETWORK_FILESYSTEM_TYPES = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs', 'glusterfs', 'ceph', 'fuse.ceph', '9p'}
+
+def network_filesystem_type(path: str) -> Optional[str]:
+    '''
+    Get the type of the network file system path is on, None if it is
+    on a local file system or mounts are unknown
+    '''
+    try:
+        with open('/proc/mounts') as mounts:
+            entries = [line.split()[1:3] for line in mounts.read().splitlines()]
+    except OSError:
+        return None
+    path = os.path.realpath(os.path.abspath(path))
+    _, filesystem_type = max(
+        ((m, t) for m, t in entries if path == m or path.startswith(m.rstrip('/') + '/')),
+        key=lambda entry: len(entry[0]),
+        default=('/', None))
+    return filesystem_type if filesystem_type in NETWORK_FILESYSTEM_TYPES else None
+
 class Configuration:
     '''
     Entry point class for loading full configuration files
@@ -430,6 +1985,82 @@ class Configuration:
                 wc = WorkerConfiguration(worker)
                 self._workers.append(wc)
 
+    def validate_topology(self) -> None:
+        '''
+        Validate references between configuration sections in a single
+        pass: duplicate ids, duplicate SCP ports and worker sets referring
+        to unknown workers or SCPs. Raises ConfigurationError listing
+        all problems found.
+        '''
+        problems: List[str] = []
+        if self._core is None:
+            problems.append('No core configuration')
+
+        worker_ids = set()
+        for worker in self._workers:
+            if worker.id in worker_ids:
+                problems.append(f'Duplicate worker id {worker.id}')
+            worker_ids.add(worker.id)
+
+        scp_ids = set()
+        scp_ports: Dict[Tuple[str, int], str] = {}
+        for scp in self._scps:
+            if scp.id in scp_ids:
+                problems.append(f'Duplicate SCP id {scp.id}')
+            scp_ids.add(scp.id)
+            if scp.type != SCPConfiguration.TYPE_DICOM:
+                continue
+            endpoint = (scp.address, scp.port)
+            if endpoint in scp_ports:
+                problems.append(f'SCP {scp.id} uses port {scp.port} already used by SCP {scp_ports[endpoint]}')
+            scp_ports[endpoint] = scp.id
+
+        worker_set_ids = set()
+        for worker_set in self._worker_sets:
+            if worker_set.id in worker_set_ids:
+                problems.append(f'Duplicate worker set id {worker_set.id}')
+            worker_set_ids.add(worker_set.id)
+            unknown_worker_ids = [i for i in worker_set.worker_ids if i not in worker_ids]
+            if unknown_worker_ids:
+                problems.append(f'Worker set {worker_set.id} refers to unknown workers {", ".join(unknown_worker_ids)}')
+            unknown_scp_ids = [i for i in worker_set.accepted_scp_ids if i not in scp_ids]
+            if unknown_scp_ids:
+                problems.append(f'Worker set {worker_set.id} refers to unknown SCPs {", ".join(unknown_scp_ids)}')
+
+        all_worker_set_ids = {worker_set.id for worker_set in self._worker_sets}
+        for worker_set in self._worker_sets:
+            if worker_set.overflow is None:
+                continue
+            overflow_id = worker_set.overflow.worker_set_id
+            if overflow_id == worker_set.id or overflow_id not in all_worker_set_ids:
+                problems.append(f'Worker set {worker_set.id} overflows to unknown or same worker set {overflow_id}')
+
+        if self._core is not None and self._core.cluster.enabled:
+            cluster = self._core.cluster
+            uses_database = cluster.backend == ClusterConfiguration.BACKEND_SQLITE or cluster.serve
+            if cluster.backend == ClusterConfiguration.BACKEND_HTTP and not cluster.serve and cluster.url is None:
+                problems.append('Cluster backend http needs the url of the state service')
+            filesystem_type = network_filesystem_type(cluster.path) if uses_database else None
+            if filesystem_type is not None:
+                problems.append(
+                    f'Cluster database {cluster.path} is on a {filesystem_type} network file system, '
+                    'use the http backend to share state between hosts')
+
+        if self._core is not None:
+            for worker in self._workers:
+                if worker.shaping_group is not None and worker.shaping_group not in self._core.shaping_groups:
+                    problems.append(f'Worker {worker.id} refers to unknown shaping group {worker.shaping_group}')
+
+        if self._core is not None:
+            priority_class_names = set()
+            for priority_class in self._core.priority_classes:
+                if priority_class.name in priority_class_names:
+                    problems.append(f'Duplicate priority class {priority_class.name}')
+                priority_class_names.add(priority_class.name)
+
+        if problems:
+            raise ConfigurationError('; '.join(problems))
+
     def workers(self) -> List[WorkerConfiguration]:
         '''
         Get the list of workers defined in this configuration
@@ -447,6 +2078,20 @@ class Configuration:
         '''
         return self._core
 
+    def routing_tags(self) -> List[Tuple[int, int]]:
+        '''
+        Get the tags routing depends on: those partitioning routers and
+        those in header requirements of worker sets and priority classes
+        '''
+        tags = {(0x0010, 0x0020), (0x0020, 0x000D)}
+        for worker_set in self._worker_sets:
+            tags.update(h.tag for h in worker_set.header_requirements)
+            tags.update(tag for key in worker_set.affinity_keys for tag in key)
+        for priority_class in self._core.priority_classes:
+            for rule in priority_class.rules:
+                tags.update(h.tag for h in rule.header_requirements)
+        return sorted(tags)
+
     def worker_sets(self) -> List[WorkerSetConfiguration]:
         '''
         Get worker set configurations for all worker sets
@@ -0,0 +1,160 @@
+'''
+Control module.
+
+Controls a running relay without restarting it. Commands are sent as a
+line of JSON through a local socket, and answered with a line of JSON:
+
+- status: state, queue depth and settings of every worker, and queue
+  depth of every router
+- pause, resume: stop sending from a worker after its current batch,
+  holding on to everything queued, such as for peer maintenance
+- drain: route new patients of a worker to the other workers of its
+  worker sets, while it keeps sending what it holds
+- retune: change batch and concurrency settings of a worker
+- add-routers: start more router threads
+
+Changes take effect from the next batch of the worker. Controlling a
+running relay:
+
+    python src/control.py --config-file-path config.json status
+    python src/control.py --config-file-path config.json pause|resume|drain WORKER_ID
+    python src/control.py --config-file-path config.json retune WORKER_ID max-in-flight=8 [...]
+    python src/control.py --config-file-path config.json add-routers [COUNT]
+'''
+import argparse
+import json
+import logging
+import socket
+import sys
+import threading
+from typing import Any, Dict
+
+import configuration
+import localsocket
+
+WORKER_COMMANDS = ['pause', 'resume', 'drain', 'retune']
+COMMANDS = ['status', 'add-routers'] + WORKER_COMMANDS
+
+class ControlServer(threading.Thread):
+    '''
+    Serves control commands for a load balancer on a local socket
+    '''
+    def __init__(self, config: configuration.ControlConfiguration, load_balancer) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self._socket_path = config.socket_path
+        self._load_balancer = load_balancer
+        # One command at a time, so commands apply in the order sent
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        '''
+        Run a command, returning its result, or the error if it failed
+        '''
+        try:
+            with self._lock:
+                return {'ok': True, 'result': self._run(request)}
+        except (KeyError, ValueError, TypeError) as exception:
+            return {'ok': False, 'error': str(exception).strip('\'"')}
+
+    def _run(self, request: Dict[str, Any]) -> Any:
+        command = request.get('command')
+        if command == 'status':
+            return self._load_balancer.status()
+        if command == 'add-routers':
+            return self._load_balancer.add_routers(request.get('count', 1))
+        if command not in WORKER_COMMANDS:
+            raise ValueError(f'Unknown control command {command}')
+        w = self._load_balancer.worker(request.get('worker-id'))
+        self._logger.info(f'Control command {command} for worker {w.id}')
+        if command == 'pause':
+            w.pause()
+        elif command == 'resume':
+            w.resume()
+        elif command == 'drain':
+            w.drain()
+        else:
+            w.retune(request.get('settings', {}))
+        return w.status()
+
+    def _serve(self, connection: socket.socket) -> None:
+        with connection, connection.makefile('rw') as f:
+            try:
+                request = json.loads(f.readline())
+                if not isinstance(request, dict):
+                    raise ValueError('Control request must be an object')
+            except ValueError as exception:
+                response = {'ok': False, 'error': f'Invalid control request: {exception}'}
+            else:
+                response = self.handle(request)
+            f.write(json.dumps(response) + '\n')
+
+    def run(self):
+        localsocket.serve(self._socket_path, self._serve, 'control commands', self._logger)
+
+def request(socket_path: str, command: str, timeout: float = None, **arguments) -> Dict[str, Any]:
+    '''
+    Send a control command to a running relay, returning its response
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+        with connection.makefile('rw') as f:
+            arguments['command'] = command
+            f.write(json.dumps(arguments) + '\n')
+            f.flush()
+            return json.loads(f.readline())
+
+def parse_setting(setting: str) -> Dict[str, int]:
+    name, separator, value = setting.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(f'Setting {setting} is not of the form name=value')
+    try:
+        return {name: int(value)}
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Setting {name} must be an integer')
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Control a running relay')
+    parser.add_argument(
+        '--config-file-path',
+        required=True,
+        type=str,
+        help='Path to configuration file or dir of the relay')
+    commands = parser.add_subparsers(dest='command')
+    # Not a keyword argument before Python 3.7
+    commands.required = True
+    commands.add_parser('status', help='Show workers and routers')
+    for command, description in [
+        ('pause', 'Stop sending from a worker, holding on to what is queued'),
+        ('resume', 'Resume a paused or drained worker'),
+        ('drain', 'Route new patients of a worker to other workers')]:
+        commands.add_parser(command, help=description).add_argument('worker_id')
+    retune = commands.add_parser('retune', help='Change settings of a worker')
+    retune.add_argument('worker_id')
+    retune.add_argument('settings', nargs='+', type=parse_setting, help='Settings as name=value')
+    add_routers = commands.add_parser('add-routers', help='Start more router threads')
+    add_routers.add_argument('count', nargs='?', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s')
+
+    arguments = {}
+    if args.command in WORKER_COMMANDS:
+        arguments['worker-id'] = args.worker_id
+    if args.command == 'retune':
+        arguments['settings'] = {name: value for setting in args.settings for name, value in setting.items()}
+    if args.command == 'add-routers':
+        arguments['count'] = args.count
+    config = configuration.Configuration(args.config_file_path)
+    response = request(config.core().control.socket_path, args.command, **arguments)
+    if not response['ok']:
+        print(f'error: {response["error"]}')
+        return 1
+    print(json.dumps(response['result'], indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
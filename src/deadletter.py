@@ -0,0 +1,266 @@
+'''
+Dead letter queue module.
+
+Instances which cannot be relayed are written to a dead letter
+directory, one sub directory per worker. Each instance is stored as
+a DICOM file accompanied by a JSON file describing why it failed.
+
+Running this module replays dead lettered instances in bulk:
+
+    python src/deadletter.py --config-file-path config.json [--worker-id ID]
+'''
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import sys
+import uuid
+from typing import Dict, Iterator, List, Optional
+
+import pydicom
+from pynetdicom import AE
+
+import configuration
+import dicomfile
+import routable
+import retry
+import storescu
+import stowrs
+
+class DeadLetter:
+    '''
+    A single instance stored in the dead letter queue
+    '''
+    def __init__(self, dicom_file_path: str, metadata: Dict) -> None:
+        self._dicom_file_path = dicom_file_path
+        self._metadata = metadata
+
+    @property
+    def dicom_file_path(self) -> str:
+        return self._dicom_file_path
+
+    @property
+    def metadata_file_path(self) -> str:
+        return os.path.splitext(self._dicom_file_path)[0] + '.json'
+
+    @property
+    def worker_id(self) -> str:
+        return self._metadata.get('worker-id')
+
+    @property
+    def scp_id(self) -> str:
+        return self._metadata.get('scp-id')
+
+    @property
+    def reason(self) -> str:
+        return self._metadata.get('reason')
+
+    def read_dataset(self) -> pydicom.Dataset:
+        '''
+        Read the dead lettered instance from disk
+        '''
+        return pydicom.dcmread(self._dicom_file_path, force=True)
+
+    def read_routable(self) -> routable.Routable:
+        '''
+        Read the dead lettered instance from disk without decoding it
+        '''
+        return dicomfile.read(self._dicom_file_path, self.scp_id)
+
+class DeadLetterQueue:
+    '''
+    On-disk queue of instances which could not be relayed
+    '''
+    def __init__(self, dir_path: str) -> None:
+        self._dir_path = dir_path
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def dir_path(self) -> str:
+        return self._dir_path
+
+    def put(self, worker_id: str, r: routable.Routable, reason: str, attempts: int = 0) -> str:
+        '''
+        Store routable in the dead letter queue of the given worker.
+        Returns the path of the stored DICOM file
+        '''
+        worker_dir_path = os.path.join(self._dir_path, worker_id)
+        os.makedirs(worker_dir_path, exist_ok=True)
+        try:
+            instance_uid = r.sop_instance_uid
+        except (AttributeError, ValueError):
+            instance_uid = str(uuid.uuid4())
+        base_path = os.path.join(worker_dir_path, instance_uid)
+        metadata = {
+            'worker-id': worker_id,
+            'scp-id': r.scp_id,
+            'sop-instance-uid': instance_uid,
+            'reason': reason,
+            'attempts': attempts,
+            'time': datetime.datetime.now().isoformat()
+        }
+        # Write to temporary files and rename, so a crash never leaves
+        # a half written entry behind
+        dicomfile.write(base_path + '.dcm', r)
+        with open(base_path + '.json.tmp', 'w') as f:
+            json.dump(metadata, f)
+        os.replace(base_path + '.json.tmp', base_path + '.json')
+        self._logger.warning('Dead lettered instance %s for worker %s: %s', instance_uid, worker_id, reason)
+        return base_path + '.dcm'
+
+    def worker_ids(self) -> List[str]:
+        '''
+        Get the ids of all workers having dead lettered instances
+        '''
+        if not os.path.isdir(self._dir_path):
+            return []
+        return sorted(
+            entry.name for entry in os.scandir(self._dir_path) if entry.is_dir())
+
+    def entries(self, worker_id: str) -> Iterator[DeadLetter]:
+        '''
+        Iterate over dead lettered instances of a worker
+        '''
+        worker_dir_path = os.path.join(self._dir_path, worker_id)
+        if not os.path.isdir(worker_dir_path):
+            return
+        for entry in os.scandir(worker_dir_path):
+            if not entry.name.endswith('.json'):
+                continue
+            dicom_file_path = entry.path[:-len('.json')] + '.dcm'
+            if not os.path.isfile(dicom_file_path):
+                continue
+            with open(entry.path) as f:
+                metadata = json.load(f)
+            yield DeadLetter(dicom_file_path, metadata)
+
+    def remove(self, dead_letter: DeadLetter) -> None:
+        '''
+        Remove an entry from the dead letter queue
+        '''
+        for path in (dead_letter.metadata_file_path, dead_letter.dicom_file_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+def _replay_stow_rs(
+    dead_letters: DeadLetterQueue,
+    worker_config: configuration.WorkerConfiguration,
+    routables: List,
+    keep: bool) -> int:
+    # Send in batches of the configured size, one request at a time
+    logger = logging.getLogger(__name__)
+    client = stowrs.StowClient(worker_config.url, worker_config.timeout, worker_config.gzip, worker_config.headers)
+    sent = 0
+    try:
+        for start in range(0, len(routables), worker_config.max_batch_count):
+            batch = routables[start:start + worker_config.max_batch_count]
+            try:
+                status, body = client.store([r for _, r in batch])
+            except (OSError, http.client.HTTPException) as exception:
+                logger.error(f'Failed to send to {worker_config.url}: {str(exception)}')
+                break
+            outcomes = stowrs.classify_response(status, body, [r.sop_instance_uid for _, r in batch])
+            for (entry, _), (failure, reason) in zip(batch, outcomes):
+                if failure is not None:
+                    logger.warning(f'Failed to replay {entry.dicom_file_path}: {reason}')
+                    continue
+                sent += 1
+                if not keep:
+                    dead_letters.remove(entry)
+    finally:
+        client.close()
+    return sent
+
+def replay(
+    dead_letters: DeadLetterQueue,
+    worker_config: configuration.WorkerConfiguration,
+    keep: bool = False) -> Dict[str, int]:
+    '''
+    Send all dead lettered instances of a SCU worker to its peer
+    over a single association, or of a STOW-RS worker in batched
+    requests. Successfully sent instances are removed from the queue
+    unless keep is set.
+    '''
+    logger = logging.getLogger(__name__)
+    counts = {'sent': 0, 'failed': 0}
+    entries = list(dead_letters.entries(worker_config.id))
+    if not entries:
+        return counts
+
+    routables = [(entry, entry.read_routable()) for entry in entries]
+    if worker_config.type == configuration.WorkerConfiguration.TYPE_STOW_RS:
+        counts['sent'] = _replay_stow_rs(dead_letters, worker_config, routables, keep)
+        counts['failed'] = len(entries) - counts['sent']
+        return counts
+    ae = AE()
+    for sop_class_uid in set(r.sop_class_uid for _, r in routables):
+        ae.add_requested_context(sop_class_uid)
+    assoc = ae.associate(worker_config.address, worker_config.port)
+    if not assoc.is_established:
+        logger.error(f'Failed to establish association with {worker_config.address}:{worker_config.port}')
+        counts['failed'] = len(entries)
+        return counts
+
+    try:
+        for entry, r in routables:
+            status: Optional[pydicom.Dataset] = None
+            try:
+                status = storescu.send_c_store(assoc, r)
+            except (AttributeError, ValueError, RuntimeError) as exception:
+                logger.warning(f'Failed to replay {entry.dicom_file_path}: {str(exception)}')
+            if status is not None and retry.classify_status(status) is None:
+                counts['sent'] += 1
+                if not keep:
+                    dead_letters.remove(entry)
+            if not assoc.is_established:
+                break
+    finally:
+        if assoc.is_established:
+            assoc.release()
+    counts['failed'] = len(entries) - counts['sent']
+    return counts
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Replay dead lettered DICOM instances')
+    parser.add_argument(
+        '--config-file-path',
+        required=True,
+        type=str,
+        help='Path to configuration file or dir')
+    parser.add_argument(
+        '--worker-id',
+        action='append',
+        type=str,
+        help='Only replay instances for this worker (may be repeated)')
+    parser.add_argument(
+        '--keep',
+        action='store_true',
+        help='Keep instances in the dead letter queue after replay')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s')
+
+    config = configuration.Configuration(args.config_file_path)
+    dead_letters = DeadLetterQueue(config.core().dead_letter_dir_path)
+    worker_configs = {w.id: w for w in config.workers()}
+    worker_ids = args.worker_id or dead_letters.worker_ids()
+
+    exit_code = 0
+    for worker_id in worker_ids:
+        worker_config = worker_configs.get(worker_id)
+        if worker_config is None or worker_config.type == configuration.WorkerConfiguration.TYPE_LOCAL_STORAGE:
+            logging.error(f'Cannot replay dead letters for unknown or local storage worker {worker_id}')
+            exit_code = 1
+            continue
+        counts = replay(dead_letters, worker_config, args.keep)
+        logging.info(f'Replayed dead letters for {worker_id}: {counts["sent"]} sent, {counts["failed"]} failed')
+        if counts['failed']:
+            exit_code = 1
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+'''
+Instance deduplication module
+'''
+import collections
+import hashlib
+import threading
+import time
+
+import buffers
+import metrics
+
+def instance_key(sop_instance_uid: str, encoded_dataset: buffers.Buffer) -> bytes:
+    '''
+    Compute the deduplication key of an instance from its SOP instance
+    UID and a digest of its encoded content. Instances re-sent with
+    modified content are therefore not considered duplicates.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(sop_instance_uid).encode('ascii', 'replace'))
+    digest.update(b'\0')
+    for segment in buffers.segments(encoded_dataset):
+        digest.update(segment)
+    return digest.digest()
+
+class DeduplicationIndex:
+    '''
+    Bounded in-memory index of recently received instances.
+
+    Entries expire after window_seconds without being seen, and the
+    least recently seen entries are evicted once max_entries is reached.
+    Keys are 16 byte digests, so a million entries cost in the order
+    of 100 MB.
+    '''
+    def __init__(self, window_seconds: float, max_entries: int) -> None:
+        self._window_seconds = window_seconds
+        self._max_entries = max_entries
+        self._entries: 'collections.OrderedDict[bytes, float]' = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = metrics.counter('dedup.hits')
+        self._misses = metrics.counter('dedup.misses')
+        self._size = metrics.gauge('dedup.entries')
+
+    def seen(self, key: bytes) -> bool:
+        '''
+        Record key as seen. Returns True if key was already
+        seen within the deduplication window.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            duplicate = key in self._entries
+            self._entries[key] = now
+            self._entries.move_to_end(key)
+            if len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            self._size.set(len(self._entries))
+        if duplicate:
+            self._hits.increment()
+        else:
+            self._misses.increment()
+        return duplicate
+
+    def forget(self, key: bytes) -> None:
+        '''
+        Remove key, so an instance which was not relayed in the end is
+        relayed when re-sent within the window
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
+            self._size.set(len(self._entries))
+
+    def _expire(self, now: float) -> None:
+        threshold = now - self._window_seconds
+        while self._entries:
+            key, last_seen = next(iter(self._entries.items()))
+            if last_seen >= threshold:
+                break
+            del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,284 @@
+'''
+Diagnostics module.
+
+Diagnoses a running relay without restarting it. Diagnostics are
+requested through a local socket, or all of them at once with SIGUSR1,
+and written to the diagnostics dir:
+
+- stacks: the stack of every thread
+- queues: number of routables and bytes held per router and worker queue
+- profile: a sampling profile of all threads over a number of seconds,
+  with the busiest functions and collapsed stacks for flame graphs
+- memory: the top allocations still held after tracing memory for a
+  number of seconds, per line and per component (module)
+
+Nothing is traced or sampled until requested, and the socket is served
+by a single thread blocked on accept, so diagnostics cost nothing while
+inactive. Requesting diagnostics of a running relay:
+
+    python src/diagnostics.py --config-file-path config.json [stacks|queues|profile|memory|all] [--seconds 10]
+'''
+import argparse
+import collections
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+from typing import Dict, List, Tuple
+
+import configuration
+import localsocket
+
+COMMANDS = ['stacks', 'queues', 'profile', 'memory']
+# Seconds between samples of a profile
+SAMPLE_INTERVAL = 0.005
+# Frames kept per traced allocation
+TRACE_FRAMES = 16
+
+_SOURCE_DIR_PATH = os.path.dirname(os.path.abspath(__file__))
+
+def _thread_names() -> Dict[int, str]:
+    return {t.ident: t.name for t in threading.enumerate()}
+
+def format_stacks() -> str:
+    '''
+    Format the current stack of every thread
+    '''
+    names = _thread_names()
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append(f'Thread {names.get(ident, ident)} ({ident})')
+        lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+        lines.append('')
+    return '\n'.join(lines)
+
+def format_footprints(components: Dict[str, object]) -> str:
+    '''
+    Format the number of routables and bytes held per queue of
+    components providing footprints()
+    '''
+    lines = [f'{"queue":<40} {"routables":>10} {"bytes":>14}']
+    total_count = 0
+    total_size = 0
+    for name, component in sorted(components.items()):
+        for queue_name, (count, size) in sorted(component.footprints().items()):
+            lines.append(f'{name + "." + queue_name:<40} {count:>10} {size:>14}')
+            total_count += count
+            total_size += size
+    lines.append(f'{"total":<40} {total_count:>10} {total_size:>14}')
+    return '\n'.join(lines)
+
+def _frame_name(frame) -> str:
+    return f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})'
+
+def sample_profile(seconds: float, top: int = 25, interval: float = SAMPLE_INTERVAL) -> Tuple[str, str]:
+    '''
+    Sample the stacks of all other threads for seconds, returning a
+    report of the functions seen most, and the samples as collapsed
+    stacks, one per line with its count, as taken by flamegraph.pl
+    '''
+    own = threading.get_ident()
+    stacks: Dict[str, int] = collections.Counter()
+    leaves: Dict[str, int] = collections.Counter()
+    inclusive: Dict[str, int] = collections.Counter()
+    samples = 0
+    names = _thread_names()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            if ident not in names:
+                names = _thread_names()
+            functions = []
+            while frame is not None:
+                functions.append(_frame_name(frame))
+                frame = frame.f_back
+            leaves[functions[0]] += 1
+            for function in set(functions):
+                inclusive[function] += 1
+            functions.append(names.get(ident, str(ident)))
+            stacks[';'.join(reversed(functions))] += 1
+        samples += 1
+        time.sleep(interval)
+    lines = [f'{samples} samples of all threads over {seconds:.1f}s', '', 'Self (leaf) samples:']
+    lines.extend(f'{count:>8} {function}' for function, count in leaves.most_common(top))
+    lines.extend(['', 'Inclusive samples:'])
+    lines.extend(f'{count:>8} {function}' for function, count in inclusive.most_common(top))
+    collapsed = '\n'.join(f'{stack} {count}' for stack, count in stacks.items())
+    return '\n'.join(lines), collapsed
+
+def _component(trace: tracemalloc.Traceback) -> str:
+    # Module of the most recent frame in relay code, or the library
+    # allocated from if there is none. Frames are ordered oldest first
+    # from Python 3.7, and most recent first before
+    frames = list(trace) if sys.version_info < (3, 7) else list(reversed(trace))
+    for frame in frames:
+        if os.path.dirname(os.path.abspath(frame.filename)) == _SOURCE_DIR_PATH:
+            return os.path.splitext(os.path.basename(frame.filename))[0]
+    return f'({os.path.basename(frames[0].filename)})' if frames else '(unknown)'
+
+def memory_snapshot(seconds: float, top: int = 25) -> str:
+    '''
+    Trace allocations for seconds, returning the top allocation sites
+    and components by size of what is still held. Tracing is left
+    alone if it was already started
+    '''
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start(TRACE_FRAMES)
+        time.sleep(seconds)
+    try:
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    components: Dict[str, List[int]] = collections.defaultdict(lambda: [0, 0])
+    for statistic in snapshot.statistics('traceback'):
+        counts = components[_component(statistic.traceback)]
+        counts[0] += statistic.count
+        counts[1] += statistic.size
+    lines = [f'Allocations made over {seconds:.1f}s and still held', '', 'Per component:']
+    for name, (count, size) in sorted(components.items(), key=lambda item: -item[1][1])[:top]:
+        lines.append(f'{size:>14} bytes {count:>10} blocks  {name}')
+    lines.extend(['', 'Per line:'])
+    for statistic in snapshot.statistics('lineno')[:top]:
+        frame = statistic.traceback[0]
+        lines.append(f'{statistic.size:>14} bytes {statistic.count:>10} blocks  {frame.filename}:{frame.lineno}')
+    return '\n'.join(lines)
+
+class Diagnostics(threading.Thread):
+    '''
+    Serves diagnostics requests on a local socket, writing results to
+    the diagnostics dir
+    '''
+    def __init__(self, config: configuration.DiagnosticsConfiguration, dir_path: str) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self._dir_path = dir_path
+        self._socket_path = config.socket_path
+        self._seconds = config.seconds
+        self._top = config.top
+        self._components: Dict[str, object] = {}
+        # Only one diagnosis at a time, as profiles and memory traces
+        # would skew each other
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    def register(self, name: str, component: object) -> None:
+        '''
+        Register a component whose queues are reported, which provides
+        footprints()
+        '''
+        self._components[name] = component
+
+    def _write(self, name: str, content: str) -> str:
+        os.makedirs(self._dir_path, exist_ok=True)
+        path = os.path.join(self._dir_path, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{name}')
+        with open(path + '.tmp', 'w') as f:
+            f.write(content + '\n')
+        os.replace(path + '.tmp', path)
+        return path
+
+    def diagnose(self, command: str, seconds: float = None) -> List[str]:
+        '''
+        Run a diagnostics command, or all, returning the paths written
+        '''
+        if command != 'all' and command not in COMMANDS:
+            raise ValueError(f'Unknown diagnostics command {command}')
+        seconds = seconds or self._seconds
+        paths = []
+        with self._lock:
+            if command in ('stacks', 'all'):
+                paths.append(self._write('stacks.txt', format_stacks()))
+            if command in ('queues', 'all'):
+                paths.append(self._write('queues.txt', format_footprints(self._components)))
+            if command in ('profile', 'all'):
+                report, collapsed = sample_profile(seconds, self._top)
+                paths.append(self._write('profile.txt', report))
+                paths.append(self._write('profile.folded', collapsed))
+            if command in ('memory', 'all'):
+                paths.append(self._write('memory.txt', memory_snapshot(seconds, self._top)))
+        self._logger.info(f'Wrote diagnostics to {", ".join(paths)}')
+        return paths
+
+    def _handle_signal(self, signum, frame) -> None:
+        # Signal handlers must return quickly, so diagnose in a thread
+        threading.Thread(target=self._diagnose_all, daemon=True, name='diagnostics-signal').start()
+
+    def _diagnose_all(self) -> None:
+        try:
+            self.diagnose('all')
+        except Exception as exception:
+            self._logger.error(f'Failed to write diagnostics: {exception}')
+
+    def install_signal_handler(self, signum: int = signal.SIGUSR1) -> None:
+        '''
+        Run all diagnostics when signum is received. Must be called
+        from the main thread
+        '''
+        signal.signal(signum, self._handle_signal)
+
+    def _serve(self, connection: socket.socket) -> None:
+        with connection, connection.makefile('rw') as f:
+            request = f.readline().split()
+            try:
+                command = request[0] if request else 'all'
+                seconds = float(request[1]) if len(request) > 1 else None
+                for path in self.diagnose(command, seconds):
+                    f.write(path + '\n')
+            except Exception as exception:
+                f.write(f'error: {exception}\n')
+
+    def run(self):
+        localsocket.serve(self._socket_path, self._serve, 'diagnostics', self._logger)
+
+def request(socket_path: str, command: str, seconds: float = None, timeout: float = None) -> List[str]:
+    '''
+    Request diagnostics from a running relay, returning the paths
+    written
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+        with connection.makefile('rw') as f:
+            f.write(f'{command} {seconds}\n' if seconds else f'{command}\n')
+            f.flush()
+            return [line.rstrip('\n') for line in f]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Request diagnostics from a running relay')
+    parser.add_argument(
+        '--config-file-path',
+        required=True,
+        type=str,
+        help='Path to configuration file or dir of the relay')
+    parser.add_argument(
+        'command',
+        nargs='?',
+        default='all',
+        choices=COMMANDS + ['all'],
+        help='Diagnostics to run (default all)')
+    parser.add_argument(
+        '--seconds',
+        type=float,
+        help='Duration of profiling and memory tracing (default configured)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s')
+
+    config = configuration.Configuration(args.config_file_path)
+    lines = request(config.core().diagnostics.socket_path, args.command, args.seconds)
+    for line in lines:
+        print(line)
+    return 1 if any(line.startswith('error:') for line in lines) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
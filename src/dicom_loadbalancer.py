@@ -1,12 +1,43 @@
-from distutils.command.config import config
 import configuration
 import worker
 import router
 import workerset
 import scp
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 import logging
 import hash_functions
+import retry
+import deadletter
+import dedup
+import livenesschecker
+import priority
+import ratelimit
+import rewrite
+import routable
+import snapshot
+import spool
+import cluster
+import affinity
+import folder
+import capture
+import overflow
+import catalog
+import control
+import diagnostics
+import os
+import threading
+import time
+
+def _create_buckets(
+    config: configuration.ShapingConfiguration) -> Tuple[Optional[ratelimit.TokenBucket], Optional[ratelimit.TokenBucket]]:
+    # Buckets of instances and of bytes, None where unlimited
+    instance_bucket = None
+    byte_bucket = None
+    if config.max_instances_per_second is not None:
+        instance_bucket = ratelimit.TokenBucket(config.max_instances_per_second, config.burst_instances)
+    if config.max_bytes_per_second is not None:
+        byte_bucket = ratelimit.TokenBucket(config.max_bytes_per_second, config.burst_bytes)
+    return instance_bucket, byte_bucket
 
 class DicomLoadBalancer:
     def __init__(self, config: configuration.Configuration) -> None:
@@ -15,43 +46,345 @@ class DicomLoadBalancer:
         self._routers: Dict[str, router.Router] =  {}
         self._worker_sets: Dict[str, workerset.WorkerSet] = {}
         self._scps: Dict[str, scp.Scp] = {}
+        self._liveness_scheduler: livenesschecker.LivenessScheduler = None
+        self._liveness_checkers: Dict[str, livenesschecker.LivenessChecker] = {}
+        self._cluster: cluster.Cluster = None
+        self._state_service: cluster.StateService = None
+        self._diagnostics: diagnostics.Diagnostics = None
+        self._catalog: catalog.CatalogWriter = None
+        self._recorder: capture.TraceRecorder = None
+        # Routers are started and added under lock, as they may be
+        # added through the control socket
+        self._routers_lock = threading.Lock()
+        self._dead_letters = deadletter.DeadLetterQueue(config.core().dead_letter_dir_path)
+        self._classifier = priority.PriorityClassifier(config.core().priority_classes)
         self._logger = logging.getLogger(__name__)
 
     def start(self):
-        self._create_workers()
+        self._config.validate_topology()
+        # Instances still queued on the last shutdown
+        restored = snapshot.load(self._config.core().snapshot_dir_path)
+        self._create_liveness_scheduler()
+        self._create_catalog()
+        self._create_workers(restored)
+        self._create_cluster()
         self._create_worker_sets()
         self._create_routers()
+        self._restore(restored)
+        # Liveness checks compete with thread start up for the GIL,
+        # so only begin checking once all workers are running
+        self._liveness_scheduler.start()
+        # Workers and routers are running at this point, so
+        # SCPs may start accepting
         self._create_scps()
+        self._create_diagnostics()
+        self._create_control()
+
+    def worker(self, worker_id: str) -> worker.Worker:
+        '''
+        Get a running worker, raising KeyError if there is none by id
+        '''
+        if worker_id not in self._workers:
+            raise KeyError(f'Unknown worker {worker_id}')
+        return self._workers[worker_id]
+
+    def status(self) -> Dict:
+        '''
+        Get the state of every worker and the queue depth of every router
+        '''
+        return {
+            'workers': {w.id: w.status() for w in self._workers.values()},
+            'routers': {r.id: {'queue-depth': r.queue_depth()} for r in list(self._routers.values())}
+        }
+
+    def add_routers(self, count: int) -> List[str]:
+        '''
+        Start count more routers, returning their ids. SCPs partition
+        patients over all routers, so patients may move to another
+        router, and instances already queued may be relayed out of
+        order with the next ones
+        '''
+        if not isinstance(count, int) or count < 1:
+            raise ValueError(f'Number of routers to add must be a positive integer, not {count!r}')
+        with self._routers_lock:
+            ids = [f'ROUTER{index}' for index in range(len(self._routers), len(self._routers) + count)]
+            for id in ids:
+                self._start_router(id)
+        self._logger.info(f'Added routers {", ".join(ids)}')
+        return ids
+
+    def shutdown(self, timeout: float = None) -> int:
+        '''
+        Stop accepting instances, let routers hand off what they queued,
+        stop workers after their current batch and snapshot what is still
+        queued, to be restored on the next start. Returns the number of
+        instances snapshotted
+        '''
+        timeout = self._config.core().shutdown_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        self._logger.info('Shutting down')
+        # Associations still receiving are aborted, so senders retry
+        # what was not acknowledged. Folder sources finish reading the
+        # files they took before moving them out of the watched dir
+        for s in self._scps.values():
+            s.stop()
+        for s in self._scps.values():
+            s.join(max(0, deadline - time.monotonic()))
+        routers = list(self._routers.values())
+        while any(r.queue_depth() for r in routers) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for r in routers:
+            r.stop()
+        for w in self._workers.values():
+            w.stop()
+        for component in routers + list(self._workers.values()):
+            component.join(max(0, deadline - time.monotonic()))
+        snapshots = {}
+        for r in routers:
+            snapshots[f'router.{r.id}'] = r.snapshot()
+        for w in self._workers.values():
+            if w.is_alive():
+                self._logger.warning(f'Worker {w.id} did not stop in time, instances it is sending may be sent again')
+            snapshots[f'worker.{w.id}'] = w.snapshot()
+        count = snapshot.save(self._config.core().snapshot_dir_path, snapshots)
+        # Write out what SCPs and workers recorded before they stopped
+        writers = [writer for writer in (self._recorder, self._catalog) if writer is not None]
+        for writer in writers:
+            writer.stop()
+        for writer in writers:
+            writer.join(max(1, deadline - time.monotonic()))
+        self._liveness_scheduler.shutdown()
+        if self._cluster is not None:
+            self._cluster.stop()
+        if self._state_service is not None:
+            self._state_service.stop()
+        self._logger.info(f'Shut down, snapshotted {count} queued instances')
+        return count
 
-    def _create_workers(self):
+    def _create_catalog(self):
+        catalog_config = self._config.core().catalog
+        if not catalog_config.enabled:
+            return
+        self._catalog = catalog.CatalogWriter(
+            catalog_config.path,
+            catalog_config.retention_days * 24 * 3600,
+            catalog_config.batch_size,
+            catalog_config.queue_size)
+        self._catalog.start()
+
+    def _create_liveness_scheduler(self):
+        liveness_config = self._config.core().liveness
+        self._liveness_scheduler = livenesschecker.LivenessScheduler(
+            liveness_config.max_concurrent_checks,
+            liveness_config.jitter)
+
+    def _create_liveness_checker(self, worker_config: configuration.WorkerConfiguration) -> livenesschecker.LivenessChecker:
+        liveness_config = self._config.core().liveness
+        if worker_config.type == configuration.WorkerConfiguration.TYPE_STOW_RS:
+            strategy = livenesschecker.HttpLivenessCheckerStrategy(
+                worker_config.url,
+                liveness_config.timeout,
+                worker_config.headers)
+        else:
+            strategy = livenesschecker.DicomEchoLivenessCheckerStrategy(
+                worker_config.address,
+                worker_config.port,
+                liveness_config.timeout)
+        checker = livenesschecker.LivenessChecker(
+            worker_config.id,
+            strategy,
+            worker_config,
+            liveness_config.check_interval,
+            liveness_config.failure_threshold,
+            liveness_config.open_interval)
+        self._liveness_scheduler.register(checker)
+        self._liveness_checkers[worker_config.id] = checker
+        return checker
+
+    def _create_workers(self, restored: Dict[str, List[Tuple[routable.Routable, int]]]):
         self._logger.info('Creating workers')
+        retry_config = self._config.core().retry
+        retry_policy = retry.RetryPolicy(
+            retry_config.max_attempts,
+            retry_config.initial_delay,
+            retry_config.max_delay)
+        # Workers of a group share its buckets
+        shaping_groups = {
+            group_id: _create_buckets(group_config)
+            for group_id, group_config in self._config.core().shaping_groups.items()}
         for worker_config in self._config.workers():
+            shaper = self._create_shaper(worker_config, shaping_groups)
             w = None
             if worker_config.type == configuration.WorkerConfiguration.TYPE_SCU:
-                w = worker.SCUWorker(worker_config)
+                w = worker.SCUWorker(
+                    worker_config,
+                    retry_policy,
+                    self._dead_letters,
+                    self._create_liveness_checker(worker_config),
+                    self._classifier.weights,
+                    shaper,
+                    self._catalog)
+            elif worker_config.type == configuration.WorkerConfiguration.TYPE_STOW_RS:
+                w = worker.StowRSWorker(
+                    worker_config,
+                    retry_policy,
+                    self._dead_letters,
+                    self._create_liveness_checker(worker_config),
+                    self._classifier.weights,
+                    shaper,
+                    self._catalog)
             elif worker_config.type == configuration.WorkerConfiguration.TYPE_LOCAL_STORAGE:
-                w = worker.LocalStorageWorker(worker_config)
+                w = worker.LocalStorageWorker(worker_config, self._classifier.weights, shaper, self._catalog)
             else:
-                self._logger.error('Failed to start worker with unknown type {}'.format(worker_config.type()))
+                self._logger.error('Failed to start worker with unknown type {}'.format(worker_config.type))
                 continue
+            # Restored before starting, so instances which were being
+            # retried keep their attempts
+            w.restore(restored.pop(f'worker.{w.id}', []))
             w.start()
             self._workers[w.id] = w
 
+    def _restore(self, restored: Dict[str, List[Tuple[routable.Routable, int]]]):
+        # Routed again, as routers or worker sets may have changed
+        count = 0
+        routers = list(self._routers.values())
+        for name, entries in restored.items():
+            if name.startswith('router.'):
+                for r, _ in entries:
+                    router.select_partition(routers, r.dataset).route(r)
+            else:
+                worker_id = name[len('worker.'):]
+                for r, attempts in entries:
+                    self._dead_letters.put(worker_id, r, f'Worker {worker_id} no longer configured', attempts)
+                    if self._catalog is not None:
+                        self._catalog.completed(r, worker_id, catalog.DEAD_LETTERED)
+                self._logger.warning(f'Dead lettered {len(entries)} instances snapshotted for removed worker {worker_id}')
+            count += len(entries)
+        if count:
+            self._logger.info(f'Restored {count} instances queued on last shutdown')
+
+    def _create_shaper(
+        self,
+        worker_config: configuration.WorkerConfiguration,
+        shaping_groups: Dict[str, Tuple[Optional[ratelimit.TokenBucket], Optional[ratelimit.TokenBucket]]]) -> Optional[ratelimit.Shaper]:
+        buckets = [_create_buckets(worker_config.shaping)]
+        if worker_config.shaping_group is not None:
+            buckets.append(shaping_groups[worker_config.shaping_group])
+        instance_buckets = [b for b, _ in buckets if b is not None]
+        byte_buckets = [b for _, b in buckets if b is not None]
+        if not instance_buckets and not byte_buckets:
+            return None
+        return ratelimit.Shaper(worker_config.id, instance_buckets, byte_buckets)
+
+    def _create_cluster(self):
+        cluster_config = self._config.core().cluster
+        if not cluster_config.enabled:
+            return
+        backend = cluster.create_backend(cluster_config)
+        if cluster_config.serve:
+            # Nodes on other hosts share state through this node
+            self._state_service = cluster.StateService(
+                backend, cluster_config.listen_address, cluster_config.listen_port, cluster_config.token)
+            self._state_service.start()
+        self._cluster = cluster.Cluster(cluster_config, backend)
+        for w in self._workers.values():
+            self._cluster.register_worker(w, self._liveness_checkers.get(w.id))
+        # Join with the current shared state, so failed over patients
+        # are routed consistently from the first instance
+        try:
+            self._cluster.sync()
+        except Exception as exception:
+            self._logger.warning(f'Failed initial cluster sync: {exception}')
+        self._cluster.start()
+
     def _create_worker_sets(self):
+        # Worker sets share UID mappings, so instances relayed through
+        # different sets still refer to each other consistently
+        uid_mapper = rewrite.UIDMapper(self._config.core().uid_remap_salt)
+        affinity_config = self._config.core().affinity
         for worker_set_config in self._config.worker_sets():
-            ws = workerset.WorkerSet(worker_set_config, self._workers, hash_functions.random)
+            affinity_table = None
+            if affinity_config.enabled:
+                affinity_table = affinity.AffinityTable(
+                    self._config.core().affinity_dir_path,
+                    worker_set_config.id,
+                    affinity_config.assignment,
+                    affinity_config.compact_after,
+                    affinity_config.refresh_interval)
+            ws = workerset.WorkerSet(
+                worker_set_config,
+                self._workers,
+                hash_functions.get(worker_set_config.hash_function),
+                uid_mapper,
+                self._cluster,
+                affinity_table)
             self._worker_sets[ws.id] = ws
+        for worker_set_config in self._config.worker_sets():
+            if worker_set_config.overflow is not None:
+                ws = self._worker_sets[worker_set_config.id]
+                ws.set_overflow(overflow.Overflow(
+                    worker_set_config.overflow, ws, self._worker_sets[worker_set_config.overflow.worker_set_id]))
 
     def _create_routers(self):
-        for router_index in range(self._config.core().router_count):
-            id = f'ROUTER{router_index}'
-            r = router.Router(id, self._worker_sets)
-            r.start()
-            self._routers[id] = r
+        with self._routers_lock:
+            for router_index in range(self._config.core().router_count):
+                self._start_router(f'ROUTER{router_index}')
+
+    def _start_router(self, id: str):
+        # Must be called with routers lock held
+        r = router.Router(id, self._worker_sets, self._classifier.weights, self._catalog)
+        r.start()
+        self._routers[id] = r
+        if self._diagnostics is not None:
+            self._diagnostics.register(f'router.{id}', r)
 
     def _create_scps(self):
+        dedup_config = self._config.core().deduplication
+        dedup_index = None
+        if dedup_config.enabled:
+            dedup_index = dedup.DeduplicationIndex(dedup_config.window_seconds, dedup_config.max_entries)
+        instance_spool = None
+        if self._config.core().spool_threshold:
+            instance_spool = spool.Spool(self._config.core().spool_dir_path, self._config.core().spool_threshold)
+        capture_config = self._config.core().capture
+        if capture_config.enabled:
+            self._recorder = capture.TraceRecorder(
+                self._config.core().capture_dir_path,
+                self._config.routing_tags() + capture_config.tags,
+                capture_config.salt,
+                capture_config.queue_size)
+            self._recorder.start()
         for scp_config in self._config.scps():
-            s = scp.SCP(scp_config, self._routers)
+            if scp_config.type == configuration.SCPConfiguration.TYPE_FOLDER:
+                s = folder.FolderSource(
+                    scp_config,
+                    self._routers,
+                    os.path.join(self._config.core().ingest_failed_dir_path, scp_config.id),
+                    dedup_index,
+                    self._classifier)
+            else:
+                s = scp.SCP(scp_config, self._routers, dedup_index, self._classifier, instance_spool, self._recorder)
             s.start()
             self._scps[s.id] = s
- 
\ No newline at end of file
+ 
+
+    def _create_diagnostics(self):
+        diagnostics_config = self._config.core().diagnostics
+        if not diagnostics_config.enabled:
+            return
+        d = diagnostics.Diagnostics(diagnostics_config, self._config.core().diagnostics_dir_path)
+        for r in self._routers.values():
+            d.register(f'router.{r.id}', r)
+        for w in self._workers.values():
+            d.register(f'worker.{w.id}', w)
+        d.start()
+        self._diagnostics = d
+        # Signal handlers can only be installed from the main thread
+        if threading.current_thread() is threading.main_thread():
+            d.install_signal_handler()
+
+    def _create_control(self):
+        control_config = self._config.core().control
+        if not control_config.enabled:
+            return
+        control.ControlServer(control_config, self).start()
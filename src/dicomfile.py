@@ -0,0 +1,66 @@
+'''
+DICOM file module.
+
+Writes routables to DICOM files and reads them back, keeping the
+dataset in its encoded form.
+'''
+import os
+
+import pydicom
+import pydicom.filereader
+import pydicom.filewriter
+from pydicom.filebase import DicomBytesIO
+
+import buffers
+import routable
+
+PREAMBLE = b'\0' * 128 + b'DICM'
+
+# Size in bytes above which files are memory mapped rather than read
+MAP_THRESHOLD = 16 * 1024 * 1024
+# Size in bytes of the chunks files are written in
+CHUNK_SIZE = 4 * 1024 * 1024
+
+def encode_file_meta(r: routable.Routable) -> bytes:
+    '''
+    Encode the preamble and file meta information of routable
+    '''
+    fp = DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = False
+    fp.write(PREAMBLE)
+    pydicom.filewriter.write_file_meta_info(fp, r.file_meta())
+    return fp.getvalue()
+
+def write(path: str, r: routable.Routable) -> None:
+    '''
+    Write routable to a DICOM file. The file is written under a
+    temporary name and renamed, so a partially written file is
+    never visible at path
+    '''
+    with open(path + '.tmp', 'wb') as f:
+        f.write(encode_file_meta(r))
+        for segment in buffers.segments(r.encoded):
+            for offset in range(0, len(segment), CHUNK_SIZE):
+                f.write(segment[offset:offset + CHUNK_SIZE])
+    os.replace(path + '.tmp', path)
+
+def read(path: str, scp_id: str = None) -> routable.Routable:
+    '''
+    Read a DICOM file into a routable without decoding the dataset.
+    Large files are memory mapped instead of read into memory
+    '''
+    with open(path, 'rb') as f:
+        preamble = f.read(len(PREAMBLE))
+        if preamble[128:] != b'DICM':
+            # No preamble, file meta information may still be present
+            f.seek(0)
+        file_meta = pydicom.filereader._read_file_meta_info(f)
+        if os.fstat(f.fileno()).st_size - f.tell() > MAP_THRESHOLD:
+            encoded = buffers.FileBuffer(path, f.tell())
+        else:
+            encoded = f.read()
+    transfer_syntax = file_meta.get('TransferSyntaxUID')
+    if transfer_syntax is None:
+        raise ValueError(f'No transfer syntax in file meta information of {path}')
+    return routable.Routable(scp_id, None, encoded=encoded, transfer_syntax=transfer_syntax)
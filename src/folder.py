@@ -0,0 +1,324 @@
+'''
+Folder module.
+
+A drop folder source ingests DICOM files placed in a watched directory,
+for example to backfill archives without pushing them through C-STORE.
+Files are read in parallel, only their routing headers are decoded, and
+they are handed to the routers like instances received over the
+network. Once a worker sent or dead lettered its instance, a file is
+moved to the processed dir, or deleted, so a crash before then leaves
+it to be ingested again. Files which cannot be moved are left in place
+and not ingested again until restarted. Files which cannot be read as
+DICOM are moved to a failed dir.
+
+New files are noticed through inotify where available, and otherwise by
+scanning the directory periodically.
+'''
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import shutil
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import configuration
+import dedup
+import dicomfile
+import metrics
+import priority
+import router
+
+# Files with these suffixes are still being written
+PARTIAL_SUFFIXES = ('.tmp', '.part', '.partial')
+# Seconds a file must be left unmodified before a scan picks it up
+SETTLE_TIME = 2
+# Seconds between checks of what the routers have pending while they
+# catch up
+PENDING_CHECK_INTERVAL = 0.05
+
+class _Inotify:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(_Inotify.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dir_paths: Dict[int, str] = {}
+
+    def add_watch(self, dir_path: str) -> None:
+        mask = _Inotify.IN_CLOSE_WRITE | _Inotify.IN_MOVED_TO | _Inotify.IN_CREATE
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {dir_path}')
+        self._dir_paths[wd] = dir_path
+
+    def read(self, timeout: float) -> List[Tuple[Optional[str], int]]:
+        '''
+        Wait for events, returning the path and mask of each. The path
+        is None if events were lost
+        '''
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self._fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _Inotify._EVENT.unpack_from(data, offset)
+            offset += _Inotify._EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            dir_path = self._dir_paths.get(wd)
+            if mask & _Inotify.IN_Q_OVERFLOW or dir_path is None:
+                events.append((None, mask))
+            else:
+                events.append((os.path.join(dir_path, os.fsdecode(name)), mask))
+        return events
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+def _scan(dir_path: str, settled_before: float = None) -> Iterator[str]:
+    # Walk dir recursively, yielding paths of files ready for ingest
+    try:
+        entries = list(os.scandir(dir_path))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scan(entry.path, settled_before)
+        elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(PARTIAL_SUFFIXES):
+            if settled_before is None or entry.stat().st_mtime < settled_before:
+                yield entry.path
+
+class FolderSource(threading.Thread):
+    '''
+    Ingests DICOM files dropped into a directory
+    '''
+    def __init__(
+        self,
+        config: configuration.SCPConfiguration,
+        routers: Dict[str, router.Router],
+        failed_dir_path: str,
+        dedup_index: dedup.DeduplicationIndex = None,
+        classifier: priority.PriorityClassifier = None) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self._logger = logging.getLogger(__name__)
+        self._id = config.id
+        self._watch_dir_path = config.watch_dir_path
+        self._processed_dir_path = config.processed_dir_path
+        self._failed_dir_path = failed_dir_path
+        self._poll_interval = config.poll_interval
+        self._max_pending = config.max_pending
+        # Shared with the load balancer, which may add routers
+        self._routers = routers
+        self._dedup_index = dedup_index
+        self._classifier = classifier or priority.PriorityClassifier([])
+        self._executor = ThreadPoolExecutor(config.threads, thread_name_prefix=f'{config.id}-reader')
+        # Bounds files submitted but not yet read, so a backfill of
+        # millions of files is not queued up front
+        self._slots = threading.BoundedSemaphore(config.threads * 2)
+        # Paths submitted and not yet moved out of the watched dir, so
+        # files reported twice, or scanned again while being sent, are
+        # read once
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        self._ingested = metrics.counter(f'folder.{config.id}.ingested')
+        self._failed = metrics.counter(f'folder.{config.id}.failed')
+        self._release_failures = metrics.counter(f'folder.{config.id}.release-failures')
+        self._stopped = threading.Event()
+
+    @property
+    def id(self):
+        return self._id
+
+    def stop(self) -> None:
+        '''
+        Stop watching after the current poll interval. Files being read
+        are still handed to the routers
+        '''
+        self._stopped.set()
+
+    def _pending(self) -> int:
+        return sum(r.queue_depth() for r in list(self._routers.values()))
+
+    def _move_out(self, path: str) -> None:
+        # Move the file out of the watched dir, keeping its relative path
+        relative_path = os.path.relpath(path, self._watch_dir_path)
+        target_dir_path = self._processed_dir_path
+        if target_dir_path is None:
+            os.remove(path)
+            return
+        target_path = os.path.join(target_dir_path, relative_path)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        try:
+            os.replace(path, target_path)
+        except OSError as exception:
+            if exception.errno != errno.EXDEV:
+                raise
+            # Not atomic across file systems, so copy under a
+            # temporary name first
+            shutil.copyfile(path, target_path + '.tmp')
+            os.replace(target_path + '.tmp', target_path)
+            os.remove(path)
+
+    def _release(self, path: str) -> None:
+        # Files which cannot be moved are kept in flight, so they are
+        # not ingested again
+        try:
+            self._move_out(path)
+        except OSError as exception:
+            self._release_failures.increment()
+            self._logger.error('Failed to move %s out of watched dir, leaving it in place: %s', path, exception)
+            return
+        with self._in_flight_lock:
+            self._in_flight.discard(path)
+
+    def _completed(self, path: str, key: Optional[bytes], sent: bool) -> None:
+        self._release(path)
+        if key is not None and not sent:
+            # Dropped or dead lettered, so relayed when dropped again
+            self._dedup_index.forget(key)
+
+    def _fail(self, path: str, reason: str) -> None:
+        self._failed.increment()
+        self._logger.warning('Failed to ingest %s: %s', path, reason)
+        target_path = os.path.join(self._failed_dir_path, os.path.relpath(path, self._watch_dir_path))
+        try:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            shutil.move(path, target_path)
+        except OSError as exception:
+            self._logger.error('Failed to move %s out of watched dir: %s', path, exception)
+
+    def ingest(self, path: str) -> bool:
+        '''
+        Route the instance in a DICOM file, moving the file out of the
+        watched dir once a worker sent or gave up on it. Returns whether
+        the file was taken in, after which it is released that way
+        '''
+        try:
+            r = dicomfile.read(path, self._id)
+            sop_instance_uid = r.sop_instance_uid
+        except FileNotFoundError:
+            # Already ingested after being reported twice
+            return False
+        except Exception as exception:
+            self._fail(path, str(exception))
+            return False
+        key = None
+        if self._dedup_index is not None:
+            key = dedup.instance_key(sop_instance_uid, r.encoded)
+            if self._dedup_index.seen(key):
+                self._logger.debug('Dropping duplicate instance %s', sop_instance_uid)
+                self._release(path)
+                return True
+        r.priority_class = self._classifier.classify(r)
+        # Large files are mapped rather than read, and the mapping stays
+        # valid when the file is moved or deleted
+        r.on_completed = lambda sent: self._completed(path, key, sent)
+        # The file stays in the watched dir until then
+        r.kept_by_source = True
+        router.select_partition(list(self._routers.values()), r.dataset).route(r)
+        self._ingested.increment()
+        return True
+
+    def _ingest_slot(self, path: str) -> None:
+        taken_in = False
+        try:
+            taken_in = self.ingest(path)
+        except Exception as exception:
+            self._logger.error('Failed to ingest %s: %s', path, exception)
+        finally:
+            if not taken_in:
+                with self._in_flight_lock:
+                    self._in_flight.discard(path)
+            self._slots.release()
+
+    def submit(self, path: str) -> None:
+        '''
+        Ingest a file in the reader pool, waiting for the routers to
+        catch up if they have too much pending. Files are left for the
+        next start once stopped
+        '''
+        with self._in_flight_lock:
+            if self._stopped.is_set() or path in self._in_flight:
+                return
+            self._in_flight.add(path)
+        while self._pending() >= self._max_pending:
+            if self._stopped.wait(PENDING_CHECK_INTERVAL):
+                with self._in_flight_lock:
+                    self._in_flight.discard(path)
+                return
+        self._slots.acquire()
+        self._executor.submit(self._ingest_slot, path)
+
+    def _submit_all(self, paths: Iterator[str]) -> None:
+        # Stops scanning once stopped, rather than going through a
+        # backfill of millions of files
+        for path in paths:
+            if self._stopped.is_set():
+                return
+            self.submit(path)
+
+    def _watch(self, inotify: _Inotify) -> None:
+        for dir_path, _, _ in os.walk(self._watch_dir_path):
+            inotify.add_watch(dir_path)
+        # Files already present, such as a backfill, are ingested after
+        # watches are added, so none are missed in between. Files still
+        # being written are reported once closed, but files closed just
+        # before watching are only picked up by a second scan
+        self._submit_all(_scan(self._watch_dir_path, time.time() - SETTLE_TIME))
+        rescan_at = time.monotonic() + SETTLE_TIME
+        while not self._stopped.is_set():
+            if rescan_at is not None and time.monotonic() >= rescan_at:
+                self._submit_all(_scan(self._watch_dir_path, time.time() - SETTLE_TIME))
+                rescan_at = None
+            for path, mask in inotify.read(self._poll_interval if rescan_at is None else SETTLE_TIME):
+                if path is None:
+                    self._logger.warning('Missed inotify events in %s, rescanning', self._watch_dir_path)
+                    self._submit_all(_scan(self._watch_dir_path))
+                elif mask & _Inotify.IN_ISDIR:
+                    # Directory created or moved in, watch and scan it
+                    if mask & (_Inotify.IN_CREATE | _Inotify.IN_MOVED_TO):
+                        for dir_path, _, _ in os.walk(path):
+                            inotify.add_watch(dir_path)
+                        self._submit_all(_scan(path))
+                elif mask & (_Inotify.IN_CLOSE_WRITE | _Inotify.IN_MOVED_TO):
+                    name = os.path.basename(path)
+                    if not name.startswith('.') and not name.endswith(PARTIAL_SUFFIXES):
+                        self.submit(path)
+
+    def _poll(self) -> None:
+        while not self._stopped.is_set():
+            self._submit_all(_scan(self._watch_dir_path, time.time() - SETTLE_TIME))
+            self._stopped.wait(self._poll_interval)
+
+    def run(self):
+        self._logger.info(f'Starting folder source {self._id} watching {self._watch_dir_path}')
+        os.makedirs(self._watch_dir_path, exist_ok=True)
+        try:
+            inotify = _Inotify()
+        except (OSError, AttributeError, TypeError) as exception:
+            self._logger.info(f'Inotify not available ({exception}), scanning {self._watch_dir_path} periodically')
+            self._poll()
+        else:
+            try:
+                self._watch(inotify)
+            finally:
+                inotify.close()
+        self._executor.shutdown()
@@ -1,4 +1,6 @@
 import hashlib
+import zlib
+from typing import Callable
 
 def random(input: str, modulo: int):
     # Ensure that input value is not ridiculously large
@@ -7,9 +9,30 @@ def random(input: str, modulo: int):
     # Ensure that modulo value is valid
     if modulo > 10000:
         raise BaseException('Modulo value too large')
-    # Create md5 hash, but use only last 6 digits
-    hash_suffix = hashlib.md5(input.encode('utf-8')).hexdigest()[-5:]
-    # 6 digit decimal number as string, decode
-    hash_number = int(hash_suffix, 16)
+    # Create md5 hash, but use only the last 5 hex digits, which are
+    # the low 20 bits of the last 3 bytes
+    hash_number = int.from_bytes(hashlib.md5(input.encode('utf-8')).digest()[-3:], 'big') & 0xFFFFF
     # Modulo
     return hash_number % modulo
+
+def crc32(input: str, modulo: int):
+    '''
+    Non-cryptographic hash, several times cheaper than random, placing
+    keys on different indices than it does
+    '''
+    if len(input) > 100000:
+        raise BaseException('Input value too large')
+    if modulo > 10000:
+        raise BaseException('Modulo value too large')
+    return zlib.crc32(input.encode('utf-8', 'surrogateescape')) % modulo
+
+HASH_FUNCTIONS = {
+    'md5': random,
+    'crc32': crc32
+}
+
+def get(name: str) -> Callable[[str, int], int]:
+    '''
+    Get a hash function by its configured name
+    '''
+    return HASH_FUNCTIONS[name]
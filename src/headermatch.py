@@ -0,0 +1,48 @@
+'''
+Evaluation of header requirements against DICOM datasets
+'''
+import logging
+import re
+from typing import List, Tuple
+
+import pydicom
+
+import configuration
+
+_logger = logging.getLogger(__name__)
+
+def evaluate_header_absent(tag: Tuple[int, int], dataset: pydicom.Dataset) -> bool:
+    return tag not in dataset
+
+def evaluate_header_present(tag: Tuple[int, int], dataset: pydicom.Dataset) -> bool:
+    return tag in dataset
+
+def evaluate_header_regexp_match(tag: Tuple[int, int], dataset: pydicom.Dataset, regexp: str) -> bool:
+    if not evaluate_header_present(tag, dataset):
+        return False
+    header_value = str(dataset[tag].value)
+    return re.match(regexp, header_value) is not None
+
+def evaluate(requirement: configuration.HeaderRequirementConfiguration, dataset: pydicom.Dataset) -> bool:
+    '''
+    Evaluate a single header requirement against dataset
+    '''
+    tag = requirement.tag
+    if requirement.requirement == configuration.HeaderRequirementConfiguration.ABSENT:
+        return evaluate_header_absent(tag, dataset)
+    if requirement.requirement == configuration.HeaderRequirementConfiguration.PRESENT:
+        return evaluate_header_present(tag, dataset)
+    if requirement.requirement == configuration.HeaderRequirementConfiguration.REGEXP_MATCH:
+        return evaluate_header_regexp_match(tag, dataset, requirement.regexp)
+    _logger.warning(f'Unknown header requirement type {requirement.requirement}')
+    return True
+
+def evaluate_all(requirements: List[configuration.HeaderRequirementConfiguration], dataset: pydicom.Dataset) -> bool:
+    '''
+    Evaluate header requirements against dataset. All requirements
+    must be satisfied.
+    '''
+    for requirement in requirements:
+        if not evaluate(requirement, dataset):
+            return False
+    return True
@@ -3,9 +3,16 @@ Liveness checker module
 '''
 import threading
 from abc import ABC, abstractmethod
-from time import sleep
+import concurrent.futures
+import heapq
+import http.client
+import itertools
 import logging
 import enum
+import random
+import time
+import urllib.parse
+from typing import Dict, List, Tuple
 
 import pynetdicom
 
@@ -35,12 +42,13 @@ class DicomEchoLivenessCheckerStrategy(LivenessCheckerStrategy):
     As such, this liveness checker checks connectivity as well as
     DICOM availability.
     '''
-    def __init__(self, hostname: str, port: int) -> None:
+    def __init__(self, hostname: str, port: int, timeout: float = None) -> None:
         '''
         Construct a new DicomEchoLivenessCheckerStrategy
         '''
         self._hostname = hostname
         self._port = port
+        self._timeout = timeout
         self._logger = logging.getLogger(__name__)
 
 
@@ -48,8 +56,12 @@ class DicomEchoLivenessCheckerStrategy(LivenessCheckerStrategy):
         '''
         Perform liveness check
         '''
-        self._logger.debug('Checking liveness of {}:{}'.format(self._hostname, self._port))
+        self._logger.debug('Checking liveness of %s:%s', self._hostname, self._port)
         ae = pynetdicom.AE()
+        if self._timeout is not None:
+            ae.acse_timeout = self._timeout
+            ae.dimse_timeout = self._timeout
+            ae.network_timeout = self._timeout
         ae.add_requested_context('1.2.840.10008.1.1')
         assoc = ae.associate(self._hostname, self._port)
         if assoc.is_established:
@@ -65,42 +77,244 @@ class DicomEchoLivenessCheckerStrategy(LivenessCheckerStrategy):
     def port(self) -> int:
         return self._port
 
-class LivenessChecker(threading.Thread):
+class HttpLivenessCheckerStrategy(LivenessCheckerStrategy):
+    '''
+    Liveness checking strategy for DICOMweb workers, sending an OPTIONS
+    request to the URL of the worker. Any response other than a server
+    error counts as live, as servers differ in what they allow
+    '''
+    def __init__(self, url: str, timeout: float = None, headers: Dict[str, str] = None) -> None:
+        parts = urllib.parse.urlsplit(url)
+        self._url = url
+        self._https = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path or '/'
+        self._timeout = timeout
+        self._headers = headers or {}
+        self._logger = logging.getLogger(__name__)
+
+    def check(self):
+        '''
+        Perform liveness check
+        '''
+        self._logger.debug('Checking liveness of %s', self._url)
+        if self._https:
+            connection = http.client.HTTPSConnection(self._host, self._port, timeout=self._timeout)
+        else:
+            connection = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+        try:
+            connection.request('OPTIONS', self._path, headers=self._headers)
+            status = connection.getresponse().status
+        except (OSError, http.client.HTTPException):
+            return LivenessStatus.HARD_FAIL
+        finally:
+            connection.close()
+        if status >= 500:
+            return LivenessStatus.HARD_FAIL
+        return LivenessStatus.LIVE
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+class LivenessChecker:
+    '''
+    Liveness state of a single worker endpoint, doubling as a
+    circuit breaker for sends to that endpoint.
+
+    The circuit is closed while the endpoint is LIVE (or UNKNOWN), and
+    opens (HARD_FAIL) when an active check fails or failure_threshold
+    consecutive passive failures are recorded. After open_interval
+    seconds the circuit goes half-open (SOFT_FAIL), letting a single
+    probe through, whose outcome closes or re-opens the circuit. A
+    probe whose outcome is not recorded within open_interval seconds,
+    for example as its sender stopped, is taken as lost and another is
+    let through.
+
+    Active checks are run by a LivenessScheduler. Recorded successes
+    postpone the next active check, as traffic already proves liveness.
+    '''
 
     def __init__(
         self,
         id: str,
         strategy: LivenessCheckerStrategy,
         config: configuration.WorkerConfiguration,
-        check_interval: int) -> None:
+        check_interval: float,
+        failure_threshold: int = 3,
+        open_interval: float = 30) -> None:
 
-        threading.Thread.__init__(self)
         self._id = id
         self._check_interval = check_interval
         self._confg = config
         self._strategy = strategy
+        self._failure_threshold = failure_threshold
+        self._open_interval = open_interval
         self._liveness_status = LivenessStatus.UNKNOWN
-        self._shutdown = False
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        self._last_success = None
+        self._lock = threading.Lock()
         self._logger = logging.getLogger(__name__)
 
     def _set_liveness_status(self, status: LivenessStatus) -> None:
+        # Must be called with lock held
+        if status == self._liveness_status:
+            self._logger.debug('Liveness status of %s is still %s', self._id, status)
+            return
         self._logger.info('Setting liveness status to %s for %s', status, self._id)
         self._liveness_status = status
+        if status == LivenessStatus.HARD_FAIL:
+            self._opened_at = time.monotonic()
+        self._probe_in_flight = False
 
-    def _check_liveness(self) -> None:
-        self._set_liveness_status(self._strategy.check())
+    def check(self) -> LivenessStatus:
+        '''
+        Perform an active liveness check using the configured strategy
+        '''
+        try:
+            result = self._strategy.check()
+        except Exception as exception:
+            self._logger.debug('Liveness check of %s failed: %s', self._id, exception)
+            result = LivenessStatus.HARD_FAIL
+        with self._lock:
+            if result == LivenessStatus.LIVE:
+                self._consecutive_failures = 0
+                self._last_success = time.monotonic()
+            self._set_liveness_status(result)
+        return result
 
-    def run(self):
-        self._logger.info('Starting liveness checker %s. Checking liveness every %d seconds.', self._id, self._check_interval)
-        while True:
-            self._check_liveness()
-            sleep(self._check_interval)
-            if self._shutdown:
-                return
+    def record_success(self) -> None:
+        '''
+        Record a successful interaction with the endpoint
+        '''
+        with self._lock:
+            self._consecutive_failures = 0
+            self._last_success = time.monotonic()
+            self._set_liveness_status(LivenessStatus.LIVE)
+
+    def record_failure(self) -> None:
+        '''
+        Record a failed interaction with the endpoint
+        '''
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._liveness_status == LivenessStatus.SOFT_FAIL \
+                    or self._consecutive_failures >= self._failure_threshold:
+                # Failed probe or too many failures, (re-)open the circuit
+                self._set_liveness_status(LivenessStatus.HARD_FAIL)
+                self._opened_at = time.monotonic()
+
+    def allow_request(self) -> bool:
+        '''
+        Check whether a request may be sent to the endpoint
+        '''
+        with self._lock:
+            if self._liveness_status in (LivenessStatus.LIVE, LivenessStatus.UNKNOWN):
+                return True
+            if self._liveness_status == LivenessStatus.HARD_FAIL:
+                if time.monotonic() - self._opened_at < self._open_interval:
+                    return False
+                self._set_liveness_status(LivenessStatus.SOFT_FAIL)
+            # Half-open, let a single probe through
+            now = time.monotonic()
+            if self._probe_in_flight and now - self._probe_started < self._open_interval:
+                return False
+            self._probe_in_flight = True
+            self._probe_started = now
+            return True
+
+    def next_check_time(self, scheduled: float) -> float:
+        '''
+        Get the time at which the next active check should run, given
+        the time it was scheduled for
+        '''
+        with self._lock:
+            if self._liveness_status == LivenessStatus.LIVE and self._last_success is not None:
+                return max(scheduled, self._last_success + self._check_interval)
+            return scheduled
+
+    @property
+    def id(self) -> str:
+        return self._id
+
+    @property
+    def check_interval(self) -> float:
+        return self._check_interval
 
     @property
     def status(self) -> LivenessStatus:
         return self._liveness_status
 
+class LivenessScheduler(threading.Thread):
+    '''
+    Single thread scheduling active liveness checks of all registered
+    checkers. Checks run concurrently on a bounded pool of threads,
+    with per-checker jitter so checks do not run in lock step.
+    '''
+
+    def __init__(self, max_concurrent_checks: int = 16, jitter: float = 0.2) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self._jitter = jitter
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrent_checks,
+            thread_name_prefix='liveness')
+        self._heap: List[Tuple[float, int, LivenessChecker]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._logger = logging.getLogger(__name__)
+
+    def register(self, checker: LivenessChecker) -> None:
+        '''
+        Register a checker. First checks are spread out over the
+        check interval, so registering many checkers does not cause
+        a burst of checks.
+        '''
+        delay = random.uniform(0, checker.check_interval)
+        self._schedule(checker, time.monotonic() + delay)
+
+    def _schedule(self, checker: LivenessChecker, due: float) -> None:
+        with self._condition:
+            heapq.heappush(self._heap, (due, next(self._sequence), checker))
+            self._condition.notify()
+
+    def _jittered_interval(self, checker: LivenessChecker) -> float:
+        return checker.check_interval * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+    def _run_check(self, checker: LivenessChecker) -> None:
+        try:
+            checker.check()
+        finally:
+            self._schedule(checker, time.monotonic() + self._jittered_interval(checker))
+
+    def run(self):
+        self._logger.info('Starting liveness scheduler')
+        while True:
+            with self._condition:
+                if self._shutdown:
+                    break
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                due, _, checker = self._heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+            # Skip the check if traffic has proven liveness meanwhile
+            next_check = checker.next_check_time(due)
+            if next_check > due:
+                self._schedule(checker, next_check)
+                continue
+            self._executor.submit(self._run_check, checker)
+        self._executor.shutdown(wait=False)
+
     def shutdown(self):
-        self._shutdown = True
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify()
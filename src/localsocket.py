@@ -0,0 +1,53 @@
+'''
+Local socket module.
+
+Serves requests, such as control commands and diagnostics, on a Unix
+domain socket only the user running the relay can connect to. Requests
+are served one at a time by the thread calling serve, blocked on accept
+in between.
+'''
+import logging
+import os
+import socket
+from typing import Callable
+
+# Backlog of connections waiting to be accepted
+BACKLOG = 4
+
+def listen(socket_path: str) -> socket.socket:
+    '''
+    Listen on a Unix domain socket at socket_path, replacing any left
+    behind by an earlier run
+    '''
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Bound under a restrictive umask, so the socket is never reachable
+    # by other users, not even between binding and changing its mode.
+    # The umask is process wide, so it only takes away permissions of
+    # group and others from files other threads create meanwhile
+    umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    except BaseException:
+        server.close()
+        raise
+    finally:
+        os.umask(umask)
+    server.listen(BACKLOG)
+    return server
+
+def serve(socket_path: str, handle: Callable[[socket.socket], None], description: str, logger: logging.Logger) -> None:
+    '''
+    Serve connections to a Unix domain socket at socket_path forever,
+    handing each to handle
+    '''
+    server = listen(socket_path)
+    logger.info(f'Serving {description} on {socket_path}')
+    while True:
+        connection, _ = server.accept()
+        try:
+            handle(connection)
+        except OSError as exception:
+            logger.warning(f'Failed to serve {description} request: {exception}')
@@ -0,0 +1,190 @@
+'''
+Logging pipeline module.
+
+Components log through the standard logging module. Records are put
+on a bounded queue without being formatted, and a single listener
+thread formats them and writes them to a rotating file in the
+configured log dir. Logging therefore never blocks relaying: records
+logged while the queue is full are dropped and counted instead.
+
+Repeated warnings, such as a routable no worker set accepts, are
+rate limited per logger and message template: after a burst, only a
+sample is logged, carrying the number of records suppressed since the
+last one.
+'''
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from typing import Dict, Tuple
+
+import configuration
+import metrics
+
+LOG_FILE_NAME = 'dicom-loadbalancer.log'
+# Maximum number of distinct warnings tracked for rate limiting
+MAX_RATE_LIMIT_KEYS = 10000
+TEXT_FORMAT = '%(asctime)s %(name)-20s %(levelname)-8s %(message)s'
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats records as single line JSON objects
+    '''
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class TextFormatter(logging.Formatter):
+    '''
+    Formats records as text, noting suppressed repeats
+    '''
+    def format(self, record: logging.LogRecord) -> str:
+        text = logging.Formatter.format(self, record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += f' ({suppressed} similar messages suppressed)'
+        return text
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Limits how often the same warning or error is logged. Records are
+    the same if logged by the same logger with the same message
+    template, regardless of arguments.
+    '''
+    def __init__(self, burst: int = 10, interval: float = 60, sample_every: int = 100) -> None:
+        logging.Filter.__init__(self)
+        self._burst = burst
+        self._interval = interval
+        self._sample_every = sample_every
+        # Per key: start of interval, records seen and records
+        # suppressed since the last one logged
+        self._state: Dict[Tuple[str, str], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None and len(self._state) >= MAX_RATE_LIMIT_KEYS:
+                # Messages formatted eagerly make every record distinct
+                self._state.clear()
+            if state is None or now - state[0] > self._interval:
+                suppressed = state[2] if state is not None else 0
+                state = self._state[key] = [now, 0, suppressed]
+            state[1] += 1
+            if state[1] > self._burst and (state[1] - self._burst) % self._sample_every:
+                state[2] += 1
+                return False
+            record.suppressed = state[2]
+            state[2] = 0
+            return True
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue, max_size: int) -> None:
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self._max_size = max_size
+        self._dropped = metrics.counter('logging.dropped')
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The listener runs in this process, so the record is passed
+        # on as is and formatted by the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # The queue is unbounded, so a full queue drops the record
+        # here instead of blocking the logging thread
+        if self.queue.qsize() >= self._max_size:
+            self._dropped.increment()
+            return
+        self.queue.put_nowait(record)
+
+class LoggingPipeline:
+    '''
+    Queue backed logging to a rotating log file
+    '''
+    def __init__(self, config: configuration.CoreConfiguration) -> None:
+        logging_config = config.logging
+        self._queue: queue.Queue = queue.Queue()
+        if config.log_format == 'json':
+            formatter = JsonFormatter()
+        elif config.log_format == 'text':
+            formatter = TextFormatter(TEXT_FORMAT)
+        else:
+            formatter = TextFormatter(config.log_format)
+        os.makedirs(config.log_dir_path, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            os.path.join(config.log_dir_path, LOG_FILE_NAME),
+            maxBytes=logging_config.max_bytes,
+            backupCount=logging_config.backup_count)
+        file_handler.setFormatter(formatter)
+        # Problems are also reported on the console
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.WARNING)
+        console_handler.setFormatter(TextFormatter(TEXT_FORMAT))
+        self._listener = logging.handlers.QueueListener(
+            self._queue, file_handler, console_handler, respect_handler_level=True)
+        self._handler = _NonBlockingQueueHandler(self._queue, logging_config.queue_size)
+        # Rate limit before enqueueing, so suppressed records cost
+        # neither queue space nor formatting
+        self._handler.addFilter(RateLimitFilter(
+            logging_config.rate_limit_burst,
+            logging_config.rate_limit_interval,
+            logging_config.sample_every))
+        self._level = logging_config.level
+        self._levels = logging_config.levels
+        self._replaced_handlers = []
+
+    def start(self) -> None:
+        '''
+        Route all logging through the pipeline
+        '''
+        # Records are not formatted with caller or process details, so
+        # skip collecting them for every record
+        logging._srcfile = None
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
+        root = logging.getLogger()
+        self._replaced_handlers = list(root.handlers)
+        for handler in self._replaced_handlers:
+            root.removeHandler(handler)
+        root.addHandler(self._handler)
+        root.setLevel(self._level)
+        for name, level in self._levels.items():
+            logging.getLogger(name).setLevel(level)
+        self._listener.start()
+
+    def stop(self) -> None:
+        '''
+        Write out queued records and stop the listener thread
+        '''
+        root = logging.getLogger()
+        root.removeHandler(self._handler)
+        self._listener.stop()
+        for handler in self._replaced_handlers:
+            root.addHandler(handler)
+
+def start(config: configuration.CoreConfiguration) -> LoggingPipeline:
+    '''
+    Start logging according to configuration
+    '''
+    pipeline = LoggingPipeline(config)
+    pipeline.start()
+    return pipeline
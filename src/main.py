@@ -2,7 +2,6 @@
 #
 # TODO:
 # - Buffer implementation
-# - Stoppable thread implementation
 # - Mypy in github workflow
 # - Docker containerization
 
@@ -10,6 +9,7 @@
 # - Pylint cleaning
 
 # Done:
+# - Stoppable thread implementation         ✅
 # - Worker type for storing files locally   ✅
 # - JSON Schema validation of configuration ✅
 # - SCP/SCU configuration handling          ✅
@@ -20,12 +20,15 @@
 
 import logging
 import argparse
+import atexit
 import pathlib
 import os.path
+import signal
 import sys
+import threading
 
-import dicom_loadbalancer
 import configuration
+import logpipeline
 
 def default_config_file_path() -> str:
     return pathlib.Path(__file__).parent.absolute().joinpath('config.json').resolve()
@@ -45,11 +48,12 @@ def process_config_file_path(args: argparse.Namespace) -> str:
 
 def configure_logging() -> None:
     '''
-    Set up python logging framework
+    Set up python logging framework for start up. Once configuration
+    is loaded, logging is handed over to the logging pipeline
     '''
     logging.basicConfig(
-        level=logging.DEBUG, 
-        format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s')
+        level=logging.INFO,
+        format=logpipeline.TEXT_FORMAT)
     logging.info('Starting DICOM loadbalancer')
 
 
@@ -61,6 +65,10 @@ if __name__ == '__main__':
         required=False, 
         type=str,
         help='Path to configuration file')
+    parser.add_argument(
+        '--check-config',
+        action='store_true',
+        help='Validate configuration and exit')
     args = parser.parse_args()
 
     configure_logging()
@@ -68,7 +76,27 @@ if __name__ == '__main__':
     config_file_path = process_config_file_path(args)
 
     config = configuration.Configuration(config_file_path)
+    config.validate_topology()
+    if args.check_config:
+        logging.info('Configuration is valid')
+        sys.exit(0)
+
+    logging_pipeline = logpipeline.start(config.core())
+    atexit.register(logging_pipeline.stop)
+
+    # Imported here, so checking configuration does not pay
+    # for importing pynetdicom
+    import dicom_loadbalancer
+
+    # Shut down on SIGTERM or SIGINT, snapshotting what is still queued.
+    # Handled from before starting, so a signal arriving while starting
+    # shuts down once started rather than killing the relay midway
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stopping.set())
 
     load_balancer = dicom_loadbalancer.DicomLoadBalancer(config)
-    # Blocking call
-    load_balancer.start()
\ No newline at end of file
+    load_balancer.start()
+    while not stopping.wait(1):
+        pass
+    load_balancer.shutdown()
\ No newline at end of file
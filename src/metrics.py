@@ -0,0 +1,104 @@
+'''
+Metrics module.
+
+Provides process wide, thread safe counters and gauges which
+components use to expose what they are doing.
+'''
+import threading
+from typing import Dict
+
+class Counter:
+    '''
+    Monotonically increasing counter
+    '''
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._value = 0
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def increment(self, amount: int = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+class Gauge:
+    '''
+    Value which may go up and down
+    '''
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._value = 0
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+class MetricsRegistry:
+    '''
+    Registry of named counters and gauges
+    '''
+    def __init__(self) -> None:
+        self._counters: Dict[str, Counter] = {}
+        self._gauges: Dict[str, Gauge] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str) -> Counter:
+        '''
+        Get the counter with the given name, creating it if needed
+        '''
+        with self._lock:
+            if name not in self._counters:
+                self._counters[name] = Counter(name)
+            return self._counters[name]
+
+    def gauge(self, name: str) -> Gauge:
+        '''
+        Get the gauge with the given name, creating it if needed
+        '''
+        with self._lock:
+            if name not in self._gauges:
+                self._gauges[name] = Gauge(name)
+            return self._gauges[name]
+
+    def snapshot(self) -> Dict[str, float]:
+        '''
+        Get the current value of all counters and gauges
+        '''
+        with self._lock:
+            result = {name: c.value for name, c in self._counters.items()}
+            result.update({name: g.value for name, g in self._gauges.items()})
+        return result
+
+REGISTRY = MetricsRegistry()
+
+def counter(name: str) -> Counter:
+    '''
+    Get a counter from the process wide registry
+    '''
+    return REGISTRY.counter(name)
+
+def gauge(name: str) -> Gauge:
+    '''
+    Get a gauge from the process wide registry
+    '''
+    return REGISTRY.gauge(name)
+
+def snapshot() -> Dict[str, float]:
+    '''
+    Get the current value of all metrics in the process wide registry
+    '''
+    return REGISTRY.snapshot()
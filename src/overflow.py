@@ -0,0 +1,207 @@
+'''
+Overflow module.
+
+Diverts new studies from a worker set to its overflow worker set while
+the workers of the first are far behind: holding more instances or
+bytes than configured, or estimated to take longer than configured to
+send what they hold at the rate they recently sent at. Diverting stops
+once the backlog is below a fraction of every threshold, so the
+decision does not flap around a threshold.
+
+The rate of a worker is only measured over intervals it was busy the
+whole time, holding instances and its queue never running empty, so
+idle time does not count as sending slowly. Until a rate was measured,
+the drain time of a worker is unknown and does not divert studies.
+
+Only studies first seen while diverting are diverted. The worker set
+of each study is remembered, so instances of a study arriving later
+follow the first, and studies are never split between worker sets.
+Studies are forgotten once none of their instances were seen or sent
+for a while, and never while any are still being sent.
+'''
+import collections
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+import configuration
+import metrics
+import routable
+
+class _Study:
+    def __init__(self, diverted: bool, now: float) -> None:
+        self.diverted = diverted
+        # Instances handed off to workers and not yet completed
+        self.in_flight = 0
+        # When an instance was last seen or completed
+        self.active = now
+
+class _Progress:
+    def __init__(self, now: float, held: int, completed: int, emptied: int) -> None:
+        self.checked = now
+        self.held = held
+        self.completed = completed
+        self.emptied = emptied
+        # Busy time and instances completed in it not yet measured
+        self.busy_seconds = 0.0
+        self.busy_completed = 0
+        # Instances per second sent at while busy recently
+        self.rate: Optional[float] = None
+
+class Overflow:
+    '''
+    Selects the worker set of studies accepted by a primary worker set
+    '''
+    # Seconds between estimates of the backlog of the primary worker set
+    CHECK_INTERVAL = 1.0
+    # Weight of the latest rate in the moving average of the drain rate
+    RATE_WEIGHT = 0.2
+
+    def __init__(self, config: configuration.OverflowConfiguration, primary, secondary) -> None:
+        self._config = config
+        self._primary = primary
+        self._secondary = secondary
+        # Studies by UID, least recently active first
+        self._studies: collections.OrderedDict = collections.OrderedDict()
+        self._diverting = False
+        self._checked = None
+        self._progress: Dict[str, _Progress] = {}
+        self._lock = threading.Lock()
+        # Held while checking, without holding the lock, as estimating
+        # the backlog takes the locks of the workers
+        self._check_lock = threading.Lock()
+        self._diverted = metrics.counter(f'workerset.{primary.id}.overflow.diverted')
+        self._diverted_studies = metrics.counter(f'workerset.{primary.id}.overflow.studies')
+        self._diverting_gauge = metrics.gauge(f'workerset.{primary.id}.overflow.diverting')
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def diverting(self) -> bool:
+        '''
+        Whether new studies are currently diverted
+        '''
+        return self._diverting
+
+    def _over(self, count: int, size: int, drain_seconds: float, ratio: float) -> bool:
+        thresholds = [
+            (self._config.max_backlog_instances, count),
+            (self._config.max_backlog_bytes, size),
+            (self._config.max_drain_seconds, drain_seconds)]
+        return any(threshold is not None and value > threshold * ratio for threshold, value in thresholds)
+
+    def _measure(self, p: _Progress, now: float, held: int, completed: int, emptied: int) -> None:
+        if p.held and emptied == p.emptied:
+            # Busy since the last check
+            p.busy_seconds += now - p.checked
+            p.busy_completed += completed - p.completed
+        # A rate is measured once instances were sent while busy, or
+        # none were for longer than the drain time allowed
+        max_drain_seconds = self._config.max_drain_seconds
+        if p.busy_seconds > 0 and (p.busy_completed or
+                (max_drain_seconds is not None and p.busy_seconds > max_drain_seconds)):
+            rate = p.busy_completed / p.busy_seconds
+            if p.rate is None:
+                p.rate = rate
+            else:
+                p.rate += Overflow.RATE_WEIGHT * (rate - p.rate)
+            p.busy_seconds = 0.0
+            p.busy_completed = 0
+        p.checked = now
+        p.held = held
+        p.completed = completed
+        p.emptied = emptied
+
+    def _drain_seconds(self, now: float) -> float:
+        # Longest estimated time for a worker to send what it holds, 0
+        # while unknown for every worker
+        drain_seconds = 0.0
+        for worker_id, (held, completed, emptied) in self._primary.progress().items():
+            p = self._progress.get(worker_id)
+            if p is None:
+                self._progress[worker_id] = _Progress(now, held, completed, emptied)
+                continue
+            self._measure(p, now, held, completed, emptied)
+            if held and p.rate is not None:
+                drain_seconds = max(drain_seconds, held / p.rate if p.rate > 0 else float('inf'))
+        return drain_seconds
+
+    def _expire(self, now: float) -> None:
+        # Must be called with lock held
+        for _ in range(len(self._studies)):
+            study_uid, study = next(iter(self._studies.items()))
+            if now - study.active < self._config.study_timeout:
+                break
+            if study.in_flight:
+                # Still being sent
+                study.active = now
+                self._studies.move_to_end(study_uid)
+            else:
+                del self._studies[study_uid]
+
+    def _check(self, now: float) -> None:
+        count, size = self._primary.backlog()
+        drain_seconds = self._drain_seconds(now)
+        if not self._diverting and self._over(count, size, drain_seconds, 1):
+            self._diverting = True
+            self._logger.info(
+                'Worker set %s holds %d instances (%d bytes, %.0fs to drain), diverting new studies to %s',
+                self._primary.id, count, size, drain_seconds, self._secondary.id)
+        elif self._diverting and not self._over(count, size, drain_seconds, self._config.resume_ratio):
+            self._diverting = False
+            self._logger.info(
+                'Worker set %s holds %d instances (%d bytes, %.0fs to drain), no longer diverting new studies to %s',
+                self._primary.id, count, size, drain_seconds, self._secondary.id)
+        self._diverting_gauge.set(1 if self._diverting else 0)
+        with self._lock:
+            self._expire(now)
+
+    def _completed(self, study_uid: str, study: _Study) -> None:
+        with self._lock:
+            study.in_flight -= 1
+            study.active = time.monotonic()
+            self._studies.move_to_end(study_uid)
+
+    def select(self, r: routable.Routable):
+        '''
+        Get the worker set to relay a routable accepted by the primary
+        worker set. The routable is tracked until completed by a worker
+        '''
+        study_uid = r.dataset.get('StudyInstanceUID')
+        if not study_uid:
+            # Cannot be kept together with the rest of its study
+            return self._primary
+        study_uid = str(study_uid)
+        now = time.monotonic()
+        if self._checked is None or now - self._checked >= Overflow.CHECK_INTERVAL:
+            # Checked by one router at a time, the others go on with
+            # the last decision
+            if self._check_lock.acquire(blocking=False):
+                try:
+                    self._check(now)
+                    self._checked = now
+                finally:
+                    self._check_lock.release()
+        with self._lock:
+            study = self._studies.get(study_uid)
+            if study is None:
+                study = _Study(self._diverting, now)
+                self._studies[study_uid] = study
+                if study.diverted:
+                    self._diverted_studies.increment()
+                    self._logger.info('Diverting new study %s from worker set %s to %s',
+                        study_uid, self._primary.id, self._secondary.id)
+            else:
+                study.active = now
+                self._studies.move_to_end(study_uid)
+            study.in_flight += 1
+        on_completed = r.on_completed
+        def completed(sent: bool):
+            self._completed(study_uid, study)
+            if on_completed is not None:
+                on_completed(sent)
+        r.on_completed = completed
+        if study.diverted:
+            self._diverted.increment()
+            return self._secondary
+        return self._primary
@@ -0,0 +1,191 @@
+'''
+Priority classes and weighted fair queueing
+'''
+import collections
+import queue
+import threading
+import time
+from typing import Deque, Dict, List, Tuple
+
+import configuration
+import headermatch
+import metrics
+import routable
+
+class PriorityClassifier:
+    '''
+    Assigns routables to priority classes according to configuration
+    '''
+    def __init__(self, configs: List[configuration.PriorityClassConfiguration]) -> None:
+        self._configs = configs
+        self._weights: Dict[str, int] = {configuration.PriorityClassConfiguration.DEFAULT: 1}
+        for config in configs:
+            self._weights[config.name] = config.weight
+
+    @property
+    def weights(self) -> Dict[str, int]:
+        '''
+        Weights of all priority classes, including the default class
+        '''
+        return self._weights
+
+    def _rule_matches(self, rule: configuration.PriorityRuleConfiguration, r: routable.Routable) -> bool:
+        if rule.accepted_scp_ids and r.scp_id not in rule.accepted_scp_ids:
+            return False
+        if rule.c_store_priorities and r.c_store_priority not in rule.c_store_priorities:
+            return False
+        return headermatch.evaluate_all(rule.header_requirements, r.dataset)
+
+    def classify(self, r: routable.Routable) -> str:
+        '''
+        Get the name of the priority class of routable
+        '''
+        for config in self._configs:
+            for rule in config.rules:
+                if self._rule_matches(rule, r):
+                    return config.name
+        return configuration.PriorityClassConfiguration.DEFAULT
+
+class WeightedFairQueue:
+    '''
+    Queue holding routables in one FIFO per priority class. Classes are
+    dequeued by smooth weighted round robin, so each class with queued
+    routables gets a share proportional to its weight and no class is
+    ever starved.
+
+    Mirrors the parts of the queue.Queue interface used by components.
+    Depth and wait time per class are published as metrics named
+    queue.<name>.<class>.depth and queue.<name>.<class>.wait.
+    '''
+    def __init__(self, name: str, weights: Dict[str, int] = None) -> None:
+        self._name = name
+        self._weights = dict(weights or {configuration.PriorityClassConfiguration.DEFAULT: 1})
+        # Routables with the time they were enqueued and their size
+        self._queues: Dict[str, Deque[Tuple[float, int, routable.Routable]]] = {}
+        self._current: Dict[str, int] = {}
+        self._size = 0
+        # Running total of queued bytes, so footprints are read in
+        # constant time however much is queued
+        self._bytes = 0
+        # Number of times the queue ran empty
+        self._emptied = 0
+        self._condition = threading.Condition()
+        self._depth_gauges: Dict[str, metrics.Gauge] = {}
+        self._wait_gauges: Dict[str, metrics.Gauge] = {}
+        for priority_class in self._weights:
+            self._add_class(priority_class)
+
+    def _add_class(self, priority_class: str) -> None:
+        self._weights.setdefault(priority_class, 1)
+        self._queues[priority_class] = collections.deque()
+        self._current[priority_class] = 0
+        self._depth_gauges[priority_class] = metrics.gauge(f'queue.{self._name}.{priority_class}.depth')
+        self._wait_gauges[priority_class] = metrics.gauge(f'queue.{self._name}.{priority_class}.wait')
+
+    def put(self, r: routable.Routable) -> None:
+        '''
+        Enqueue routable in the queue of its priority class
+        '''
+        self.put_many([r])
+
+    def put_many(self, routables: List[routable.Routable]) -> None:
+        '''
+        Enqueue several routables taking the lock only once
+        '''
+        now = time.monotonic()
+        with self._condition:
+            for r in routables:
+                priority_class = r.priority_class
+                if priority_class not in self._queues:
+                    self._add_class(priority_class)
+                size = r.encoded_size
+                self._queues[priority_class].append((now, size, r))
+                self._bytes += size
+                self._depth_gauges[priority_class].set(len(self._queues[priority_class]))
+            self._size += len(routables)
+            self._condition.notify(len(routables))
+
+    def _next_class(self) -> str:
+        # Smooth weighted round robin over classes with queued routables
+        total = 0
+        best = None
+        for priority_class, q in self._queues.items():
+            if not q:
+                continue
+            weight = self._weights[priority_class]
+            self._current[priority_class] += weight
+            total += weight
+            if best is None or self._current[priority_class] > self._current[best]:
+                best = priority_class
+        self._current[best] -= total
+        return best
+
+    def _pop(self) -> routable.Routable:
+        priority_class = self._next_class()
+        q = self._queues[priority_class]
+        enqueued, size, r = q.popleft()
+        self._size -= 1
+        self._bytes -= size
+        if not self._size:
+            self._emptied += 1
+        self._depth_gauges[priority_class].set(len(q))
+        # Exponentially weighted moving average of wait time
+        wait_gauge = self._wait_gauges[priority_class]
+        wait_gauge.set(0.9 * wait_gauge.value + 0.1 * (time.monotonic() - enqueued))
+        return r
+
+    def get(self, block: bool = True, timeout: float = None) -> routable.Routable:
+        '''
+        Dequeue the next routable. Raises queue.Empty if none is
+        available within timeout
+        '''
+        return self.get_batch(1, block, timeout)[0]
+
+    def get_nowait(self) -> routable.Routable:
+        return self.get(block=False)
+
+    def get_batch(self, max_items: int, block: bool = True, timeout: float = None) -> List[routable.Routable]:
+        '''
+        Dequeue up to max_items routables in priority order, taking the
+        lock only once. Blocks until at least one routable is available,
+        raising queue.Empty if none is available within timeout
+        '''
+        with self._condition:
+            if not block:
+                if not self._size:
+                    raise queue.Empty
+            elif not self._condition.wait_for(lambda: self._size > 0, timeout):
+                raise queue.Empty
+            return [self._pop() for _ in range(min(max_items, self._size))]
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def emptied(self) -> int:
+        '''
+        Number of times the queue ran empty so far
+        '''
+        return self._emptied
+
+    def footprint(self) -> Tuple[int, int]:
+        '''
+        Get the number of queued routables and their size in bytes
+        '''
+        with self._condition:
+            return self._size, self._bytes
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        '''
+        Get depth and average wait time in seconds per priority class
+        '''
+        with self._condition:
+            return {
+                priority_class: {
+                    'depth': len(self._queues[priority_class]),
+                    'wait': self._wait_gauges[priority_class].value
+                }
+                for priority_class in self._queues
+            }
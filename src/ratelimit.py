@@ -0,0 +1,167 @@
+'''
+Rate limiting module
+'''
+import threading
+import time
+from typing import Dict, List
+
+import metrics
+
+class TokenBucket:
+    '''
+    Token bucket passing rate tokens per second on average, in bursts
+    of up to burst tokens. Taking more tokens than are available puts
+    the bucket in debt, which the taker waits out, so amounts larger
+    than the burst still pass
+    '''
+    def __init__(self, rate: float, burst: float = None) -> None:
+        self._rate = rate
+        self._burst = burst if burst is not None else rate
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def _refill(self, now: float) -> None:
+        # Must be called with lock held
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def set_rate(self, rate: float, burst: float = None) -> None:
+        '''
+        Change the rate, keeping the tokens accumulated so far
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            self._rate = rate
+            self._burst = burst if burst is not None else rate
+            self._tokens = min(self._tokens, self._burst)
+
+    def take(self, amount: float) -> float:
+        '''
+        Take tokens, returning the seconds to wait before going ahead
+        '''
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+
+class Shaper:
+    '''
+    Shapes what a worker sends to rates of instances and bytes per
+    second, taking from its own buckets and from those of the
+    destination group it shares with other workers. Senders wait out
+    the longest debt of any bucket before sending
+    '''
+    def __init__(self, name: str, instance_buckets: List[TokenBucket], byte_buckets: List[TokenBucket]) -> None:
+        self._instance_buckets = instance_buckets
+        self._byte_buckets = byte_buckets
+        self._delayed = metrics.counter(f'worker.{name}.shaping.delayed')
+        self._wait = metrics.gauge(f'worker.{name}.shaping.wait')
+
+    @property
+    def wait(self) -> float:
+        '''
+        Moving average of seconds sends are delayed by shaping
+        '''
+        return self._wait.value
+
+    def delay(self, count: int, size: int) -> float:
+        '''
+        Take count instances of size bytes in total, returning the
+        seconds to wait before sending them
+        '''
+        delay = 0.0
+        for bucket in self._instance_buckets:
+            delay = max(delay, bucket.take(count))
+        for bucket in self._byte_buckets:
+            delay = max(delay, bucket.take(size))
+        if delay > 0:
+            self._delayed.increment(count)
+        # Exponentially weighted moving average of delay
+        self._wait.set(0.9 * self._wait.value + 0.1 * delay)
+        return delay
+
+class AdaptiveLimit:
+    '''
+    Limit on concurrent sends to a peer, adapted to how the peer copes
+    (AIMD). The limit is raised by one after a limit's worth of sends
+    without the peer slowing down, and halved when sends fail or the
+    peer takes markedly longer than it did at its fastest, for sends of
+    a similar size
+    '''
+    # Factor the limit is multiplied by on backing off
+    BACKOFF_RATIO = 0.5
+    # Factor the baseline drifts up by per send, so it follows lasting
+    # changes of the peer or network rather than its best moment ever
+    BASELINE_DRIFT = 1.01
+
+    def __init__(self, name: str, floor: int, ceiling: int, latency_tolerance: float = 2.0) -> None:
+        self._floor = floor
+        self._ceiling = ceiling
+        self._latency_tolerance = latency_tolerance
+        self._limit = floor
+        # Seconds taken by the fastest recent send, per power of two of
+        # the size sent, as both fixed and per byte costs of the peer
+        # matter
+        self._baselines: Dict[int, float] = {}
+        self._successes = 0
+        # Sends still to be recorded which were in flight when backing off
+        self._holding = 0
+        self._lock = threading.Lock()
+        self._gauge = metrics.gauge(f'{name}.limit')
+        self._gauge.set(floor)
+        self._back_offs = metrics.counter(f'{name}.back-offs')
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def _set_limit(self, limit: int) -> None:
+        # Must be called with lock held
+        self._limit = limit
+        self._successes = 0
+        self._gauge.set(limit)
+
+    def _back_off(self) -> None:
+        # Must be called with lock held. Sends in flight met the same
+        # overload, so they do not back off again when they complete
+        self._holding = self._limit - 1
+        self._back_offs.increment()
+        self._set_limit(max(self._floor, int(self._limit * AdaptiveLimit.BACKOFF_RATIO)))
+
+    def record_success(self, latency: float, size: int) -> None:
+        '''
+        Record a send of size bytes the peer accepted after latency seconds
+        '''
+        size_class = size.bit_length()
+        with self._lock:
+            baseline = self._baselines.get(size_class)
+            slow = baseline is not None and latency > baseline * self._latency_tolerance
+            if baseline is None:
+                self._baselines[size_class] = latency
+            else:
+                self._baselines[size_class] = min(latency, baseline * AdaptiveLimit.BASELINE_DRIFT)
+            if self._holding:
+                self._holding -= 1
+            elif slow:
+                self._back_off()
+            else:
+                self._successes += 1
+                if self._successes >= self._limit and self._limit < self._ceiling:
+                    self._set_limit(self._limit + 1)
+
+    def record_failure(self) -> None:
+        '''
+        Record a send failing as the peer is overloaded or unavailable
+        '''
+        with self._lock:
+            if self._holding:
+                self._holding -= 1
+            else:
+                self._back_off()
@@ -0,0 +1,303 @@
+'''
+Replay module.
+
+Replays a captured trace against a relay. For each record, a synthetic
+instance with the recorded SOP class, tag values and size is sent to
+the SCP the original was received by, at the recorded pace or faster.
+Pixel data is zero filled and shared between instances, so replaying
+multi-frame outliers does not take memory per instance. Instances are
+always sent as explicit VR little endian.
+
+The relay described by the configuration can be started in this
+process, with stand-in SCPs accepting and discarding instances in
+place of its SCU workers, so production incidents can be reproduced
+offline. STOW-RS workers are stood in for by stand-in DICOMweb servers:
+
+    python src/replay.py --config-file-path config.json --trace trace.jsonl [--speed 2] [--start-relay] [--stand-in-workers]
+'''
+import argparse
+import logging
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Tuple
+
+import pydicom
+import pydicom.uid
+from pydicom.dataelem import DataElement
+import pynetdicom
+from pynetdicom import AE, evt
+
+import buffers
+import capture
+import configuration
+import dicom_loadbalancer
+import routable
+import storescu
+import stowrs
+
+# Pixel Data element header for explicit VR little endian, OB
+_PIXEL_DATA_HEADER = struct.Struct('<HH2s2xI')
+
+class InstanceFactory:
+    '''
+    Creates synthetic instances matching trace records
+    '''
+    def __init__(self) -> None:
+        self._zeros = memoryview(b'')
+        self._lock = threading.Lock()
+
+    def _padding(self, length: int) -> memoryview:
+        with self._lock:
+            if len(self._zeros) < length:
+                self._zeros = memoryview(bytes(max(length, 2 * len(self._zeros))))
+            return self._zeros[:length]
+
+    def create(self, record: Dict) -> routable.Routable:
+        dataset = pydicom.Dataset()
+        for key, (vr, value) in record['tags'].items():
+            dataset.add(DataElement(int(key, 16), vr, value))
+        dataset.SOPClassUID = record['sop-class-uid']
+        dataset.SOPInstanceUID = pydicom.uid.generate_uid()
+        header = routable.encode(dataset, pydicom.uid.ExplicitVRLittleEndian)
+        # Pad with pixel data up to the recorded size, keeping the
+        # value length even
+        pixel_length = max(0, record['size'] - len(header) - _PIXEL_DATA_HEADER.size) & ~1
+        encoded = buffers.SegmentedBuffer([
+            header,
+            _PIXEL_DATA_HEADER.pack(0x7FE0, 0x0010, b'OB', pixel_length),
+            self._padding(pixel_length)])
+        return routable.Routable(
+            record['scp-id'],
+            dataset,
+            record.get('priority', 0),
+            encoded,
+            pydicom.uid.ExplicitVRLittleEndian)
+
+class ReplayStats:
+    def __init__(self) -> None:
+        self.sent = 0
+        self.failed = 0
+        self.max_lag = 0.0
+        self.latencies: List[float] = []
+        self._lock = threading.Lock()
+
+    def add(self, success: bool, latency: float, lag: float) -> None:
+        with self._lock:
+            if success:
+                self.sent += 1
+                self.latencies.append(latency)
+            else:
+                self.failed += 1
+            self.max_lag = max(self.max_lag, lag)
+
+    def percentile(self, fraction: float) -> float:
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+class Replayer:
+    '''
+    Sends synthetic instances for trace records to the SCPs they were
+    received by, over a number of concurrent associations per SCP
+    '''
+    def __init__(self, endpoints: Dict[str, Tuple[str, str, int]], senders: int = 4, speed: float = 1) -> None:
+        # AE title, address and port per SCP id
+        self._endpoints = endpoints
+        self._senders = senders
+        self._speed = speed
+        self._factory = InstanceFactory()
+        self._logger = logging.getLogger(__name__)
+
+    def _send_loop(self, work: queue.Queue, sop_class_uids: List[str], start: float, stats: ReplayStats) -> None:
+        ae = AE()
+        ae.dimse_timeout = 600
+        for sop_class_uid in sop_class_uids:
+            ae.add_requested_context(sop_class_uid, pydicom.uid.ExplicitVRLittleEndian)
+        associations = {}
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            record, due = item
+            lag = time.monotonic() - start - due
+            success = False
+            sent_at = time.monotonic()
+            try:
+                r = self._factory.create(record)
+                assoc = associations.get(r.scp_id)
+                if assoc is None or not assoc.is_established:
+                    ae_title, address, port = self._endpoints[r.scp_id]
+                    assoc = associations[r.scp_id] = ae.associate(address, port, ae_title=ae_title)
+                if assoc.is_established:
+                    status = storescu.send_c_store(assoc, r)
+                    success = status is not None and status.Status == 0x0000
+            except Exception as exception:
+                self._logger.warning('Failed to replay instance: %s', exception)
+            stats.add(success, time.monotonic() - sent_at, lag)
+        for assoc in associations.values():
+            if assoc.is_established:
+                assoc.release()
+
+    def replay(self, records: List[Dict]) -> ReplayStats:
+        '''
+        Replay records, returning once all were sent
+        '''
+        stats = ReplayStats()
+        unknown_scp_ids = {r['scp-id'] for r in records} - set(self._endpoints)
+        if unknown_scp_ids:
+            raise configuration.ConfigurationError(f'Trace refers to unknown SCPs {", ".join(sorted(unknown_scp_ids))}')
+        # Presentation contexts are limited to 128
+        sop_class_uids = sorted({r['sop-class-uid'] for r in records})[:128]
+        work: queue.Queue = queue.Queue(self._senders * 2)
+        start = time.monotonic()
+        threads = [
+            threading.Thread(target=self._send_loop, args=(work, sop_class_uids, start, stats), daemon=True)
+            for _ in range(self._senders)]
+        for thread in threads:
+            thread.start()
+        first_time = records[0]['time'] if records else 0
+        for record in records:
+            due = (record['time'] - first_time) / self._speed if self._speed else 0
+            delay = due - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+            work.put((record, due))
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        return stats
+
+class StandInWorker:
+    '''
+    SCP accepting and discarding instances in place of a worker
+    '''
+    def __init__(self, ae_title: str, address: str, port: int) -> None:
+        self._ae = AE(ae_title=ae_title)
+        self._ae.supported_contexts = pynetdicom.StoragePresentationContexts
+        self._ae.add_supported_context(pynetdicom.sop_class.VerificationSOPClass)
+        self._ae.maximum_associations = 64
+        self._address = address
+        self._port = port
+        self._received = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def received(self) -> int:
+        return self._received
+
+    def _handle_store(self, event) -> int:
+        with self._lock:
+            self._received += 1
+        return 0x0000
+
+    def start(self) -> None:
+        self._server = self._ae.start_server(
+            (self._address, self._port),
+            block=False,
+            evt_handlers=[(evt.EVT_C_STORE, self._handle_store)])
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+
+def _wait_for_port(address: str, port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((address, port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def _connect_address(address: str) -> str:
+    return '127.0.0.1' if address in ('', '0.0.0.0') else address
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Replay a captured trace against a relay')
+    parser.add_argument(
+        '--config-file-path',
+        required=True,
+        type=str,
+        help='Path to configuration file or dir of the relay')
+    parser.add_argument(
+        '--trace',
+        required=True,
+        type=str,
+        help='Path to trace written in capture mode')
+    parser.add_argument(
+        '--speed',
+        default=1,
+        type=float,
+        help='Speed relative to the recorded pace, 0 to send as fast as possible')
+    parser.add_argument(
+        '--senders',
+        default=4,
+        type=int,
+        help='Number of concurrent associations')
+    parser.add_argument(
+        '--start-relay',
+        action='store_true',
+        help='Start the relay in this process')
+    parser.add_argument(
+        '--stand-in-workers',
+        action='store_true',
+        help='Start stand-in SCPs and STOW-RS servers in place of SCU and STOW-RS workers')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s')
+
+    config = configuration.Configuration(args.config_file_path)
+    stand_ins = []
+    if args.stand_in_workers:
+        for worker_config in config.workers():
+            if worker_config.type == configuration.WorkerConfiguration.TYPE_SCU:
+                stand_in = StandInWorker(worker_config.ae_title, worker_config.address, worker_config.port)
+            elif worker_config.type == configuration.WorkerConfiguration.TYPE_STOW_RS:
+                url = urllib.parse.urlsplit(worker_config.url)
+                stand_in = stowrs.StandInServer(url.hostname, url.port or 80)
+            else:
+                continue
+            stand_in.start()
+            stand_ins.append(stand_in)
+    endpoints = {
+        s.id: (s.ae_title, _connect_address(s.address), s.port)
+        for s in config.scps() if s.type == configuration.SCPConfiguration.TYPE_DICOM}
+    if args.start_relay:
+        dicom_loadbalancer.DicomLoadBalancer(config).start()
+        for _, address, port in endpoints.values():
+            _wait_for_port(address, port)
+
+    records = capture.read_trace(args.trace)
+    started = time.monotonic()
+    stats = Replayer(endpoints, args.senders, args.speed).replay(records)
+    duration = time.monotonic() - started
+    print(f'Replayed {len(records)} instances in {duration:.1f} s ({len(records) / duration if duration else 0:.1f}/s)')
+    print(f'Sent {stats.sent}, failed {stats.failed}, max lag {stats.max_lag:.3f} s')
+    print(f'C-STORE latency p50 {stats.percentile(0.5) * 1000:.1f} ms, p99 {stats.percentile(0.99) * 1000:.1f} ms')
+    if stand_ins:
+        # Give the relay time to forward what it received, until the
+        # stand-ins stop receiving
+        received = -1
+        while received != sum(s.received for s in stand_ins) and received < stats.sent:
+            received = sum(s.received for s in stand_ins)
+            time.sleep(5)
+        print(f'Stand-in workers received {sum(s.received for s in stand_ins)} instances')
+    sys.stdout.flush()
+    # Relay threads do not stop, so exit without joining them
+    os._exit(0 if not stats.failed else 1)
+
+if __name__ == '__main__':
+    sys.exit(main())
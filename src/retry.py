@@ -0,0 +1,162 @@
+'''
+Retry scheduling module
+'''
+import enum
+import heapq
+import itertools
+import random
+import time
+from typing import List, Optional, Tuple
+
+import pydicom
+
+import routable
+
+class FailureClass(enum.Enum):
+    '''
+    Classification of a failed attempt to relay an instance
+    '''
+    TRANSIENT = 0
+    PERMANENT = 1
+
+# C-STORE failure statuses which will never succeed on retry, see
+# PS3.4 Annex B.2.3 and PS3.7 Annex C
+_PERMANENT_STATUSES = frozenset([
+    0x0111, # Duplicate SOP instance
+    0x0117, # Invalid SOP instance
+    0x0122, # SOP class not supported
+    0x0124, # Refused: not authorized
+    0x0211, # Unrecognized operation
+    0x0212, # Mistyped argument
+])
+
+# Statuses which are considered successful, including warnings
+_SUCCESS_STATUSES = frozenset([0x0000, 0x0001, 0x0107, 0x0116, 0xB000, 0xB006, 0xB007])
+
+def classify_status(status: pydicom.Dataset) -> Optional[FailureClass]:
+    '''
+    Classify the status dataset returned by a C-STORE request.
+    Returns None if the instance was stored successfully
+    '''
+    if status is None or 'Status' not in status:
+        # No response from peer (timeout or abort)
+        return FailureClass.TRANSIENT
+    return classify_status_code(status.Status)
+
+def classify_status_code(code: int) -> Optional[FailureClass]:
+    '''
+    Classify a C-STORE status code.
+    Returns None if the code signals success
+    '''
+    if code in _SUCCESS_STATUSES:
+        return None
+    if code in _PERMANENT_STATUSES:
+        return FailureClass.PERMANENT
+    # Dataset does not match SOP class / cannot understand
+    if 0xA900 <= code <= 0xA9FF or 0xC000 <= code <= 0xCFFF:
+        return FailureClass.PERMANENT
+    # Out of resources, processing failures and anything unknown
+    # is assumed to be recoverable
+    return FailureClass.TRANSIENT
+
+class RetryPolicy:
+    '''
+    Jittered exponential backoff policy
+    '''
+    def __init__(self, max_attempts: int, initial_delay: float, max_delay: float) -> None:
+        self._max_attempts = max_attempts
+        self._initial_delay = initial_delay
+        self._max_delay = max_delay
+
+    @property
+    def max_attempts(self) -> int:
+        '''
+        Number of failed attempts after which an instance is dead lettered
+        '''
+        return self._max_attempts
+
+    def delay(self, attempts: int) -> float:
+        '''
+        Get the delay in seconds before the next attempt, given the
+        number of failed attempts so far
+        '''
+        if attempts < 1:
+            return 0.0
+        ceiling = min(self._max_delay, self._initial_delay * (2 ** min(attempts - 1, 32)))
+        # Equal jitter, so retries from many instances are spread out
+        # while never retrying immediately
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+class RetryEntry:
+    '''
+    Per-instance retry state
+    '''
+    def __init__(self, r: routable.Routable) -> None:
+        self._routable = r
+        self.attempts = 0
+        self.last_failure: Optional[str] = None
+
+    @property
+    def routable(self) -> routable.Routable:
+        return self._routable
+
+class RetryScheduler:
+    '''
+    Heap based scheduler holding instances until they are due for
+    (re)sending. Not thread safe; owned by a single worker thread.
+    '''
+    def __init__(self) -> None:
+        # Entries by due time, with the size of their routable
+        self._heap: List[Tuple[float, int, RetryEntry, int]] = []
+        self._sequence = itertools.count()
+        # Running total of held bytes, so footprints are read in
+        # constant time however much is held
+        self._bytes = 0
+
+    def schedule(self, entry: RetryEntry, delay: float = 0.0) -> None:
+        '''
+        Schedule entry to become due after delay seconds
+        '''
+        size = entry.routable.encoded_size if entry.routable is not None else 0
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), entry, size))
+        self._bytes += size
+
+    def pop_due(self, limit: int = 0) -> List[RetryEntry]:
+        '''
+        Remove and return entries which are due, in due order.
+        If limit is positive, at most limit entries are returned
+        '''
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, entry, size = heapq.heappop(self._heap)
+            self._bytes -= size
+            due.append(entry)
+            if limit and len(due) >= limit:
+                break
+        return due
+
+    def entries(self) -> List[RetryEntry]:
+        '''
+        Get all held entries in due order, without removing them. May be
+        called from other threads
+        '''
+        return [entry for _, _, entry, _ in sorted(list(self._heap), key=lambda item: item[:2])]
+
+    def next_due_in(self) -> Optional[float]:
+        '''
+        Seconds until the next entry is due, or None if empty
+        '''
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def footprint(self) -> Tuple[int, int]:
+        '''
+        Get the number of held entries and the size in bytes of their
+        routables. May be called from other threads
+        '''
+        return len(self._heap), self._bytes
+
+    def __len__(self) -> int:
+        return len(self._heap)
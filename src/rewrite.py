@@ -0,0 +1,304 @@
+'''
+Header rewrite module.
+
+Rewrites configured for a worker set are compiled into a pipeline
+which edits the encoded dataset of a routable. Only the rewritten top
+level elements are encoded anew. All other bytes, pixel data included,
+are shared with the original routable, which is left untouched so it
+can be rewritten differently for other destinations.
+'''
+import collections
+import hashlib
+import logging
+import re
+import struct
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pydicom
+import pydicom.charset
+import pydicom.datadict
+import pydicom.tag
+
+import buffers
+import configuration
+import metrics
+import routable
+
+_logger = logging.getLogger(__name__)
+
+# VRs holding character strings, which are the only ones rewritten
+STRING_VRS = {
+    'AE', 'AS', 'CS', 'DA', 'DS', 'DT', 'IS', 'LO', 'LT',
+    'PN', 'SH', 'ST', 'TM', 'UC', 'UI', 'UR', 'UT'}
+# VRs having a 4 byte length in explicit VR transfer syntaxes
+LONG_LENGTH_VRS = {
+    b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ',
+    b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM = 0xFFFEE000
+ITEM_DELIMITER = 0xFFFEE00D
+SEQUENCE_DELIMITER = 0xFFFEE0DD
+SPECIFIC_CHARACTER_SET = 0x00080005
+
+class UIDMapper:
+    '''
+    Maps UIDs to new UIDs consistently, so references between
+    instances survive remapping. New UIDs are derived from a salted
+    digest of the original under the 2.25 root, so the mapping is the
+    same across worker sets and restarts without storing a table.
+    Recently mapped UIDs are cached.
+    '''
+    def __init__(self, salt: str = '', max_entries: int = 100000) -> None:
+        self._salt = salt.encode('utf-8')
+        self._max_entries = max_entries
+        self._cache: 'collections.OrderedDict[str, str]' = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def map(self, uid: str) -> str:
+        '''
+        Get the UID replacing uid
+        '''
+        with self._lock:
+            mapped = self._cache.get(uid)
+            if mapped is not None:
+                self._cache.move_to_end(uid)
+                return mapped
+        digest = hashlib.blake2b(self._salt + uid.encode('ascii', 'replace'), digest_size=16).digest()
+        mapped = '2.25.' + str(int.from_bytes(digest, 'big'))
+        with self._lock:
+            self._cache[uid] = mapped
+            if len(self._cache) > self._max_entries:
+                self._cache.popitem(last=False)
+        return mapped
+
+# An operation takes the current value of an element, or None if it is
+# absent, and returns the new value, or None to remove the element
+Operation = Callable[[Optional[str]], Optional[str]]
+
+def _compile_operation(config: configuration.RewriteConfiguration, uid_mapper: UIDMapper) -> Operation:
+    if config.operation == configuration.RewriteConfiguration.SET:
+        value = config.value
+        return lambda old: value
+    if config.operation == configuration.RewriteConfiguration.DELETE:
+        return lambda old: None
+    if config.operation == configuration.RewriteConfiguration.REGEXP_REPLACE:
+        pattern = re.compile(config.regexp)
+        replacement = config.replacement
+        return lambda old: None if old is None else pattern.sub(replacement, old)
+    if config.operation == configuration.RewriteConfiguration.UID_REMAP:
+        return lambda old: None if old is None else '\\'.join(uid_mapper.map(uid) for uid in old.split('\\'))
+    raise configuration.ConfigurationError(f'Unknown rewrite operation {config.operation}')
+
+class _Target:
+    # All operations on a single element, applied in order
+    def __init__(self, tag: int, vr: str) -> None:
+        self.tag = tag
+        self.vr = vr
+        self.operations: List[Operation] = []
+
+    def apply(self, value: Optional[str]) -> Optional[str]:
+        for operation in self.operations:
+            value = operation(value)
+        return value
+
+def _encode_element(tag: int, vr: str, value: str, is_implicit_VR: bool, encoding: str) -> bytes:
+    data = value.encode(encoding, 'surrogateescape')
+    if len(data) % 2:
+        data += b'\0' if vr == 'UI' else b' '
+    if is_implicit_VR:
+        return struct.pack('<HHI', tag >> 16, tag & 0xFFFF, len(data)) + data
+    vr_bytes = vr.encode('ascii')
+    if vr_bytes in LONG_LENGTH_VRS:
+        return struct.pack('<HH2s2xI', tag >> 16, tag & 0xFFFF, vr_bytes, len(data)) + data
+    if len(data) > 0xFFFF:
+        raise ValueError(f'Value of ({tag >> 16:04X},{tag & 0xFFFF:04X}) too long for VR {vr}')
+    return struct.pack('<HH2sH', tag >> 16, tag & 0xFFFF, vr_bytes, len(data)) + data
+
+def _read_tag(view: memoryview, position: int) -> int:
+    group, element = struct.unpack_from('<HH', view, position)
+    return group << 16 | element
+
+def _read_header(view: memoryview, position: int, is_implicit_VR: bool) -> Tuple[int, Optional[bytes], int, int]:
+    # Returns tag, VR (None if implicit), value length and header length
+    tag = _read_tag(view, position)
+    if is_implicit_VR or tag >> 16 == 0xFFFE:
+        length, = struct.unpack_from('<I', view, position + 4)
+        return tag, None, length, 8
+    vr = bytes(view[position + 4:position + 6])
+    if vr in LONG_LENGTH_VRS:
+        length, = struct.unpack_from('<I', view, position + 8)
+        return tag, vr, length, 12
+    length, = struct.unpack_from('<H', view, position + 6)
+    return tag, vr, length, 8
+
+def _skip_sequence(view: memoryview, position: int, is_implicit_VR: bool) -> int:
+    # Skip items of an undefined length sequence or encapsulated pixel
+    # data, returning the position following the sequence delimiter
+    while True:
+        tag = _read_tag(view, position)
+        length, = struct.unpack_from('<I', view, position + 4)
+        position += 8
+        if tag == SEQUENCE_DELIMITER:
+            return position
+        if tag != ITEM:
+            raise ValueError(f'Unexpected tag {tag:08X} in sequence')
+        if length == UNDEFINED_LENGTH:
+            position = _skip_item(view, position, is_implicit_VR)
+        else:
+            position += length
+
+def _skip_item(view: memoryview, position: int, is_implicit_VR: bool) -> int:
+    # Skip elements of an undefined length item, returning the position
+    # following the item delimiter
+    while True:
+        if _read_tag(view, position) == ITEM_DELIMITER:
+            return position + 8
+        position = _skip_element(view, position, is_implicit_VR)
+
+def _skip_element(view: memoryview, position: int, is_implicit_VR: bool) -> int:
+    tag, vr, length, header_length = _read_header(view, position, is_implicit_VR)
+    position += header_length
+    if length != UNDEFINED_LENGTH:
+        return position + length
+    # Undefined length UN elements are encoded as implicit VR
+    return _skip_sequence(view, position, is_implicit_VR or vr == b'UN')
+
+def _encoding(value: bytes) -> str:
+    terms = value.decode('ascii', 'replace').strip(' \0').split('\\')
+    if len(terms) > 1:
+        # Code extensions are not interpreted, latin-1 at least keeps
+        # bytes of values which are not rewritten intact
+        return 'latin_1'
+    return pydicom.charset.python_encoding.get(terms[0].strip(), 'latin_1')
+
+class RewritePipeline:
+    '''
+    Rewrites compiled from configuration, applied to routables
+    '''
+    def __init__(self, configs: List[configuration.RewriteConfiguration], uid_mapper: UIDMapper = None) -> None:
+        uid_mapper = uid_mapper or UIDMapper()
+        targets: Dict[int, _Target] = {}
+        for config in configs:
+            tag = config.tag[0] << 16 | config.tag[1]
+            target = targets.get(tag)
+            if target is None:
+                target = targets[tag] = _Target(tag, self._vr(config))
+            target.operations.append(_compile_operation(config, uid_mapper))
+        self._targets: List[_Target] = [targets[tag] for tag in sorted(targets)]
+        self._groups = {target.tag >> 16 for target in self._targets}
+        self._rewritten = metrics.counter('rewrite.rewritten')
+        self._decoded = metrics.counter('rewrite.decoded')
+
+    def _vr(self, config: configuration.RewriteConfiguration) -> str:
+        tag_str = f'({config.tag[0]:04X},{config.tag[1]:04X})'
+        vr = config.vr
+        if vr is None:
+            try:
+                vr = pydicom.datadict.dictionary_VR(config.tag)
+            except KeyError:
+                if config.operation == configuration.RewriteConfiguration.SET:
+                    raise configuration.ConfigurationError(f'Rewrite setting {tag_str} must specify a VR')
+                vr = 'UN'
+        if vr not in STRING_VRS and config.operation != configuration.RewriteConfiguration.DELETE:
+            raise configuration.ConfigurationError(f'Rewrite of {tag_str} with VR {vr} not supported, only string values can be rewritten')
+        return vr
+
+    def __len__(self) -> int:
+        return len(self._targets)
+
+    def apply(self, r: routable.Routable) -> routable.Routable:
+        '''
+        Get a routable with rewrites applied. The given routable is
+        not modified, and is returned as is if there are no rewrites
+        '''
+        if not self._targets:
+            return r
+        self._rewritten.increment()
+        transfer_syntax = r.transfer_syntax
+        if transfer_syntax.is_deflated or not transfer_syntax.is_little_endian:
+            # Rare enough to not warrant editing in place
+            self._decoded.increment()
+            return r.with_encoded(self._rewrite_dataset(r))
+        segments = buffers.segments(r.encoded)
+        view = segments[0] if len(segments) == 1 else memoryview(b''.join(segments))
+        return r.with_encoded(self._rewrite_encoded(view.cast('B'), transfer_syntax.is_implicit_VR))
+
+    def _rewrite_encoded(self, view: memoryview, is_implicit_VR: bool) -> buffers.SegmentedBuffer:
+        segments = []
+        # Start of the bytes not yet copied to segments
+        copied = 0
+        position = 0
+        index = 0
+        encoding = 'latin_1'
+
+        def replace(start: int, end: int, target: _Target, vr: str, value: Optional[str]) -> None:
+            # Replace bytes from start to end with an element, or with
+            # nothing if value is None
+            nonlocal copied
+            segments.append(view[copied:start])
+            if value is not None:
+                segments.append(_encode_element(target.tag, vr, value, is_implicit_VR, encoding))
+            copied = end
+
+        while position < len(view) and index < len(self._targets):
+            tag, vr, length, header_length = _read_header(view, position, is_implicit_VR)
+            if length == UNDEFINED_LENGTH:
+                end = _skip_sequence(view, position + header_length, is_implicit_VR or vr == b'UN')
+            else:
+                end = position + header_length + length
+            # Add targets which are absent
+            while index < len(self._targets) and self._targets[index].tag < tag:
+                target = self._targets[index]
+                value = target.apply(None)
+                if value is not None:
+                    replace(position, position, target, target.vr, value)
+                index += 1
+            if index < len(self._targets) and self._targets[index].tag == tag:
+                target = self._targets[index]
+                element_vr = vr.decode('ascii') if vr is not None else target.vr
+                if element_vr in STRING_VRS:
+                    old_value = bytes(view[position + header_length:end]).decode(encoding, 'surrogateescape').rstrip(' \0')
+                    value = target.apply(old_value)
+                    if value != old_value:
+                        replace(position, end, target, element_vr, value)
+                elif target.apply('') is None:
+                    # Other values can only be deleted
+                    replace(position, end, target, element_vr, None)
+                index += 1
+            elif tag & 0xFFFF == 0 and tag >> 16 in self._groups:
+                # Group lengths of rewritten groups would be wrong
+                replace(position, end, None, None, None)
+            if tag == SPECIFIC_CHARACTER_SET:
+                encoding = _encoding(bytes(view[position + header_length:end]))
+            position = end
+
+        # Add targets following the last element
+        for target in self._targets[index:]:
+            value = target.apply(None)
+            if value is not None:
+                replace(len(view), len(view), target, target.vr, value)
+        segments.append(view[copied:])
+        return buffers.SegmentedBuffer(segments)
+
+    def _rewrite_dataset(self, r: routable.Routable) -> bytes:
+        dataset = routable.decode(r.encoded, r.transfer_syntax)
+        for target in self._targets:
+            tag = pydicom.tag.Tag(target.tag)
+            old_value = None
+            if tag in dataset:
+                element = dataset[tag]
+                if element.VR not in STRING_VRS:
+                    if target.apply('') is None:
+                        del dataset[tag]
+                    continue
+                old_value = '\\'.join(str(v) for v in element.value) if element.VM > 1 else str(element.value or '')
+            value = target.apply(old_value)
+            if value is None:
+                if tag in dataset:
+                    del dataset[tag]
+            elif tag in dataset:
+                dataset[tag].value = value
+            else:
+                dataset.add_new(tag, target.vr, value)
+        return routable.encode(dataset, r.transfer_syntax)
@@ -1,9 +1,92 @@
+import io
+import zlib
+from typing import Callable, Optional
+
 import pydicom
+import pydicom.filereader
+import pydicom.filewriter
+import pydicom.uid
+from pydicom.filebase import DicomBytesIO
+
+import buffers
+
+# Tag at which header decoding stops, so pixel data is never decoded
+PIXEL_DATA_GROUP = 0x7FE0
+
+def _stop_at_pixel_data(tag, vr, length) -> bool:
+    return tag.group >= PIXEL_DATA_GROUP
+
+def _open(encoded, transfer_syntax: pydicom.uid.UID) -> io.BufferedIOBase:
+    if transfer_syntax.is_deflated:
+        return io.BytesIO(zlib.decompress(b''.join(buffers.segments(encoded)), -zlib.MAX_WBITS))
+    return buffers.open_buffer(encoded)
+
+def decode_header(encoded: bytes, transfer_syntax: str) -> pydicom.Dataset:
+    '''
+    Decode the elements of an encoded dataset preceding pixel data
+    '''
+    transfer_syntax = pydicom.uid.UID(transfer_syntax)
+    return pydicom.filereader.read_dataset(
+        _open(encoded, transfer_syntax),
+        transfer_syntax.is_implicit_VR,
+        transfer_syntax.is_little_endian,
+        stop_when=_stop_at_pixel_data)
+
+def decode(encoded: bytes, transfer_syntax: str) -> pydicom.Dataset:
+    '''
+    Decode a full encoded dataset
+    '''
+    transfer_syntax = pydicom.uid.UID(transfer_syntax)
+    return pydicom.filereader.read_dataset(
+        _open(encoded, transfer_syntax),
+        transfer_syntax.is_implicit_VR,
+        transfer_syntax.is_little_endian)
+
+def encode(dataset: pydicom.Dataset, transfer_syntax: str) -> bytes:
+    '''
+    Encode dataset, without file meta information
+    '''
+    transfer_syntax = pydicom.uid.UID(transfer_syntax)
+    fp = DicomBytesIO()
+    fp.is_little_endian = transfer_syntax.is_little_endian
+    fp.is_implicit_VR = transfer_syntax.is_implicit_VR
+    pydicom.filewriter.write_dataset(fp, dataset)
+    encoded = fp.getvalue()
+    if transfer_syntax.is_deflated:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        encoded = compressor.compress(encoded) + compressor.flush()
+    return encoded
 
 class Routable:
-    def __init__(self, scp_id: str, dataset: pydicom.Dataset) -> None:
+    '''
+    A received instance on its way through the relay.
+
+    Instances are carried in their encoded form, as received, so they
+    can be relayed without being re-encoded. Only the header preceding
+    pixel data is decoded, and only when needed for routing.
+    '''
+    def __init__(
+        self,
+        scp_id: str,
+        dataset: pydicom.Dataset = None,
+        c_store_priority: int = 0,
+        encoded: bytes = None,
+        transfer_syntax: str = None) -> None:
         self._scp_id = scp_id
         self._dataset = dataset
+        self._c_store_priority = c_store_priority
+        self._encoded = encoded
+        if transfer_syntax is None:
+            file_meta = getattr(dataset, 'file_meta', None)
+            transfer_syntax = getattr(file_meta, 'TransferSyntaxUID', pydicom.uid.ExplicitVRLittleEndian)
+        self._transfer_syntax = pydicom.uid.UID(transfer_syntax)
+        self.priority_class = 'default'
+        # Called once a worker has sent or given up on the routable, or
+        # it was dropped, with whether it was sent
+        self.on_completed: Optional[Callable[[bool], None]] = None
+        # Whether the source keeps the instance until completed and
+        # ingests it again after a restart, so it is not snapshotted
+        self.kept_by_source = False
 
     @property
     def scp_id(self) -> str:
@@ -11,4 +94,79 @@ class Routable:
 
     @property
     def dataset(self) -> pydicom.Dataset:
-        return self._dataset
\ No newline at end of file
+        '''
+        The dataset, or for routables created from encoded data only
+        the header preceding pixel data
+        '''
+        if self._dataset is None:
+            self._dataset = decode_header(self._encoded, self._transfer_syntax)
+        return self._dataset
+
+    @property
+    def encoded_size(self) -> int:
+        '''
+        Size in bytes of the encoded dataset, or 0 if not encoded yet
+        '''
+        return len(self._encoded) if self._encoded is not None else 0
+
+    @property
+    def encoded(self) -> bytes:
+        '''
+        The encoded dataset, without file meta information
+        '''
+        if self._encoded is None:
+            self._encoded = encode(self._dataset, self._transfer_syntax)
+        return self._encoded
+
+    @property
+    def transfer_syntax(self) -> pydicom.uid.UID:
+        '''
+        Transfer syntax of the encoded dataset
+        '''
+        return self._transfer_syntax
+
+    @property
+    def sop_class_uid(self) -> str:
+        return str(self.dataset.SOPClassUID)
+
+    @property
+    def sop_instance_uid(self) -> str:
+        return str(self.dataset.SOPInstanceUID)
+
+    @property
+    def c_store_priority(self) -> int:
+        '''
+        Priority of the C-STORE request the routable was received by
+        (0 medium, 1 high, 2 low)
+        '''
+        return self._c_store_priority
+
+    def full_dataset(self) -> pydicom.Dataset:
+        '''
+        Decode the full dataset, including pixel data, with file meta
+        information
+        '''
+        dataset = decode(self.encoded, self._transfer_syntax)
+        dataset.file_meta = self.file_meta()
+        return dataset
+
+    def file_meta(self) -> pydicom.dataset.FileMetaDataset:
+        '''
+        Create file meta information describing the encoded dataset
+        '''
+        file_meta = pydicom.dataset.FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = self.sop_class_uid
+        file_meta.MediaStorageSOPInstanceUID = self.sop_instance_uid
+        file_meta.TransferSyntaxUID = self._transfer_syntax
+        file_meta.ImplementationClassUID = pydicom.uid.PYDICOM_IMPLEMENTATION_UID
+        return file_meta
+
+    def with_encoded(self, encoded: bytes) -> 'Routable':
+        '''
+        Create a copy of this routable carrying different encoded data
+        '''
+        r = Routable(self._scp_id, None, self._c_store_priority, encoded, self._transfer_syntax)
+        r.priority_class = self.priority_class
+        r.on_completed = self.on_completed
+        r.kept_by_source = self.kept_by_source
+        return r
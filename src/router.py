@@ -3,40 +3,129 @@ import threading
 
 import threading
 import logging
-import routable
 import queue
+import catalog
+import routable
+import priority
+import worker
 import workerset
-from typing import Dict, List
+import hash_functions
+import pydicom
+from typing import Dict, List, Optional, Tuple
+
+def select_partition(routers: List['Router'], dataset: pydicom.Dataset) -> 'Router':
+    '''
+    Select the router for a dataset. Routers are partitioned by patient,
+    so all instances of a patient pass through the same router in the
+    order they were received
+    '''
+    partition_key = dataset.get('PatientID') or dataset.get('StudyInstanceUID') or ''
+    return routers[hash_functions.random(str(partition_key), len(routers))]
 
 class Router(threading.Thread):
-    def __init__(self, id: str, worker_sets: Dict[str, workerset.WorkerSet]) -> None:
+    # Maximum number of routables taken from the queue at once
+    BATCH_SIZE = 64
+
+    def __init__(
+        self,
+        id: str,
+        worker_sets: Dict[str, workerset.WorkerSet],
+        priority_weights: Dict[str, int] = None,
+        catalog: catalog.CatalogWriter = None) -> None:
         threading.Thread.__init__(self)
         self._id: str = id
         self._logger = logging.getLogger(__name__)
-        self._queue: queue.Queue[routable.Routable] = queue.Queue()
+        self._queue = priority.WeightedFairQueue(id, priority_weights)
         self._worker_sets: List[workerset.WorkerSet] = list(worker_sets.values())
+        self._stopped = threading.Event()
+        self._catalog = catalog
+
+    def _select_worker_set(self, r: routable.Routable) -> Optional[workerset.WorkerSet]:
+        # Find a workerset which will accept this routable
+        for worker_set in self._worker_sets:
+            if worker_set.can_accept(r):
+                return worker_set
+        self._logger.warning('No worker sets accepting routable from %s. Dropping routable.', r.scp_id)
+        return None
+
+    def plan_batch(
+        self,
+        batch: List[routable.Routable]) -> List[Tuple[Optional[workerset.WorkerSet], Optional[worker.Worker]]]:
+        '''
+        Select the worker set and worker of each routable in batch,
+        without handing them off. Either is None for routables which
+        are dropped
+        '''
+        plan = []
+        for r in batch:
+            worker_set = self._select_worker_set(r)
+            w = None
+            if worker_set is not None:
+                # New studies may be diverted while its workers are far behind
+                worker_set = worker_set.divert(r)
+                # Select the worker on the original headers, so
+                # rewrites do not affect which worker gets a patient
+                w = worker_set.select_worker(r)
+            if w is None and r.on_completed is not None:
+                # Dropped, so never completed by a worker
+                r.on_completed(False)
+            plan.append((worker_set, w))
+        return plan
 
     def run(self):
         self._logger.info(f'Starting router {self._id}')
-        while True:
-            # Get the routable
-            r = self._queue.get(block=True)
-            self._logger.debug(f'Routing routable in {self.id}')
-            # Find a workerset which will accept this routable
-            routed = False
-            for worker_set in self._worker_sets:
-                if worker_set.can_accept(r):
-                    # Asynchronously hand the routable off to the workerset
-                    worker_set.consume(r)
-                    routed = True
-                    break
-            if not routed:
-                self._logger.warn(f'No worker sets accepting routable from {r.scp_id}. Dropping routable.')
+        while not self._stopped.is_set():
+            # Get a batch of routables, waking up now and then to
+            # notice being stopped
+            try:
+                batch = self._queue.get_batch(Router.BATCH_SIZE, block=True, timeout=1)
+            except queue.Empty:
+                continue
+            self._logger.debug('Routing %d routables in %s', len(batch), self._id)
+            # Group routables per worker, preserving order, so each
+            # worker is handed its share in a single enqueue
+            hand_offs: Dict[worker.Worker, List[routable.Routable]] = {}
+            for r, (worker_set, w) in zip(batch, self.plan_batch(batch)):
+                if w is None:
+                    continue
+                # Catalogued as sent, after rewrites
+                r = worker_set.rewrite(r)
+                hand_offs.setdefault(w, []).append(r)
+                if self._catalog is not None:
+                    self._catalog.routed(r, worker_set.id, w.id)
+            for w, routables in hand_offs.items():
+                # Asynchronously hand the routables off to the worker
+                w.process_many(routables)
+
+    def stop(self) -> None:
+        '''
+        Stop routing after the current batch. What is still queued is
+        not routed
+        '''
+        self._stopped.set()
+
+    def snapshot(self) -> List[Tuple[routable.Routable, int]]:
+        '''
+        Take what is still queued, once the router is stopped
+        '''
+        size = self._queue.qsize()
+        if not size:
+            return []
+        return [(r, 0) for r in self._queue.get_batch(size, block=False)]
 
     def route(self, r: routable.Routable) -> bool:
         # Asynchronously hand over routable to the router
         self._queue.put(r)
 
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def footprints(self) -> Dict[str, Tuple[int, int]]:
+        '''
+        Number of routables and bytes held, per queue of this router
+        '''
+        return {'queue': self._queue.footprint()}
+
     @property
     def id(self):
         return self._id
\ No newline at end of file
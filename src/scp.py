@@ -10,10 +10,16 @@ from pydicom.uid import ExplicitVRLittleEndian
 from pynetdicom import AE, debug_logger, evt
 import pynetdicom.sop_class
 import pynetdicom
+import pydicom
 import configuration
 import logging
 import router
 import routable
+import dedup
+import priority
+import spool
+import capture
+import admission
 
 #debug_logger()
 
@@ -29,7 +35,14 @@ import routable
 #ae.start_server(("127.0.0.1", 11112), block=True, evt_handlers=handlers)
 
 class SCP(threading.Thread):
-    def __init__(self, config: configuration.SCPConfiguration, routers: Dict[str, router.Router]) -> None:
+    def __init__(
+        self,
+        config: configuration.SCPConfiguration,
+        routers: Dict[str, router.Router],
+        dedup_index: dedup.DeduplicationIndex = None,
+        classifier: priority.PriorityClassifier = None,
+        instance_spool: spool.Spool = None,
+        recorder: capture.TraceRecorder = None) -> None:
         threading.Thread.__init__(self)
         self._logger = logging.getLogger(__name__)
         self._id = config.id
@@ -37,37 +50,98 @@ class SCP(threading.Thread):
         self._ae_title = config.ae_title
         self._address = config.address
         self._port = config.port
-        self._routers = list(routers.values())
+        # Shared with the load balancer, which may add routers
+        self._routers = routers
         self._ae = None
-        self._current_router_index = 0
+        self._dedup_index = dedup_index
+        self._classifier = classifier or priority.PriorityClassifier([])
+        self._spool = instance_spool
+        self._recorder = recorder
+        self._admission = None
+        if config.admission.enabled:
+            self._admission = admission.AdmissionController(config.id, config.admission)
+        self._max_associations = config.admission.max_associations
 
-    def _next_router(self) -> router.Router:
-        # Round robin over available routers
-        self._current_router_index = (self._current_router_index + 1) % len(self._routers)
-        return self._routers[self._current_router_index]
+    def _select_router(self, dataset: pydicom.Dataset) -> router.Router:
+        return router.select_partition(list(self._routers.values()), dataset)
+
+    def _completed(self, key: bytes, sent: bool) -> None:
+        # Instances re-sent while this one is on its way are dropped,
+        # but once it was dropped or dead lettered they are relayed
+        if not sent:
+            self._dedup_index.forget(key)
 
     def _handle_store(self, event: pynetdicom.events.Event):
+        encoded = event.request.DataSet.getvalue()
+        if self._admission is not None:
+            # Delaying the response slows down calling AEs over their rate
+            self._admission.throttle(event.assoc, len(encoded))
+        # Drop instances already received, before paying for decoding
+        key = None
+        if self._dedup_index is not None:
+            key = dedup.instance_key(event.request.AffectedSOPInstanceUID, encoded)
+            if self._dedup_index.seen(key):
+                self._logger.debug('Dropping duplicate instance %s', event.request.AffectedSOPInstanceUID)
+                return 0x0000
         # Create a routable to encapsulate DICOM
-        # and required meta data
-        r = routable.Routable(self._id, event.dataset)
-        router = self._next_router()
+        # and required meta data. The instance is kept encoded as
+        # received, along with its transfer syntax, so it can be relayed
+        # and stored without being decoded and encoded again
+        r = routable.Routable(
+            self._id,
+            c_store_priority=event.request.Priority,
+            encoded=encoded,
+            transfer_syntax=event.context.transfer_syntax)
+        r.priority_class = self._classifier.classify(r)
+        if key is not None:
+            r.on_completed = lambda sent: self._completed(key, sent)
+        if self._recorder is not None:
+            self._recorder.record(r)
+        router = self._select_router(r.dataset)
         # Hand routable off to router in a buffered
         # non-blocking way
-        self._logger.debug(f'Routing via {router.id}')
+        self._logger.debug('Routing via %s', router.id)
         router.route(r)
         return 0x0000
 
     def _handle_echo(self):
         return 0x0000
 
+    def _handle_requested(self, event: pynetdicom.events.Event):
+        if self._admission is not None:
+            calling_ae = event.assoc.requestor.primitive.calling_ae_title
+            if isinstance(calling_ae, bytes):
+                calling_ae = calling_ae.decode('ascii', 'replace')
+            rejection = self._admission.admit(event.assoc, calling_ae.strip())
+            if rejection is not None:
+                # Reject before negotiating, and wait for the peer to
+                # close the connection as ACSE does
+                event.assoc.acse.send_reject(*rejection)
+                event.assoc.kill()
+                return
+        # Large instances are streamed to disk as they are received
+        if self._spool is not None:
+            self._spool.install(event.assoc)
+
+    def _handle_closed(self, event: pynetdicom.events.Event):
+        if self._admission is not None:
+            self._admission.release(event.assoc)
+
     def run(self):
         self._logger.info(f'Starting SCP {self._id} on {self._address}:{self._port}')
         handlers = [
             (evt.EVT_C_STORE, self._handle_store),
-            (evt.EVT_C_ECHO, self._handle_echo)
+            (evt.EVT_C_ECHO, self._handle_echo),
+            (evt.EVT_REQUESTED, self._handle_requested),
+            (evt.EVT_CONN_CLOSE, self._handle_closed)
             ]
 
         self._ae = AE()
+        if self._admission is not None:
+            # Limits are enforced by admission control, which rejects
+            # with reasons of its own. Rejected associations still count
+            # here until closed, so leave room for them
+            self._ae.maximum_associations = 2 * self._max_associations
         self._ae.add_supported_context("1.2.840.10008.1.1")
         self._ae.add_supported_context(pynetdicom.sop_class.MRImageStorage, ExplicitVRLittleEndian)
         self._ae.add_supported_context(pynetdicom.sop_class.CTImageStorage, ExplicitVRLittleEndian)
@@ -75,6 +149,13 @@ class SCP(threading.Thread):
         self._ae.add_supported_context(pynetdicom.sop_class.EnhancedMRImageStorage, ExplicitVRLittleEndian)
         self._ae.start_server((self._address, self._port), block=True, evt_handlers=handlers)        
 
+    def stop(self) -> None:
+        '''
+        Stop accepting associations, aborting those still open
+        '''
+        if self._ae is not None:
+            self._ae.shutdown()
+
     @property
     def id(self):
         return self._id
@@ -0,0 +1,330 @@
+'''
+Routing simulator module.
+
+Shows what a configuration would do to load distribution before it is
+deployed. DICOM headers are read from a directory, or from a manifest
+file listing one DICOM file path per line, by several processes which
+only read the elements routing depends on. They are then routed in
+batches through the worker sets of the configuration, without any
+network, and counted per worker. Given the current configuration too,
+it reports how many instances and patients the new one would move:
+
+    python src/simulate.py --config-file-path new.json --input /archive [--current-config-file-path config.json] [--scp-id ID] [--json]
+
+Patients are placed by hashing, as with affinity disabled.
+'''
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import pydicom
+import pydicom.tag
+
+import configuration
+import hash_functions
+import priority
+import rewrite
+import routable
+import router
+import workerset
+
+# Number of files read per task of a reader process
+CHUNK_SIZE = 500
+# Number of tasks queued per reader process
+TASKS_PER_PROCESS = 4
+
+PATIENT_ID = (0x0010, 0x0020)
+
+# Tags to read, set in reader processes
+_tags: List[pydicom.tag.BaseTag] = []
+
+class SimulatedWorker:
+    '''
+    Stands in for a worker, as the simulation only counts what each
+    worker would receive
+    '''
+    def __init__(self, worker_id: str) -> None:
+        self._id = worker_id
+
+    @property
+    def id(self) -> str:
+        return self._id
+
+    @property
+    def accepting(self) -> bool:
+        return True
+
+    def process(self, data: routable.Routable):
+        pass
+
+    def process_many(self, data: List[routable.Routable]):
+        pass
+
+    def queue_depth(self) -> int:
+        return 0
+
+def _init_reader(tags: List[Tuple[int, int]]) -> None:
+    global _tags
+    _tags = [pydicom.tag.Tag(tag) for tag in tags]
+
+def read_headers(paths: List[str]) -> List[Tuple[int, Optional[pydicom.Dataset]]]:
+    '''
+    Read the size and routing elements of DICOM files. The dataset is
+    None for files which cannot be read
+    '''
+    headers = []
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            file_dataset = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=_tags)
+            dataset = pydicom.Dataset()
+            for tag in _tags:
+                if tag in file_dataset:
+                    dataset.add(file_dataset[tag])
+            headers.append((size, dataset))
+        except Exception:
+            headers.append((0, None))
+    return headers
+
+def iter_paths(input_path: str) -> Iterator[str]:
+    '''
+    Iterate over the files in a directory, recursively, or over the
+    paths listed in a manifest file
+    '''
+    if os.path.isdir(input_path):
+        dir_paths = [input_path]
+        while dir_paths:
+            with os.scandir(dir_paths.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dir_paths.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path
+    else:
+        with open(input_path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+def _chunks(items: Iterable[str], size: int) -> Iterator[List[str]]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def read_all_headers(paths: Iterable[str], tags: List[Tuple[int, int]], processes: int) -> Iterator[List[Tuple[int, Optional[pydicom.Dataset]]]]:
+    '''
+    Read headers in a pool of processes, yielding them in chunks. Only
+    a few chunks are queued at a time, so paths are listed as they are
+    read rather than up front
+    '''
+    with multiprocessing.Pool(processes, initializer=_init_reader, initargs=(tags,)) as pool:
+        pending = collections.deque()
+        for chunk in _chunks(paths, CHUNK_SIZE):
+            pending.append(pool.apply_async(read_headers, (chunk,)))
+            if len(pending) >= processes * TASKS_PER_PROCESS:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+class Simulation:
+    '''
+    Routes headers through the worker sets of a configuration, counting
+    instances and bytes per worker
+    '''
+    def __init__(self, config: configuration.Configuration, scp_id: str) -> None:
+        self._scp_id = scp_id
+        self._worker_set_configs = config.worker_sets()
+        workers = {w.id: SimulatedWorker(w.id) for w in config.workers()}
+        self._classifier = priority.PriorityClassifier(config.core().priority_classes)
+        uid_mapper = rewrite.UIDMapper(config.core().uid_remap_salt)
+        worker_sets = {}
+        for worker_set_config in self._worker_set_configs:
+            ws = workerset.WorkerSet(
+                worker_set_config, workers, hash_functions.get(worker_set_config.hash_function), uid_mapper)
+            worker_sets[ws.id] = ws
+        self._router = router.Router('SIMULATOR', worker_sets, self._classifier.weights)
+        # Instances and bytes per worker set and worker
+        self._counts: Dict[Tuple[str, str], List[int]] = collections.defaultdict(lambda: [0, 0])
+        self._unmatched = 0
+        self._dropped = 0
+
+    def route_batch(self, headers: List[Tuple[int, pydicom.Dataset]]) -> List[Optional[str]]:
+        '''
+        Route a batch of headers with their sizes, returning the id of
+        the worker each is routed to, or None if dropped
+        '''
+        batch = []
+        for _, dataset in headers:
+            r = routable.Routable(self._scp_id, dataset)
+            r.priority_class = self._classifier.classify(r)
+            batch.append(r)
+        worker_ids = []
+        for (size, _), (worker_set, w) in zip(headers, self._router.plan_batch(batch)):
+            if worker_set is None:
+                self._unmatched += 1
+                worker_ids.append(None)
+            elif w is None:
+                self._dropped += 1
+                worker_ids.append(None)
+            else:
+                counts = self._counts[(worker_set.id, w.id)]
+                counts[0] += 1
+                counts[1] += size
+                worker_ids.append(w.id)
+        return worker_ids
+
+    def report(self) -> Dict:
+        '''
+        Summarise instances and bytes per worker, and the imbalance of
+        each worker set as the ratio of its busiest worker to the mean
+        '''
+        worker_sets = []
+        for worker_set_config in self._worker_set_configs:
+            workers = [{
+                'id': worker_id,
+                'instances': self._counts[(worker_set_config.id, worker_id)][0],
+                'bytes': self._counts[(worker_set_config.id, worker_id)][1]
+            } for worker_id in worker_set_config.worker_ids]
+            entry = {'id': worker_set_config.id, 'workers': workers}
+            for key in ['instances', 'bytes']:
+                total = sum(w[key] for w in workers)
+                mean = total / len(workers) if workers else 0
+                entry[key] = total
+                entry[f'{key}-imbalance'] = max(w[key] for w in workers) / mean if mean else None
+            worker_sets.append(entry)
+        return {
+            'worker-sets': worker_sets,
+            'unmatched': self._unmatched,
+            'dropped-no-patient-id': self._dropped
+        }
+
+def simulate(
+    config: configuration.Configuration,
+    input_path: str,
+    scp_id: str,
+    current_config: configuration.Configuration = None,
+    processes: int = None) -> Dict:
+    '''
+    Route the headers in input_path through config, and optionally
+    current_config, returning a report
+    '''
+    simulation = Simulation(config, scp_id)
+    tags = set(config.routing_tags())
+    current = None
+    if current_config is not None:
+        current = Simulation(current_config, scp_id)
+        tags.update(current_config.routing_tags())
+    unreadable = 0
+    moved_instances = 0
+    patients: Set[str] = set()
+    moved_patients: Set[str] = set()
+    for headers in read_all_headers(iter_paths(input_path), sorted(tags), processes or os.cpu_count()):
+        unreadable += sum(1 for _, dataset in headers if dataset is None)
+        headers = [h for h in headers if h[1] is not None]
+        worker_ids = simulation.route_batch(headers)
+        if current is None:
+            continue
+        for (_, dataset), worker_id, current_worker_id in zip(headers, worker_ids, current.route_batch(headers)):
+            patient_id = str(dataset.get(PATIENT_ID).value) if PATIENT_ID in dataset else ''
+            patients.add(patient_id)
+            if worker_id != current_worker_id:
+                moved_instances += 1
+                moved_patients.add(patient_id)
+    report = simulation.report()
+    report['unreadable'] = unreadable
+    if current is not None:
+        report['current'] = current.report()
+        report['moved-instances'] = moved_instances
+        report['moved-patients'] = len(moved_patients)
+        report['patients'] = len(patients)
+    return report
+
+def _ratio(value: Optional[float]) -> str:
+    return '-' if value is None else f'{value:.2f}'
+
+def format_report(report: Dict) -> str:
+    lines = []
+    for worker_set in report['worker-sets']:
+        lines.append(f'Worker set {worker_set["id"]}')
+        lines.append(f'  {"worker":<20} {"instances":>12} {"share":>7} {"bytes":>16} {"share":>7}')
+        for w in worker_set['workers']:
+            instance_share = w['instances'] / worker_set['instances'] if worker_set['instances'] else 0
+            byte_share = w['bytes'] / worker_set['bytes'] if worker_set['bytes'] else 0
+            lines.append(
+                f'  {w["id"]:<20} {w["instances"]:>12} {instance_share:>7.1%} {w["bytes"]:>16} {byte_share:>7.1%}')
+        lines.append(
+            f'  imbalance (max / mean): instances {_ratio(worker_set["instances-imbalance"])}, '
+            f'bytes {_ratio(worker_set["bytes-imbalance"])}')
+    lines.append(f'Unmatched by any worker set: {report["unmatched"]}')
+    lines.append(f'Dropped without patient id: {report["dropped-no-patient-id"]}')
+    lines.append(f'Unreadable: {report["unreadable"]}')
+    if 'current' in report:
+        lines.append(
+            f'Moved versus current configuration: {report["moved-instances"]} instances, '
+            f'{report["moved-patients"]} of {report["patients"]} patients')
+    return '\n'.join(lines)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Simulate routing of DICOM instances with a configuration')
+    parser.add_argument(
+        '--config-file-path',
+        required=True,
+        type=str,
+        help='Path to configuration file or dir to simulate')
+    parser.add_argument(
+        '--input',
+        required=True,
+        type=str,
+        help='Dir of DICOM files, or manifest file listing DICOM file paths')
+    parser.add_argument(
+        '--current-config-file-path',
+        type=str,
+        help='Path to configuration file or dir to compare with')
+    parser.add_argument(
+        '--scp-id',
+        type=str,
+        help='SCP the instances are received by (default first configured SCP)')
+    parser.add_argument(
+        '--processes',
+        type=int,
+        help='Number of processes reading headers (default number of CPUs)')
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Print report as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s')
+    # Dropped instances are reported in the summary instead
+    logging.getLogger('router').setLevel(logging.ERROR)
+    logging.getLogger('workerset').setLevel(logging.ERROR)
+
+    config = configuration.Configuration(args.config_file_path)
+    current_config = None
+    if args.current_config_file_path:
+        current_config = configuration.Configuration(args.current_config_file_path)
+    scp_id = args.scp_id
+    if scp_id is None:
+        if not config.scps():
+            logging.error('No SCPs configured, specify --scp-id')
+            return 1
+        scp_id = config.scps()[0].id
+    report = simulate(config, args.input, scp_id, current_config, args.processes)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+'''
+Snapshot module.
+
+On shutdown, instances still queued in routers and workers are written
+to snapshot files under the buffer dir, one per queue, and restored on
+the next start before listeners open, so a restart loses nothing and
+modalities need not re-send. Instances kept by their source, such as
+files in a drop folder, are left out, as the source ingests them again.
+
+A snapshot file starts with a magic string, followed by a record per
+instance: the lengths of its metadata and of its encoded dataset, the
+metadata as JSON and the encoded dataset as received. Datasets are
+written from their buffers and read back without being re-encoded,
+large ones as memory mapped views of the snapshot file.
+'''
+import json
+import logging
+import os
+import struct
+from typing import Dict, Iterator, List, Tuple
+
+import buffers
+import dicomfile
+import routable
+
+MAGIC = b'DLBSNAP1'
+SUFFIX = '.snapshot'
+_RECORD = struct.Struct('<IQ')
+
+_logger = logging.getLogger(__name__)
+
+def write(path: str, entries: List[Tuple[routable.Routable, int]]) -> None:
+    '''
+    Write routables with the number of attempts made to send them to a
+    snapshot file. The file is written under a temporary name and
+    renamed once synced, so a partial snapshot is never restored
+    '''
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC)
+        for r, attempts in entries:
+            metadata = json.dumps({
+                'scp-id': r.scp_id,
+                'transfer-syntax': str(r.transfer_syntax),
+                'c-store-priority': r.c_store_priority,
+                'priority-class': r.priority_class,
+                'attempts': attempts
+            }).encode('utf-8')
+            encoded = r.encoded
+            f.write(_RECORD.pack(len(metadata), len(encoded)))
+            f.write(metadata)
+            f.writelines(buffers.segments(encoded))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def read(path: str) -> Iterator[Tuple[routable.Routable, int]]:
+    '''
+    Read routables with the number of attempts made to send them from
+    a snapshot file
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a snapshot file')
+        while True:
+            header = f.read(_RECORD.size)
+            if not header:
+                return
+            if len(header) < _RECORD.size:
+                raise ValueError(f'Snapshot file {path} is truncated')
+            metadata_length, encoded_length = _RECORD.unpack(header)
+            metadata = json.loads(f.read(metadata_length).decode('utf-8'))
+            if encoded_length > dicomfile.MAP_THRESHOLD:
+                encoded = buffers.FileBuffer(path, f.tell(), length=encoded_length)
+                f.seek(encoded_length, os.SEEK_CUR)
+            else:
+                encoded = f.read(encoded_length)
+            if len(encoded) < encoded_length:
+                raise ValueError(f'Snapshot file {path} is truncated')
+            r = routable.Routable(
+                metadata['scp-id'],
+                c_store_priority=metadata['c-store-priority'],
+                encoded=encoded,
+                transfer_syntax=metadata['transfer-syntax'])
+            r.priority_class = metadata['priority-class']
+            yield r, metadata['attempts']
+
+def save(dir_path: str, snapshots: Dict[str, List[Tuple[routable.Routable, int]]]) -> int:
+    '''
+    Write a snapshot file per queue name, returning the number of
+    routables written. Routables kept by their source are left out
+    '''
+    os.makedirs(dir_path, exist_ok=True)
+    count = 0
+    for name, entries in snapshots.items():
+        entries = [(r, attempts) for r, attempts in entries if not r.kept_by_source]
+        if not entries:
+            continue
+        write(os.path.join(dir_path, name + SUFFIX), entries)
+        count += len(entries)
+    return count
+
+def load(dir_path: str) -> Dict[str, List[Tuple[routable.Routable, int]]]:
+    '''
+    Read and remove all snapshot files, by queue name. Memory mapped
+    datasets stay readable once the files are removed
+    '''
+    snapshots = {}
+    if not os.path.isdir(dir_path):
+        return snapshots
+    for file_name in sorted(os.listdir(dir_path)):
+        if not file_name.endswith(SUFFIX):
+            continue
+        path = os.path.join(dir_path, file_name)
+        try:
+            snapshots[file_name[:-len(SUFFIX)]] = list(read(path))
+        except (OSError, ValueError, KeyError) as exception:
+            # Keep the file for inspection rather than losing it
+            _logger.error('Failed to restore snapshot %s: %s', path, exception)
+            os.replace(path, path + '.failed')
+            continue
+        os.remove(path)
+    return snapshots
@@ -0,0 +1,111 @@
+'''
+Spool module.
+
+pynetdicom collects the data set of a received DIMSE message in
+memory. Data sets growing beyond a threshold, typically enhanced
+multi-frame instances, are instead streamed to a spool file as their
+P-DATA arrives, and relayed from there as a memory mapped FileBuffer.
+'''
+import io
+import logging
+import os
+import uuid
+import weakref
+
+from pynetdicom.dimse_messages import DIMSEMessage
+
+import buffers
+import metrics
+
+def _discard(f: io.BufferedWriter, path: str) -> None:
+    # Spool file of a data set which was never completely received
+    f.close()
+    if os.path.isfile(path):
+        os.remove(path)
+
+class SpoolBuffer(io.BytesIO):
+    '''
+    Stands in for the in-memory buffer a DIMSE message collects its
+    data set in, moving the data set to a spool file once it grows
+    beyond threshold bytes
+    '''
+    def __init__(self, dir_path: str, threshold: int) -> None:
+        io.BytesIO.__init__(self)
+        self._dir_path = dir_path
+        self._threshold = threshold
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._value = None
+        self._finalizer = None
+
+    def write(self, data: bytes) -> int:
+        if self._file is None and self._size + len(data) > self._threshold:
+            self._path = os.path.join(self._dir_path, f'{uuid.uuid4()}.spool')
+            self._file = open(self._path, 'wb')
+            self._file.write(io.BytesIO.getvalue(self))
+            self.truncate(0)
+            # Remove the spool file if the data set is never completed,
+            # for example when the association is aborted
+            self._finalizer = weakref.finalize(self, _discard, self._file, self._path)
+            metrics.counter('spool.files').increment()
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            io.BytesIO.write(self, data)
+        self._size += len(data)
+        return len(data)
+
+    def getvalue(self) -> buffers.Buffer:
+        '''
+        Get the data set received, as bytes or, if spooled, as a
+        buffer mapping the spool file
+        '''
+        if self._value is not None:
+            return self._value
+        if self._file is None:
+            return io.BytesIO.getvalue(self)
+        self._finalizer.detach()
+        self._file.close()
+        self._value = buffers.FileBuffer(self._path, unlink=True)
+        return self._value
+
+class Spool:
+    '''
+    Spools large data sets received over associations to files in a
+    directory. Files are unlinked once received completely, so they
+    only take up disk space while instances referring to them are
+    in flight.
+    '''
+    def __init__(self, dir_path: str, threshold: int) -> None:
+        self._dir_path = dir_path
+        self._threshold = threshold
+        self._logger = logging.getLogger(__name__)
+        os.makedirs(dir_path, exist_ok=True)
+        # Files left behind by a previous run belong to instances which
+        # were never acknowledged, so the sender will send them again
+        for entry in os.scandir(dir_path):
+            if entry.name.endswith('.spool'):
+                self._logger.info(f'Removing stale spool file {entry.path}')
+                os.remove(entry.path)
+
+    @property
+    def threshold(self) -> int:
+        return self._threshold
+
+    def install(self, assoc) -> None:
+        '''
+        Make messages received over association spool their data sets
+        '''
+        dimse = assoc.dimse
+        receive_primitive = dimse.receive_primitive
+
+        def spooling_receive_primitive(primitive):
+            # Give each new message a spooling data set buffer before
+            # pynetdicom creates one
+            if dimse.message is None:
+                dimse.message = DIMSEMessage()
+                dimse.message.data_set = SpoolBuffer(self._dir_path, self._threshold)
+            receive_primitive(primitive)
+
+        dimse.receive_primitive = spooling_receive_primitive
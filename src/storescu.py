@@ -0,0 +1,109 @@
+'''
+C-STORE of encoded instances.
+
+pynetdicom only sends pydicom datasets, which it encodes for every
+request. Routables are carried encoded as received, so when the peer
+accepted their transfer syntax the encoded bytes are sent as they are.
+'''
+import io
+import queue
+import time
+from typing import Optional
+
+import pydicom
+from pynetdicom.dimse_primitives import C_STORE
+from pynetdicom.presentation import PresentationContext
+
+import buffers
+import routable
+
+# Maximum number of P-DATA fragments waiting to be sent by pynetdicom
+MAX_PENDING_FRAGMENTS = 64
+# Seconds between checks of the pending fragments, should a fragment
+# being taken go unnoticed
+PENDING_CHECK_INTERVAL = 0.1
+
+class _ThrottledBuffer:
+    # pynetdicom slices the data set into P-DATA fragments and queues
+    # all of them for sending at once. Holding back slicing while the
+    # queue is full keeps large instances from being copied into memory
+    # as a whole. Taking a fragment off a queue.Queue notifies its
+    # not_full condition, also when the queue is unbounded, so slicing
+    # waits on that rather than polling
+    def __init__(self, encoded: buffers.Buffer, pending: queue.Queue) -> None:
+        self._encoded = encoded
+        self._pending = pending
+
+    def __len__(self) -> int:
+        return len(self._encoded)
+
+    def __getitem__(self, key: slice) -> bytes:
+        with self._pending.not_full:
+            # qsize() takes the lock already held
+            while self._pending._qsize() > MAX_PENDING_FRAGMENTS:
+                self._pending.not_full.wait(PENDING_CHECK_INTERVAL)
+        return self._encoded[key]
+
+class _EncodedDataSet(io.BytesIO):
+    # pynetdicom only calls getvalue() on the data set of a request and
+    # slices the result into P-DATA fragments, so any sliceable buffer
+    # can stand in for the bytes
+    def __init__(self, encoded) -> None:
+        io.BytesIO.__init__(self)
+        self._encoded = encoded
+
+    def getvalue(self):
+        return self._encoded
+
+def _find_context(assoc, r: routable.Routable) -> Optional[PresentationContext]:
+    # Only an exact transfer syntax match allows sending as encoded
+    for context in assoc.accepted_contexts:
+        if (context.abstract_syntax == r.sop_class_uid
+                and context.transfer_syntax[0] == r.transfer_syntax
+                and context.as_scu):
+            return context
+    return None
+
+def send_c_store(assoc, r: routable.Routable, msg_id: int = 1) -> pydicom.Dataset:
+    '''
+    Send routable over an established association, returning the
+    C-STORE response status. Falls back to letting pynetdicom decode and
+    convert the instance if no accepted presentation context has the
+    transfer syntax of the routable. Raises like
+    pynetdicom.Association.send_c_store
+    '''
+    if not assoc.is_established:
+        raise RuntimeError('The association with a peer SCP must be established before sending a C-STORE request')
+
+    context = _find_context(assoc, r)
+    if context is None:
+        return assoc.send_c_store(r.full_dataset(), msg_id, r.c_store_priority)
+
+    req = C_STORE()
+    req.MessageID = msg_id
+    req.AffectedSOPClassUID = r.sop_class_uid
+    req.AffectedSOPInstanceUID = r.sop_instance_uid
+    req.Priority = r.c_store_priority
+    encoded = r.encoded
+    if not assoc.dimse.maximum_pdu_size:
+        # Unlimited PDU size sends the data set as a single fragment,
+        # which must be bytes
+        encoded = b''.join(buffers.segments(encoded))
+    else:
+        encoded = _ThrottledBuffer(encoded, assoc.dul.to_provider_queue)
+    req.DataSet = _EncodedDataSet(encoded)
+
+    # Same sequence as pynetdicom.Association.send_c_store: pause the
+    # reactor so it does not consume the response
+    assoc._reactor_checkpoint.clear()
+    while not assoc._is_paused:
+        time.sleep(0.0001)
+    assoc.dimse.send_msg(req, context.context_id)
+    _, rsp = assoc.dimse.get_msg(block=True)
+    assoc._reactor_checkpoint.set()
+
+    if rsp is None:
+        # DIMSE timeout expired
+        assoc._handle_no_response()
+        return pydicom.Dataset()
+    return assoc._check_received_status(rsp)
@@ -0,0 +1,338 @@
+'''
+STOW-RS module.
+
+Stores instances with DICOMweb STOW-RS (PS3.18 section 10.5), several
+per multipart/related request, over a pool of keep-alive HTTP
+connections. Instances are sent as DICOM files straight from their
+encoded form, and request bodies can be gzip compressed.
+
+Also provides a stand-in STOW-RS server accepting and discarding
+instances, in place of a DICOMweb archive in tests and replay.
+'''
+import gzip
+import http.client
+import http.server
+import io
+import json
+import re
+import socketserver
+import threading
+import urllib.parse
+import uuid
+import zlib
+from typing import Dict, List, Optional, Set, Tuple
+
+import pydicom
+
+import buffers
+import dicomfile
+import retry
+import routable
+
+# Response attributes, in DICOM JSON (PS3.18 F.2)
+FAILED_SOP_SEQUENCE = '00081198'
+REFERENCED_SOP_SEQUENCE = '00081199'
+REFERENCED_SOP_CLASS_UID = '00081150'
+REFERENCED_SOP_INSTANCE_UID = '00081155'
+FAILURE_REASON = '00081197'
+
+# Request statuses which will never succeed on retry: a malformed
+# request or unsupported media type
+_PERMANENT_STATUSES = frozenset([400, 415])
+# Status of a request too large for the peer to accept
+REQUEST_TOO_LARGE = 413
+# Size in bytes below which parts of the body are copied together
+COALESCE_SIZE = 64 * 1024
+
+_BOUNDARY = re.compile(r'boundary="?([^";]+)"?')
+
+class ConnectionPool:
+    '''
+    Keep-alive HTTP connections to a single origin. Connections are
+    taken for the duration of a request, so there are as many as there
+    are concurrent requests
+    '''
+    def __init__(self, url: str, timeout: float = 60) -> None:
+        parts = urllib.parse.urlsplit(url)
+        self._https = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path or '/'
+        if parts.query:
+            self._path += '?' + parts.query
+        self._timeout = timeout
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self._https:
+            return http.client.HTTPSConnection(self._host, self._port, timeout=self._timeout)
+        return http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+
+    def request(self, method: str, body: List, headers: Dict[str, str]) -> Tuple[int, bytes]:
+        '''
+        Send a request with a body given as a list of bytes-like
+        objects, returning the response status and body
+        '''
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        reused = connection is not None
+        if connection is None:
+            connection = self._connect()
+        while True:
+            try:
+                connection.request(method, self._path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if not reused:
+                    raise
+                # The peer closed the idle connection, retry once on a
+                # new one
+                reused = False
+                connection = self._connect()
+            except BaseException:
+                connection.close()
+                raise
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                self._idle.append(connection)
+        return response.status, data
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+def encode_multipart(routables: List[routable.Routable], boundary: str) -> List:
+    '''
+    Encode routables as the parts of a multipart/related body, one
+    DICOM file per part. Encoded datasets are referred to, not copied
+    '''
+    body = []
+    # Small pieces are joined, so they are not sent one by one
+    pending = bytearray()
+    delimiter = f'--{boundary}\r\nContent-Type: application/dicom\r\n\r\n'.encode('ascii')
+    for r in routables:
+        pending += delimiter
+        pending += dicomfile.encode_file_meta(r)
+        for segment in buffers.segments(r.encoded):
+            if len(segment) < COALESCE_SIZE:
+                pending += segment
+                continue
+            body.append(bytes(pending))
+            pending.clear()
+            body.append(segment)
+        pending += b'\r\n'
+    pending += f'--{boundary}--\r\n'.encode('ascii')
+    body.append(bytes(pending))
+    return body
+
+def _compress(body: List) -> bytes:
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return b''.join([compressor.compress(chunk) for chunk in body] + [compressor.flush()])
+
+class StowClient:
+    '''
+    Sends STOW-RS requests to a single URL
+    '''
+    def __init__(self, url: str, timeout: float = 60, compress: bool = False, headers: Dict[str, str] = None) -> None:
+        self._url = url
+        self._pool = ConnectionPool(url, timeout)
+        self._compress = compress
+        self._headers = headers or {}
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    def store(self, routables: List[routable.Routable]) -> Tuple[int, bytes]:
+        '''
+        Store routables in a single request, returning the response
+        status and body. Raises OSError or http.client.HTTPException if
+        no response is received
+        '''
+        boundary = uuid.uuid4().hex
+        body = encode_multipart(routables, boundary)
+        headers = dict(self._headers)
+        headers['Content-Type'] = f'multipart/related; type="application/dicom"; boundary={boundary}'
+        headers['Accept'] = 'application/dicom+json'
+        if self._compress:
+            # Batches are bounded in size, so compress in one go to send
+            # a Content-Length, which more servers accept than chunked
+            body = [_compress(body)]
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(sum(len(chunk) for chunk in body))
+        return self._pool.request('POST', body, headers)
+
+    def close(self) -> None:
+        self._pool.close()
+
+def parse_failures(body: bytes) -> Dict[str, int]:
+    '''
+    Get the failure reason per SOP instance UID from the failed SOP
+    sequence of a DICOM JSON response body
+    '''
+    try:
+        response = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return {}
+    if isinstance(response, list):
+        response = response[0] if response else {}
+    failures = {}
+    for item in response.get(FAILED_SOP_SEQUENCE, {}).get('Value', []):
+        uids = item.get(REFERENCED_SOP_INSTANCE_UID, {}).get('Value', [])
+        reasons = item.get(FAILURE_REASON, {}).get('Value', [])
+        if uids:
+            failures[uids[0]] = reasons[0] if reasons else None
+    return failures
+
+def classify_response(status: int, body: bytes, sop_instance_uids: List[str]) -> List[Tuple[Optional[retry.FailureClass], str]]:
+    '''
+    Classify the outcome of a STOW-RS request for each instance, with a
+    reason for failures. The class is None for stored instances
+    '''
+    if 200 <= status < 300 and status != 202:
+        return [(None, '')] * len(sop_instance_uids)
+    if status in (202, 409):
+        # Some (202) or all (409) instances failed, as listed in the
+        # failed SOP sequence with C-STORE failure reasons
+        failures = parse_failures(body)
+        outcomes = []
+        for uid in sop_instance_uids:
+            if uid in failures and failures[uid] is not None:
+                code = failures[uid]
+                failure = retry.classify_status_code(code)
+                outcomes.append((failure, f'STOW-RS failure reason 0x{code:04X}' if failure else ''))
+            elif uid in failures or status == 409:
+                outcomes.append((retry.FailureClass.TRANSIENT, f'STOW-RS status {status}'))
+            else:
+                outcomes.append((None, ''))
+        return outcomes
+    if status in _PERMANENT_STATUSES:
+        return [(retry.FailureClass.PERMANENT, f'STOW-RS status {status}')] * len(sop_instance_uids)
+    # Authorization, throttling and server errors may be resolved later
+    return [(retry.FailureClass.TRANSIENT, f'STOW-RS status {status}')] * len(sop_instance_uids)
+
+def peer_failed(status: int) -> bool:
+    '''
+    Whether a response status shows the peer is not accepting
+    instances at all, rather than rejecting specific ones
+    '''
+    return status >= 400 and status not in _PERMANENT_STATUSES and status != REQUEST_TOO_LARGE
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                length = int(self.rfile.readline().split(b';')[0], 16)
+                chunks.append(self.rfile.read(length))
+                self.rfile.readline()
+                if not length:
+                    break
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _respond(self, status: int, body: bytes = b'') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/dicom+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        self._respond(200)
+
+    def do_POST(self):
+        server: StandInServer = self.server.stand_in
+        body = self._read_body()
+        match = _BOUNDARY.search(self.headers.get('Content-Type', ''))
+        if match is None:
+            self._respond(415)
+            return
+        if server.status is not None:
+            server.add(0)
+            self._respond(server.status)
+            return
+        stored, failed = [], []
+        delimiter = b'--' + match.group(1).encode('ascii')
+        for part in body.split(delimiter)[1:-1]:
+            content = part[part.index(b'\r\n\r\n') + 4:-2]
+            dataset = pydicom.dcmread(io.BytesIO(content), stop_before_pixels=True)
+            item = {
+                REFERENCED_SOP_CLASS_UID: {'vr': 'UI', 'Value': [str(dataset.SOPClassUID)]},
+                REFERENCED_SOP_INSTANCE_UID: {'vr': 'UI', 'Value': [str(dataset.SOPInstanceUID)]}
+            }
+            if dataset.SOPInstanceUID in server.failed_uids:
+                item[FAILURE_REASON] = {'vr': 'US', 'Value': [server.failure_reason]}
+                failed.append(item)
+            else:
+                stored.append(item)
+        server.add(len(stored))
+        response = {}
+        if stored:
+            response[REFERENCED_SOP_SEQUENCE] = {'vr': 'SQ', 'Value': stored}
+        if failed:
+            response[FAILED_SOP_SEQUENCE] = {'vr': 'SQ', 'Value': failed}
+        status = 200 if not failed else 202 if stored else 409
+        self._respond(status, json.dumps(response).encode('utf-8'))
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class StandInServer:
+    '''
+    STOW-RS server accepting and discarding instances, in place of a
+    DICOMweb archive. Instances with UIDs in failed_uids are rejected
+    with failure_reason, and if status is set all requests are
+    answered with it
+    '''
+    def __init__(self, address: str = '127.0.0.1', port: int = 0) -> None:
+        self._server = _ThreadingHTTPServer((address, port), _StandInHandler)
+        self._server.stand_in = self
+        self.status: Optional[int] = None
+        self.failed_uids: Set[str] = set()
+        self.failure_reason = 0xA700
+        self._received = 0
+        self._requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        address, port = self._server.server_address[:2]
+        return f'http://{address}:{port}/studies'
+
+    @property
+    def received(self) -> int:
+        return self._received
+
+    @property
+    def requests(self) -> int:
+        return self._requests
+
+    def add(self, received: int) -> None:
+        with self._lock:
+            self._received += received
+            self._requests += 1
+
+    def start(self) -> None:
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -2,30 +2,72 @@
 Worker module
 '''
 import threading
-import datetime
 import threading
 import logging
 import queue
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 import abc
+import http.client
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from pynetdicom import AE
 from pynetdicom.sop_class import CTImageStorage
 from pynetdicom.sop_class import MRImageStorage
+from pynetdicom.sop_class import EnhancedCTImageStorage
+from pynetdicom.sop_class import EnhancedMRImageStorage
 
+import catalog
 import configuration
+import dicomfile
+import hash_functions
 import routable
 import livenesschecker
+import metrics
+import retry
+import deadletter
+import priority
+import ratelimit
+import storescu
+import stowrs
+
+def _partition_by_patient(entries: List[retry.RetryEntry], count: int) -> List[List[retry.RetryEntry]]:
+    # Split entries into up to count non-empty groups, keeping the
+    # instances of a patient together and in order
+    if count <= 1:
+        return [entries]
+    groups: List[List[retry.RetryEntry]] = [[] for _ in range(count)]
+    for entry in entries:
+        patient_id = entry.routable.dataset.get('PatientID') or ''
+        groups[hash_functions.crc32(str(patient_id), count)].append(entry)
+    return [group for group in groups if group]
 
 class Worker(threading.Thread, metaclass=abc.ABCMeta):
-    def __init__(self, config: configuration.WorkerConfiguration) -> None:
+    # Seconds a paused worker waits before checking if it was resumed
+    PAUSE_INTERVAL = 0.5
+    # Settings which can be changed while running, mapped to the
+    # attributes holding them
+    TUNABLES: Dict[str, str] = {}
+
+    def __init__(
+        self,
+        config: configuration.WorkerConfiguration,
+        priority_weights: Dict[str, int] = None,
+        shaper: ratelimit.Shaper = None,
+        catalog: catalog.CatalogWriter = None) -> None:
         threading.Thread.__init__(self)
         self._id = config.id
         self._logger = logging.getLogger(__name__)
         self._name = config.name
-        self._queue = queue.Queue()
-        
+        self._queue = priority.WeightedFairQueue(config.id, priority_weights)
+        self._stopped = threading.Event()
+        self._paused = threading.Event()
+        self._draining = False
+        self._shaper = shaper
+        self._catalog = catalog
+        self._completed_count = metrics.counter(f'worker.{config.id}.completed')
+
     @property
     def id(self) -> str:
         return self._id
@@ -34,12 +76,174 @@ class Worker(threading.Thread, metaclass=abc.ABCMeta):
     def name(self) -> str:
         return self._name
 
+    @property
+    def accepting(self) -> bool:
+        '''
+        Whether new patients may be routed to this worker. Draining and
+        stopped workers only finish what they hold
+        '''
+        return not self._draining and not self._stopped.is_set()
+
+    @property
+    def state(self) -> str:
+        if self._stopped.is_set():
+            return 'stopped'
+        if self._paused.is_set():
+            return 'paused'
+        if self._draining:
+            return 'draining' if self.held() else 'drained'
+        return 'running'
+
+    def pause(self) -> None:
+        '''
+        Stop sending after the current batch, holding on to everything
+        queued, until resumed
+        '''
+        self._paused.set()
+        self._logger.info(f'Paused worker {self._id}')
+
+    def resume(self) -> None:
+        '''
+        Resume sending, and accept new patients again after draining
+        '''
+        self._draining = False
+        self._paused.clear()
+        self._logger.info(f'Resumed worker {self._id}')
+
+    def drain(self) -> None:
+        '''
+        Keep sending what is held, while new patients are routed to
+        other workers of the worker set
+        '''
+        self._draining = True
+        self._logger.info(f'Draining worker {self._id}')
+
+    def stop(self) -> None:
+        '''
+        Stop the worker after the current batch. What is still held is
+        not sent
+        '''
+        self._stopped.set()
+
+    def _wait_while_paused(self) -> bool:
+        # Returns whether the worker is paused, waiting a little so the
+        # run loop does not spin
+        if not self._paused.is_set():
+            return False
+        self._stopped.wait(Worker.PAUSE_INTERVAL)
+        return True
+
+    def _shape(self, count: int, size: int) -> None:
+        # Wait until the shaper lets count instances of size bytes
+        # through, or the worker is stopped
+        if self._shaper is None:
+            return
+        delay = self._shaper.delay(count, size)
+        if delay > 0:
+            self._stopped.wait(delay)
+
+    def _completed(self, r: routable.Routable, status: str) -> None:
+        # Record an instance being sent, dead lettered or dropped, also
+        # in the catalog
+        self._completed_count.increment()
+        if self._catalog is not None:
+            self._catalog.completed(r, self._id, status)
+        if r.on_completed is not None:
+            r.on_completed(status == catalog.SENT)
+
+    def settings(self) -> Dict[str, Any]:
+        '''
+        Current values of the settings which can be retuned
+        '''
+        return {name: getattr(self, attribute) for name, attribute in self.TUNABLES.items()}
+
+    def retune(self, settings: Dict[str, Any]) -> None:
+        '''
+        Change settings while running, taking effect from the next batch
+        '''
+        unknown = [name for name in settings if name not in self.TUNABLES]
+        if unknown:
+            raise ValueError(f'Worker {self._id} has no settings {", ".join(sorted(unknown))}')
+        for name, value in settings.items():
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise ValueError(f'Setting {name} of worker {self._id} must be a positive integer, not {value!r}')
+        for name, value in settings.items():
+            setattr(self, self.TUNABLES[name], value)
+        self._logger.info(f'Retuned worker {self._id}: {settings}')
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'name': self._name,
+            'state': self.state,
+            'queue-depth': self.queue_depth(),
+            'held': self.held(),
+            'queue-wait': {priority_class: stats['wait'] for priority_class, stats in self._queue.stats().items()},
+            'shaping-wait': self._shaper.wait if self._shaper is not None else 0.0,
+            'settings': self.settings()
+        }
+
     def process(self, data: routable.Routable):
         self._queue.put(data)
 
+    def process_many(self, data: List[routable.Routable]):
+        self._queue.put_many(data)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def held(self) -> int:
+        '''
+        Number of routables queued or otherwise not yet sent
+        '''
+        return self.queue_depth()
+
+    def completed(self) -> int:
+        '''
+        Number of routables sent, dead lettered or dropped so far
+        '''
+        return self._completed_count.value
+
+    def queue_emptied(self) -> int:
+        '''
+        Number of times the queue ran empty so far
+        '''
+        return self._queue.emptied()
+
+    def footprints(self) -> Dict[str, Tuple[int, int]]:
+        '''
+        Number of routables and bytes held, per queue of this worker
+        '''
+        return {'queue': self._queue.footprint()}
+
+    def snapshot(self) -> List[Tuple[routable.Routable, int]]:
+        '''
+        Take what is held, with the number of attempts made to send
+        each, once the worker is stopped
+        '''
+        size = self._queue.qsize()
+        if not size:
+            return []
+        return [(r, 0) for r in self._queue.get_batch(size, block=False)]
+
+    def restore(self, entries: List[Tuple[routable.Routable, int]]) -> None:
+        '''
+        Hold on to what was snapshotted, before the worker is started
+        '''
+        self._queue.put_many([r for r, _ in entries])
+
 class LocalStorageWorker(Worker):
-    def __init__(self, config: configuration.WorkerConfiguration) -> None:
-        Worker.__init__(self, config)
+    # Maximum number of routables taken from the queue at once
+    BATCH_SIZE = 16
+    TUNABLES = {'batch-size': '_batch_size'}
+
+    def __init__(
+        self,
+        config: configuration.WorkerConfiguration,
+        priority_weights: Dict[str, int] = None,
+        shaper: ratelimit.Shaper = None,
+        catalog: catalog.CatalogWriter = None) -> None:
+        Worker.__init__(self, config, priority_weights, shaper, catalog)
+        self._batch_size = LocalStorageWorker.BATCH_SIZE
         self._output_dir_path = self._path_replace(config.output_dir_path)
         if not os.path.isdir(self._output_dir_path):
             raise configuration.ConfigurationError(f'Local storage worker {self.name} ({self.id}) configured to store outputs in non-existant dir {self._output_dir_path}')
@@ -50,82 +254,496 @@ class LocalStorageWorker(Worker):
 
     def run(self):
         self._logger.info(f'Starting local storage worker {self._id}')
-        while True:
+        while not self._stopped.is_set():
+            if self._wait_while_paused():
+                continue
             try:
-                r = self._queue.get(block=True, timeout=5)
-                self._write_routable(r)
+                batch = self._queue.get_batch(self._batch_size, block=True, timeout=1)
+                for index, r in enumerate(batch):
+                    if self._paused.is_set() or self._stopped.is_set():
+                        # Put back what was not written, in case of a
+                        # long pause or to be snapshotted
+                        self._queue.put_many(batch[index:])
+                        break
+                    self._write_routable(r)
             except queue.Empty as e:
                 # Queue is empty, so go back to waiting on queue
                 pass
 
     def _write_routable(self, r: routable.Routable) -> bool:
-        instance_uid = str(r.dataset[0x0008, 0x0018].value)
+        instance_uid = r.sop_instance_uid
         output_file_path = os.path.join(self._output_dir_path, instance_uid + '.dcm')
 
         if os.path.isfile(output_file_path):
-            self._logger.debug(f'Skipping instance with id {instance_uid} as it is already stored in output dir')
+            self._logger.debug('Skipping instance with id %s as it is already stored in output dir', instance_uid)
+            self._completed(r, catalog.SENT)
             return True
             
         try:
-            r.dataset.save_as(output_file_path, write_like_original=True)
+            self._shape(1, len(r.encoded))
+            dicomfile.write(output_file_path, r)
+            self._completed(r, catalog.SENT)
             return True
         except BaseException as exception:
-            self._logger.warn(f'Failed to write instance to {output_file_path}: {str(exception)}')
+            self._logger.warning('Failed to write instance to %s: %s', output_file_path, exception)
+            self._completed(r, catalog.FAILED)
             return False
 
 
-class SCUWorker(Worker):
-    def __init__(self, config: configuration.WorkerConfiguration) -> None:
-        Worker.__init__(self, config)
+class RetryingWorker(Worker):
+    '''
+    Worker sending to a peer, holding instances which failed to send
+    for retry with backoff, and dead lettering those which never will
+    '''
+    def __init__(
+        self,
+        config: configuration.WorkerConfiguration,
+        retry_policy: retry.RetryPolicy,
+        dead_letters: deadletter.DeadLetterQueue,
+        liveness_checker: livenesschecker.LivenessChecker,
+        priority_weights: Dict[str, int] = None,
+        shaper: ratelimit.Shaper = None,
+        catalog: catalog.CatalogWriter = None) -> None:
+        Worker.__init__(self, config, priority_weights, shaper, catalog)
+        self._buffer = retry.RetryScheduler()
+        self._retry_policy = retry_policy
+        self._dead_letters = dead_letters
+        # Active checks are run by the shared liveness scheduler, send
+        # outcomes are fed back as passive signals
+        self._liveness_checker = liveness_checker
+        # Instances taken from the buffer and being sent
+        self._sending = 0
+
+    def _retry_later(self, entry: retry.RetryEntry, reason: str) -> Optional[str]:
+        # Schedule another attempt. Returns why to dead letter the entry
+        # instead once given up on, which callers holding a lock do
+        # after releasing it, as dead lettering writes files
+        entry.attempts += 1
+        entry.last_failure = reason
+        if entry.attempts >= self._retry_policy.max_attempts:
+            return f'Giving up after {entry.attempts} attempts: {reason}'
+        self._buffer.schedule(entry, self._retry_policy.delay(entry.attempts))
+        return None
+
+    def _dead_letter(self, entry: retry.RetryEntry, reason: str) -> None:
+        try:
+            self._dead_letters.put(self._id, entry.routable, reason, entry.attempts)
+        except BaseException as exception:
+            self._logger.error('Failed to dead letter instance for %s: %s', self._id, exception)
+            return
+        self._completed(entry.routable, catalog.DEAD_LETTERED)
+
+    def _queue_timeout(self) -> float:
+        # Wake up in time to send instances due for retry, and to notice
+        # being paused or stopped within a second when idle
+        next_due_in = self._buffer.next_due_in()
+        if next_due_in is None:
+            return 1
+        return min(1, next_due_in)
+
+    def held(self) -> int:
+        return self.queue_depth() + len(self._buffer) + self._sending
+
+    def snapshot(self) -> List[Tuple[routable.Routable, int]]:
+        entries = Worker.snapshot(self)
+        entries.extend((entry.routable, entry.attempts) for entry in self._buffer.entries())
+        return entries
+
+    def restore(self, entries: List[Tuple[routable.Routable, int]]) -> None:
+        # Instances which were attempted keep counting towards giving
+        # up, the rest are queued in priority order again
+        Worker.restore(self, [(r, attempts) for r, attempts in entries if not attempts])
+        for r, attempts in entries:
+            if attempts:
+                entry = retry.RetryEntry(r)
+                entry.attempts = attempts
+                self._buffer.schedule(entry)
+
+    def footprints(self) -> Dict[str, Tuple[int, int]]:
+        footprints = Worker.footprints(self)
+        footprints['buffer'] = self._buffer.footprint()
+        return footprints
+
+class SCUWorker(RetryingWorker):
+    # Maximum number of instances sent over a single association
+    MAX_SEND_BATCH = 100
+    TUNABLES = {'max-send-batch': '_max_send_batch'}
+
+    def __init__(
+        self,
+        config: configuration.WorkerConfiguration,
+        retry_policy: retry.RetryPolicy,
+        dead_letters: deadletter.DeadLetterQueue,
+        liveness_checker: livenesschecker.LivenessChecker,
+        priority_weights: Dict[str, int] = None,
+        shaper: ratelimit.Shaper = None,
+        catalog: catalog.CatalogWriter = None) -> None:
+        RetryingWorker.__init__(
+            self, config, retry_policy, dead_letters, liveness_checker, priority_weights, shaper, catalog)
         self._address = config.address
         self._port = config.port
         self._ae_title = config.ae_title
-        self._buffer: List[routable.Routable] = []
-        self._last_send_time: datetime.datetime = datetime.datetime.now()
-        self._liveness_checker = livenesschecker.LivenessChecker(
-            self._id, 
-            livenesschecker.DicomEchoLivenessCheckerStrategy(self._address, self._port), 
-            config, 
-            10)
+        self._max_send_batch = SCUWorker.MAX_SEND_BATCH
+        # Consecutive failures to associate with the peer. These back
+        # off the whole worker rather than counting against instances
+        self._association_failures = 0
+        concurrency = config.concurrency
+        self._concurrency = ratelimit.AdaptiveLimit(
+            f'worker.{config.id}.concurrency',
+            concurrency.min_associations,
+            concurrency.max_associations,
+            concurrency.latency_tolerance)
+        # Sends over further associations, when more than one may be
+        # used at once
+        self._executor = None
+        if concurrency.max_associations > 1:
+            self._executor = ThreadPoolExecutor(concurrency.max_associations, thread_name_prefix=f'{config.id}-scu')
+        # Guards the retry buffer and counters, which associations
+        # sending at once update
+        self._lock = threading.Lock()
 
     def _send_buffer(self):
-        if not self._buffer:
-            # Do nothing if buffer is empty
+        # Up to a batch per association which may be sent over
+        due = self._buffer.pop_due(self._max_send_batch * self._concurrency.limit)
+        if not due:
+            # Do nothing if nothing is due for sending
+            return
+        self._sending = len(due)
+        try:
+            self._send_due(due)
+        finally:
+            self._sending = 0
+
+    def _send_due(self, due: List[retry.RetryEntry]) -> None:
+        if not self._liveness_checker.allow_request():
+            # Circuit is open, hold on to the instances without
+            # counting it against them
+            with self._lock:
+                delay = self._retry_policy.delay(max(1, self._association_failures))
+                for entry in due:
+                    self._buffer.schedule(entry, delay)
+            self._logger.debug('Peer %s:%d is failed, deferring %d instances', self._address, self._port, len(due))
             return
 
-        if (datetime.datetime.now() - self._last_send_time).seconds < 3:
-            # We just stopped sending, so take a short break
+        groups = _partition_by_patient(due, self._concurrency.limit)
+        if len(groups) > 1 and self._liveness_checker.status == livenesschecker.LivenessStatus.SOFT_FAIL:
+            # Circuit is half-open, probe the peer over a single
+            # association and hold on to the rest until it is closed
+            with self._lock:
+                for group in groups[1:]:
+                    for entry in group:
+                        self._buffer.schedule(entry)
+            groups = groups[:1]
+        if len(groups) == 1:
+            self._send_association(groups[0])
             return
+        # Each patient's instances are sent over a single association,
+        # in order, while other patients are sent over others at once
+        for future in [self._executor.submit(self._send_association, group) for group in groups]:
+            future.result()
 
-        # Nothing preventing us from sending, so let's go
+    def _send_association(self, entries: List[retry.RetryEntry]) -> None:
         ae = AE()
         ae.add_requested_context(MRImageStorage)
         ae.add_requested_context(CTImageStorage)
+        ae.add_requested_context(EnhancedMRImageStorage)
+        ae.add_requested_context(EnhancedCTImageStorage)
         assoc = ae.associate(self._address, self._port)
-        if assoc.is_established:
-            self._logger.debug(f'Established association with {self._address}:{self._port}')
-            while self._buffer:
-                r = self._buffer.pop()
-                status = assoc.send_c_store(r.data)
-                if not status:
-                    self._buffer.append(r)
-                    self._logger.warn(f'Failed to send to peer at {self._address}:{self._port}')
-                    return
+        if not assoc.is_established:
+            self._liveness_checker.record_failure()
+            self._concurrency.record_failure()
+            with self._lock:
+                self._association_failures += 1
+                delay = self._retry_policy.delay(self._association_failures)
+                for entry in entries:
+                    self._buffer.schedule(entry, delay)
+            self._logger.warning('Failed to establish association with %s:%d, retrying in %.1fs', self._address, self._port, delay)
+            return
 
-            assoc.release()
-        else:
-            self._logger.warn(f'Failed to establish association with {self._address}:{self._port}')
+        with self._lock:
+            self._association_failures = 0
+        self._logger.debug('Established association with %s:%d', self._address, self._port)
+        try:
+            for index, entry in enumerate(entries):
+                if self._stopped.is_set():
+                    # Put back what was not attempted, to be snapshotted
+                    with self._lock:
+                        for remaining in entries[index:]:
+                            self._buffer.schedule(remaining)
+                    return
+                if not assoc.is_established:
+                    # Peer aborted, put back what was not attempted
+                    with self._lock:
+                        for remaining in entries[index:]:
+                            self._buffer.schedule(remaining, self._retry_policy.delay(1))
+                    self._liveness_checker.record_failure()
+                    self._concurrency.record_failure()
+                    self._logger.warning('Association with %s:%d lost', self._address, self._port)
+                    return
+                try:
+                    self._shape(1, len(entry.routable.encoded))
+                    started = time.monotonic()
+                    status = storescu.send_c_store(assoc, entry.routable)
+                except (AttributeError, ValueError) as exception:
+                    # No presentation context or instance cannot be
+                    # encoded, which will never succeed on retry
+                    self._dead_letter(entry, str(exception))
+                    continue
+                failure = retry.classify_status(status)
+                if failure is None:
+                    self._liveness_checker.record_success()
+                    self._concurrency.record_success(time.monotonic() - started, len(entry.routable.encoded))
+                    self._completed(entry.routable, catalog.SENT)
+                    continue
+                reason = f'C-STORE status 0x{status.Status:04X}' if 'Status' in status else 'No C-STORE response'
+                self._logger.warning('Failed to send to peer at %s:%d: %s', self._address, self._port, reason)
+                if failure == retry.FailureClass.PERMANENT:
+                    # The peer is fine, it just rejects this instance
+                    self._liveness_checker.record_success()
+                    self._dead_letter(entry, reason)
+                else:
+                    self._liveness_checker.record_failure()
+                    self._concurrency.record_failure()
+                    with self._lock:
+                        give_up = self._retry_later(entry, reason)
+                    if give_up is not None:
+                        self._dead_letter(entry, give_up)
+        finally:
+            if assoc.is_established:
+                assoc.release()
 
+    def status(self) -> Dict[str, Any]:
+        status = RetryingWorker.status(self)
+        status['concurrency-limit'] = self._concurrency.limit
+        return status
 
     def run(self):
         self._logger.info(f'Starting SCU worker {self._id}')
-        self._liveness_checker.start()
-        while True:
+        while not self._stopped.is_set():
+            if self._wait_while_paused():
+                continue
+            try:
+                # Take up to a batch of what is queued per association it
+                # may be sent over. The rest stays in the queue, where it
+                # is dequeued in priority order.
+                batch = self._queue.get_batch(
+                    self._max_send_batch * self._concurrency.limit, block=True, timeout=self._queue_timeout())
+                for r in batch:
+                    self._buffer.schedule(retry.RetryEntry(r))
+            except queue.Empty as e:
+                # Queue is empty, so add nothing to buffer
+                pass
+            # Try to send, if something is due in the buffer. Paused
+            # workers hold on to what was just taken from the queue
+            if not self._paused.is_set():
+                self._send_buffer()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+class StowRSWorker(RetryingWorker):
+    '''
+    Worker storing instances to a DICOMweb peer with STOW-RS. Instances
+    are batched into requests by count and size, and several requests
+    are in flight at once, each over a keep-alive connection
+    '''
+    TUNABLES = {
+        'max-batch-count': '_max_batch_count',
+        'max-batch-bytes': '_max_batch_bytes',
+        'max-in-flight': '_max_in_flight'
+    }
+
+    def __init__(
+        self,
+        config: configuration.WorkerConfiguration,
+        retry_policy: retry.RetryPolicy,
+        dead_letters: deadletter.DeadLetterQueue,
+        liveness_checker: livenesschecker.LivenessChecker,
+        priority_weights: Dict[str, int] = None,
+        shaper: ratelimit.Shaper = None,
+        catalog: catalog.CatalogWriter = None) -> None:
+        RetryingWorker.__init__(
+            self, config, retry_policy, dead_letters, liveness_checker, priority_weights, shaper, catalog)
+        self._client = stowrs.StowClient(config.url, config.timeout, config.gzip, config.headers)
+        self._max_batch_count = config.max_batch_count
+        self._max_batch_bytes = config.max_batch_bytes
+        self._max_in_flight = config.max_in_flight
+        self._executor = ThreadPoolExecutor(config.max_in_flight, thread_name_prefix=f'{config.id}-stow')
+        self._executor_size = config.max_in_flight
+        self._in_flight = 0
+        # Consecutive failed requests. These back off the whole worker
+        # rather than counting against instances
+        self._request_failures = 0
+        # Guards the retry buffer and counters, which requests update
+        # from the sender threads
+        self._lock = threading.Lock()
+        # Notified when a request completes, or more may be in flight
+        self._slot_available = threading.Condition(self._lock)
+
+    def _next_batch(self) -> List[retry.RetryEntry]:
+        # Must be called with lock held
+        due = self._buffer.pop_due(self._max_batch_count)
+        batch = []
+        size = 0
+        for index, entry in enumerate(due):
+            length = len(entry.routable.encoded)
+            if batch and size + length > self._max_batch_bytes:
+                for remaining in due[index:]:
+                    self._buffer.schedule(remaining)
+                break
+            batch.append(entry)
+            size += length
+        return batch
+
+    def _defer(self, batch: List[retry.RetryEntry], reason: str) -> None:
+        # Hold on to the instances without counting it against them.
+        # Must be called with lock held
+        delay = self._retry_policy.delay(max(1, self._request_failures))
+        self._logger.debug('Deferring %d instances for %s by %.1fs: %s', len(batch), self._id, delay, reason)
+        for entry in batch:
+            self._buffer.schedule(entry, delay)
+
+    def _send(self, batch: List[retry.RetryEntry]) -> None:
+        try:
+            try:
+                status, body = self._client.store([entry.routable for entry in batch])
+                outcomes = self._handle_response(batch, status, body)
+            except (OSError, http.client.HTTPException) as exception:
+                self._liveness_checker.record_failure()
+                self._logger.warning('Failed to send to peer at %s: %s', self._client.url, exception)
+                with self._lock:
+                    self._request_failures += 1
+                    self._defer(batch, str(exception))
+                return
+            except Exception as exception:
+                # Instances which cannot be encoded, or a response which
+                # cannot be read, before any instance has an outcome
+                self._logger.error('Failed to send %d instances for %s: %s', len(batch), self._id, exception)
+                with self._lock:
+                    given_up = [(entry, self._retry_later(entry, str(exception))) for entry in batch]
+                for entry, reason in given_up:
+                    if reason is not None:
+                        self._dead_letter(entry, reason)
+                return
+            if outcomes is not None:
+                self._apply_outcomes(batch, outcomes)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._sending -= len(batch)
+                self._slot_available.notify()
+
+    def _handle_response(
+        self,
+        batch: List[retry.RetryEntry],
+        status: int,
+        body: bytes) -> Optional[List[Tuple[Optional[retry.FailureClass], str]]]:
+        # Work out the outcome of every instance, without applying them,
+        # so failing to read the response leaves none half applied.
+        # Requests failed as a whole are handled here, returning None
+        if status == stowrs.REQUEST_TOO_LARGE and len(batch) > 1:
+            # Send smaller batches from now on, without counting it
+            # against the instances
+            with self._lock:
+                self._max_batch_bytes = max(1, sum(len(entry.routable.encoded) for entry in batch) // 2)
+                for entry in batch:
+                    self._buffer.schedule(entry)
+            self._logger.warning('Peer at %s rejected request as too large, lowering batch size to %d bytes', self._client.url, self._max_batch_bytes)
+            return None
+        if stowrs.peer_failed(status):
+            self._liveness_checker.record_failure()
+            self._logger.warning('Failed to send to peer at %s: STOW-RS status %d', self._client.url, status)
+            with self._lock:
+                self._request_failures += 1
+                self._defer(batch, f'STOW-RS status {status}')
+            return None
+        outcomes = stowrs.classify_response(status, body, [entry.routable.sop_instance_uid for entry in batch])
+        self._liveness_checker.record_success()
+        return outcomes
+
+    def _apply_outcomes(
+        self,
+        batch: List[retry.RetryEntry],
+        outcomes: List[Tuple[Optional[retry.FailureClass], str]]) -> None:
+        sent = []
+        dead_letters = []
+        with self._lock:
+            self._request_failures = 0
+            for entry, (failure, reason) in zip(batch, outcomes):
+                if failure is None:
+                    sent.append(entry)
+                    continue
+                self._logger.warning('Failed to send instance to peer at %s: %s', self._client.url, reason)
+                if failure == retry.FailureClass.PERMANENT:
+                    dead_letters.append((entry, reason))
+                else:
+                    give_up = self._retry_later(entry, reason)
+                    if give_up is not None:
+                        dead_letters.append((entry, give_up))
+        # Completed and written after releasing the lock, as completing
+        # may move files and take other locks
+        for entry in sent:
+            self._completed(entry.routable, catalog.SENT)
+        for entry, reason in dead_letters:
+            self._dead_letter(entry, reason)
+
+    def _send_buffer(self) -> None:
+        while not self._paused.is_set() and not self._stopped.is_set():
+            with self._lock:
+                batch = self._next_batch()
+                if not batch:
+                    return
+                if not self._liveness_checker.allow_request():
+                    self._defer(batch, 'peer is failed')
+                    return
+                self._sending += len(batch)
+                # Wait for a request to complete if all are in flight. The
+                # queue fills up meanwhile, which is dequeued in priority order
+                while self._in_flight >= self._max_in_flight:
+                    self._slot_available.wait()
+                self._in_flight += 1
+                executor = self._executor
+            self._shape(len(batch), sum(len(entry.routable.encoded) for entry in batch))
+            executor.submit(self._send, batch)
+
+    def retune(self, settings: Dict[str, Any]) -> None:
+        with self._lock:
+            RetryingWorker.retune(self, settings)
+            if self._max_in_flight > self._executor_size:
+                # Requests already submitted finish on the old pool
+                self._executor.shutdown(wait=False)
+                self._executor = ThreadPoolExecutor(self._max_in_flight, thread_name_prefix=f'{self._id}-stow')
+                self._executor_size = self._max_in_flight
+            self._slot_available.notify_all()
+
+    def status(self) -> Dict[str, Any]:
+        status = RetryingWorker.status(self)
+        status['in-flight'] = self._in_flight
+        return status
+
+    def _queue_timeout(self) -> float:
+        with self._lock:
+            timeout = RetryingWorker._queue_timeout(self)
+            # Requests in flight may schedule retries
+            return min(1, timeout) if self._in_flight else timeout
+
+    def run(self):
+        self._logger.info(f'Starting STOW-RS worker {self._id} storing to {self._client.url}')
+        while not self._stopped.is_set():
+            if self._wait_while_paused():
+                continue
             try:
-                r = self._queue.get(block=True, timeout=5)
-                self._buffer.append(r)
+                batch = self._queue.get_batch(self._max_batch_count, block=True, timeout=self._queue_timeout())
+                with self._lock:
+                    for r in batch:
+                        self._buffer.schedule(retry.RetryEntry(r))
             except queue.Empty as e:
                 # Queue is empty, so add nothing to buffer
                 pass
-            # Try to send, if something is in the buffer
             self._send_buffer()
+        # Requests in flight put back what fails to send, so wait for
+        # them before the buffer is snapshotted
+        with self._lock:
+            while self._in_flight:
+                self._slot_available.wait()
+        self._executor.shutdown()
+        self._client.close()
@@ -1,81 +1,180 @@
 import worker
-from typing import List, Dict, Tuple, Callable
+from typing import List, Dict, Tuple, Callable, Optional
 import configuration
+import functools
 import logging
-import routable
-import pynetdicom
 import pydicom
-import re
+import routable
+import headermatch
+import rewrite
+
+# Number of affinity keys whose hashes are remembered, per worker set
+HASH_CACHE_SIZE = 65536
+
+def affinity_key(keys: List[List[pydicom.tag.BaseTag]], dataset: pydicom.Dataset) -> Optional[str]:
+    '''
+    Get the value of the first key all of whose tags have a value. The
+    values of keys of several tags are joined with backslashes, which
+    cannot occur within a single value. If no key has values, the last
+    key is used if all its tags are present, so instances with empty
+    values are relayed rather than dropped
+    '''
+    for key in keys:
+        values = []
+        for tag in key:
+            element = dataset.get(tag)
+            if element is None or element.value is None or element.value == '':
+                break
+            values.append(str(element.value))
+        else:
+            return '\\'.join(values)
+    if all(tag in dataset for tag in keys[-1]):
+        return '\\'.join(str(dataset[tag].value) for tag in keys[-1])
+    return None
 
 class WorkerSet:
-    def __init__(self, config: configuration.WorkerSetConfiguration, all_workers: Dict[str, worker.Worker], hash_function: Callable[[str], str]) -> None:
+    def __init__(
+        self,
+        config: configuration.WorkerSetConfiguration,
+        all_workers: Dict[str, worker.Worker],
+        hash_function: Callable[[str, int], int],
+        uid_mapper: rewrite.UIDMapper = None,
+        cluster=None,
+        affinity_table=None) -> None:
         self._worker_ids = config.worker_ids
         self._header_requirements = config.header_requirements
-        self._workers: List[worker.Worker] = []
         self._accepted_scp_ids = config.accepted_scp_ids
-        for worker_id in self._worker_ids:
-            self._workers.append(all_workers[worker_id])
-        self._hash_function = hash_function
+        unknown_worker_ids = [i for i in self._worker_ids if i not in all_workers]
+        if unknown_worker_ids:
+            raise configuration.ConfigurationError(f'Worker set {config.id} refers to unknown workers {", ".join(unknown_worker_ids)}')
+        self._workers: List[worker.Worker] = [all_workers[i] for i in self._worker_ids]
+        self._workers_by_id: Dict[str, worker.Worker] = {w.id: w for w in self._workers}
+        # Instances of a patient or study arrive together, so most are
+        # placed from the cache
+        self._hash_function = functools.lru_cache(maxsize=HASH_CACHE_SIZE)(hash_function)
+        self._affinity_keys = [[pydicom.tag.Tag(tag) for tag in key] for key in config.affinity_keys]
+        self._rewrites = rewrite.RewritePipeline(config.rewrites, uid_mapper)
         self._id = config.id
+        self._cluster = cluster
+        self._affinity_table = affinity_table
+        self._overflow = None
         self._logger = logging.getLogger(__name__)
         self._logger.info(f'Creating worker set {self._id} with {len(self._workers)} workers')
 
-    def _evaluate_header_absent(self, tag: Tuple[int, int], dataset: pydicom.Dataset) -> bool:
-        return tag not in dataset
-
-    def _evaluate_header_regexp_match(self, tag: Tuple[int, int], dataset: pydicom.Dataset, regexp: str) -> bool:
-        if not self._evaluate_header_present(tag, dataset):
-            return False
-        header_value = dataset[tag]
-        header_value = str(dataset[tag].value)
-        match = re.match(regexp, header_value)
-        if match:
-            return True
-        else:
-            return False
-
-    def _evaluate_header_present(self, tag: Tuple[int, int], dataset: pydicom.Dataset) -> bool:
-        return tag in dataset
-
     def can_accept(self, r: routable.Routable):
         # If accepted SCP ids were specified and not empty
         # reject if source SCP not in list
-        self._logger.debug(f'Finding worker for routable from {r.scp_id} (acceping routables from {str(self._accepted_scp_ids)}')
+        self._logger.debug('Finding worker for routable from %s (acceping routables from %s)', r.scp_id, self._accepted_scp_ids)
         if r.scp_id not in self._accepted_scp_ids:
             return False
 
         # Check specified header requirements
         # if any
-        if self._header_requirements:
-            can_accept = True
-            for header_requirement in self._header_requirements:
-                tag = header_requirement.tag
-                if header_requirement.requirement == configuration.HeaderRequirementConfiguration.ABSENT:
-                    can_accept &= self._evaluate_header_absent(tag, r.dataset)
-                elif header_requirement.requirement == configuration.HeaderRequirementConfiguration.PRESENT:
-                    can_accept &= self._evaluate_header_present(tag, r.dataset)
-                elif header_requirement.requirement == configuration.HeaderRequirementConfiguration.REGEXP_MATCH:
-                    can_accept &= self._evaluate_header_regexp_match(tag, r.dataset, header_requirement.regexp)
-                else:
-                    self._logger.warn(f'Unknown header requirement type {header_requirement.requirement}')
-            return can_accept
-        return True
+        return headermatch.evaluate_all(self._header_requirements, r.dataset)
 
+    def select_worker(self, data: routable.Routable) -> Optional[worker.Worker]:
+        # Determine worker index by hashing the affinity key to a number
+        # To ensure longitudinal support, all data for a given
+        # patient (by default) must be processed by the same worker
+        key = affinity_key(self._affinity_keys, data.dataset)
+        if key is None:
+            self._logger.warning('Dropping DICOM instance due to missing affinity key')
+            return None
+
+        if self._affinity_table is not None:
+            # Patients stay with the worker they were assigned to
+            worker = self._workers_by_id[
+                self._affinity_table.worker_for(key, self._workers_by_id, self._hash_function)]
+        else:
+            worker = self._workers[self._hash_function(key, len(self._workers))]
+        if self._cluster is not None:
+            worker = self._select_clustered_worker(key, worker)
+        if not worker.accepting:
+            worker = self._select_accepting_worker(key, worker)
+        self._logger.debug('Allocating to worker %s', worker.id)
+        return worker
+
+    def _select_accepting_worker(self, patient_id: str, drained_worker: worker.Worker) -> worker.Worker:
+        # Patients of a worker being drained are spread over the others
+        # until it is resumed
+        candidates = [w for w in self._workers if w.accepting]
+        if not candidates:
+            # Nowhere else to go, the worker still holds on to them
+            return drained_worker
+        return candidates[self._hash_function(patient_id, len(candidates))]
+
+    def _select_clustered_worker(self, patient_id: str, hashed_worker: worker.Worker) -> worker.Worker:
+        # Patients failed over stay with their failover worker, also
+        # once the hashed worker recovers, until the override expires,
+        # and all nodes agree on it
+        key = f'{self._id}/{patient_id}'
+        override_id = self._cluster.override(key)
+        if override_id in self._workers_by_id and self._cluster.worker_available(override_id):
+            return self._workers_by_id[override_id]
+        if self._cluster.worker_available(hashed_worker.id):
+            if override_id is not None:
+                # The failover worker failed or left, back to the hashed one
+                self._cluster.remove_override(key, override_id)
+                self._logger.info('Moving patient back from worker %s to %s in worker set %s',
+                    override_id, hashed_worker.id, self._id)
+            return hashed_worker
+        candidates = [w for w in self._workers if self._cluster.worker_available(w.id)]
+        if not candidates:
+            # Nowhere to fail over to, the worker retries or dead letters
+            return self._workers_by_id.get(override_id, hashed_worker)
+        # The least deep of two candidates, so patients failing over
+        # at once are spread, but away from workers already behind
+        failover = min(
+            candidates[self._hash_function(patient_id, len(candidates))],
+            candidates[self._hash_function(f'{patient_id}/failover', len(candidates))],
+            key=lambda w: self._cluster.queue_depth(w.id))
+        winner_id = self._cluster.claim_override(key, failover.id, override_id)
+        self._logger.info('Failing patient over from worker %s to %s in worker set %s',
+            override_id or hashed_worker.id, winner_id, self._id)
+        return self._workers_by_id.get(winner_id, failover)
+
+    def set_overflow(self, overflow) -> None:
+        '''
+        Divert new studies through overflow while the workers are far behind
+        '''
+        self._overflow = overflow
+
+    def divert(self, data: routable.Routable) -> 'WorkerSet':
+        '''
+        Get the worker set to relay a routable accepted by this worker
+        set, which is the overflow worker set for studies diverted to it
+        '''
+        if self._overflow is None:
+            return self
+        return self._overflow.select(data)
+
+    def backlog(self) -> Tuple[int, int]:
+        '''
+        Number of routables held by the workers and their size in bytes
+        '''
+        count = 0
+        size = 0
+        for w in self._workers:
+            count += w.held()
+            size += sum(footprint[1] for footprint in w.footprints().values())
+        return count, size
+
+    def progress(self) -> Dict[str, Tuple[int, int, int]]:
+        '''
+        Number of routables held, number completed so far and number of
+        times the queue ran empty so far, per worker
+        '''
+        return {w.id: (w.held(), w.completed(), w.queue_emptied()) for w in self._workers}
+
+    def rewrite(self, data: routable.Routable) -> routable.Routable:
+        # Rewrite headers for the workers of this set. The routable
+        # is not modified, as other worker sets may receive it too
+        return self._rewrites.apply(data)
 
     def consume(self, data: routable.Routable):
-        # Determine worker index by hashing patient id to a number
-        # To ensure longitudinal support, all data for a given
-        # patient must be processed by the same worker
-        patient_id_tag = (0x0010,0x0020)
-        if patient_id_tag not in data.dataset:
-            self._logger.warn('Dropping DICOM instance due to missing patient id')
-            return
-        patient_id = str(data.dataset[patient_id_tag].value)
-
-        worker_index = self._hash_function(patient_id, len(self._workers))
-        worker = self._workers[worker_index]
-        self._logger.debug(f'Allocating to worker {worker.id} at index {worker_index}')
-        worker.process(data)
+        worker = self.select_worker(data)
+        if worker is not None:
+            worker.process(self.rewrite(data))
 
     @property
     def id(self):
@@ -0,0 +1,118 @@
+import socket
+import time
+import unittest
+import unittest.mock
+import pydicom
+import pynetdicom
+from pynetdicom import AE
+import admission
+import configuration
+import metrics
+import router
+import routable
+import scp
+import storescu
+import utils
+
+def create_controller(**json_data) -> admission.AdmissionController:
+    json_data['enabled'] = True
+    return admission.AdmissionController('SCP1', configuration.AdmissionConfiguration(json_data))
+
+class TestAdmissionController(unittest.TestCase):
+    def test_max_associations(self):
+        controller = create_controller(**{'max-associations': 2})
+        self.assertIsNone(controller.admit('a1', 'CT1'))
+        self.assertIsNone(controller.admit('a2', 'CT2'))
+        self.assertEqual(admission.REJECT_CONGESTION, controller.admit('a3', 'CT3'))
+        controller.release('a1')
+        controller.release('a3')
+        self.assertEqual(1, controller.associations())
+        self.assertIsNone(controller.admit('a3', 'CT3'))
+
+    def test_max_associations_per_ae(self):
+        controller = create_controller(**{
+            'max-associations-per-ae': 2,
+            'calling-aes': {'ARCHIVE': {'max-associations': 1}}
+        })
+        self.assertIsNone(controller.admit('a1', 'ARCHIVE'))
+        self.assertEqual(admission.REJECT_LIMIT_EXCEEDED, controller.admit('a2', 'ARCHIVE'))
+        self.assertIsNone(controller.admit('a3', 'CT1'))
+        self.assertIsNone(controller.admit('a4', 'CT1'))
+        self.assertEqual(admission.REJECT_LIMIT_EXCEEDED, controller.admit('a5', 'CT1'))
+        # Rejections are only counted per calling AE configured
+        names = metrics.snapshot()
+        self.assertIn('scp.SCP1.admission.rejected.ARCHIVE', names)
+        self.assertNotIn('scp.SCP1.admission.rejected.CT1', names)
+
+    def test_reserved_associations(self):
+        controller = create_controller(**{'max-associations': 4, 'reserved-associations': 2})
+        self.assertIsNone(controller.admit('a1', 'ARCHIVE'))
+        self.assertIsNone(controller.admit('a2', 'ARCHIVE'))
+        # The rest is kept for calling AEs under their fair share
+        self.assertEqual(admission.REJECT_CONGESTION, controller.admit('a3', 'ARCHIVE'))
+        self.assertIsNone(controller.admit('a4', 'CT1'))
+        self.assertEqual(admission.REJECT_CONGESTION, controller.admit('a5', 'CT1'))
+        self.assertIsNone(controller.admit('a6', 'MR1'))
+
+    def test_fair_share_of_bytes(self):
+        controller = create_controller(**{'max-bytes-per-second': 1000})
+        controller.admit('a1', 'ARCHIVE')
+        self.assertEqual(1000, controller._buckets['ARCHIVE'].rate)
+        controller.admit('a2', 'CT1')
+        self.assertEqual(500, controller._buckets['ARCHIVE'].rate)
+        self.assertEqual(0, controller.throttle('a2', 500))
+        started = time.monotonic()
+        controller.throttle('a2', 50)
+        self.assertGreater(time.monotonic() - started, 0.05)
+        controller.release('a2')
+        self.assertEqual(1000, controller._buckets['ARCHIVE'].rate)
+        # Buckets of calling AEs no longer connected are dropped
+        self.assertNotIn('CT1', controller._buckets)
+
+class TestSCPAdmission(unittest.TestCase):
+    def test_reject_over_limit(self):
+        config = configuration.SCPConfiguration({
+            'id': 'SCP1',
+            'name': 'SCP',
+            'ae-title': 'RELAY',
+            'address': '127.0.0.1',
+            'port': 12349,
+            'admission': {'enabled': True, 'max-associations-per-ae': 1}
+        })
+        r = unittest.mock.Mock(spec=router.Router)
+        r.id = 'ROUTER0'
+        s = scp.SCP(config, {'ROUTER0': r})
+        s.daemon = True
+        s.start()
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', 12349), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        try:
+            bulk = AE(ae_title=b'BULK')
+            bulk.add_requested_context(pynetdicom.sop_class.CTImageStorage, pydicom.uid.ExplicitVRLittleEndian)
+            first = bulk.associate('127.0.0.1', 12349)
+            self.assertTrue(first.is_established)
+            second = bulk.associate('127.0.0.1', 12349)
+            self.assertTrue(second.is_rejected)
+            self.assertEqual(0x02, second.acceptor.primitive.result)
+            self.assertEqual(0x02, second.acceptor.primitive.diagnostic)
+            modality = AE(ae_title=b'CT1')
+            modality.add_requested_context(pynetdicom.sop_class.CTImageStorage, pydicom.uid.ExplicitVRLittleEndian)
+            assoc = modality.associate('127.0.0.1', 12349)
+            self.assertTrue(assoc.is_established)
+            self.assertEqual(0x0000, storescu.send_c_store(assoc, routable.Routable('SCP1', utils.create_dataset())).Status)
+            assoc.release()
+            first.release()
+            # Released associations make room again
+            time.sleep(0.5)
+            third = bulk.associate('127.0.0.1', 12349)
+            self.assertTrue(third.is_established)
+            third.release()
+        finally:
+            s._ae.shutdown()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+import affinity
+import configuration
+import hash_functions
+import routable
+import utils
+import worker
+import workerset
+
+class TestAffinityTable(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _create_table(self, **kwargs) -> affinity.AffinityTable:
+        return affinity.AffinityTable(self._dir.name, 'WS1', **kwargs)
+
+    def test_assignment_survives_membership_change(self):
+        table = self._create_table()
+        worker_id = table.worker_for('patient1', {'W1': None, 'W2': None}, hash_functions.random)
+        members = {'W1': None, 'W2': None, 'W3': None, 'W4': None}
+        self.assertEqual(worker_id, table.worker_for('patient1', members, hash_functions.random))
+
+    def test_departed_worker(self):
+        table = self._create_table()
+        table.move('patient1', 'W9')
+        self.assertEqual('W1', table.worker_for('patient1', {'W1': None}, hash_functions.random))
+        self.assertEqual(0, table.patient_count('W9'))
+
+    def test_least_patients(self):
+        table = self._create_table(assignment=configuration.AffinityConfiguration.ASSIGNMENT_LEAST_PATIENTS)
+        members = {'W1': None, 'W2': None}
+        table.move('patient1', 'W1')
+        self.assertEqual('W2', table.worker_for('patient2', members, hash_functions.random))
+
+    def test_persistence(self):
+        table = self._create_table(compact_after=3)
+        for i in range(5):
+            table.move(f'patient{i}', f'W{i}')
+        # Compacted in the background once three assignments were logged
+        self.assertTrue(utils.wait_for(lambda: os.path.isfile(os.path.join(self._dir.name, 'WS1.snapshot'))))
+        reloaded = self._create_table()
+        self.assertEqual(5, len(reloaded))
+        self.assertEqual('W4', reloaded.get('patient4'))
+
+    def test_refresh(self):
+        table = self._create_table(compact_after=2, refresh_interval=3600)
+        other = self._create_table(compact_after=None)
+        table.get('patient1')
+        other.move('patient1', 'W1')
+        self.assertIsNone(table.get('patient1'))
+        table.refresh()
+        self.assertEqual('W1', table.get('patient1'))
+        # Compaction by one process is noticed by the other
+        table.move('patient2', 'W2')
+        other.move('patient3', 'W3')
+        other.refresh()
+        table.refresh()
+        self.assertEqual('W2', other.get('patient2'))
+        self.assertEqual('W3', table.get('patient3'))
+
+    def test_compact_unlocked(self):
+        table = self._create_table(compact_after=None)
+        other = self._create_table(compact_after=None)
+        for i in range(3):
+            table.move(f'patient{i}', 'W1')
+        fsync = os.fsync
+        def assign_while_writing(fd):
+            # Another process assigns while the snapshot is written
+            if not os.path.isfile(os.path.join(self._dir.name, 'WS1.log.tmp')):
+                thread = threading.Thread(target=other.move, args=('patient3', 'W2'))
+                thread.start()
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+            fsync(fd)
+        with unittest.mock.patch('os.fsync', side_effect=assign_while_writing):
+            table.compact()
+        # Assignments made meanwhile are kept in the log
+        with open(os.path.join(self._dir.name, 'WS1.log'), 'rb') as f:
+            self.assertEqual(b'patient3\tW2\n', f.read())
+        reloaded = self._create_table()
+        self.assertEqual(4, len(reloaded))
+        self.assertEqual('W2', reloaded.get('patient3'))
+        other.refresh()
+        self.assertEqual(4, len(other))
+
+    def test_rebalance(self):
+        table = self._create_table()
+        members = ['W1', 'W2']
+        for i in range(100):
+            table.move(f'patient{i}', 'W1')
+        table.move('patient100', 'W9')
+        moves = affinity.plan_rebalance(table, members, hash_functions.random, 0.1)
+        self.assertLess(len(moves), 10)
+        self.assertEqual('patient100', moves[0][0])
+        affinity.rebalance(table, moves, 1000)
+        self.assertEqual(moves[1][1], table.get(moves[1][0]))
+        self.assertEqual(0, table.patient_count('W9'))
+
+class TestAffinityWorkerSet(unittest.TestCase):
+    def test_select_worker(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            workers = {}
+            for worker_id in ['W1', 'W2']:
+                workers[worker_id] = unittest.mock.Mock(spec=worker.Worker)
+                workers[worker_id].id = worker_id
+            config = unittest.mock.Mock(spec=configuration.WorkerSetConfiguration)
+            config.id = 'WS1'
+            config.worker_ids = ['W1']
+            config.accepted_scp_ids = []
+            config.rewrites = []
+            config.affinity_keys = [[(0x0010, 0x0020)]]
+            table = affinity.AffinityTable(dir_path, 'WS1')
+            ws = workerset.WorkerSet(config, workers, hash_functions.random, None, None, table)
+            r = routable.Routable('scp1', utils.create_dataset('patient1', 'CT'))
+            self.assertIs(workers['W1'], ws.select_worker(r))
+            # Adding a worker does not move the patient
+            config.worker_ids = ['W2', 'W1']
+            ws = workerset.WorkerSet(config, workers, hash_functions.random, None, None, table)
+            self.assertIs(workers['W1'], ws.select_worker(r))
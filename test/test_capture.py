@@ -0,0 +1,71 @@
+import tempfile
+import time
+import unittest
+import capture
+import configuration
+import routable
+import utils
+
+PATIENT_ID = (0x0010, 0x0020)
+STUDY_INSTANCE_UID = (0x0020, 0x000D)
+MANUFACTURER = (0x0008, 0x0070)
+
+class TestPseudonymiser(unittest.TestCase):
+    def test_pseudonymise(self):
+        pseudonymiser = capture.Pseudonymiser('secret')
+        patient_id = pseudonymiser.pseudonymise(PATIENT_ID, 'LO', 'PATIENT1')
+        self.assertNotEqual('PATIENT1', patient_id)
+        self.assertEqual(patient_id, pseudonymiser.pseudonymise(PATIENT_ID, 'LO', 'PATIENT1'))
+        self.assertNotEqual(patient_id, capture.Pseudonymiser('other').pseudonymise(PATIENT_ID, 'LO', 'PATIENT1'))
+        self.assertTrue(pseudonymiser.pseudonymise(STUDY_INSTANCE_UID, 'UI', '1.2.3').startswith('2.25.'))
+        self.assertEqual('GE', pseudonymiser.pseudonymise(MANUFACTURER, 'LO', 'GE'))
+
+    def test_salt(self):
+        # Unkeyed or truncated keys would weaken pseudonyms
+        with self.assertRaises(ValueError):
+            capture.Pseudonymiser('')
+        with self.assertRaises(ValueError):
+            capture.Pseudonymiser('s' * 65)
+        with self.assertRaises(configuration.ConfigurationError):
+            configuration.CaptureConfiguration({'enabled': True})
+        with self.assertRaises(configuration.ConfigurationError):
+            configuration.CaptureConfiguration({'enabled': True, 'salt': 's' * 65})
+        self.assertEqual('', configuration.CaptureConfiguration({}).salt)
+
+class TestTraceRecorder(unittest.TestCase):
+    def test_record(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            recorder = capture.TraceRecorder(dir_path, [PATIENT_ID, STUDY_INSTANCE_UID, MANUFACTURER], 'secret')
+            recorder.start()
+            dataset = utils.create_dataset('PATIENT1', 'MR')
+            r = routable.Routable('SCP1', dataset, c_store_priority=1)
+            recorder.record(r)
+            recorder.record(routable.Routable('SCP2', utils.create_dataset('PATIENT2')))
+            deadline = time.monotonic() + 5
+            records = []
+            while len(records) < 2 and time.monotonic() < deadline:
+                time.sleep(0.05)
+                records = capture.read_trace(recorder.path)
+            self.assertEqual(2, len(records))
+            record = records[0]
+            self.assertEqual('SCP1', record['scp-id'])
+            self.assertEqual(len(r.encoded), record['size'])
+            self.assertEqual(dataset.SOPClassUID, record['sop-class-uid'])
+            self.assertEqual(1, record['priority'])
+            self.assertEqual(['CS', 'MR'], record['tags']['00080060'])
+            self.assertEqual(['LO', 'GE MEDICAL SYSTEMS'], record['tags']['00080070'])
+            self.assertNotIn('PATIENT1', record['tags']['00100020'][1])
+            self.assertNotIn(dataset.StudyInstanceUID, record['tags']['0020000D'][1])
+            self.assertLessEqual(records[0]['time'], records[1]['time'])
+
+    def test_stop(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            recorder = capture.TraceRecorder(dir_path, [PATIENT_ID], 'secret')
+            for _ in range(100):
+                recorder.record(routable.Routable('SCP1', utils.create_dataset()))
+            recorder.start()
+            recorder.stop()
+            recorder.join(5)
+            # What was queued is written out before stopping
+            self.assertFalse(recorder.is_alive())
+            self.assertEqual(100, len(capture.read_trace(recorder.path)))
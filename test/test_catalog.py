@@ -0,0 +1,125 @@
+import os
+import tempfile
+import time
+import unittest
+import catalog
+import configuration
+import routable
+import worker
+import utils
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'catalog', 'catalog.sqlite')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _create_writer(self, retention_seconds: float = 3600, queue_size: int = 100) -> catalog.CatalogWriter:
+        writer = catalog.CatalogWriter(self._path, retention_seconds, batch_size=10, queue_size=queue_size)
+        writer.start()
+        return writer
+
+    def _stop(self, writer: catalog.CatalogWriter) -> None:
+        writer.stop()
+        writer.join(10)
+        self.assertFalse(writer.is_alive())
+
+    def _find(self, **keys):
+        connection = catalog.connect(self._path)
+        try:
+            return catalog.find(connection, **keys)
+        finally:
+            connection.close()
+
+    def test_routed_completed(self):
+        writer = self._create_writer()
+        ds = utils.create_dataset('PATIENT1')
+        r = routable.Routable('SCP1', ds)
+        writer.routed(r, 'WS1', 'SCU1')
+        writer.routed(r, 'WS1', 'SCU2')
+        writer.completed(r, 'SCU1', catalog.SENT)
+        writer.completed(r, 'SCU2', catalog.DEAD_LETTERED)
+        writer.routed(routable.Routable('SCP1', utils.create_dataset('PATIENT2')), 'WS1', 'SCU1')
+        self._stop(writer)
+
+        records = self._find(study_instance_uid=ds.StudyInstanceUID)
+        self.assertEqual([('SCU1', catalog.SENT), ('SCU2', catalog.DEAD_LETTERED)],
+                         [(record['worker_id'], record['status']) for record in records])
+        self.assertEqual(ds.SOPInstanceUID, records[0]['sop_instance_uid'])
+        self.assertEqual(ds.SeriesInstanceUID, records[0]['series_instance_uid'])
+        self.assertEqual('SCP1', records[0]['scp_id'])
+        self.assertEqual('WS1', records[0]['worker_set_id'])
+        self.assertTrue(records[0]['routed_at'] <= records[0]['completed_at'])
+        self.assertEqual(2, len(self._find(patient_id='PATIENT1')))
+        self.assertEqual([catalog.ROUTED], [record['status'] for record in self._find(patient_id='PATIENT2')])
+        with self.assertRaises(ValueError):
+            self._find()
+
+    def test_routed_again(self):
+        writer = self._create_writer()
+        r = routable.Routable('SCP1', utils.create_dataset())
+        writer.routed(r, 'WS1', 'SCU1')
+        writer.completed(r, 'SCU1', catalog.SENT)
+        writer.routed(r, 'WS1', 'SCU1')
+        self._stop(writer)
+        records = self._find(sop_instance_uid=r.sop_instance_uid)
+        self.assertEqual(1, len(records))
+        self.assertEqual(catalog.ROUTED, records[0]['status'])
+        self.assertIsNone(records[0]['completed_at'])
+
+    def test_completed_without_routed(self):
+        writer = self._create_writer()
+        r = routable.Routable('SCP1', utils.create_dataset())
+        writer.completed(r, 'SCU1', catalog.SENT)
+        self._stop(writer)
+        records = self._find(sop_instance_uid=r.sop_instance_uid)
+        self.assertEqual(catalog.SENT, records[0]['status'])
+        self.assertIsNone(records[0]['routed_at'])
+
+    def test_prune(self):
+        writer = self._create_writer()
+        writer.routed(routable.Routable('SCP1', utils.create_dataset()), 'WS1', 'SCU1')
+        self._stop(writer)
+        self.assertEqual(1, len(self._find(patient_id='PATIENT1')))
+        # Pruned on start once older than the retention period
+        time.sleep(0.1)
+        self._stop(self._create_writer(retention_seconds=0.05))
+        self.assertEqual([], self._find(patient_id='PATIENT1'))
+
+    def test_queue_full(self):
+        writer = catalog.CatalogWriter(self._path, 3600, queue_size=1)
+        dropped = writer._dropped.value
+        r = routable.Routable('SCP1', utils.create_dataset())
+        writer.routed(r, 'WS1', 'SCU1')
+        writer.completed(r, 'SCU1', catalog.SENT)
+        self.assertEqual(dropped + 1, writer._dropped.value)
+
+    def test_worker(self):
+        output_dir_path = os.path.join(self._dir.name, 'output')
+        os.makedirs(output_dir_path)
+        config = configuration.WorkerConfiguration({
+            'id': 'LOCAL1',
+            'name': 'Local',
+            'type': 'local-storage',
+            'ae-title': 'LOCAL1',
+            'address': '127.0.0.1',
+            'port': 104,
+            'output-dir-path': output_dir_path
+        })
+        writer = self._create_writer()
+        w = worker.LocalStorageWorker(config, catalog=writer)
+        w.daemon = True
+        w.start()
+        r = routable.Routable('SCP1', utils.create_dataset())
+        writer.routed(r, 'WS1', 'LOCAL1')
+        w.process(r)
+        self.assertTrue(utils.wait_for(lambda: w.held() == 0 and os.listdir(output_dir_path)))
+        w.stop()
+        w.join(5)
+        self._stop(writer)
+        self.assertEqual(catalog.SENT, self._find(sop_instance_uid=r.sop_instance_uid)[0]['status'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
+import cluster
+import configuration
+import hash_functions
+import livenesschecker
+import routable
+import utils
+import worker
+import workerset
+
+LIVE = livenesschecker.LivenessStatus.LIVE
+HARD_FAIL = livenesschecker.LivenessStatus.HARD_FAIL
+
+def create_worker(worker_id: str, depth: int = 0):
+    w = unittest.mock.Mock(spec=worker.Worker)
+    w.id = worker_id
+    w.queue_depth.return_value = depth
+    return w
+
+def create_checker(status: livenesschecker.LivenessStatus):
+    checker = unittest.mock.Mock(spec=livenesschecker.LivenessChecker)
+    checker.status = status
+    return checker
+
+def create_cluster(path: str, node_id: str, node_timeout: float = 10, override_ttl: float = 86400, url: str = None) -> cluster.Cluster:
+    json_data = {'enabled': True, 'node-id': node_id, 'node-timeout': node_timeout, 'override-ttl': override_ttl}
+    if url is not None:
+        json_data.update({'backend': 'http', 'url': url, 'token': 'secret'})
+    config = configuration.ClusterConfiguration(json_data, path)
+    return cluster.Cluster(config, cluster.create_backend(config))
+
+class TestMergeLiveness(unittest.TestCase):
+    def test_majority(self):
+        merged = cluster.merge_liveness({
+            'W1': [HARD_FAIL, HARD_FAIL, LIVE],
+            'W2': [HARD_FAIL, LIVE],
+            'W3': [livenesschecker.LivenessStatus.UNKNOWN]
+        })
+        self.assertEqual(HARD_FAIL, merged['W1'])
+        self.assertEqual(LIVE, merged['W2'])
+        self.assertEqual(livenesschecker.LivenessStatus.UNKNOWN, merged['W3'])
+
+class TestCluster(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'cluster.sqlite')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _create_cluster(self, node_id: str, **kwargs) -> cluster.Cluster:
+        return create_cluster(self._path, node_id, **kwargs)
+
+    def test_shared_state(self):
+        node1 = self._create_cluster('node1')
+        node2 = self._create_cluster('node2')
+        node1.register_worker(create_worker('W1', 3), create_checker(HARD_FAIL))
+        node2.register_worker(create_worker('W1', 4), create_checker(HARD_FAIL))
+        node1.sync()
+        node2.sync()
+        self.assertFalse(node2.worker_available('W1'))
+        self.assertEqual(7, node2.queue_depth('W1'))
+        self.assertTrue(node2.worker_available('W2'))
+
+    def test_node_timeout(self):
+        node1 = self._create_cluster('node1')
+        node2 = self._create_cluster('node2', node_timeout=0.1)
+        node1.register_worker(create_worker('W1'), create_checker(HARD_FAIL))
+        node2.register_worker(create_worker('W1'), create_checker(LIVE))
+        node1.sync()
+        time.sleep(0.2)
+        node2.sync()
+        # Report of node1 is stale, so only node2 is heard
+        self.assertTrue(node2.worker_available('W1'))
+
+    def test_claim_override(self):
+        node1 = self._create_cluster('node1')
+        node2 = self._create_cluster('node2')
+        self.assertEqual('W2', node1.claim_override('WS1/P1', 'W2'))
+        # Node 2 has not synced, but loses the claim
+        self.assertEqual('W2', node2.claim_override('WS1/P1', 'W3'))
+        self.assertEqual('W2', node2.override('WS1/P1'))
+        # Replacing requires knowing the current override
+        self.assertEqual('W3', node2.claim_override('WS1/P1', 'W3', 'W2'))
+        node1.sync()
+        self.assertEqual('W3', node1.override('WS1/P1'))
+        node1.remove_override('WS1/P1')
+        self.assertIsNone(node1.override('WS1/P1'))
+        # The removal is synced to other nodes
+        node2.sync()
+        self.assertIsNone(node2.override('WS1/P1'))
+        self.assertEqual('W1', node2.claim_override('WS1/P1', 'W1'))
+
+    def test_remove_override_of_worker(self):
+        node1 = self._create_cluster('node1')
+        node1.claim_override('WS1/P1', 'W2')
+        # Routed elsewhere, so left in place
+        node1.remove_override('WS1/P1', 'W3')
+        node1.sync()
+        self.assertEqual('W2', node1.override('WS1/P1'))
+
+    def test_override_ttl(self):
+        node1 = self._create_cluster('node1', override_ttl=0.1)
+        node2 = self._create_cluster('node2', override_ttl=0.1)
+        node1.claim_override('WS1/P1', 'W2')
+        node2.sync()
+        self.assertEqual('W2', node2.override('WS1/P1'))
+        time.sleep(0.2)
+        self.assertIsNone(node2.override('WS1/P1'))
+        node2.sync()
+        # Expired overrides are removed from the backend
+        self.assertEqual('W3', node1.claim_override('WS1/P1', 'W3'))
+
+class TestHTTPCluster(TestCluster):
+    '''
+    Runs the cluster tests with nodes sharing state through a state service
+    '''
+    def setUp(self):
+        TestCluster.setUp(self)
+        self._service = cluster.StateService(cluster.SQLiteBackend(self._path), '127.0.0.1', 0, 'secret')
+        self._service.start()
+
+    def tearDown(self):
+        self._service.stop()
+        TestCluster.tearDown(self)
+
+    def _create_cluster(self, node_id: str, **kwargs) -> cluster.Cluster:
+        return create_cluster(self._path, node_id, url=self._service.url, **kwargs)
+
+    def test_token(self):
+        backend = cluster.HTTPBackend(self._service.url, 'wrong')
+        with self.assertRaises(OSError):
+            backend.claim_override('WS1/P1', 'W2')
+        backend.close()
+
+    def test_service_unreachable(self):
+        node1 = self._create_cluster('node1')
+        self._service.stop()
+        with self.assertRaises(OSError):
+            node1.sync()
+        # Routed locally until the service is back
+        self.assertEqual('W2', node1.claim_override('WS1/P1', 'W2'))
+        self._service = cluster.StateService(cluster.SQLiteBackend(self._path), '127.0.0.1', 0, 'secret')
+        self._service.start()
+
+class TestClusteredWorkerSet(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'cluster.sqlite')
+        self._workers = {i: create_worker(i) for i in ['W1', 'W2', 'W3']}
+        self._config = unittest.mock.Mock(spec=configuration.WorkerSetConfiguration)
+        self._config.id = 'WS1'
+        self._config.worker_ids = list(self._workers)
+        self._config.accepted_scp_ids = []
+        self._config.rewrites = []
+        self._config.affinity_keys = [[(0x0010, 0x0020)]]
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _create_node(self, node_id: str, failed: str = None):
+        c = create_cluster(self._path, node_id)
+        checkers = {}
+        for w in self._workers.values():
+            checkers[w.id] = create_checker(HARD_FAIL if w.id == failed else LIVE)
+            c.register_worker(w, checkers[w.id])
+        c.sync()
+        return c, checkers, workerset.WorkerSet(self._config, self._workers, hash_functions.random, None, c)
+
+    def test_failover_agreement(self):
+        r = routable.Routable('scp1', utils.create_dataset('patient1', 'CT'))
+        _, _, ws = self._create_node('node1')
+        hashed = ws.select_worker(r)
+        # Both nodes observe the hashed worker failing
+        node1, checkers1, ws1 = self._create_node('node1', hashed.id)
+        node2, checkers2, ws2 = self._create_node('node2', hashed.id)
+        node1.sync()
+        failover = ws1.select_worker(r)
+        self.assertIsNot(hashed, failover)
+        node2.sync()
+        self.assertIs(failover, ws2.select_worker(r))
+        # Once the hashed worker recovers, the patient stays put
+        checkers1[hashed.id].status = LIVE
+        checkers2[hashed.id].status = LIVE
+        node1.sync()
+        node2.sync()
+        self.assertTrue(node2.worker_available(hashed.id))
+        self.assertIs(failover, ws2.select_worker(r))
+
+    def test_failover_back_to_hashed(self):
+        r = routable.Routable('scp1', utils.create_dataset('patient1', 'CT'))
+        _, _, ws = self._create_node('node1')
+        hashed = ws.select_worker(r)
+        node1, checkers, ws1 = self._create_node('node1', hashed.id)
+        failover = ws1.select_worker(r)
+        # The failover worker fails while the hashed one recovers
+        checkers[hashed.id].status = LIVE
+        checkers[failover.id].status = HARD_FAIL
+        node1.sync()
+        self.assertIs(hashed, ws1.select_worker(r))
+        self.assertIsNone(node1.override('WS1/patient1'))
+
+    def test_failover_least_deep(self):
+        r = routable.Routable('scp1', utils.create_dataset('patient1', 'CT'))
+        _, _, ws = self._create_node('node1')
+        hashed = ws.select_worker(r)
+        others = [w for w in self._workers.values() if w is not hashed]
+        for depth, w in enumerate(others):
+            w.queue_depth.return_value = 100 - depth
+        node1, _, ws1 = self._create_node('node1', hashed.id)
+        # Either candidate is chosen by hash, the least deep one wins
+        hashed_index = list(self._workers.values()).index(hashed)
+        with unittest.mock.patch.object(ws1, '_hash_function', side_effect=[hashed_index, 0, 1]):
+            self.assertIs(others[1], ws1.select_worker(r))
+
+    def test_no_cluster_failover_for_minority(self):
+        r = routable.Routable('scp1', utils.create_dataset('patient1', 'CT'))
+        _, _, ws = self._create_node('node1')
+        hashed = ws.select_worker(r)
+        # Only one of two nodes observes the hashed worker failing
+        node1, _, ws1 = self._create_node('node1', hashed.id)
+        self._create_node('node2')
+        node1.sync()
+        self.assertIs(hashed, ws1.select_worker(r))
@@ -1,4 +1,6 @@
 import unittest
+import unittest.mock
+import os
 import configuration
 
 class TestConfiguration(unittest.TestCase):
@@ -18,5 +20,114 @@ class TestConfiguration(unittest.TestCase):
         self.assertEqual(len(c.scps()), 2)
         self.assertIsNotNone(c.core())
 
+    def test_validate_topology(self):
+        c = configuration.Configuration('test/data/config/sample-config.json')
+        c.validate_topology()
+
+    def test_validate_topology_duplicates(self):
+        # Both files in the dir define SCP1 on the same port and SET1
+        c = configuration.Configuration('test/data/config')
+        with self.assertRaises(configuration.ConfigurationError):
+            c.validate_topology()
+
+    def test_invalid_section(self):
+        with self.assertRaises(configuration.ConfigurationError):
+            configuration.SCPConfiguration({"id": "SCP1"})
+
+    def test_stow_rs_worker(self):
+        c = configuration.WorkerConfiguration(
+            {"id": "STOW1", "name": "Archive", "type": "stow-rs", "url": "https://archive/dicomweb/studies"})
+        self.assertEqual(50, c.max_batch_count)
+        self.assertFalse(c.gzip)
+        with self.assertRaises(configuration.ConfigurationError):
+            configuration.WorkerConfiguration({"id": "STOW1", "name": "Archive", "type": "stow-rs"})
+
+    def test_affinity_keys(self):
+        json_data = {
+            "id": "SET1",
+            "name": "Set",
+            "worker-ids": ["W1"],
+            "distribution": "round-robin",
+            "hash-method": "modulo",
+            "accepted-scp-ids": [],
+            "header-requirements": []
+        }
+        c = configuration.WorkerSetConfiguration(json_data)
+        self.assertEqual([[(0x0010, 0x0020)]], c.affinity_keys)
+        self.assertEqual('md5', c.hash_function)
+        json_data['affinity-keys'] = [[["0x0010", "0x0021"], ["0x0010", "0x0020"]], [["0x0020", "0x000D"]]]
+        json_data['hash-function'] = 'crc32'
+        c = configuration.WorkerSetConfiguration(json_data)
+        self.assertEqual([[(0x0010, 0x0021), (0x0010, 0x0020)], [(0x0020, 0x000D)]], c.affinity_keys)
+        json_data['affinity-keys'] = [[["StudyInstanceUID"]]]
+        with self.assertRaises(configuration.ConfigurationError):
+            configuration.WorkerSetConfiguration(json_data)
+
+    def test_shaping(self):
+        c = configuration.WorkerConfiguration({
+            "id": "STOW1", "name": "Archive", "type": "stow-rs", "url": "https://archive/dicomweb/studies",
+            "shaping": {"max-instances-per-second": 20}, "shaping-group": "archive"})
+        self.assertEqual(20, c.shaping.max_instances_per_second)
+        self.assertEqual(20, c.shaping.burst_instances)
+        self.assertIsNone(c.shaping.max_bytes_per_second)
+        self.assertEqual('archive', c.shaping_group)
+        c = configuration.Configuration('test/data/config/sample-config.json')
+        c._workers[0]._shaping_group = 'archive'
+        with self.assertRaises(configuration.ConfigurationError):
+            c.validate_topology()
+
+    def test_catalog(self):
+        c = configuration.Configuration('test/data/config/sample-config.json')
+        self.assertFalse(c.core().catalog.enabled)
+        self.assertEqual(os.path.join(c.core().buffer_dir_path, 'catalog.sqlite'), c.core().catalog.path)
+        self.assertEqual(30, c.core().catalog.retention_days)
+        with self.assertRaises(configuration.ConfigurationError):
+            configuration.CatalogConfiguration({"retention-days": 0}, 'catalog.sqlite')
+
+    def test_concurrency(self):
+        c = configuration.WorkerConfiguration({
+            "id": "SCU1", "name": "Peer", "type": "scu", "ae-title": "PEER", "address": "127.0.0.1", "port": 104,
+            "output-dir-path": "/tmp", "concurrency": {"max-associations": 4}})
+        self.assertEqual(1, c.concurrency.min_associations)
+        self.assertEqual(4, c.concurrency.max_associations)
+        self.assertEqual(2.0, c.concurrency.latency_tolerance)
+        with self.assertRaises(configuration.ConfigurationError):
+            configuration.ConcurrencyConfiguration({"min-associations": 4, "max-associations": 2})
+
+    def test_overflow(self):
+        c = configuration.Configuration('test/data/config/sample-config.json')
+        self.assertIsNone(c.worker_sets()[0].overflow)
+        c.worker_sets()[0]._overflow = configuration.OverflowConfiguration(
+            {"worker-set-id": "BURST", "max-drain-seconds": 600})
+        with self.assertRaises(configuration.ConfigurationError):
+            c.validate_topology()
+        with self.assertRaises(configuration.ConfigurationError):
+            configuration.OverflowConfiguration({"worker-set-id": "BURST"})
+
+    def test_cluster_network_filesystem(self):
+        mounts = '/dev/sda1 / ext4 rw 0 0\nserver:/export /shared nfs4 rw 0 0\n'
+        with unittest.mock.patch('builtins.open', unittest.mock.mock_open(read_data=mounts)):
+            self.assertEqual('nfs4', configuration.network_filesystem_type('/shared/cluster.sqlite'))
+            self.assertIsNone(configuration.network_filesystem_type('/sharedlocal/cluster.sqlite'))
+            self.assertIsNone(configuration.network_filesystem_type('/var/cluster.sqlite'))
+        c = configuration.Configuration('test/data/config/sample-config.json')
+        c.core()._cluster = configuration.ClusterConfiguration(
+            {"enabled": True, "path": "/shared/cluster.sqlite"}, 'cluster.sqlite')
+        with unittest.mock.patch('configuration.network_filesystem_type', return_value='nfs4'):
+            with self.assertRaises(configuration.ConfigurationError):
+                c.validate_topology()
+            # Nodes on several hosts share state through the http backend
+            c.core()._cluster = configuration.ClusterConfiguration(
+                {"enabled": True, "backend": "http", "url": "http://relay1:7070/", "path": "/shared/cluster.sqlite"},
+                'cluster.sqlite')
+            c.validate_topology()
+            c.core()._cluster = configuration.ClusterConfiguration(
+                {"enabled": True, "backend": "http"}, 'cluster.sqlite')
+            with self.assertRaises(configuration.ConfigurationError):
+                c.validate_topology()
+        c.core()._cluster = configuration.ClusterConfiguration(
+            {"enabled": True, "path": "/shared/cluster.sqlite"}, 'cluster.sqlite')
+        c.validate_topology()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
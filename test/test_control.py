@@ -0,0 +1,112 @@
+import os
+import tempfile
+import time
+import unittest
+import configuration
+import control
+import routable
+import worker
+import utils
+
+class StandInLoadBalancer:
+    def __init__(self, workers):
+        self._workers = {w.id: w for w in workers}
+        self.router_count = 1
+
+    def worker(self, worker_id):
+        if worker_id not in self._workers:
+            raise KeyError(f'Unknown worker {worker_id}')
+        return self._workers[worker_id]
+
+    def status(self):
+        return {'workers': {w.id: w.status() for w in self._workers.values()}}
+
+    def add_routers(self, count):
+        ids = [f'ROUTER{index}' for index in range(self.router_count, self.router_count + count)]
+        self.router_count += count
+        return ids
+
+class TestControlServer(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        config = configuration.WorkerConfiguration({
+            'id': 'LOCAL1',
+            'name': 'Local',
+            'type': 'local-storage',
+            'ae-title': 'LOCAL1',
+            'address': '127.0.0.1',
+            'port': 104,
+            'output-dir-path': self._dir.name
+        })
+        self._worker = worker.LocalStorageWorker(config)
+        self._worker.daemon = True
+        self._worker.start()
+        self._server = control.ControlServer(
+            configuration.ControlConfiguration({}, os.path.join(self._dir.name, 'control.sock')),
+            StandInLoadBalancer([self._worker]))
+
+    def tearDown(self):
+        self._worker.stop()
+        self._worker.join(5)
+        self._dir.cleanup()
+
+    def _stored(self) -> int:
+        return len([name for name in os.listdir(self._dir.name) if name.endswith('.dcm')])
+
+    def test_pause_resume(self):
+        response = self._server.handle({'command': 'pause', 'worker-id': 'LOCAL1'})
+        self.assertEqual('paused', response['result']['state'])
+        time.sleep(worker.Worker.PAUSE_INTERVAL)
+        self._worker.process(routable.Routable('SCP1', utils.create_dataset()))
+        time.sleep(0.5)
+        self.assertEqual(0, self._stored())
+        self.assertEqual(1, self._server.handle({'command': 'status'})['result']['workers']['LOCAL1']['queue-depth'])
+        self._server.handle({'command': 'resume', 'worker-id': 'LOCAL1'})
+        self.assertTrue(utils.wait_for(lambda: self._stored() == 1))
+
+    def test_drain(self):
+        response = self._server.handle({'command': 'drain', 'worker-id': 'LOCAL1'})
+        self.assertEqual('drained', response['result']['state'])
+        self.assertFalse(self._worker.accepting)
+        self._server.handle({'command': 'resume', 'worker-id': 'LOCAL1'})
+        self.assertTrue(self._worker.accepting)
+
+    def test_retune(self):
+        response = self._server.handle({'command': 'retune', 'worker-id': 'LOCAL1', 'settings': {'batch-size': 4}})
+        self.assertEqual({'batch-size': 4}, response['result']['settings'])
+        response = self._server.handle({'command': 'retune', 'worker-id': 'LOCAL1', 'settings': {'max-in-flight': 4}})
+        self.assertEqual({'ok': False, 'error': 'Worker LOCAL1 has no settings max-in-flight'}, response)
+        response = self._server.handle({'command': 'retune', 'worker-id': 'LOCAL1', 'settings': {'batch-size': 0}})
+        self.assertFalse(response['ok'])
+        self.assertEqual(4, self._worker.settings()['batch-size'])
+
+    def test_errors(self):
+        self.assertEqual(
+            {'ok': False, 'error': 'Unknown worker LOCAL2'},
+            self._server.handle({'command': 'pause', 'worker-id': 'LOCAL2'}))
+        self.assertEqual(
+            {'ok': False, 'error': 'Unknown control command restart'},
+            self._server.handle({'command': 'restart'}))
+
+    def test_socket(self):
+        self._server.start()
+        self.assertTrue(utils.wait_for(lambda: os.path.exists(os.path.join(self._dir.name, 'control.sock'))))
+        socket_path = os.path.join(self._dir.name, 'control.sock')
+        response = control.request(socket_path, 'add-routers', timeout=10, count=2)
+        self.assertEqual({'ok': True, 'result': ['ROUTER1', 'ROUTER2']}, response)
+        response = control.request(socket_path, 'status', timeout=10)
+        self.assertEqual('running', response['result']['workers']['LOCAL1']['state'])
+
+    def test_shaping_status(self):
+        status = self._server.handle({'command': 'status'})['result']['workers']['LOCAL1']
+        self.assertEqual(['default'], list(status['queue-wait']))
+        self.assertEqual(0.0, status['shaping-wait'])
+
+    def test_stop(self):
+        self._worker.stop()
+        self._worker.join(5)
+        self.assertFalse(self._worker.is_alive())
+        self.assertEqual('stopped', self._worker.state)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,21 @@
+import unittest
+import tempfile
+import deadletter
+import routable
+import utils
+
+class TestDeadLetterQueue(unittest.TestCase):
+    def test_put_and_remove(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            dataset = utils.create_dataset()
+            dlq = deadletter.DeadLetterQueue(dir_path)
+            self.assertEqual([], dlq.worker_ids())
+            dlq.put('SCU1', routable.Routable('SCP1', dataset), 'C-STORE status 0x0122', 1)
+            self.assertEqual(['SCU1'], dlq.worker_ids())
+            entries = list(dlq.entries('SCU1'))
+            self.assertEqual(1, len(entries))
+            self.assertEqual('SCP1', entries[0].scp_id)
+            self.assertEqual('C-STORE status 0x0122', entries[0].reason)
+            self.assertEqual(dataset.SOPInstanceUID, entries[0].read_dataset().SOPInstanceUID)
+            dlq.remove(entries[0])
+            self.assertEqual([], list(dlq.entries('SCU1')))
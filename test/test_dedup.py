@@ -0,0 +1,47 @@
+import unittest
+import time
+import dedup
+import metrics
+
+class TestInstanceKey(unittest.TestCase):
+    def test_key(self):
+        key = dedup.instance_key('1.2.3', b'data')
+        self.assertEqual(key, dedup.instance_key('1.2.3', b'data'))
+        self.assertNotEqual(key, dedup.instance_key('1.2.4', b'data'))
+        # Same UID but modified content is not a duplicate
+        self.assertNotEqual(key, dedup.instance_key('1.2.3', b'other data'))
+
+class TestDeduplicationIndex(unittest.TestCase):
+    def test_seen(self):
+        hits = metrics.counter('dedup.hits').value
+        index = dedup.DeduplicationIndex(60, 10)
+        self.assertFalse(index.seen(b'a'))
+        self.assertTrue(index.seen(b'a'))
+        self.assertFalse(index.seen(b'b'))
+        self.assertEqual(hits + 1, metrics.counter('dedup.hits').value)
+
+    def test_max_entries(self):
+        index = dedup.DeduplicationIndex(60, 2)
+        index.seen(b'a')
+        index.seen(b'b')
+        index.seen(b'c')
+        self.assertEqual(2, len(index))
+        # Oldest entry was evicted
+        self.assertFalse(index.seen(b'a'))
+
+    def test_window(self):
+        index = dedup.DeduplicationIndex(0.01, 10)
+        index.seen(b'a')
+        time.sleep(0.02)
+        self.assertFalse(index.seen(b'a'))
+
+    def test_forget(self):
+        index = dedup.DeduplicationIndex(60, 10)
+        index.seen(b'a')
+        index.seen(b'b')
+        # Not relayed, so a re-send is not a duplicate
+        index.forget(b'a')
+        index.forget(b'c')
+        self.assertEqual(1, len(index))
+        self.assertFalse(index.seen(b'a'))
+        self.assertTrue(index.seen(b'b'))
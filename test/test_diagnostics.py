@@ -0,0 +1,75 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import configuration
+import diagnostics
+import router
+import routable
+import utils
+
+def busy_loop(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+def allocate(held: list):
+    for _ in range(100):
+        held.append(bytearray(10 * 1024))
+        time.sleep(0.002)
+
+class TestDiagnostics(unittest.TestCase):
+    def test_format_footprints(self):
+        r = router.Router('ROUTER0', {})
+        r.route(routable.Routable('SCP1', encoded=b'\0' * 100))
+        report = diagnostics.format_footprints({'router.ROUTER0': r})
+        self.assertIn('router.ROUTER0.queue', report)
+        self.assertEqual(['total', '1', '100'], report.splitlines()[-1].split())
+
+    def test_sample_profile(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_loop, args=(stop,), name='busy')
+        thread.start()
+        try:
+            report, collapsed = diagnostics.sample_profile(0.3)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertIn('busy_loop', report)
+        self.assertTrue(any(line.startswith('busy;') for line in collapsed.splitlines()))
+
+    def test_memory_snapshot(self):
+        held = []
+        thread = threading.Thread(target=allocate, args=(held,))
+        thread.start()
+        report = diagnostics.memory_snapshot(0.5)
+        thread.join()
+        self.assertIn('(test_diagnostics.py)', report)
+
+    def test_component(self):
+        # Oldest frame first, as ordered from Python 3.7
+        frames = [unittest.mock.Mock(filename=os.path.join(diagnostics._SOURCE_DIR_PATH, name)) for name in ['router.py', 'worker.py']]
+        frames.append(unittest.mock.Mock(filename='/usr/lib/python3/site-packages/pydicom/dataset.py'))
+        self.assertEqual('worker', diagnostics._component(frames))
+        with unittest.mock.patch.object(diagnostics.sys, 'version_info', (3, 6, 15)):
+            self.assertEqual('worker', diagnostics._component(list(reversed(frames))))
+        self.assertEqual('(dataset.py)', diagnostics._component(frames[2:]))
+
+    def test_socket(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            config = configuration.DiagnosticsConfiguration({}, os.path.join(dir_path, 'diagnostics.sock'))
+            d = diagnostics.Diagnostics(config, os.path.join(dir_path, 'diagnostics'))
+            d.start()
+            for _ in range(50):
+                if os.path.exists(config.socket_path):
+                    break
+                time.sleep(0.05)
+            paths = diagnostics.request(config.socket_path, 'stacks', timeout=10)
+            self.assertEqual(1, len(paths))
+            with open(paths[0]) as f:
+                self.assertIn('MainThread', f.read())
+            self.assertTrue(diagnostics.request(config.socket_path, 'unknown', timeout=10)[0].startswith('error:'))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+import os
+import tempfile
+import unittest
+import pydicom
+import dicomfile
+import routable
+import utils
+
+class TestDicomFile(unittest.TestCase):
+    def test_write_and_read(self):
+        dataset = utils.create_dataset()
+        r = routable.Routable('SCP1', dataset)
+        with tempfile.TemporaryDirectory() as dir_path:
+            path = os.path.join(dir_path, 'instance.dcm')
+            dicomfile.write(path, r)
+            self.assertEqual(['instance.dcm'], os.listdir(dir_path))
+            # Readable as a regular DICOM file
+            read_dataset = pydicom.dcmread(path)
+            self.assertEqual(dataset.SOPInstanceUID, read_dataset.SOPInstanceUID)
+            self.assertEqual(pydicom.uid.ExplicitVRLittleEndian, read_dataset.file_meta.TransferSyntaxUID)
+            read_routable = dicomfile.read(path, 'SCP2')
+            self.assertEqual('SCP2', read_routable.scp_id)
+            self.assertEqual(r.encoded, read_routable.encoded)
+            self.assertEqual(pydicom.uid.ExplicitVRLittleEndian, read_routable.transfer_syntax)
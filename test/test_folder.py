@@ -0,0 +1,155 @@
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
+import configuration
+import dedup
+import dicomfile
+import folder
+import routable
+import router
+import utils
+
+def create_router():
+    r = unittest.mock.Mock(spec=router.Router)
+    r.queue_depth.return_value = 0
+    return r
+
+def complete(r: routable.Routable) -> None:
+    # As a worker does once it sent the instance
+    r.on_completed(True)
+
+class TestFolderSource(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._watch_dir_path = os.path.join(self._dir.name, 'watch')
+        self._processed_dir_path = os.path.join(self._dir.name, 'processed')
+        self._failed_dir_path = os.path.join(self._dir.name, 'failed')
+        os.makedirs(os.path.join(self._watch_dir_path, 'study'))
+        self._router = create_router()
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _create_source(
+        self,
+        processed: bool = True,
+        poll_interval: float = 5,
+        dedup_index: dedup.DeduplicationIndex = None) -> folder.FolderSource:
+        json_data = {
+            'id': 'FOLDER1',
+            'name': 'Drop folder',
+            'type': 'folder',
+            'watch-dir-path': self._watch_dir_path,
+            'poll-interval': poll_interval
+        }
+        if processed:
+            json_data['processed-dir-path'] = self._processed_dir_path
+        config = configuration.SCPConfiguration(json_data)
+        return folder.FolderSource(config, {'ROUTER0': self._router}, self._failed_dir_path, dedup_index)
+
+    def _write(self, relative_path: str) -> routable.Routable:
+        r = routable.Routable('SCP1', utils.create_dataset())
+        dicomfile.write(os.path.join(self._watch_dir_path, relative_path), r)
+        return r
+
+    def test_ingest(self):
+        written = self._write('study/instance.dcm')
+        source = self._create_source()
+        self.assertTrue(source.ingest(os.path.join(self._watch_dir_path, 'study', 'instance.dcm')))
+        routed = self._router.route.call_args[0][0]
+        self.assertEqual('FOLDER1', routed.scp_id)
+        self.assertEqual(written.sop_instance_uid, routed.sop_instance_uid)
+        # Kept until sent, so not snapshotted
+        self.assertTrue(routed.kept_by_source)
+        self.assertEqual(['instance.dcm'], os.listdir(os.path.join(self._watch_dir_path, 'study')))
+        complete(routed)
+        self.assertEqual([], os.listdir(os.path.join(self._watch_dir_path, 'study')))
+        self.assertTrue(os.path.isfile(os.path.join(self._processed_dir_path, 'study', 'instance.dcm')))
+
+    def test_ingest_delete(self):
+        self._write('instance.dcm')
+        source = self._create_source(processed=False)
+        self.assertTrue(source.ingest(os.path.join(self._watch_dir_path, 'instance.dcm')))
+        complete(self._router.route.call_args[0][0])
+        self.assertEqual(['study'], os.listdir(self._watch_dir_path))
+
+    def test_dedup(self):
+        source = self._create_source(dedup_index=dedup.DeduplicationIndex(60, 10))
+        path = os.path.join(self._watch_dir_path, 'instance.dcm')
+        written = self._write('instance.dcm')
+        self.assertTrue(source.ingest(path))
+        # Dead lettered, so the same instance dropped again is relayed
+        self._router.route.call_args[0][0].on_completed(False)
+        dicomfile.write(path, written)
+        self.assertTrue(source.ingest(path))
+        self.assertEqual(2, self._router.route.call_count)
+        complete(self._router.route.call_args[0][0])
+        # Sent, so dropped as a duplicate
+        dicomfile.write(path, written)
+        self.assertTrue(source.ingest(path))
+        self.assertEqual(2, self._router.route.call_count)
+        self.assertFalse(os.path.exists(path))
+
+    def test_release_failed(self):
+        self._write('instance.dcm')
+        path = os.path.join(self._watch_dir_path, 'instance.dcm')
+        source = self._create_source(poll_interval=0.1)
+        self._router.route.side_effect = complete
+        with unittest.mock.patch('os.replace', side_effect=PermissionError('Read-only file system')):
+            source.submit(path)
+            self.assertTrue(utils.wait_for(lambda: self._router.route.call_count == 1))
+            # Left in place, and not ingested again
+            source.submit(path)
+            time.sleep(0.2)
+        self.assertEqual(1, self._router.route.call_count)
+        self.assertTrue(os.path.isfile(path))
+
+    def test_ingest_failed(self):
+        path = os.path.join(self._watch_dir_path, 'notes.txt')
+        with open(path, 'w') as f:
+            f.write('not DICOM')
+        source = self._create_source()
+        self.assertFalse(source.ingest(path))
+        self._router.route.assert_not_called()
+        self.assertTrue(os.path.isfile(os.path.join(self._failed_dir_path, 'notes.txt')))
+
+    def test_watch(self):
+        self._write('study/existing.dcm')
+        source = self._create_source()
+        self._router.route.side_effect = complete
+        # Only scanned once settled
+        os.utime(os.path.join(self._watch_dir_path, 'study', 'existing.dcm'), (0, 0))
+        source.start()
+        self.assertTrue(utils.wait_for(lambda: self._router.route.call_count == 1))
+        os.makedirs(os.path.join(self._watch_dir_path, 'new'))
+        time.sleep(0.2)
+        self._write('new/dropped.dcm')
+        self.assertTrue(utils.wait_for(lambda: self._router.route.call_count == 2))
+        self.assertTrue(utils.wait_for(lambda: os.path.isfile(os.path.join(self._processed_dir_path, 'new', 'dropped.dcm'))))
+
+    def test_backpressure(self):
+        self._write('instance.dcm')
+        source = self._create_source()
+        self._router.queue_depth.return_value = 1000
+        source.start()
+        time.sleep(0.5)
+        self._router.route.assert_not_called()
+        self._router.queue_depth.return_value = 0
+        self.assertTrue(utils.wait_for(lambda: self._router.route.call_count == 1))
+
+    def test_stop_during_backpressure(self):
+        for i in range(3):
+            self._write(f'instance{i}.dcm')
+        source = self._create_source(poll_interval=0.1)
+        self._router.queue_depth.return_value = 1000
+        source.start()
+        time.sleep(0.2)
+        # Stops without waiting for the routers to catch up
+        source.stop()
+        source.join(2)
+        self.assertFalse(source.is_alive())
+        self._router.route.assert_not_called()
+        # Left in place for the next start
+        self.assertEqual(['instance0.dcm', 'instance1.dcm', 'instance2.dcm', 'study'], sorted(os.listdir(self._watch_dir_path)))
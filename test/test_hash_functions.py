@@ -15,3 +15,21 @@ class TestHashFunctions(unittest.TestCase):
             hash_functions.random('hest', 1000000)
         with self.assertRaises(BaseException):
             hash_functions.random('b'*1000000, 10)
+
+    def test_random_matches_hex_digest(self):
+        # Placements must not change with how the digest is read
+        import hashlib
+        for index in range(1000):
+            value = f'PATIENT{index}'
+            expected = int(hashlib.md5(value.encode('utf-8')).hexdigest()[-5:], 16) % 7
+            self.assertEqual(expected, hash_functions.random(value, 7))
+
+    def test_crc32(self):
+        self.assertEqual(hash_functions.crc32('hest', 100), hash_functions.crc32('hest', 100))
+        counts = [0] * 4
+        for index in range(4000):
+            counts[hash_functions.crc32(f'PATIENT{index}', 4)] += 1
+        self.assertTrue(all(800 < count < 1200 for count in counts))
+        with self.assertRaises(BaseException):
+            hash_functions.crc32('hest', 1000000)
+        self.assertIs(hash_functions.crc32, hash_functions.get('crc32'))
@@ -1,8 +1,10 @@
 import unittest
+import time
 import livenesschecker
 import pydicom
 import utils
 import configuration
+import stowrs
 
 class TestLivenessStatus(unittest.TestCase):
     def test_enum_values(self):
@@ -31,6 +33,17 @@ class TestDicomEchoLivenessCheckerStrategy(unittest.TestCase):
         self.assertEqual(livenesschecker.LivenessStatus.LIVE, s.check())
         ss.shutdown()
 
+class TestHttpLivenessCheckerStrategy(unittest.TestCase):
+    def test_failed_check(self):
+        s = livenesschecker.HttpLivenessCheckerStrategy('http://127.0.0.1:1/studies', 1)
+        self.assertEqual(livenesschecker.LivenessStatus.HARD_FAIL, s.check())
+
+    def test_successful_check(self):
+        server = stowrs.StandInServer()
+        server.start()
+        s = livenesschecker.HttpLivenessCheckerStrategy(server.url, 1)
+        self.assertEqual(livenesschecker.LivenessStatus.LIVE, s.check())
+        server.stop()
 
 class MockLivenessCheckerStrategy(livenesschecker.LivenessCheckerStrategy):
     def __init__(self, check_result):
@@ -50,6 +63,70 @@ class TestLivenessChecker(unittest.TestCase):
         strategy = MockLivenessCheckerStrategy(livenesschecker.LivenessStatus.LIVE)
         config = MockConfiguration()
         lc = livenesschecker.LivenessChecker(checker_id, strategy, config, 1)
-        lc.start()
+        self.assertEqual(livenesschecker.LivenessStatus.UNKNOWN, lc.status)
+        self.assertEqual(livenesschecker.LivenessStatus.LIVE, lc.check())
+        self.assertEqual(livenesschecker.LivenessStatus.LIVE, lc.status)
+
+    def test_circuit_breaker(self):
+        strategy = MockLivenessCheckerStrategy(livenesschecker.LivenessStatus.LIVE)
+        lc = livenesschecker.LivenessChecker("id1", strategy, MockConfiguration(), 1, 2, 0.05)
+        lc.record_failure()
+        self.assertTrue(lc.allow_request())
+        lc.record_failure()
+        # Circuit opens after reaching the failure threshold
+        self.assertEqual(livenesschecker.LivenessStatus.HARD_FAIL, lc.status)
+        self.assertFalse(lc.allow_request())
+        time.sleep(0.06)
+        # Half-open, only a single probe is let through
+        self.assertTrue(lc.allow_request())
+        self.assertEqual(livenesschecker.LivenessStatus.SOFT_FAIL, lc.status)
+        self.assertFalse(lc.allow_request())
+        # Failed probe re-opens the circuit
+        lc.record_failure()
+        self.assertEqual(livenesschecker.LivenessStatus.HARD_FAIL, lc.status)
+        time.sleep(0.06)
+        self.assertTrue(lc.allow_request())
+        lc.record_success()
         self.assertEqual(livenesschecker.LivenessStatus.LIVE, lc.status)
-        lc.shutdown()
\ No newline at end of file
+        self.assertTrue(lc.allow_request())
+
+    def test_lost_probe(self):
+        strategy = MockLivenessCheckerStrategy(livenesschecker.LivenessStatus.LIVE)
+        lc = livenesschecker.LivenessChecker("id1", strategy, MockConfiguration(), 1, 1, 0.05)
+        lc.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(lc.allow_request())
+        self.assertFalse(lc.allow_request())
+        # No outcome recorded in time, so another probe is let through
+        time.sleep(0.06)
+        self.assertTrue(lc.allow_request())
+        self.assertFalse(lc.allow_request())
+
+    def test_passive_success_postpones_check(self):
+        strategy = MockLivenessCheckerStrategy(livenesschecker.LivenessStatus.LIVE)
+        lc = livenesschecker.LivenessChecker("id1", strategy, MockConfiguration(), 10)
+        now = time.monotonic()
+        self.assertEqual(now, lc.next_check_time(now))
+        lc.record_success()
+        self.assertTrue(lc.next_check_time(now) >= now + 10)
+
+class TestLivenessScheduler(unittest.TestCase):
+
+    def test_scheduler(self):
+        scheduler = livenesschecker.LivenessScheduler(4)
+        checkers = [
+            livenesschecker.LivenessChecker(
+                f"id{i}",
+                MockLivenessCheckerStrategy(livenesschecker.LivenessStatus.LIVE),
+                MockConfiguration(),
+                0.1)
+            for i in range(10)]
+        for checker in checkers:
+            scheduler.register(checker)
+        scheduler.start()
+        time.sleep(0.5)
+        for checker in checkers:
+            self.assertEqual(livenesschecker.LivenessStatus.LIVE, checker.status)
+        scheduler.shutdown()
+        scheduler.join(1)
+        self.assertFalse(scheduler.is_alive())
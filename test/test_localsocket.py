@@ -0,0 +1,27 @@
+import os
+import stat
+import tempfile
+import unittest
+import localsocket
+
+class TestLocalSocket(unittest.TestCase):
+    def test_listen(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            socket_path = os.path.join(dir_path, 'run', 'relay.sock')
+            os.makedirs(os.path.dirname(socket_path))
+            # Left behind by an earlier run
+            open(socket_path, 'w').close()
+            umask = os.umask(0)
+            os.umask(umask)
+            server = localsocket.listen(socket_path)
+            try:
+                self.assertTrue(stat.S_ISSOCK(os.stat(socket_path).st_mode))
+                # Only the owner may connect
+                self.assertEqual(0, os.stat(socket_path).st_mode & 0o077)
+                # The umask of the process is restored
+                self.assertEqual(umask, os.umask(umask))
+            finally:
+                server.close()
+
+if __name__ == "__main__":
+    unittest.main()
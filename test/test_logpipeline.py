@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+import configuration
+import logpipeline
+import metrics
+
+def create_core_config(log_dir_path: str, logging_config: dict) -> configuration.CoreConfiguration:
+    return configuration.CoreConfiguration({
+        'log-dir-path': log_dir_path,
+        'log-format': 'json',
+        'buffer-dir-path': log_dir_path,
+        'router-count': 1,
+        'logging': logging_config
+    })
+
+class TestRateLimitFilter(unittest.TestCase):
+    def _record(self, level: int, msg: str, *args) -> logging.LogRecord:
+        return logging.LogRecord('router', level, __file__, 1, msg, args, None)
+
+    def test_rate_limit(self):
+        f = logpipeline.RateLimitFilter(burst=3, interval=60, sample_every=5)
+        passed = [f.filter(self._record(logging.WARNING, 'No worker sets accepting routable from %s', f'SCP{i}')) for i in range(13)]
+        # Burst, then one in every five
+        self.assertEqual([True] * 3 + [False] * 4 + [True] + [False] * 4 + [True], passed)
+        record = self._record(logging.WARNING, 'No worker sets accepting routable from %s', 'SCP1')
+        for _ in range(4):
+            f.filter(record)
+        self.assertTrue(f.filter(record))
+        self.assertEqual(4, record.suppressed)
+
+    def test_debug_not_limited(self):
+        f = logpipeline.RateLimitFilter(burst=1, interval=60, sample_every=100)
+        self.assertTrue(all(f.filter(self._record(logging.DEBUG, 'Routing')) for _ in range(10)))
+
+class TestLoggingPipeline(unittest.TestCase):
+    def tearDown(self):
+        logging.getLogger('test.quiet').setLevel(logging.NOTSET)
+        logging.getLogger().setLevel(logging.WARNING)
+
+    def test_json_log_file(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            pipeline = logpipeline.start(create_core_config(dir_path, {'level': 'DEBUG', 'levels': {'test.quiet': 'ERROR'}}))
+            try:
+                logging.getLogger('test.loud').debug('Routed %d routables', 5)
+                logging.getLogger('test.quiet').warning('Not logged')
+            finally:
+                pipeline.stop()
+            with open(os.path.join(dir_path, logpipeline.LOG_FILE_NAME)) as f:
+                entries = [json.loads(line) for line in f]
+            self.assertEqual(1, len(entries))
+            self.assertEqual('test.loud', entries[0]['logger'])
+            self.assertEqual('DEBUG', entries[0]['level'])
+            self.assertEqual('Routed 5 routables', entries[0]['message'])
+
+    def test_drops_when_full(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            pipeline = logpipeline.LoggingPipeline(create_core_config(dir_path, {'queue-size': 1}))
+            handler = pipeline._handler
+            dropped = metrics.counter('logging.dropped').value
+            for i in range(3):
+                handler.handle(logging.LogRecord('test', logging.INFO, __file__, 1, 'Record %d', (i,), None))
+            self.assertEqual(dropped + 2, metrics.counter('logging.dropped').value)
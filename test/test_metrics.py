@@ -0,0 +1,15 @@
+import unittest
+import metrics
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_counter(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter('a').increment()
+        registry.counter('a').increment(2)
+        self.assertEqual(3, registry.counter('a').value)
+
+    def test_snapshot(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter('a').increment()
+        registry.gauge('b').set(5)
+        self.assertEqual({'a': 1, 'b': 5}, registry.snapshot())
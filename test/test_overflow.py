@@ -0,0 +1,113 @@
+import time
+import unittest
+from unittest import mock
+import configuration
+import overflow
+import routable
+import utils
+
+class StandInWorkerSet:
+    def __init__(self, id: str) -> None:
+        self.id = id
+        self.held = 0
+        self.size = 0
+        self.sent = 0
+        self.emptied = 0
+
+    def backlog(self):
+        return self.held, self.size
+
+    def progress(self):
+        return {'W1': (self.held, self.sent, self.emptied)}
+
+def create_routable(study_uid: str) -> routable.Routable:
+    ds = utils.create_dataset()
+    ds.StudyInstanceUID = study_uid
+    return routable.Routable('SCP1', ds)
+
+@mock.patch.object(overflow.Overflow, 'CHECK_INTERVAL', 0)
+class TestOverflow(unittest.TestCase):
+    def setUp(self):
+        self._primary = StandInWorkerSet('AI')
+        self._secondary = StandInWorkerSet('BURST')
+
+    def _create_overflow(self, **thresholds) -> overflow.Overflow:
+        config = configuration.OverflowConfiguration(dict({'worker-set-id': 'BURST'}, **thresholds))
+        return overflow.Overflow(config, self._primary, self._secondary)
+
+    def test_divert_new_studies(self):
+        o = self._create_overflow(**{'max-backlog-instances': 100})
+        self.assertIs(self._primary, o.select(create_routable('1.1')))
+        self._primary.held = 101
+        # Studies already started are not split
+        self.assertIs(self._primary, o.select(create_routable('1.1')))
+        self.assertIs(self._secondary, o.select(create_routable('1.2')))
+        self.assertTrue(o.diverting)
+        self._primary.held = 0
+        self.assertIs(self._secondary, o.select(create_routable('1.2')))
+        self.assertIs(self._primary, o.select(create_routable('1.3')))
+
+    def test_hysteresis(self):
+        o = self._create_overflow(**{'max-backlog-bytes': 1000, 'resume-ratio': 0.5})
+        self._primary.size = 1001
+        self.assertIs(self._secondary, o.select(create_routable('1.1')))
+        # Diverting until below half the threshold
+        self._primary.size = 900
+        self.assertIs(self._secondary, o.select(create_routable('1.2')))
+        self._primary.size = 600
+        self.assertIs(self._secondary, o.select(create_routable('1.3')))
+        self._primary.size = 400
+        self.assertIs(self._primary, o.select(create_routable('1.4')))
+        self.assertFalse(o.diverting)
+
+    def test_drain_time(self):
+        o = self._create_overflow(**{'max-drain-seconds': 60})
+        self._primary.held = 100000
+        # Drain rate is unknown on the first check
+        self.assertIs(self._primary, o.select(create_routable('1.1')))
+        time.sleep(0.05)
+        self._primary.sent = 50
+        # About 1000 per second, longer than the threshold to drain
+        self.assertIs(self._secondary, o.select(create_routable('1.2')))
+
+    def test_drain_time_idle(self):
+        o = self._create_overflow(**{'max-drain-seconds': 60})
+        # Idle, nothing held
+        self.assertIs(self._primary, o.select(create_routable('1.1')))
+        time.sleep(0.05)
+        self._primary.held = 100000
+        self.assertIs(self._primary, o.select(create_routable('1.2')))
+        time.sleep(0.05)
+        # Ran empty since, so not busy the whole time
+        self._primary.emptied = 1
+        self.assertIs(self._primary, o.select(create_routable('1.3')))
+        time.sleep(0.05)
+        # Nothing sent while busy, but not for longer than the threshold
+        self.assertIs(self._primary, o.select(create_routable('1.4')))
+        self.assertFalse(o.diverting)
+
+    def test_study_timeout(self):
+        o = self._create_overflow(**{'max-backlog-instances': 100, 'study-timeout': 0.05})
+        self._primary.held = 101
+        r = create_routable('1.1')
+        self.assertIs(self._secondary, o.select(r))
+        sent = create_routable('1.2')
+        self.assertIs(self._secondary, o.select(sent))
+        sent.on_completed(True)
+        self._primary.held = 0
+        time.sleep(0.1)
+        # Both timed out, but an instance of the first is still in flight
+        self.assertIs(self._primary, o.select(create_routable('1.3')))
+        self.assertIs(self._secondary, o.select(create_routable('1.1')))
+        self.assertIs(self._primary, o.select(create_routable('1.2')))
+        r.on_completed(True)
+
+    def test_no_study(self):
+        o = self._create_overflow(**{'max-backlog-instances': 1})
+        self._primary.held = 2
+        r = create_routable('1.1')
+        del r.dataset.StudyInstanceUID
+        self.assertIs(self._primary, o.select(r))
+
+if __name__ == "__main__":
+    unittest.main()
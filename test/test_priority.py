@@ -0,0 +1,87 @@
+import unittest
+import queue
+import configuration
+import priority
+import routable
+import utils
+
+def make_routable(priority_class='default', c_store_priority=0, modality='CT'):
+    r = routable.Routable('SCP1', utils.create_dataset(modality=modality), c_store_priority)
+    r.priority_class = priority_class
+    return r
+
+class TestPriorityClassifier(unittest.TestCase):
+    def test_classify(self):
+        classifier = priority.PriorityClassifier([
+            configuration.PriorityClassConfiguration({
+                "name": "stat",
+                "weight": 8,
+                "rules": [{"c-store-priorities": ["high"]}]
+            }),
+            configuration.PriorityClassConfiguration({
+                "name": "mammo",
+                "weight": 1,
+                "rules": [{
+                    "accepted-scp-ids": ["SCP1"],
+                    "header-requirements": [
+                        {"tag": ["0x0008", "0x0060"], "requirement": "regexp-match", "regexp": "^MG$"}
+                    ]
+                }]
+            })
+        ])
+        self.assertEqual({'default': 1, 'stat': 8, 'mammo': 1}, classifier.weights)
+        self.assertEqual('stat', classifier.classify(make_routable(c_store_priority=1, modality='MG')))
+        self.assertEqual('mammo', classifier.classify(make_routable(modality='MG')))
+        self.assertEqual('default', classifier.classify(make_routable()))
+
+class TestWeightedFairQueue(unittest.TestCase):
+    def test_fifo_within_class(self):
+        q = priority.WeightedFairQueue('test')
+        routables = [make_routable() for _ in range(3)]
+        for r in routables:
+            q.put(r)
+        self.assertEqual(3, q.qsize())
+        self.assertEqual(routables, [q.get() for _ in range(3)])
+        self.assertTrue(q.empty())
+
+    def test_weighted_share(self):
+        q = priority.WeightedFairQueue('test', {'stat': 3, 'default': 1})
+        q.put_many([make_routable('default') for _ in range(100)])
+        q.put_many([make_routable('stat') for _ in range(100)])
+        first = [q.get().priority_class for _ in range(40)]
+        self.assertEqual(30, first.count('stat'))
+        # Low priority is not starved
+        self.assertEqual(10, first.count('default'))
+        self.assertEqual({'stat': 70, 'default': 90},
+            {c: s['depth'] for c, s in q.stats().items()})
+
+    def test_unknown_class(self):
+        q = priority.WeightedFairQueue('test')
+        q.put(make_routable('other'))
+        self.assertEqual('other', q.get_nowait().priority_class)
+
+    def test_empty(self):
+        q = priority.WeightedFairQueue('test')
+        with self.assertRaises(queue.Empty):
+            q.get_nowait()
+        with self.assertRaises(queue.Empty):
+            q.get(timeout=0.01)
+
+    def test_get_batch(self):
+        q = priority.WeightedFairQueue('test')
+        q.put_many([make_routable() for _ in range(5)])
+        self.assertEqual(3, len(q.get_batch(3)))
+        self.assertEqual(2, len(q.get_batch(3)))
+        with self.assertRaises(queue.Empty):
+            q.get_batch(3, timeout=0.01)
+
+    def test_footprint(self):
+        q = priority.WeightedFairQueue('test')
+        q.put_many([routable.Routable('SCP1', encoded=b'\0' * size) for size in (10, 20, 30)])
+        self.assertEqual((3, 60), q.footprint())
+        q.get_batch(2)
+        self.assertEqual((1, 30), q.footprint())
+        self.assertEqual(0, q.emptied())
+        q.get()
+        self.assertEqual((0, 0), q.footprint())
+        self.assertEqual(1, q.emptied())
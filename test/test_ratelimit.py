@@ -0,0 +1,102 @@
+import os
+import tempfile
+import time
+import unittest
+import configuration
+import ratelimit
+import routable
+import worker
+import utils
+
+class TestTokenBucket(unittest.TestCase):
+    def test_take(self):
+        bucket = ratelimit.TokenBucket(100)
+        self.assertEqual(0, bucket.take(100))
+        # In debt, wait until paid back
+        self.assertAlmostEqual(0.5, bucket.take(50), places=1)
+
+    def test_set_rate(self):
+        bucket = ratelimit.TokenBucket(100)
+        bucket.set_rate(10)
+        self.assertEqual(10, bucket.rate)
+        self.assertEqual(0, bucket.take(10))
+        self.assertAlmostEqual(1, bucket.take(10), places=1)
+
+class TestAdaptiveLimit(unittest.TestCase):
+    def test_increase(self):
+        limit = ratelimit.AdaptiveLimit('worker.SCU1.concurrency', 1, 3)
+        limit.record_success(0.01, 1000)
+        self.assertEqual(2, limit.limit)
+        limit.record_success(0.01, 1000)
+        self.assertEqual(2, limit.limit)
+        limit.record_success(0.01, 1000)
+        self.assertEqual(3, limit.limit)
+        # Bounded by the ceiling
+        for _ in range(10):
+            limit.record_success(0.01, 1000)
+        self.assertEqual(3, limit.limit)
+
+    def test_back_off(self):
+        limit = ratelimit.AdaptiveLimit('worker.SCU1.concurrency', 1, 8)
+        for _ in range(1 + 2 + 3 + 4 + 5 + 6 + 7):
+            limit.record_success(0.01, 1000)
+        self.assertEqual(8, limit.limit)
+        limit.record_failure()
+        self.assertEqual(4, limit.limit)
+        # Sends which were in flight do not back off again
+        for _ in range(7):
+            limit.record_failure()
+        self.assertEqual(4, limit.limit)
+        limit.record_failure()
+        self.assertEqual(2, limit.limit)
+
+    def test_back_off_slow(self):
+        limit = ratelimit.AdaptiveLimit('worker.SCU1.concurrency', 1, 8, latency_tolerance=2)
+        for _ in range(3):
+            limit.record_success(0.01, 1000)
+        self.assertEqual(3, limit.limit)
+        # Large instances take longer without the peer slowing down
+        limit.record_success(0.2, 10 * 1024 * 1024)
+        limit.record_success(0.3, 10 * 1024 * 1024)
+        self.assertEqual(3, limit.limit)
+        limit.record_success(0.05, 1000)
+        self.assertEqual(1, limit.limit)
+
+class TestShaper(unittest.TestCase):
+    def test_delay(self):
+        shaper = ratelimit.Shaper('LOCAL1', [ratelimit.TokenBucket(10, 2)], [ratelimit.TokenBucket(1000)])
+        self.assertEqual(0, shaper.delay(1, 100))
+        self.assertEqual(0, shaper.delay(1, 100))
+        # Over the burst of instances, or the bytes per second
+        self.assertAlmostEqual(0.1, shaper.delay(1, 100), places=1)
+        self.assertAlmostEqual(0.3, shaper.delay(1, 1000), places=1)
+        self.assertGreater(shaper.wait, 0)
+
+    def test_shared_group(self):
+        group = ratelimit.TokenBucket(10, 1)
+        first = ratelimit.Shaper('SCU1', [group], [])
+        second = ratelimit.Shaper('SCU2', [ratelimit.TokenBucket(100), group], [])
+        self.assertEqual(0, first.delay(1, 0))
+        # Waits for what the other worker of the group sent
+        self.assertAlmostEqual(0.1, second.delay(1, 0), places=1)
+        self.assertAlmostEqual(0.2, first.delay(1, 0), places=1)
+
+    def test_worker(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            config = configuration.WorkerConfiguration({
+                'id': 'LOCAL1', 'name': 'Local', 'type': 'local-storage',
+                'ae-title': 'LOCAL1', 'address': '127.0.0.1', 'port': 104, 'output-dir-path': dir_path})
+            w = worker.LocalStorageWorker(config, shaper=ratelimit.Shaper('LOCAL1', [ratelimit.TokenBucket(20, 1)], []))
+            w.daemon = True
+            w.start()
+            started = time.monotonic()
+            w.process_many([routable.Routable('SCP1', utils.create_dataset()) for _ in range(5)])
+            while len(os.listdir(dir_path)) < 5 and time.monotonic() - started < 10:
+                time.sleep(0.01)
+            self.assertEqual(5, len(os.listdir(dir_path)))
+            # One instance goes through at once, the rest at the rate
+            self.assertGreater(time.monotonic() - started, 0.19)
+            w.stop()
+
+if __name__ == "__main__":
+    unittest.main()
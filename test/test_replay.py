@@ -0,0 +1,51 @@
+import time
+import unittest
+import pydicom
+import pynetdicom
+import replay
+import routable
+
+def create_record(arrival_time: float, size: int = 10000):
+    return {
+        'time': arrival_time,
+        'scp-id': 'SCP1',
+        'size': size,
+        'sop-class-uid': pynetdicom.sop_class.CTImageStorage,
+        'transfer-syntax': pydicom.uid.ExplicitVRLittleEndian,
+        'priority': 0,
+        'tags': {
+            '00100020': ['LO', 'a1b2c3'],
+            '00080060': ['CS', 'CT'],
+            '00080008': ['CS', 'ORIGINAL\\PRIMARY']
+        }
+    }
+
+class TestInstanceFactory(unittest.TestCase):
+    def test_create(self):
+        factory = replay.InstanceFactory()
+        r = factory.create(create_record(0, 100001))
+        self.assertEqual('SCP1', r.scp_id)
+        self.assertIn(len(r.encoded), [100000, 100001])
+        dataset = routable.decode(r.encoded[:], r.transfer_syntax)
+        self.assertEqual('a1b2c3', dataset.PatientID)
+        self.assertEqual(['ORIGINAL', 'PRIMARY'], list(dataset.ImageType))
+        self.assertEqual(pynetdicom.sop_class.CTImageStorage, dataset.SOPClassUID)
+        # Small records still carry their header
+        self.assertGreater(len(factory.create(create_record(0, 0)).encoded), 0)
+
+class TestReplayer(unittest.TestCase):
+    def test_replay(self):
+        stand_in = replay.StandInWorker('STANDIN', '127.0.0.1', 12348)
+        stand_in.start()
+        try:
+            records = [create_record(100 + i * 0.1) for i in range(10)]
+            replayer = replay.Replayer({'SCP1': ('STANDIN', '127.0.0.1', 12348)}, senders=2, speed=2)
+            started = time.monotonic()
+            stats = replayer.replay(records)
+            # 0.9 s of traffic replayed at twice the speed
+            self.assertGreaterEqual(time.monotonic() - started, 0.45)
+            self.assertEqual(10, stats.sent)
+            self.assertEqual(0, stats.failed)
+            self.assertEqual(10, stand_in.received)
+        finally:
+            stand_in.stop()
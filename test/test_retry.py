@@ -0,0 +1,75 @@
+import unittest
+import time
+import pydicom
+import retry
+import routable
+
+class TestClassifyStatus(unittest.TestCase):
+    def _status(self, code):
+        status = pydicom.Dataset()
+        status.Status = code
+        return status
+
+    def test_success(self):
+        self.assertIsNone(retry.classify_status(self._status(0x0000)))
+        # Warnings are successful stores
+        self.assertIsNone(retry.classify_status(self._status(0xB000)))
+
+    def test_transient(self):
+        self.assertEqual(retry.FailureClass.TRANSIENT, retry.classify_status(self._status(0xA700)))
+        self.assertEqual(retry.FailureClass.TRANSIENT, retry.classify_status(self._status(0x0110)))
+        # No response from peer
+        self.assertEqual(retry.FailureClass.TRANSIENT, retry.classify_status(pydicom.Dataset()))
+
+    def test_permanent(self):
+        self.assertEqual(retry.FailureClass.PERMANENT, retry.classify_status(self._status(0x0122)))
+        self.assertEqual(retry.FailureClass.PERMANENT, retry.classify_status(self._status(0xA900)))
+        self.assertEqual(retry.FailureClass.PERMANENT, retry.classify_status(self._status(0xC211)))
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_delay(self):
+        policy = retry.RetryPolicy(5, 1, 10)
+        self.assertEqual(0.0, policy.delay(0))
+        for _ in range(100):
+            self.assertTrue(0.5 <= policy.delay(1) <= 1)
+            self.assertTrue(2 <= policy.delay(3) <= 4)
+            # Bounded by max delay
+            self.assertTrue(5 <= policy.delay(20) <= 10)
+
+class TestRetryScheduler(unittest.TestCase):
+    def test_pop_due(self):
+        scheduler = retry.RetryScheduler()
+        first = retry.RetryEntry(None)
+        second = retry.RetryEntry(None)
+        later = retry.RetryEntry(None)
+        scheduler.schedule(first)
+        scheduler.schedule(later, 60)
+        scheduler.schedule(second)
+        self.assertEqual(3, len(scheduler))
+        self.assertEqual([first], scheduler.pop_due(1))
+        self.assertEqual([second], scheduler.pop_due())
+        self.assertEqual([], scheduler.pop_due())
+        self.assertTrue(scheduler.next_due_in() > 50)
+
+    def test_entries(self):
+        scheduler = retry.RetryScheduler()
+        first = retry.RetryEntry(None)
+        later = retry.RetryEntry(None)
+        scheduler.schedule(later, 60)
+        scheduler.schedule(first)
+        self.assertEqual([first, later], scheduler.entries())
+        # Entries are left in place
+        self.assertEqual(2, len(scheduler))
+
+    def test_footprint(self):
+        scheduler = retry.RetryScheduler()
+        scheduler.schedule(retry.RetryEntry(routable.Routable('SCP1', encoded=b'\0' * 10)))
+        scheduler.schedule(retry.RetryEntry(routable.Routable('SCP1', encoded=b'\0' * 20)), 60)
+        self.assertEqual((2, 30), scheduler.footprint())
+
+    def test_next_due_in_empty(self):
+        scheduler = retry.RetryScheduler()
+        self.assertIsNone(scheduler.next_due_in())
+        scheduler.schedule(retry.RetryEntry(None), 0.01)
+        time.sleep(0.02)
+        self.assertEqual(0.0, scheduler.next_due_in())
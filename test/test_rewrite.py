@@ -0,0 +1,76 @@
+import unittest
+import pydicom
+import configuration
+import rewrite
+import routable
+import utils
+
+def create_routable(transfer_syntax=pydicom.uid.ExplicitVRLittleEndian) -> routable.Routable:
+    dataset = utils.create_dataset()
+    dataset.ReferencedImageSequence = [pydicom.Dataset()]
+    dataset.ReferencedImageSequence[0].ReferencedSOPInstanceUID = '1.2.3'
+    dataset.BitsAllocated = 8
+    dataset.PixelData = bytes(range(256)) * 4
+    dataset.file_meta.TransferSyntaxUID = transfer_syntax
+    return routable.Routable('SCP1', dataset).with_encoded(routable.encode(dataset, transfer_syntax))
+
+def create_pipeline(*rewrites) -> rewrite.RewritePipeline:
+    return rewrite.RewritePipeline(
+        [configuration.RewriteConfiguration(r) for r in rewrites],
+        rewrite.UIDMapper('salt'))
+
+class TestRewritePipeline(unittest.TestCase):
+    def test_rewrites(self):
+        pipeline = create_pipeline(
+            {'tag': ['0010', '0010'], 'operation': 'set', 'value': 'ANONYMOUS'},
+            {'tag': ['0010', '0020'], 'operation': 'regexp-replace', 'regexp': '^PATIENT', 'replacement': 'P'},
+            {'tag': ['0008', '0070'], 'operation': 'delete'},
+            {'tag': ['0020', '000D'], 'operation': 'uid-remap'},
+            {'tag': ['0012', '0062'], 'operation': 'set', 'value': 'YES'})
+        for transfer_syntax in (pydicom.uid.ExplicitVRLittleEndian, pydicom.uid.ImplicitVRLittleEndian):
+            original = create_routable(transfer_syntax)
+            original_encoded = bytes(original.encoded)
+            rewritten = pipeline.apply(original)
+            dataset = rewritten.full_dataset()
+            self.assertEqual('ANONYMOUS', dataset.PatientName)
+            self.assertEqual('P1', dataset.PatientID)
+            self.assertNotIn('Manufacturer', dataset)
+            self.assertEqual('YES', dataset.PatientIdentityRemoved)
+            self.assertEqual(rewrite.UIDMapper('salt').map(original.dataset.StudyInstanceUID), dataset.StudyInstanceUID)
+            self.assertEqual('1.2.3', dataset.ReferencedImageSequence[0].ReferencedSOPInstanceUID)
+            self.assertEqual(bytes(range(256)) * 4, dataset.PixelData)
+            # The original is untouched
+            self.assertEqual(original_encoded, bytes(original.encoded))
+            self.assertEqual('Test^Patient', original.dataset.PatientName)
+
+    def test_pixel_data_shared(self):
+        original = create_routable()
+        rewritten = create_pipeline({'tag': ['0010', '0010'], 'operation': 'set', 'value': 'X'}).apply(original)
+        # Pixel data is a view of the original bytes, not a copy
+        tail = rewritten.encoded.segments[-1]
+        self.assertIs(original.encoded, tail.obj)
+
+    def test_deflated(self):
+        original = create_routable(pydicom.uid.DeflatedExplicitVRLittleEndian)
+        rewritten = create_pipeline({'tag': ['0010', '0010'], 'operation': 'delete'}).apply(original)
+        self.assertNotIn('PatientName', rewritten.dataset)
+        self.assertEqual('PATIENT1', rewritten.dataset.PatientID)
+
+    def test_no_rewrites(self):
+        original = create_routable()
+        self.assertIs(original, create_pipeline().apply(original))
+
+    def test_unsupported_vr(self):
+        with self.assertRaises(configuration.ConfigurationError):
+            create_pipeline({'tag': ['0028', '0010'], 'operation': 'set', 'value': '1'})
+
+class TestUIDMapper(unittest.TestCase):
+    def test_map(self):
+        mapper = rewrite.UIDMapper('salt')
+        mapped = mapper.map('1.2.3')
+        self.assertTrue(mapped.startswith('2.25.'))
+        self.assertLessEqual(len(mapped), 64)
+        self.assertEqual(mapped, mapper.map('1.2.3'))
+        self.assertEqual(mapped, rewrite.UIDMapper('salt').map('1.2.3'))
+        self.assertNotEqual(mapped, rewrite.UIDMapper('other').map('1.2.3'))
+        self.assertNotEqual(mapped, mapper.map('1.2.4'))
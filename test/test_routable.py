@@ -1,6 +1,7 @@
 import unittest
 import routable
 import pydicom
+import utils
 
 class TestRoutable(unittest.TestCase):
     def test_ctor(self):
@@ -8,4 +9,23 @@ class TestRoutable(unittest.TestCase):
         scp_id = "id1"
         r = routable.Routable(scp_id, dataset)
         self.assertEqual(dataset, r.dataset)
-        self.assertEqual(scp_id, r.scp_id)
\ No newline at end of file
+        self.assertEqual(scp_id, r.scp_id)
+
+    def test_encoded(self):
+        dataset = utils.create_dataset()
+        dataset.BitsAllocated = 8
+        dataset.PixelData = b'\0' * 64
+        encoded = routable.encode(dataset, pydicom.uid.ExplicitVRLittleEndian)
+        r = routable.Routable('SCP1', encoded=encoded, transfer_syntax=pydicom.uid.ExplicitVRLittleEndian)
+        # Only the header is decoded
+        self.assertEqual(dataset.SOPInstanceUID, r.sop_instance_uid)
+        self.assertNotIn('PixelData', r.dataset)
+        self.assertEqual(b'\0' * 64, r.full_dataset().PixelData)
+        self.assertIs(encoded, r.encoded)
+
+    def test_with_encoded(self):
+        r = routable.Routable('SCP1', utils.create_dataset(), 1)
+        r.priority_class = 'urgent'
+        copy = r.with_encoded(r.encoded)
+        self.assertEqual(('SCP1', 1, 'urgent'), (copy.scp_id, copy.c_store_priority, copy.priority_class))
+        self.assertEqual(r.sop_instance_uid, copy.sop_instance_uid)
@@ -0,0 +1,43 @@
+import unittest
+import unittest.mock
+import time
+import router
+import routable
+import worker
+import workerset
+import utils
+
+class TestRouter(unittest.TestCase):
+    def test_batched_hand_off(self):
+        workers = [unittest.mock.Mock(spec=worker.Worker) for _ in range(2)]
+        worker_set = unittest.mock.Mock(spec=workerset.WorkerSet)
+        worker_set.can_accept.return_value = True
+        worker_set.select_worker.side_effect = lambda r: workers[int(r.dataset.PatientID)]
+        worker_set.rewrite.side_effect = lambda r: r
+        worker_set.divert.side_effect = lambda r: worker_set
+        r = router.Router('ROUTER0', {'SET1': worker_set})
+        r.daemon = True
+        routables = [routable.Routable('SCP1', utils.create_dataset(patient_id=str(i % 2))) for i in range(10)]
+        for item in routables:
+            r.route(item)
+        r.start()
+        time.sleep(0.2)
+        # Each worker receives its share, in order, in a single hand-off
+        workers[0].process_many.assert_called_once_with(routables[0::2])
+        workers[1].process_many.assert_called_once_with(routables[1::2])
+
+    def test_dropped_completed(self):
+        r = router.Router('ROUTER0', {})
+        item = routable.Routable('SCP1', utils.create_dataset())
+        item.on_completed = unittest.mock.Mock()
+        # No worker set accepts it, so no worker completes it
+        self.assertEqual([(None, None)], r.plan_batch([item]))
+        item.on_completed.assert_called_once_with(False)
+
+    def test_stop(self):
+        r = router.Router('ROUTER0', {})
+        r.daemon = True
+        r.start()
+        r.stop()
+        r.join(5)
+        self.assertFalse(r.is_alive())
@@ -0,0 +1,87 @@
+import copy
+import json
+import os
+import tempfile
+import unittest
+import configuration
+import dicomfile
+import routable
+import simulate
+import utils
+
+CONFIG = {
+    'core': {
+        'log-dir-path': '.',
+        'log-format': 'json',
+        'buffer-dir-path': '/tmp/',
+        'router-count': 1
+    },
+    'workers': [{
+        'type': 'local-storage',
+        'id': f'W{i}',
+        'name': f'W{i}',
+        'ae-title': '',
+        'address': '',
+        'port': 0,
+        'output-dir-path': '/tmp/localstorage'
+    } for i in range(3)],
+    'scps': [{ 'id': 'SCP1', 'name': 'SCP1', 'ae-title': 'SCP1', 'address': '127.0.0.1', 'port': 23456 }],
+    'worker-sets': [{
+        'id': 'SET1',
+        'name': 'SET1',
+        'worker-ids': ['W0', 'W1'],
+        'distribution': 'round-robin',
+        'hash-method': 'modulo',
+        'accepted-scp-ids': ['SCP1'],
+        'header-requirements': [
+            { 'tag': ['0x0008', '0x0060'], 'requirement': 'regexp-match', 'regexp': '^CT' }
+        ]
+    }]
+}
+
+class TestSimulate(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._input_dir_path = os.path.join(self._dir.name, 'input')
+        os.makedirs(os.path.join(self._input_dir_path, 'nested'))
+        for i in range(20):
+            dataset = utils.create_dataset(f'PATIENT{i % 10}', 'CT' if i < 16 else 'MR')
+            dicomfile.write(os.path.join(self._input_dir_path, 'nested' if i % 2 else '', f'{i}.dcm'), routable.Routable('SCP1', dataset))
+        with open(os.path.join(self._input_dir_path, 'notes.txt'), 'w') as f:
+            f.write('not DICOM')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _write_config(self, name: str, config: dict) -> configuration.Configuration:
+        path = os.path.join(self._dir.name, name)
+        with open(path, 'w') as f:
+            json.dump(config, f)
+        return configuration.Configuration(path)
+
+    def test_simulate(self):
+        config = self._write_config('current.json', CONFIG)
+        proposed = copy.deepcopy(CONFIG)
+        proposed['worker-sets'][0]['worker-ids'].append('W2')
+        proposed_config = self._write_config('proposed.json', proposed)
+        report = simulate.simulate(proposed_config, self._input_dir_path, 'SCP1', config, processes=2)
+        worker_set = report['worker-sets'][0]
+        self.assertEqual(['W0', 'W1', 'W2'], [w['id'] for w in worker_set['workers']])
+        self.assertEqual(16, worker_set['instances'])
+        self.assertEqual(sum(os.path.getsize(os.path.join(self._input_dir_path, f'{i}.dcm'))
+            for i in range(0, 16, 2)) + sum(os.path.getsize(os.path.join(self._input_dir_path, 'nested', f'{i}.dcm'))
+            for i in range(1, 16, 2)), worker_set['bytes'])
+        self.assertEqual(4, report['unmatched'])
+        self.assertEqual(1, report['unreadable'])
+        self.assertEqual(10, report['patients'])
+        self.assertGreater(report['moved-patients'], 0)
+        self.assertIn('Worker set SET1', simulate.format_report(report))
+
+    def test_manifest(self):
+        config = self._write_config('current.json', CONFIG)
+        manifest_path = os.path.join(self._dir.name, 'manifest.txt')
+        with open(manifest_path, 'w') as f:
+            f.write(os.path.join(self._input_dir_path, '0.dcm') + '\n\n')
+        report = simulate.simulate(config, manifest_path, 'SCP1', processes=1)
+        self.assertEqual(1, report['worker-sets'][0]['instances'])
+        self.assertNotIn('moved-instances', report)
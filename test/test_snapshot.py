@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import buffers
+import configuration
+import deadletter
+import dicomfile
+import retry
+import routable
+import snapshot
+import worker
+import utils
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _routable(self, patient_id: str = 'PATIENT1') -> routable.Routable:
+        r = routable.Routable('SCP1', utils.create_dataset(patient_id), c_store_priority=1)
+        r.priority_class = 'stat'
+        return r
+
+    def test_read_write(self):
+        routables = [self._routable('PATIENT1'), self._routable('PATIENT2')]
+        path = os.path.join(self._dir.name, 'worker.SCU1' + snapshot.SUFFIX)
+        snapshot.write(path, [(routables[0], 0), (routables[1], 3)])
+        restored = list(snapshot.read(path))
+        self.assertEqual([0, 3], [attempts for _, attempts in restored])
+        for original, (r, _) in zip(routables, restored):
+            self.assertEqual(bytes(original.encoded), bytes(r.encoded))
+            self.assertEqual('SCP1', r.scp_id)
+            self.assertEqual(1, r.c_store_priority)
+            self.assertEqual('stat', r.priority_class)
+            self.assertEqual(original.transfer_syntax, r.transfer_syntax)
+        self.assertEqual('PATIENT2', restored[1][0].dataset.PatientID)
+
+    def test_read_mapped(self):
+        r = self._routable()
+        path = os.path.join(self._dir.name, 'router.ROUTER1' + snapshot.SUFFIX)
+        snapshot.write(path, [(r, 0), (r, 0)])
+        with mock.patch.object(dicomfile, 'MAP_THRESHOLD', 16):
+            restored = list(snapshot.read(path))
+        self.assertEqual(2, len(restored))
+        mapped = restored[1][0].encoded
+        self.assertIsInstance(mapped, buffers.FileBuffer)
+        self.assertEqual(bytes(r.encoded), b''.join(buffers.segments(mapped)))
+        self.assertEqual('PATIENT1', restored[1][0].dataset.PatientID)
+
+    def test_save_load(self):
+        count = snapshot.save(self._dir.name, {
+            'router.ROUTER1': [(self._routable(), 0)],
+            'worker.SCU1': [(self._routable(), 0), (self._routable(), 2)],
+            'worker.SCU2': []
+        })
+        self.assertEqual(3, count)
+        with open(os.path.join(self._dir.name, 'worker.SCU3' + snapshot.SUFFIX), 'wb') as f:
+            f.write(b'not a snapshot')
+        restored = snapshot.load(self._dir.name)
+        self.assertEqual(['router.ROUTER1', 'worker.SCU1'], sorted(restored))
+        self.assertEqual(2, len(restored['worker.SCU1']))
+        # Restored files are removed, unreadable ones kept aside
+        self.assertEqual(['worker.SCU3' + snapshot.SUFFIX + '.failed'], os.listdir(self._dir.name))
+        self.assertEqual({}, snapshot.load(os.path.join(self._dir.name, 'missing')))
+
+    def test_save_kept_by_source(self):
+        kept = self._routable('PATIENT2')
+        kept.kept_by_source = True
+        # Ingested again by its source, so not restored a second time
+        count = snapshot.save(self._dir.name, {
+            'router.ROUTER1': [(self._routable(), 0), (kept.with_encoded(kept.encoded), 0)],
+            'worker.SCU1': [(kept, 1)]
+        })
+        self.assertEqual(1, count)
+        restored = snapshot.load(self._dir.name)
+        self.assertEqual(['router.ROUTER1'], list(restored))
+        self.assertEqual('PATIENT1', restored['router.ROUTER1'][0][0].dataset.PatientID)
+
+    def test_worker_snapshot_restore(self):
+        config = configuration.WorkerConfiguration({
+            'id': 'STOW1', 'name': 'Archive', 'type': 'stow-rs', 'url': 'http://127.0.0.1:1/studies'})
+        w = worker.StowRSWorker(
+            config, retry.RetryPolicy(3, 60, 60), deadletter.DeadLetterQueue(self._dir.name), None)
+        first = self._routable('PATIENT1')
+        second = self._routable('PATIENT2')
+        w.restore([(first, 0), (second, 2)])
+        self.assertEqual(2, w.held())
+        entries = w.snapshot()
+        self.assertEqual([(first, 0), (second, 2)], entries)
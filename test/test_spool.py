@@ -0,0 +1,86 @@
+import gc
+import os
+import tempfile
+import unittest
+import pydicom
+import pynetdicom
+from pynetdicom import AE, evt
+import buffers
+import routable
+import spool
+import storescu
+import utils
+
+class TestSpoolBuffer(unittest.TestCase):
+    def test_in_memory(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            b = spool.SpoolBuffer(dir_path, 10)
+            b.write(b'12345')
+            b.write(b'67890')
+            self.assertEqual(b'1234567890', b.getvalue())
+            self.assertEqual([], os.listdir(dir_path))
+
+    def test_spooled(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            b = spool.SpoolBuffer(dir_path, 10)
+            b.write(b'12345')
+            b.write(b'67890')
+            b.write(b'abc')
+            self.assertEqual(1, len(os.listdir(dir_path)))
+            value = b.getvalue()
+            self.assertIsInstance(value, buffers.FileBuffer)
+            self.assertEqual(b'1234567890abc', value[:])
+            self.assertIs(value, b.getvalue())
+            # Spool file is unlinked once mapped
+            self.assertEqual([], os.listdir(dir_path))
+
+    def test_incomplete(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            b = spool.SpoolBuffer(dir_path, 1)
+            b.write(b'12345')
+            self.assertEqual(1, len(os.listdir(dir_path)))
+            del b
+            gc.collect()
+            self.assertEqual([], os.listdir(dir_path))
+
+class TestSpool(unittest.TestCase):
+    def test_removes_stale_files(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            open(os.path.join(dir_path, 'stale.spool'), 'wb').close()
+            spool.Spool(dir_path, 10)
+            self.assertEqual([], os.listdir(dir_path))
+
+    def test_receive_and_send(self):
+        received = []
+        def handle_store(event):
+            received.append(event.request.DataSet.getvalue())
+            return 0x0000
+        with tempfile.TemporaryDirectory() as dir_path:
+            s = spool.Spool(dir_path, 64 * 1024)
+            scp_ae = AE()
+            scp_ae.add_supported_context(pynetdicom.sop_class.CTImageStorage, pydicom.uid.ExplicitVRLittleEndian)
+            scp_ae.start_server(('127.0.0.1', 12347), block=False, evt_handlers=[
+                (evt.EVT_C_STORE, handle_store),
+                (evt.EVT_REQUESTED, lambda event: s.install(event.assoc))])
+            try:
+                small = routable.Routable('SCP1', utils.create_dataset())
+                dataset = utils.create_dataset()
+                dataset.BitsAllocated = 8
+                dataset.PixelData = os.urandom(1024 * 1024)
+                large = routable.Routable('SCP1', dataset)
+                ae = AE()
+                ae.add_requested_context(pynetdicom.sop_class.CTImageStorage, pydicom.uid.ExplicitVRLittleEndian)
+                assoc = ae.associate('127.0.0.1', 12347)
+                self.assertEqual(0x0000, storescu.send_c_store(assoc, small).Status)
+                self.assertEqual(0x0000, storescu.send_c_store(assoc, large).Status)
+                # Relay the spooled instance from its mapped file
+                spooled = routable.Routable('SCP1', encoded=received[1], transfer_syntax=pydicom.uid.ExplicitVRLittleEndian)
+                self.assertEqual(0x0000, storescu.send_c_store(assoc, spooled).Status)
+                assoc.release()
+            finally:
+                scp_ae.shutdown()
+            self.assertEqual(small.encoded, received[0])
+            self.assertIsInstance(received[1], buffers.FileBuffer)
+            self.assertEqual(large.encoded, received[1][:])
+            self.assertEqual(large.encoded, received[2][:])
+            self.assertEqual(dataset.SOPInstanceUID, spooled.sop_instance_uid)
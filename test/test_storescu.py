@@ -0,0 +1,165 @@
+import queue
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import pydicom
+import pynetdicom
+from pynetdicom import AE, evt
+import configuration
+import deadletter
+import livenesschecker
+import retry
+import routable
+import storescu
+import worker
+import utils
+
+class TestStoreSCU(unittest.TestCase):
+    def setUp(self):
+        self._received = []
+        def handle_store(event):
+            self._received.append((event.context.transfer_syntax, event.request.DataSet.getvalue()))
+            return 0x0000
+        self._ae = AE()
+        self._ae.add_supported_context(pynetdicom.sop_class.CTImageStorage, [
+            pydicom.uid.ExplicitVRLittleEndian, pydicom.uid.ImplicitVRLittleEndian])
+        self._ae.start_server(('127.0.0.1', 12346), block=False, evt_handlers=[(evt.EVT_C_STORE, handle_store)])
+
+    def tearDown(self):
+        self._ae.shutdown()
+
+    def _send(self, transfer_syntax: str, r: routable.Routable) -> pydicom.Dataset:
+        ae = AE()
+        ae.add_requested_context(pynetdicom.sop_class.CTImageStorage, transfer_syntax)
+        assoc = ae.associate('127.0.0.1', 12346)
+        self.assertTrue(assoc.is_established)
+        try:
+            return storescu.send_c_store(assoc, r)
+        finally:
+            assoc.release()
+
+    def test_send_encoded(self):
+        r = routable.Routable('SCP1', utils.create_dataset())
+        status = self._send(pydicom.uid.ExplicitVRLittleEndian, r)
+        self.assertEqual(0x0000, status.Status)
+        self.assertEqual([(pydicom.uid.ExplicitVRLittleEndian, r.encoded)], self._received)
+
+    def test_send_converted(self):
+        r = routable.Routable('SCP1', utils.create_dataset())
+        status = self._send(pydicom.uid.ImplicitVRLittleEndian, r)
+        self.assertEqual(0x0000, status.Status)
+        transfer_syntax, encoded = self._received[0]
+        self.assertEqual(pydicom.uid.ImplicitVRLittleEndian, transfer_syntax)
+        self.assertEqual(r.sop_instance_uid, routable.decode(encoded, transfer_syntax).SOPInstanceUID)
+
+class TestThrottledBuffer(unittest.TestCase):
+    def test_wait_for_pending(self):
+        pending = queue.Queue()
+        for _ in range(storescu.MAX_PENDING_FRAGMENTS + 1):
+            pending.put(b'')
+        buffer = storescu._ThrottledBuffer(b'0123456789', pending)
+        taker = threading.Timer(0.2, pending.get)
+        taker.start()
+        started = time.monotonic()
+        # Sliced once a fragment is taken
+        self.assertEqual(b'0123', buffer[0:4])
+        self.assertGreater(time.monotonic() - started, 0.15)
+        taker.join()
+
+class TestSCUWorker(unittest.TestCase):
+    def setUp(self):
+        self._received = []
+        self._associations = 0
+        self.max_associations = 0
+        self._lock = threading.Lock()
+        def handle_established(event):
+            with self._lock:
+                self._associations += 1
+                self.max_associations = max(self.max_associations, self._associations)
+        def handle_released(event):
+            with self._lock:
+                self._associations -= 1
+        def handle_store(event):
+            time.sleep(0.01)
+            with self._lock:
+                self._received.append(event.request.DataSet.getvalue())
+            return 0x0000
+        self._ae = AE()
+        self._ae.add_supported_context(pynetdicom.sop_class.CTImageStorage, pydicom.uid.ExplicitVRLittleEndian)
+        self._ae.start_server(('127.0.0.1', 12347), block=False, evt_handlers=[
+            (evt.EVT_C_STORE, handle_store),
+            (evt.EVT_ESTABLISHED, handle_established),
+            (evt.EVT_RELEASED, handle_released)])
+        self._dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._ae.shutdown()
+        self._dir.cleanup()
+
+    def test_concurrency(self):
+        config = configuration.WorkerConfiguration({
+            'id': 'SCU1',
+            'name': 'Peer',
+            'type': 'scu',
+            'ae-title': 'PEER',
+            'address': '127.0.0.1',
+            'port': 12347,
+            'output-dir-path': self._dir.name,
+            'concurrency': {'min-associations': 1, 'max-associations': 4}
+        })
+        checker = livenesschecker.LivenessChecker(
+            config.id,
+            livenesschecker.DicomEchoLivenessCheckerStrategy(config.address, config.port),
+            config,
+            10,
+            3,
+            0.1)
+        w = worker.SCUWorker(config, retry.RetryPolicy(3, 0.05, 0.1), deadletter.DeadLetterQueue(self._dir.name), checker)
+        w.retune({'max-send-batch': 10})
+        w.daemon = True
+        w.start()
+        routables = [
+            routable.Routable('SCP1', utils.create_dataset(f'PATIENT{index % 8}')) for index in range(80)]
+        for r in routables:
+            r.encoded
+        w.process_many(routables)
+        self.assertTrue(utils.wait_for(lambda: len(self._received) == 80 and w.held() == 0, timeout=30))
+        w.stop()
+        w.join(5)
+        # Raised while the peer keeps up, sending over several
+        # associations, each patient in order
+        self.assertTrue(w.status()['concurrency-limit'] > 1)
+        self.assertTrue(self.max_associations > 1)
+        order = {encoded: index for index, encoded in enumerate(self._received)}
+        for patient in range(8):
+            indices = [order[bytes(r.encoded)] for r in routables[patient::8]]
+            self.assertEqual(sorted(indices), indices)
+
+    def test_half_open_single_association(self):
+        config = configuration.WorkerConfiguration({
+            'id': 'SCU2',
+            'name': 'Peer',
+            'type': 'scu',
+            'ae-title': 'PEER',
+            'address': '127.0.0.1',
+            'port': 12347,
+            'output-dir-path': self._dir.name,
+            'concurrency': {'min-associations': 4, 'max-associations': 4}
+        })
+        checker = unittest.mock.Mock(spec=livenesschecker.LivenessChecker)
+        checker.allow_request.return_value = True
+        checker.status = livenesschecker.LivenessStatus.SOFT_FAIL
+        w = worker.SCUWorker(config, retry.RetryPolicy(3, 0.05, 0.1), deadletter.DeadLetterQueue(self._dir.name), checker)
+        entries = [
+            retry.RetryEntry(routable.Routable('SCP1', utils.create_dataset(f'PATIENT{index % 8}')))
+            for index in range(16)]
+        with unittest.mock.patch.object(w, '_send_association') as send_association:
+            w._send_due(entries)
+        # A single probe, the rest is held on to without an attempt
+        send_association.assert_called_once()
+        probed = send_association.call_args[0][0]
+        self.assertEqual(16 - len(probed), len(w._buffer))
+        self.assertTrue(all(entry.attempts == 0 for entry in entries))
+        w._executor.shutdown()
@@ -0,0 +1,196 @@
+import json
+import tempfile
+import time
+import unittest
+import unittest.mock
+import configuration
+import deadletter
+import livenesschecker
+import retry
+import routable
+import stowrs
+import worker
+import utils
+
+def failed_response(uid: str, reason: int) -> bytes:
+    return json.dumps({
+        stowrs.FAILED_SOP_SEQUENCE: {'vr': 'SQ', 'Value': [{
+            stowrs.REFERENCED_SOP_INSTANCE_UID: {'vr': 'UI', 'Value': [uid]},
+            stowrs.FAILURE_REASON: {'vr': 'US', 'Value': [reason]}
+        }]}
+    }).encode('utf-8')
+
+class TestStowClient(unittest.TestCase):
+    def setUp(self):
+        self._server = stowrs.StandInServer()
+        self._server.start()
+
+    def tearDown(self):
+        self._server.stop()
+
+    def test_store(self):
+        client = stowrs.StowClient(self._server.url)
+        routables = [routable.Routable('SCP1', utils.create_dataset()) for _ in range(3)]
+        status, body = client.store(routables)
+        self.assertEqual(200, status)
+        self.assertEqual({}, stowrs.parse_failures(body))
+        self.assertEqual(3, self._server.received)
+        # The connection is kept for the next request
+        client.store(routables[:1])
+        self.assertEqual(2, self._server.requests)
+        self.assertEqual(1, len(client._pool._idle))
+        client.close()
+
+    def test_store_gzip(self):
+        client = stowrs.StowClient(self._server.url, compress=True)
+        status, _ = client.store([routable.Routable('SCP1', utils.create_dataset())])
+        self.assertEqual(200, status)
+        self.assertEqual(1, self._server.received)
+
+    def test_store_partial_failure(self):
+        client = stowrs.StowClient(self._server.url)
+        routables = [routable.Routable('SCP1', utils.create_dataset()) for _ in range(2)]
+        self._server.failed_uids.add(routables[1].sop_instance_uid)
+        status, body = client.store(routables)
+        self.assertEqual(202, status)
+        self.assertEqual({routables[1].sop_instance_uid: 0xA700}, stowrs.parse_failures(body))
+
+class TestClassifyResponse(unittest.TestCase):
+    def test_success(self):
+        self.assertEqual([(None, '')] * 2, stowrs.classify_response(200, b'', ['1', '2']))
+
+    def test_partial_failure(self):
+        outcomes = stowrs.classify_response(202, failed_response('2', 0xA900), ['1', '2'])
+        self.assertIsNone(outcomes[0][0])
+        self.assertEqual(retry.FailureClass.PERMANENT, outcomes[1][0])
+
+    def test_conflict_without_reasons(self):
+        outcomes = stowrs.classify_response(409, b'', ['1'])
+        self.assertEqual(retry.FailureClass.TRANSIENT, outcomes[0][0])
+
+    def test_request_statuses(self):
+        self.assertEqual(retry.FailureClass.PERMANENT, stowrs.classify_response(415, b'', ['1'])[0][0])
+        self.assertEqual(retry.FailureClass.TRANSIENT, stowrs.classify_response(503, b'', ['1'])[0][0])
+        self.assertTrue(stowrs.peer_failed(503))
+        self.assertFalse(stowrs.peer_failed(202))
+        self.assertFalse(stowrs.peer_failed(400))
+
+class TestStowRSWorker(unittest.TestCase):
+    def setUp(self):
+        self._server = stowrs.StandInServer()
+        self._server.start()
+        self._dir = tempfile.TemporaryDirectory()
+        self._dead_letters = deadletter.DeadLetterQueue(self._dir.name)
+
+    def tearDown(self):
+        self._server.stop()
+        self._dir.cleanup()
+
+    def _create_worker(self, max_batch_count: int = 2) -> worker.StowRSWorker:
+        config = configuration.WorkerConfiguration({
+            'id': 'STOW1',
+            'name': 'Archive',
+            'type': 'stow-rs',
+            'url': self._server.url,
+            'max-batch-count': max_batch_count,
+            'max-in-flight': 2
+        })
+        checker = livenesschecker.LivenessChecker(
+            config.id,
+            livenesschecker.HttpLivenessCheckerStrategy(config.url),
+            config,
+            10,
+            3,
+            0.1)
+        w = worker.StowRSWorker(config, retry.RetryPolicy(3, 0.05, 0.1), self._dead_letters, checker)
+        w.daemon = True
+        w.start()
+        return w
+
+    def test_send_batches(self):
+        w = self._create_worker()
+        w.process_many([routable.Routable('SCP1', utils.create_dataset()) for _ in range(5)])
+        self.assertTrue(utils.wait_for(lambda: self._server.received == 5))
+        self.assertEqual(3, self._server.requests)
+
+    def test_dead_letter_permanent_failure(self):
+        routables = [routable.Routable('SCP1', utils.create_dataset()) for _ in range(2)]
+        self._server.failed_uids.add(routables[0].sop_instance_uid)
+        self._server.failure_reason = 0xA900
+        w = self._create_worker()
+        w.process_many(routables)
+        self.assertTrue(utils.wait_for(lambda: len(list(self._dead_letters.entries('STOW1'))) == 1))
+        self.assertEqual(1, self._server.received)
+        self.assertEqual('STOW-RS failure reason 0xA900', list(self._dead_letters.entries('STOW1'))[0].reason)
+
+    def test_retry_after_server_error(self):
+        self._server.status = 503
+        w = self._create_worker()
+        w.process(routable.Routable('SCP1', utils.create_dataset()))
+        self.assertTrue(utils.wait_for(lambda: self._server.requests >= 2))
+        self._server.status = None
+        self.assertTrue(utils.wait_for(lambda: self._server.received == 1))
+        self.assertEqual([], list(self._dead_letters.entries('STOW1')))
+
+    def test_unreadable_response(self):
+        classify_response = stowrs.classify_response
+        calls = []
+        def classify_once_unreadable(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise ValueError('Unreadable response')
+            return classify_response(*args)
+        routables = [routable.Routable('SCP1', utils.create_dataset()) for _ in range(2)]
+        with unittest.mock.patch('stowrs.classify_response', side_effect=classify_once_unreadable):
+            w = self._create_worker()
+            # Counted per worker id, also by other tests
+            completed = w.completed()
+            w.process_many(routables)
+            # Retried as a whole, each instance completed once
+            self.assertTrue(utils.wait_for(lambda: w.completed() - completed == 2 and w.held() == 0))
+        self.assertEqual(2, len(calls))
+        self.assertEqual([], list(self._dead_letters.entries('STOW1')))
+
+    def test_completed_outside_lock(self):
+        w = self._create_worker()
+        locked = []
+        r = routable.Routable('SCP1', utils.create_dataset())
+        # Completing may move files, so senders must not wait on it
+        r.on_completed = lambda sent: locked.append(w._lock.locked())
+        w.process(r)
+        self.assertTrue(utils.wait_for(lambda: locked))
+        self.assertEqual([False], locked)
+
+    def test_retune(self):
+        w = self._create_worker()
+        w.retune({'max-batch-count': 5, 'max-in-flight': 8})
+        self.assertEqual(8, w._executor_size)
+        # Takes effect once the worker is done waiting for the queue
+        time.sleep(1.1)
+        w.process_many([routable.Routable('SCP1', utils.create_dataset()) for _ in range(5)])
+        self.assertTrue(utils.wait_for(lambda: self._server.received == 5))
+        self.assertEqual(1, self._server.requests)
+        with self.assertRaises(ValueError):
+            w.retune({'gzip': 1})
+
+    def test_pause(self):
+        w = self._create_worker()
+        w.pause()
+        time.sleep(worker.Worker.PAUSE_INTERVAL)
+        w.process(routable.Routable('SCP1', utils.create_dataset()))
+        time.sleep(0.3)
+        self.assertEqual(0, self._server.requests)
+        self.assertEqual(1, w.held())
+        w.resume()
+        self.assertTrue(utils.wait_for(lambda: self._server.received == 1))
+        self.assertTrue(utils.wait_for(lambda: w.held() == 0))
+
+    def test_replay_dead_letters(self):
+        config = configuration.WorkerConfiguration({
+            'id': 'STOW1', 'name': 'Archive', 'type': 'stow-rs', 'url': self._server.url})
+        self._dead_letters.put('STOW1', routable.Routable('SCP1', utils.create_dataset()), 'STOW-RS status 503', 3)
+        self.assertEqual({'sent': 1, 'failed': 0}, deadletter.replay(self._dead_letters, config))
+        self.assertEqual([], list(self._dead_letters.entries('STOW1')))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,19 +1,41 @@
 import unittest
 import unittest.mock
 import logging
+import pydicom
 import workerset
 import configuration
 import routable
+import worker
+import utils
 
 class MockWorkerSetConfiguration(configuration.WorkerSetConfiguration):
     def __init__(self) -> None:
         pass
 
+def create_config(worker_ids, affinity_keys=None):
+    config = unittest.mock.Mock(spec=configuration.WorkerSetConfiguration)
+    config.id = 'SET1'
+    config.worker_ids = worker_ids
+    config.accepted_scp_ids = []
+    config.rewrites = []
+    config.affinity_keys = affinity_keys or [[(0x0010, 0x0020)]]
+    return config
+
+def create_workers(worker_ids):
+    workers = {}
+    for worker_id in worker_ids:
+        workers[worker_id] = unittest.mock.Mock(spec=worker.Worker)
+        workers[worker_id].id = worker_id
+        workers[worker_id].accepting = True
+    return workers
+
 class TestWorkerSet(unittest.TestCase):
     def test_ctor(self):
         config = unittest.mock.Mock(spec=configuration.WorkerSetConfiguration)
         config.worker_ids = []
         config.accepted_scp_ids = []
+        config.rewrites = []
+        config.affinity_keys = [[(0x0010, 0x0020)]]
         workers = {}
         hash_function = lambda x: x
         ws = workerset.WorkerSet(config, workers, hash_function)
@@ -28,9 +50,65 @@ class TestWorkerSet(unittest.TestCase):
         mock_config = unittest.mock.Mock(spec=configuration.WorkerSetConfiguration)
         mock_config.worker_ids = []
         mock_config.accepted_scp_ids = []
+        mock_config.rewrites = []
+        mock_config.affinity_keys = [[(0x0010, 0x0020)]]
         mock_config.header_requirements = []
         workers = {}
         hash_function = lambda x: x
         ws = workerset.WorkerSet(mock_config, workers, hash_function)        
         # Should always be False, as no workers can accept the routable
-        self.assertEqual(False, ws.can_accept(mock_routable))
\ No newline at end of file
+        self.assertEqual(False, ws.can_accept(mock_routable))
+
+    def test_drained_worker(self):
+        config = create_config(['W1', 'W2', 'W3'])
+        workers = create_workers(config.worker_ids)
+        ws = workerset.WorkerSet(config, workers, lambda key, count: 0)
+        data = routable.Routable('SCP1', utils.create_dataset())
+        self.assertEqual('W1', ws.select_worker(data).id)
+        # New patients go to other workers while a worker is drained
+        workers['W1'].accepting = False
+        self.assertEqual('W2', ws.select_worker(data).id)
+        for w in workers.values():
+            w.accepting = False
+        self.assertEqual('W1', ws.select_worker(data).id)
+
+    def test_affinity_key(self):
+        keys = [[pydicom.tag.Tag(0x0010, 0x0021), pydicom.tag.Tag(0x0010, 0x0020)], [pydicom.tag.Tag(0x0008, 0x0050)]]
+        dataset = utils.create_dataset()
+        dataset.AccessionNumber = ''
+        # Empty values fall back to the next key, or the last if none has values
+        self.assertEqual('', workerset.affinity_key(keys, dataset))
+        dataset.AccessionNumber = 'ACC1'
+        self.assertEqual('ACC1', workerset.affinity_key(keys, dataset))
+        dataset.IssuerOfPatientID = 'HOSPITAL'
+        self.assertEqual('HOSPITAL\\PATIENT1', workerset.affinity_key(keys, dataset))
+        del dataset.AccessionNumber
+        del dataset.IssuerOfPatientID
+        self.assertIsNone(workerset.affinity_key(keys, dataset))
+
+    def test_hash_cache(self):
+        config = create_config(['W1', 'W2'], [[(0x0020, 0x000D)]])
+        workers = create_workers(config.worker_ids)
+        hash_function = unittest.mock.Mock(side_effect=lambda key, count: 1)
+        ws = workerset.WorkerSet(config, workers, hash_function)
+        dataset = utils.create_dataset()
+        for _ in range(3):
+            self.assertEqual('W2', ws.select_worker(routable.Routable('SCP1', dataset)).id)
+        hash_function.assert_called_once_with(dataset.StudyInstanceUID, 2)
+
+    def test_backlog_divert(self):
+        config = create_config(['W1', 'W2'])
+        workers = create_workers(config.worker_ids)
+        for index, worker_id in enumerate(config.worker_ids):
+            workers[worker_id].held.return_value = index + 1
+            workers[worker_id].footprints.return_value = {'queue': (index + 1, 100), 'buffer': (0, 0)}
+            workers[worker_id].completed.return_value = 10
+            workers[worker_id].queue_emptied.return_value = 2
+        ws = workerset.WorkerSet(config, workers, lambda key, count: 0)
+        self.assertEqual((3, 200), ws.backlog())
+        self.assertEqual({'W1': (1, 10, 2), 'W2': (2, 10, 2)}, ws.progress())
+        data = routable.Routable('SCP1', utils.create_dataset())
+        self.assertIs(ws, ws.divert(data))
+        overflow = unittest.mock.Mock()
+        ws.set_overflow(overflow)
+        self.assertIs(overflow.select.return_value, ws.divert(data))
@@ -1,4 +1,4 @@
-from time import sleep
+from time import monotonic, sleep
 from typing import Tuple
 
 import pynetdicom
@@ -40,3 +40,35 @@ def start_scp() -> SimpleScp:
     ss = SimpleScp()
     ss.run()
     return ss
+
+def wait_for(condition, timeout: float = 10) -> bool:
+    '''
+    Wait for condition to hold, False if it does not within timeout seconds
+    '''
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            return False
+        sleep(0.05)
+    return True
+
+def create_dataset(patient_id: str = 'PATIENT1', modality: str = 'CT') -> pydicom.Dataset:
+    '''
+    Create a small CT image dataset with file meta information
+    '''
+    ds = pydicom.Dataset()
+    ds.SOPClassUID = pynetdicom.sop_class.CTImageStorage
+    ds.SOPInstanceUID = pydicom.uid.generate_uid()
+    ds.StudyInstanceUID = pydicom.uid.generate_uid()
+    ds.SeriesInstanceUID = pydicom.uid.generate_uid()
+    ds.PatientID = patient_id
+    ds.PatientName = 'Test^Patient'
+    ds.Modality = modality
+    ds.Manufacturer = 'GE MEDICAL SYSTEMS'
+    ds.file_meta = pydicom.dataset.FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    return ds